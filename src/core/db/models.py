@@ -1,5 +1,5 @@
 # file: src/core/db/models.py
-# updated: 2025-08-22
+# updated: 2025-09-07
 # note: đồng bộ ORM với CSDL tổng
 
 from __future__ import annotations
@@ -306,6 +306,11 @@ class ChatMessage(Base):
     )
 
 
+# transcript gần đây: WHERE message_chat_id = ? ORDER BY message_created_at DESC LIMIT n
+# (khai báo ngoài class để dùng .desc() — khớp migrations/schema.sql & bosung_chat_messages_index.sql)
+Index("ix_chat_messages_chat_created", ChatMessage.message_chat_id, ChatMessage.message_created_at.desc())
+
+
 # =============================================================================
 # [8] DOCUMENTS
 # =============================================================================
@@ -714,7 +719,55 @@ class NotificationRecipient(Base):
 
 
 # =============================================================================
-# [24] UTIL
+# [24] CHAT_JOBS — hàng đợi bền (Postgres) cho pipeline send/edit/regenerate
+# =============================================================================
+class ChatJob(Base):
+    __tablename__ = "chat_jobs"
+    __table_args__ = (
+        CheckConstraint("job_kind IN ('send','edit','regenerate')", name="ck_chat_jobs_kind"),
+        CheckConstraint(
+            "job_status IN ('queued','running','done','failed','canceled')",
+            name="ck_chat_jobs_status",
+        ),
+        Index("ix_chat_jobs_claim", "job_status", "job_run_after"),
+        Index("ix_chat_jobs_message", "job_message_id"),
+        Index("ix_chat_jobs_user_status", "job_user_id", "job_status"),
+    )
+
+    job_id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    job_kind: Mapped[str] = mapped_column(String(20), default="send", nullable=False)
+    job_status: Mapped[str] = mapped_column(String(20), default="queued", nullable=False)
+    job_user_id: Mapped[Optional[str]] = mapped_column(
+        String(36), ForeignKey("users.user_id", ondelete="CASCADE")
+    )
+    job_chat_id: Mapped[str] = mapped_column(
+        String(36), ForeignKey("chat_histories.chat_id", ondelete="CASCADE"), nullable=False
+    )
+    job_message_id: Mapped[str] = mapped_column(String(36), nullable=False)
+    job_payload: Mapped[Optional[dict]] = mapped_column(JSONB)
+
+    job_attempts: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    job_max_attempts: Mapped[int] = mapped_column(Integer, default=3, nullable=False)
+    job_run_after: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    job_locked_by: Mapped[Optional[str]] = mapped_column(String(100))
+    job_heartbeat_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
+    job_cancel_requested: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+    job_partial_text: Mapped[Optional[str]] = mapped_column(Text)
+    job_error: Mapped[Optional[str]] = mapped_column(Text)
+
+    job_created_at: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    job_updated_at: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), server_onupdate=func.now(), nullable=False
+    )
+    job_finished_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime(timezone=True))
+
+
+# =============================================================================
+# [25] UTIL
 # =============================================================================
 def create_tables(engine):
     """Tạo toàn bộ bảng (dev/test)."""
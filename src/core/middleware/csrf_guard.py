@@ -1,5 +1,5 @@
 # 📁 src/core/middleware/csrf_guard.py
-# 🕒 Last updated: 2025-08-31
+# 🕒 Last updated: 2025-09-26
 # =============================================================================
 # CSRF Guard Middleware — Double-Submit Cookie pattern (safe for large uploads)
 # -----------------------------------------------------------------------------
@@ -8,6 +8,8 @@
 #  • Ưu tiên xác thực bằng header (X-CSRFToken) khớp cookie (csrftoken / csrf_token).
 #  • Chỉ fallback sang đọc form NẾU body nhỏ (mặc định ≤ 1MB, đổi bằng ENV).
 #  • Back-compat alias: CsrfGuardMiddleware = CsrfGuard
+#  • stream_paths: route tự đọc multipart theo stream (vd. /chat/api/send) → middleware KHÔNG BAO GIỜ đọc body
+#    của multipart ở đó (bắt buộc header), để handler áp giới hạn upload ngay khi byte tới.
 # =============================================================================
 
 from __future__ import annotations
@@ -43,6 +45,7 @@ class CsrfGuard(AbstractMiddleware):
       1) Nếu header token khớp cookie token → PASS (không parse body).
       2) Nếu body nhỏ (≤ CSRF_FORM_PARSE_MAX) và là form → fallback đọc form field.
       3) Với multipart lớn mà thiếu header hợp lệ → 403 (không parse).
+      Path thuộc stream_paths: multipart không bao giờ được parse ở đây (chỉ chấp nhận header).
     """
 
     def __init__(
@@ -53,10 +56,13 @@ class CsrfGuard(AbstractMiddleware):
         header_names: Optional[Iterable[str]] = None,
         form_field: str = "csrf_token",
         max_form_parse_bytes: Optional[int] = None,
+        stream_paths: Optional[Iterable[str]] = None,
     ) -> None:
         super().__init__(app)
         # Bỏ qua những path prefix tĩnh/GET-only… (truyền từ main.py)
         self.skip_paths: tuple[str, ...] = tuple(skip_paths or ())
+        # Path handler tự đọc multipart theo stream (không đọc body trước handler)
+        self.stream_paths: tuple[str, ...] = tuple(stream_paths or ())
 
         # Danh sách header có thể chứa CSRF token (ưu tiên đầu danh sách)
         self.header_names: list[str] = [h.lower() for h in (header_names or [
@@ -129,8 +135,10 @@ class CsrfGuard(AbstractMiddleware):
             or ("application/x-www-form-urlencoded" in content_type)
         )
 
+        streamed = "multipart/form-data" in content_type and any(path.startswith(p) for p in self.stream_paths)
+
         # 2a) Nếu là form và body NHỎ → fallback đọc form field
-        if is_form_like and (content_length == 0 or content_length <= self.max_form_parse_bytes):
+        if is_form_like and not streamed and (content_length == 0 or content_length <= self.max_form_parse_bytes):
             try:
                 form = await request.form()  # nhỏ → an toàn để parse
                 form_token = form.get(self.form_field) or ""
@@ -143,8 +151,8 @@ class CsrfGuard(AbstractMiddleware):
                 await resp(scope, receive, send)
                 return
 
-        # 2b) Nếu là multipart lớn nhưng thiếu header hợp lệ → 403 rõ ràng, KHÔNG parse
-        if is_form_like and content_length > self.max_form_parse_bytes:
+        # 2b) Nếu là multipart lớn (hoặc route đọc stream) nhưng thiếu header hợp lệ → 403 rõ ràng, KHÔNG parse
+        if is_form_like and (streamed or content_length > self.max_form_parse_bytes):
             resp = _json_response(
                 {
                     "ok": False,
@@ -84,8 +84,10 @@ from modules.chat.routes.chat_header import (
 from modules.chat.routes.chat_api import (
     chat_api_send,
     chat_api_message,
+    chat_api_message_stream,  # ✅ SSE stream câu trả lời
     chat_api_edit,          # ✅ endpoints versioning / thao tác message
     chat_api_regenerate,
+    chat_api_cancel,        # ✅ huỷ lượt sinh đang chạy (STOP / ESC)
     chat_api_upload_limits, # ✅ upload limits (GET)
     chat_tools as chat_tools_list,          # ✅ tools menu (GET /chat/tools)
     chat_tools_select as chat_tools_select, # ✅ tools select (POST /chat/tools/select)
@@ -255,6 +257,11 @@ from core.middleware.maintenance_guard import MaintenanceGuardMiddleware
 from core.middleware.auth_guard import AuthGuardMiddleware
 from core.middleware.csrf_setter import CsrfCookieSetter
 from core.db.engine import engine
+from shared import llm_client
+from shared import file_storage
+from shared import tokenizer
+from modules.chat.service import chat_jobs
+from modules.chat.service import ocr_pool
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -327,6 +334,10 @@ async def test_db_connect() -> None:
     with engine.connect():
         print("✅ DB OK")
 
+async def warm_tokenizers() -> None:
+    # tiktoken có thể tải file BPE lần đầu → nạp trong thread lúc startup, không trong request
+    await tokenizer.warm_async([os.getenv("RUNPOD_DEFAULT_MODEL", "openai/gpt-oss-20b").strip()])
+
 def not_found_handler(request: Request, exc: NotFoundException):
     return Template(template_name="error/404_error.html", status_code=404)
 
@@ -401,8 +412,10 @@ app = Litestar(
         # chat API
         chat_api_send,
         chat_api_message,
+        chat_api_message_stream,
         chat_api_edit,
         chat_api_regenerate,
+        chat_api_cancel,
         chat_api_upload_limits,  # ✅ route upload limits (GET)
         # auth
         login_form,
@@ -586,13 +599,16 @@ app = Litestar(
                     "/admin/documents", "/admin/documents/fragment",
                     # ❌ Không skip các POST/PUT/DELETE khác.
                 ],
+                # Handler đọc multipart theo stream (giới hạn upload áp ngay khi byte tới) → chỉ nhận header CSRF
+                "stream_paths": ["/chat/api/send"],
             },
         ),
         MaintenanceGuardMiddleware,
         AuthGuardMiddleware,
         CsrfCookieSetter,
     ],
-    on_startup=[test_db_connect],
+    on_startup=[test_db_connect, warm_tokenizers, chat_jobs.start_embedded_workers, ocr_pool.start],  # + tokenizer, worker chat_jobs nhúng, warm pool OCR
+    on_shutdown=[chat_jobs.stop_embedded_workers, llm_client.aclose, ocr_pool.stop, file_storage.stop_io_pool],  # dừng worker trước, rồi đóng pool LLM / OCR / ghi file
     template_config=template_config,
     static_files_config=[
         StaticFilesConfig(
@@ -164,6 +164,7 @@ CREATE TABLE chat_messages (
     message_created_at    TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     message_updated_at    TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
+CREATE INDEX ix_chat_messages_chat_created ON chat_messages(message_chat_id, message_created_at DESC);
 
 ---------------------------------------------------------------------------
 -- 10. Phiên bản chat
@@ -348,4 +349,34 @@ CREATE TABLE notification_recipients (
     user_id   CHAR(36) REFERENCES users(user_id)                  ON DELETE CASCADE,
     read_at   TIMESTAMP WITH TIME ZONE,
     PRIMARY KEY (notify_id, user_id)
-);
\ No newline at end of file
+);
+
+---------------------------------------------------------------------------
+-- 24. Hàng đợi job chat (send / edit / regenerate)
+---------------------------------------------------------------------------
+DROP TABLE IF EXISTS chat_jobs CASCADE;
+CREATE TABLE chat_jobs (
+    job_id               CHAR(36) PRIMARY KEY,
+    job_kind             VARCHAR(20) NOT NULL DEFAULT 'send'
+                         CHECK (job_kind IN ('send','edit','regenerate')),
+    job_status           VARCHAR(20) NOT NULL DEFAULT 'queued'
+                         CHECK (job_status IN ('queued','running','done','failed','canceled')),
+    job_user_id          CHAR(36) REFERENCES users(user_id) ON DELETE CASCADE,
+    job_chat_id          CHAR(36) NOT NULL REFERENCES chat_histories(chat_id) ON DELETE CASCADE,
+    job_message_id       CHAR(36) NOT NULL,
+    job_payload          JSONB,
+    job_attempts         INT NOT NULL DEFAULT 0,
+    job_max_attempts     INT NOT NULL DEFAULT 3,
+    job_run_after        TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    job_locked_by        VARCHAR(100),
+    job_heartbeat_at     TIMESTAMP WITH TIME ZONE,
+    job_cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+    job_partial_text     TEXT,
+    job_error            TEXT,
+    job_created_at       TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    job_updated_at       TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    job_finished_at      TIMESTAMP WITH TIME ZONE
+);
+CREATE INDEX ix_chat_jobs_claim       ON chat_jobs(job_status, job_run_after);
+CREATE INDEX ix_chat_jobs_message     ON chat_jobs(job_message_id);
+CREATE INDEX ix_chat_jobs_user_status ON chat_jobs(job_user_id, job_status);
@@ -0,0 +1,55 @@
+-- file: migrations/triggers/bosung_chat_jobs.sql
+-- updated: 2025-09-07
+-- note:    Bảng chat_jobs — hàng đợi bền cho pipeline /chat/api/send, edit, regenerate.
+--          Worker claim bằng SELECT … FOR UPDATE SKIP LOCKED (xem modules/chat/service/chat_jobs.py).
+--          Chạy lại nhiều lần không lỗi (IF NOT EXISTS / duplicate_object).
+
+---------------------------------------------------------------------------
+-- 1. Bảng
+---------------------------------------------------------------------------
+CREATE TABLE IF NOT EXISTS chat_jobs (
+    job_id               CHAR(36) PRIMARY KEY,
+    job_kind             VARCHAR(20) NOT NULL DEFAULT 'send',
+    job_status           VARCHAR(20) NOT NULL DEFAULT 'queued',
+    job_user_id          CHAR(36) REFERENCES users(user_id) ON DELETE CASCADE,
+    job_chat_id          CHAR(36) NOT NULL REFERENCES chat_histories(chat_id) ON DELETE CASCADE,
+    job_message_id       CHAR(36) NOT NULL,
+    job_payload          JSONB,
+    job_attempts         INT NOT NULL DEFAULT 0,
+    job_max_attempts     INT NOT NULL DEFAULT 3,
+    job_run_after        TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    job_locked_by        VARCHAR(100),
+    job_heartbeat_at     TIMESTAMP WITH TIME ZONE,
+    job_cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+    job_partial_text     TEXT,
+    job_error            TEXT,
+    job_created_at       TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    job_updated_at       TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    job_finished_at      TIMESTAMP WITH TIME ZONE
+);
+
+---------------------------------------------------------------------------
+-- 2. Check constraints
+---------------------------------------------------------------------------
+DO $$
+BEGIN
+  ALTER TABLE chat_jobs
+    ADD CONSTRAINT ck_chat_jobs_kind CHECK (job_kind IN ('send','edit','regenerate'));
+EXCEPTION
+  WHEN duplicate_object THEN NULL;
+END $$;
+
+DO $$
+BEGIN
+  ALTER TABLE chat_jobs
+    ADD CONSTRAINT ck_chat_jobs_status CHECK (job_status IN ('queued','running','done','failed','canceled'));
+EXCEPTION
+  WHEN duplicate_object THEN NULL;
+END $$;
+
+---------------------------------------------------------------------------
+-- 3. Index phục vụ claim / tra trạng thái theo message / đếm theo user
+---------------------------------------------------------------------------
+CREATE INDEX IF NOT EXISTS ix_chat_jobs_claim       ON chat_jobs(job_status, job_run_after);
+CREATE INDEX IF NOT EXISTS ix_chat_jobs_message     ON chat_jobs(job_message_id);
+CREATE INDEX IF NOT EXISTS ix_chat_jobs_user_status ON chat_jobs(job_user_id, job_status);
@@ -0,0 +1,9 @@
+-- file: migrations/triggers/bosung_chat_messages_index.sql
+-- updated: 2025-09-10
+-- note:    Index cho transcript gần đây (modules/chat/service/transcript.py):
+--          WHERE message_chat_id = ? ORDER BY message_created_at DESC LIMIT n → chỉ đọc cửa sổ cuối của chat.
+--          CONCURRENTLY → không khoá ghi chat_messages trên DB đang chạy (không chạy trong transaction block).
+--          Chạy lại nhiều lần không lỗi (IF NOT EXISTS).
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_chat_messages_chat_created
+    ON chat_messages(message_chat_id, message_created_at DESC);
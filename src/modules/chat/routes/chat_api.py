@@ -1,5 +1,126 @@
 # file: src/modules/chat/routes/chat_api.py
-# updated: 2025-09-03 (v2.11.0)
+# updated: 2025-09-29 (v2.25.10)
+# changes (v2.25.10):
+#   - edit / regenerate: _enqueue_job bỏ buffer stream của lượt trước (_stream_reset) → SSE mở ngay sau đó không
+#     phát lại `done` với câu trả lời cũ / "(canceled)", progress cũ không còn hiện trong /chat/api/message.
+#   - Bỏ _save_files_and_build_appendix (không còn caller từ khi OCR / extract chuyển vào job).
+#
+# changes (v2.25.9):
+#   - SSE khi job chạy ở process khác: chu kỳ đọc DB giãn dần (x1.5, trần CHAT_STREAM_DB_POLL_MAX_SEC=10) khi
+#     không có text / vị trí hàng đợi mới, về lại CHAT_JOB_HEARTBEAT_SEC khi có thay đổi → N tab chờ lâu
+#     không còn bắn N query mỗi heartbeat.
+#
+# changes (v2.25.8):
+#   - Admission nguyên tử: _enqueue_job đếm + insert job dưới khoá advisory theo user trong cùng transaction với
+#     message / Document (_save_uploads không còn commit riêng); vượt trần lúc insert → rollback + 429
+#     (_busy_response). _admission_reject chỉ còn là kiểm tra sớm trước khi đọc body.
+#   - edit/regenerate: lượt cũ chỉ bị huỷ (_cancel_inflight) sau khi job mới được nhận.
+#
+# changes (v2.25.7):
+#   - _extract_doc / OCR nền: ghi file .txt (kết quả OCR / extract) qua file_storage.write_text_async (pool I/O,
+#     tmp + os.replace) thay vì open()/write() ngay trên event loop.
+#
+# changes (v2.25.6):
+#   - _completion_stream chỉ fallback sang gọi thường khi provider báo không hỗ trợ stream (400 / 404 / 501 của
+#     request stream — llm.is_stream_unsupported); LLMBusyError / timeout / lỗi mạng ném tiếp (retry theo job).
+#
+# changes (v2.25.5):
+#   - _gather_context lấy cờ excerpt từ pc.relevant_doc_text (text, is_excerpt): fallback full text tài liệu gần
+#     nhất không còn bị gắn nhãn "các đoạn liên quan".
+#
+# changes (v2.25.4):
+#   - Tool phân loại ép EasyOCR qua tham số engine= (_extract_doc → _ocr_with_progress → ocr_text) thay vì sửa
+#     ocr_text.OCR_ENGINE toàn cục (giẫm lên tin nhắn khác đang OCR song song).
+#   - Budget OCR chia theo số file chạy song song (_ocr_budget_kwargs n_files) thay vì mỗi file nhận đủ budget.
+#
+# changes (v2.25.3):
+#   - /chat/api/message/{id}/stream luôn xác minh chủ sở hữu trước khi stream: không có message / chat → 404,
+#     chat của user khác → 403, lỗi DB → 503 (trước đây lỗi DB / thiếu row vẫn stream).
+#
+# changes (v2.25.2):
+#   - /chat/api/send: mọi nhánh trả sớm sau khi đọc form (TOO_MANY_FILES, EMPTY_MESSAGE, MODEL_NOT_REGISTERED,
+#     ack chỉ-memory, lỗi) bỏ blob vừa ghi từ stream qua _discard_form (an toàn khi request khác dùng lại blob).
+#
+# changes (v2.25.1):
+#   - Edit/regenerate khi lượt cũ còn chạy: _cancel_inflight bật job.cancel_requested của task cũ trước khi huỷ →
+#     _run_cancellable nhận ra là cancel (không còn dựa vào _CANCEL_REQS, vốn bị lượt mới xoá) → vòng worker không chết.
+#
+# changes (v2.25.0):
+#   - File của 1 tin nhắn xử lý song song: _extract_docs chạy pipeline từng file (OCR / extract → .txt → chỉ mục)
+#     đồng thời, tối đa CHAT_ATTACH_CONCURRENCY (3) file / lúc, main + attachments chung 1 lượt; _build_appendix
+#     ghép snippet tuần tự theo thứ tự file → appendix không đổi theo file nào xong trước. Ép EasyOCR (tool phân
+#     loại) set 1 lần cho cả lượt thay vì set / restore từng file.
+#
+# changes (v2.24.0):
+#   - /chat/api/send đọc multipart theo stream (upload_stream.read_form, UPLOAD_STREAMING=1): số file / đuôi file /
+#     dung lượng từng file / tổng body kiểm tra ngay khi byte tới → vượt là trả 413 / 415 (Connection: close) mà không
+#     nhận hết body; file đổ thẳng vào kho blob, _save_uploads chỉ tạo tham chiếu. CsrfGuard không đọc body route này.
+#
+# changes (v2.23.0):
+#   - Upload 1 lượt đọc: shared.file_storage.store_blob_async vừa ghi vào kho blob (UPLOAD_BLOB_DIR) vừa băm sha256
+#     (bỏ _hash_of_upload đọc riêng), chống trùng theo digest đó; file của chat là tham chiếu link_blob tới blob →
+#     cùng nội dung từ chat / user khác không tốn thêm byte, OCR dùng lại cache theo digest blob.
+#   - Ghi upload / tạo tham chiếu không chặn event loop (pool I/O của file_storage, link_blob_async).
+#
+# changes (v2.22.0):
+#   - OCR tiến độ theo trang: _build_appendix đọc ocr_text.iter_pages_async, mỗi trang xong → _stream_progress
+#     → SSE event `progress` {file, page, done, planned, total} + trường `progress` ở /chat/api/message (job chạy
+#     ở process này). Chế độ budget dừng stream ngay khi đủ trang cho snippet, phần còn lại OCR nền.
+#
+# changes (v2.21.0):
+#   - OCR theo budget (OCR_BUDGET_MODE): PDF dài hơn số trang snippet dùng (đầu/cuối theo OCR_APPEND_FIRST_LAST)
+#     chỉ OCR các trang đó và dừng khi đủ ký tự cho budget của file; OCR đầy đủ chạy nền (priority thấp) rồi
+#     thay file text của Document + chỉ mục lại. Luồng phân loại vẫn OCR toàn bộ.
+#
+# changes (v2.20.0):
+#   - Tài liệu được chunk + đánh chỉ mục 1 lần lúc upload (modules/chat/service/doc_index.py). Luồng thường và
+#     edit/regenerate chỉ đưa top-k đoạn liên quan câu hỏi trên mọi tài liệu của chat (pc.relevant_doc_text) thay
+#     vì full text tài liệu mới nhất mỗi lượt; tool phân loại vẫn dùng full text.
+#
+# changes (v2.19.0):
+#   - Ngân sách token theo tokenizer thật của ModelVariant (shared/tokenizer.py, cache theo model) thay cho len/4:
+#     appendix OCR (_count_tokens/_trim_to_tokens) và prompt (pc.pack_context: tài liệu → RAG → transcript →
+#     memory lấp phần còn lại sau hướng dẫn + câu hỏi). Token từng khối → log + prompt_pack.json.txt.
+#
+# changes (v2.18.0):
+#   - Transcript gần đây đọc qua modules/chat/service/transcript.py: chỉ lấy cửa sổ cuối (DESC LIMIT trên index
+#     message_chat_id + created_at) thay vì load cả chat; cache text đã format theo chat, invalidate khi ghi message.
+#
+# changes (v2.17.0):
+#   - Dựng ngữ cảnh song song (_gather_context): memory global, transcript gần đây, tài liệu gần nhất (+RAG),
+#     chú thích tool, catalog tool chạy đồng thời (asyncio.to_thread, session riêng mỗi bước) → độ trễ trước
+#     khi gọi model ≈ bước chậm nhất. Router vẫn chạy sau vì cần prompt đã ghép. Log thời gian từng bước.
+#   - _user_info nhận session của request (send/edit/regenerate không mở thêm kết nối DB).
+#
+# changes (v2.16.0):
+#   - CANCEL thật sự: mỗi job chạy như 1 task huỷ được (_run_cancellable). /chat/api/cancel (cùng process) hoặc
+#     cờ job_cancel_requested (process khác, nhận qua heartbeat) → task.cancel() → đóng HTTP stream tới provider,
+#     trả slot llm_client + slot worker ngay thay vì để model sinh hết RUNPOD_MAX_TOKENS.
+#   - edit/regenerate huỷ lượt sinh cũ của cùng message trước khi enqueue lượt mới.
+#   - /chat/api/cancel được đăng ký trong main.py (trước đây chưa có route).
+#
+# changes (v2.15.0):
+#   - Admission control: send/edit/regenerate trả 429 + Retry-After khi user có quá nhiều job chờ/chạy
+#     (CHAT_JOB_USER_MAX_PENDING) hoặc hàng đợi chung đầy (CHAT_JOB_MAX_QUEUED); kiểm tra trước khi đọc upload.
+#   - /chat/api/message trả queue_position; SSE phát event `queued` khi vị trí thay đổi.
+#
+# changes (v2.14.0):
+#   - JOB QUEUE: send/edit/regenerate chỉ lưu upload + tạo message "(queued)" + enqueue bảng chat_jobs rồi
+#     trả message_id. OCR/extract, ngữ cảnh, router, gọi model, tóm tắt memory chạy trong job
+#     (modules/chat/service/chat_jobs.py: claim FOR UPDATE SKIP LOCKED, heartbeat, retry, resume sau crash).
+#   - /chat/api/message + SSE đọc trạng thái job / job_partial_text khi job chạy ở process khác.
+#   - Cancel bật cờ job trong DB (worker nhận qua heartbeat), không chỉ cờ RAM của process nhận request.
+#
+# changes (v2.13.0):
+#   - Gọi model qua shared.llm_client (AsyncOpenAI + httpx keep-alive pool dùng chung, giới hạn in-flight
+#     theo endpoint "chat", metrics thời gian chờ slot). Bỏ OpenAI sync + run_in_executor.
+#
+# changes (v2.12.0):
+#   - STREAMING: provider gọi với stream=True, token đẩy về buffer theo message_id và phát cho FE qua SSE
+#     GET /chat/api/message/{id}/stream (event: delta / done / failed / pending).
+#   - send/edit/regenerate trả message_id ngay; gọi model chạy nền (session riêng), text cuối ghi vào
+#     ChatMessage khi stream kết thúc. Tắt bằng CHAT_STREAM_ENABLED=0 (quay về gọi đồng bộ + poll).
+#
 # changes (v2.11.0):
 #   - SIMPLE MODE cho tool “Phân loại phòng ban”: 1 bước tự nhiên, không JSON, không ép định dạng 2 dòng.
 #     • Khi người dùng chọn tool này, prompt sẽ:
@@ -24,26 +145,29 @@ from __future__ import annotations
 
 import os
 import uuid
-import math
 import time
 import asyncio
 import logging
-import hashlib
 import json
 import re
 import unicodedata
-from typing import Any, Optional, Dict, List, Tuple
+import functools
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional, Dict, List, Tuple
 from collections.abc import Iterable
 from collections import OrderedDict
 
 from litestar import post, get, Request
-from litestar.response import Response
-from openai import OpenAI
+from litestar.response import Response, ServerSentEvent
+from litestar.response.sse import ServerSentEventMessage
 
 from sqlalchemy import select, func, or_
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 
 from shared.secure_cookie import get_secure_cookie
+from shared import llm_client as llm
+from shared import tokenizer as _tokenizer
+from shared.file_storage import write_text_async
 
 # DB
 from core.db.engine import SessionLocal
@@ -91,6 +215,16 @@ except Exception:
     def resolve_tool_id(tools: List[Dict[str, Any]], predicted_tool_name: Optional[str]) -> Optional[str]:  # type: ignore
         return None
 
+# Job queue (send / edit / regenerate)
+from modules.chat.service import chat_jobs as jobs
+from modules.chat.service import transcript as _transcript
+try:
+    from modules.chat.service import doc_index as _doc_index
+    DOC_RETRIEVAL_ENABLED = _doc_index.DOC_RETRIEVAL_ENABLED
+except Exception:
+    _doc_index = None  # type: ignore
+    DOC_RETRIEVAL_ENABLED = False
+
 # Email scheduler tool
 try:
     from modules.chat.service import email_scheduler as es  # type: ignore
@@ -173,6 +307,9 @@ def _effective_body_cap() -> int:
     vals = [c for c in candidates if isinstance(c, int) and c > 0]
     return min(vals) if vals else (REQUEST_MAX_SIZE or 50 * 1024 * 1024)
 
+# Đọc multipart của /chat/api/send theo stream (giới hạn áp ngay khi byte tới); 0 = request.form() như cũ
+UPLOAD_STREAMING = (os.getenv("UPLOAD_STREAMING", "1").strip() != "0")
+
 def _limit_headers() -> dict:
     return {
         "X-Upload-Limit-Bytes": str(_effective_body_cap()),
@@ -195,30 +332,40 @@ OCR_SNIPPET_PER_FILE = int(os.getenv("OCR_SNIPPET_PER_FILE", "2000"))
 OCR_APPEND_FULL_THRESHOLD = int(os.getenv("OCR_APPEND_FULL_THRESHOLD", "25"))
 OCR_APPEND_FIRST_LAST     = int(os.getenv("OCR_APPEND_FIRST_LAST", "5"))
 
+# OCR theo budget: PDF dài chỉ OCR các trang snippet sẽ dùng, phần còn lại OCR nền (priority thấp) cho cache
+OCR_BUDGET_MODE = (os.getenv("OCR_BUDGET_MODE", "1").strip() != "0")
+OCR_BUDGET_CHARS_PER_TOKEN = max(1, int(os.getenv("OCR_BUDGET_CHARS_PER_TOKEN", "4")))
+# Số file của 1 tin nhắn OCR / extract song song (thứ tự appendix vẫn theo thứ tự file)
+CHAT_ATTACH_CONCURRENCY = max(1, int(os.getenv("CHAT_ATTACH_CONCURRENCY", "3")))
+_OCR_BG_TASKS: "set[asyncio.Task[Any]]" = set()
+
 UPLOAD_DEDUP_WINDOW_SEC = int(os.getenv("UPLOAD_DEDUP_WINDOW_SEC", "300"))
 _RECENT_UPLOADS: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
 
-_client: Optional[OpenAI] = None
-
-def get_client() -> OpenAI:
-    global _client
-    if _client is None:
-        if not RUNPOD_BASE_URL or not RUNPOD_API_KEY:
-            raise RuntimeError("RUNPOD_BASE_URL / RUNPOD_API_KEY chưa cấu hình.")
-        base_url = RUNPOD_BASE_URL.rstrip("/")
-        if not base_url.endswith("/v1"):
-            base_url += "/v1"
-        _client = OpenAI(base_url=base_url, api_key=RUNPOD_API_KEY, timeout=RUNPOD_TIMEOUT)
-    return _client
-
 # RAM cache cho polling nhanh
 _MSGS: Dict[str, Dict[str, Optional[str]]] = {}
 # Cancel flags
 _CANCEL_REQS: "OrderedDict[str, float]" = OrderedDict()
+# Job đang chạy trong process này: message_id -> {job_id: (job, task)} → cancel huỷ task thật (đóng stream upstream)
+_INFLIGHT: Dict[str, Dict[str, Tuple["jobs.ClaimedJob", "asyncio.Task[Any]"]]] = {}
+
+def _cancel_inflight(message_id: str, job_id: Optional[str] = None) -> int:
+    n = 0
+    for jid, (job, task) in list((_INFLIGHT.get(message_id) or {}).items()):
+        if job_id and jid != job_id:
+            continue
+        # cờ nằm trên chính job (không dùng _CANCEL_REQS) → job mới của cùng message xoá cờ cũ cũng không
+        # làm task cũ tưởng là shutdown
+        job.cancel_requested = True
+        if not task.done():
+            task.cancel()
+            n += 1
+    return n
 
 def _mark_cancel(message_id: str) -> None:
     if not message_id:
         return
+    _cancel_inflight(message_id)
     now = time.time()
     _CANCEL_REQS[message_id] = now
     try:
@@ -239,6 +386,76 @@ def _is_canceled(message_id: str) -> bool:
 def _set_msg_status(message_id: str, status: str, ai_text: Optional[str] = None, error: Optional[str] = None) -> None:
     _MSGS[message_id] = {"status": status, "ai_response": (ai_text or None), "error": error or None}
 
+# ───────────────── streaming (SSE) ─────────────────
+# Provider trả token dần (stream=True) → đẩy vào buffer theo message_id → /chat/api/message/{id}/stream
+# phát lại cho FE qua Server-Sent Events. Buffer nằm ở process chạy job; process khác đọc job_partial_text.
+# Khi stream kết thúc mới ghi text cuối vào ChatMessage (FE vẫn có thể poll như cũ).
+CHAT_STREAM_ENABLED = (os.getenv("CHAT_STREAM_ENABLED", "1").strip() != "0")
+CHAT_STREAM_KEEPALIVE_SEC = _env_int("CHAT_STREAM_KEEPALIVE_SEC", 15) or 15
+CHAT_STREAM_TTL_SEC = _env_int("CHAT_STREAM_TTL_SEC", 600) or 600
+# SSE đọc tiến độ từ DB (job ở process khác): không có gì mới → giãn chu kỳ poll từ CHAT_JOB_HEARTBEAT_SEC
+# tới trần này (x1.5 mỗi lượt), có text / vị trí hàng đợi mới → về lại chu kỳ heartbeat
+CHAT_STREAM_DB_POLL_MAX_SEC = _env_int("CHAT_STREAM_DB_POLL_MAX_SEC", 10) or 10
+
+# message_id -> {"text", "done", "error", "ts", "waiters", "progress"}
+_STREAMS: Dict[str, Dict[str, Any]] = {}
+
+def _stream_gc() -> None:
+    now = time.time()
+    try:
+        for mid, st in list(_STREAMS.items()):
+            if st.get("done") and now - float(st.get("ts") or 0) > CHAT_STREAM_TTL_SEC:
+                _STREAMS.pop(mid, None)
+    except Exception:
+        pass
+
+def _stream_wake(st: Dict[str, Any]) -> None:
+    waiters = st.get("waiters") or []
+    st["waiters"] = []
+    for fut in waiters:
+        if not fut.done():
+            fut.set_result(True)
+
+def _stream_open(message_id: str) -> None:
+    _stream_gc()
+    _STREAMS[message_id] = {"text": "", "done": False, "error": None, "ts": time.time(), "waiters": [], "progress": None}
+
+def _stream_reset(message_id: str) -> None:
+    """Bỏ buffer của lượt trước (edit / regenerate): SSE mới không được phát lại `done` / progress cũ.
+    SSE đang chờ buffer cũ được đánh thức → quay về đọc DB cho tới khi job mới mở buffer của nó."""
+    st = _STREAMS.pop(message_id, None)
+    if st is not None:
+        _stream_wake(st)
+
+def _stream_progress(message_id: str, info: Dict[str, Any]) -> None:
+    """Tiến độ xử lý tệp (OCR trang N/M) trước khi model bắt đầu sinh → event `progress`."""
+    st = _STREAMS.get(message_id)
+    if not st or st["done"]:
+        return
+    st["progress"] = info
+    st["ts"] = time.time()
+    _stream_wake(st)
+
+def _stream_push(message_id: str, delta: str) -> None:
+    """Chạy trên event loop của job (đọc stream từ llm_client)."""
+    st = _STREAMS.get(message_id)
+    if not st or st["done"] or not delta:
+        return
+    st["text"] += delta
+    st["ts"] = time.time()
+    _stream_wake(st)
+
+def _stream_close(message_id: str, final_text: Optional[str] = None, error: Optional[str] = None) -> None:
+    st = _STREAMS.get(message_id)
+    if not st:
+        return
+    if final_text is not None:
+        st["text"] = final_text
+    st["done"] = True
+    st["error"] = error or None
+    st["ts"] = time.time()
+    _stream_wake(st)
+
 # ───────────────── model/helpers ─────────────────
 def _get_model_variant(session: Any, provider_model_id: str) -> Optional[ModelVariant]:
     return session.execute(
@@ -363,22 +580,36 @@ def _ext_of(name: str) -> str:
     except Exception:
         return ""
 
-def _approx_tokens(text_len: int) -> int:
-    return math.ceil(max(0, text_len) / 4)
+def _count_tokens(text: str) -> int:
+    # appendix dựng trước khi router chọn model → đếm theo tokenizer của model mặc định
+    return _tokenizer.for_model(RUNPOD_DEFAULT_MODEL).count(text or "")
 
 def _trim_to_tokens(s: str, token_budget: int) -> str:
     if token_budget <= 0 or not s:
         return ""
-    char_budget = max(1, token_budget * 4)
-    if len(s) <= char_budget:
-        return s
-    chunk = s[:char_budget]
-    sp = chunk.rfind(" ")
-    if sp > 120:
-        chunk = s[:sp] + " …"
-    else:
-        chunk = chunk.rstrip() + " …"
-    return chunk
+    return _tokenizer.for_model(RUNPOD_DEFAULT_MODEL).truncate(s, token_budget)
+
+def _snippet_pages(total_pages: int, page_limit: int) -> Tuple[List[int], str]:
+    """Các trang (1-based, theo thứ tự đưa vào snippet) + nhãn hiển thị."""
+    thr = max(1, OCR_APPEND_FULL_THRESHOLD)
+    k = max(1, min(OCR_APPEND_FIRST_LAST, total_pages))
+    if total_pages <= thr:
+        selected = list(range(1, min(page_limit, total_pages) + 1))
+        return selected, (f"{selected[0]}–{selected[-1]}" if selected else "")
+    first = list(range(1, min(k, total_pages) + 1))
+    last  = list(range(max(1, total_pages - k + 1), total_pages + 1))
+    left  = f"{first[0]}–{first[-1]}" if first else ""
+    right = f"{last[0]}–{last[-1]}" if last else ""
+    return sorted(set(first + last)), (f"{left}, …, {right}" if left and right else (left or right))
+
+def _per_file_token_budget(total_tokens_used: int) -> Tuple[int, bool]:
+    """(budget token cho file kế tiếp, unlimited)."""
+    unlimited_all = (OCR_MAX_APPEND_TOKENS or 0) <= 0 and (OCR_MAX_APPEND_CHARS or 0) <= 0 and (OCR_SNIPPET_PER_FILE or 0) <= 0
+    if unlimited_all:
+        return 10**9, True
+    remaining_tok = (OCR_MAX_APPEND_TOKENS or 0) - total_tokens_used if (OCR_MAX_APPEND_TOKENS or 0) > 0 else 10**9
+    per_file_hint = (OCR_SNIPPET_PER_FILE or 0) // 4 if (OCR_SNIPPET_PER_FILE or 0) > 0 else 10**9
+    return max(256, min(remaining_tok, max(256, per_file_hint))), False
 
 def _build_per_file_snippet(
     *,
@@ -392,22 +623,11 @@ def _build_per_file_snippet(
 ) -> Tuple[str, int]:
     used = 0
     if pages_text and len(pages_text) == total_pages:
-        thr = max(1, OCR_APPEND_FULL_THRESHOLD)
-        k = max(1, min(OCR_APPEND_FIRST_LAST, total_pages))
-        if total_pages <= thr:
-            selected = list(range(1, min(page_limit, total_pages) + 1))
-            label = f"{selected[0]}–{selected[-1]}" if selected else ""
-        else:
-            first = list(range(1, min(k, total_pages) + 1))
-            last  = list(range(max(1, total_pages - k + 1), total_pages + 1))
-            selected = sorted(set(first + last))
-            left  = f"{first[0]}–{first[-1]}" if first else ""
-            right = f"{last[0]}–{last[-1]}" if last else ""
-            label = f"{left}, …, {right}" if left and right else (left or right)
+        selected, label = _snippet_pages(total_pages, page_limit)
 
         parts: List[str] = []
         header = f"[{file_name}] (trang {label}/{total_pages})" if selected else f"[{file_name}]"
-        parts.append(header); used += _approx_tokens(len(header))
+        parts.append(header); used += _count_tokens(header)
 
         for p in selected:
             body = (pages_text[p - 1] or "").strip()
@@ -417,23 +637,23 @@ def _build_per_file_snippet(
             if unlimited:
                 seg = head + body
             else:
-                budget_left = max(0, token_budget - used) - _approx_tokens(len(head))
+                budget_left = max(0, token_budget - used) - _count_tokens(head)
                 if budget_left <= 0:
                     break
                 seg = head + _trim_to_tokens(body, budget_left)
             parts.append(seg)
-            used += _approx_tokens(len(seg))
+            used += _count_tokens(seg)
         return ("\n".join(parts)).strip(), used
 
     header = f"[{file_name}]"
     body = (full_text or "").strip()
     if unlimited:
-        used = _approx_tokens(len(header) + len(body))
+        used = _count_tokens(header) + _count_tokens(body)
         return (header + ("\n" + body if body else "")).strip(), used
-    used = _approx_tokens(len(header))
+    used = _count_tokens(header)
     body_budget = max(0, token_budget - used)
     body = _trim_to_tokens(body, body_budget)
-    return (header + ("\n" + body if body else "")).strip(), used + _approx_tokens(len(body))
+    return (header + ("\n" + body if body else "")).strip(), used + _count_tokens(body)
 
 _textex = None
 try:
@@ -441,51 +661,20 @@ try:
 except Exception:
     _textex = None
 
+try:
+    from modules.chat.service import upload_stream as _upstream  # type: ignore
+    from modules.chat.service.save_documents import (  # type: ignore
+        UploadError, TooManyFiles, FileTooLarge, TotalTooLarge, DisallowedType, UploadLimits,
+    )
+except Exception:
+    _upstream = None
+
 def _is_text_extractable(ext: str) -> bool:
     if not _textex:
         return False
     e = (ext or "").lower()
     return (e in _textex.DOCS) or (e in _textex.SHEETS) or (e in _textex.SLIDES) or (e in _textex.CODE) or (e in _textex.OTHERS)
 
-def _hash_of_upload(up: Any) -> Optional[str]:
-    f = getattr(up, "file", None) or getattr(up, "_file", None) or None
-    if f is None:
-        if hasattr(up, "read"):
-            f = up
-        else:
-            return None
-    try:
-        pos = f.tell() if hasattr(f, "tell") else None
-    except Exception:
-        pos = None
-    try:
-        if hasattr(f, "seek"):
-            try:
-                f.seek(0)
-            except Exception:
-                pass
-        h = hashlib.sha256()
-        while True:
-            chunk = f.read(1 << 20)
-            if not chunk:
-                break
-            if isinstance(chunk, str):
-                chunk = chunk.encode("utf-8", "ignore")
-            h.update(chunk)
-        digest = h.hexdigest()
-        return digest
-    except Exception:
-        return None
-    finally:
-        try:
-            if hasattr(f, "seek"):
-                if pos is not None:
-                    f.seek(pos)
-                else:
-                    f.seek(0)
-        except Exception:
-            pass
-
 def _mark_recent(uid: str, digest: str) -> bool:
     if not uid or not digest:
         return False
@@ -508,54 +697,46 @@ def _mark_recent(uid: str, digest: str) -> bool:
         return False
     return (now - last) <= UPLOAD_DEDUP_WINDOW_SEC
 
-# ───────────────── save files + build OCR/TextExtract appendix ─────────────────
-async def _save_files_and_build_appendix(
+# ───────────────── save files (request) ─────────────────
+async def _save_uploads(
     *,
     session: Any,
     uid: str,
     chat_row: ChatHistory,
     message_id: str,
     files: List[Any],
-    classification_only_ocr: bool = False,  # Force EasyOCR khi tool = “Phân loại phòng ban”
-) -> Tuple[str, List[Document]]:
+) -> List[Document]:
+    """Chỉ ghi file + tạo Document (doc_status="new"); OCR/extract để job làm (_build_appendix)."""
     if not files:
-        return "", []
-    ocr_mod: Any = None
-    if OCR_ENABLED:
-        try:
-            from modules.chat.service import ocr_text as _ocr_mod  # type: ignore
-            ocr_mod = _ocr_mod
-        except Exception:
-            ocr_mod = None
+        return []
 
-    from shared.file_storage import safe_filename, save_upload_async, ensure_dir
+    from shared.file_storage import safe_filename, store_blob_async, link_blob_async
 
-    base_dir = os.path.join(UPLOAD_ROOT, "chat", chat_row.chat_id, message_id)
-    ensure_dir(base_dir)
+    base_dir = os.path.join(UPLOAD_ROOT, "chat", chat_row.chat_id, message_id)  # link_blob_async tự tạo
 
-    appended_chunks: List[str] = []
     docs: List[Document] = []
-    total_tokens_used = 0
-
     seen_digests: set[str] = set()
 
     for up in files:
         raw_name = getattr(up, "filename", None) or getattr(up, "name", None) or "file.bin"
         fname = safe_filename(raw_name)
-        ext = _ext_of(fname)
 
-        digest = _hash_of_upload(up) or ""
-        if digest:
-            if digest in seen_digests:
-                logger.info("Skip duplicate in-message: %s", fname)
-                continue
-            if _mark_recent(uid, digest):
-                logger.info("Skip duplicate recent (user-window): %s", fname)
-                continue
-            seen_digests.add(digest)
+        # 1 lượt đọc: ghi vào kho blob + sha256; nội dung trùng (chat / user khác) → dùng lại blob cũ.
+        # File từ upload_stream đã nằm sẵn trong kho (ghi ngay lúc nhận body).
+        blob = getattr(up, "blob", None) or await store_blob_async(up)
+        digest = blob.digest
+        if digest in seen_digests:
+            logger.info("Skip duplicate in-message: %s", fname)
+            continue
+        if _mark_recent(uid, digest):
+            logger.info("Skip duplicate recent (user-window): %s", fname)
+            continue
+        seen_digests.add(digest)
+        if blob.existed:
+            logger.info("Upload %s reuses blob %s (%d bytes)", fname, digest[:12], blob.size)
 
         abs_path = os.path.join(base_dir, fname)
-        saved_path = await save_upload_async(up, abs_path, make_unique=True)
+        saved_path = await link_blob_async(blob.path, abs_path, make_unique=True)
         rel_path = os.path.relpath(saved_path, start=UPLOAD_ROOT).replace(os.sep, "/")
 
         doc = Document(  # type: ignore[call-arg]
@@ -570,61 +751,110 @@ async def _save_files_and_build_appendix(
         session.flush()
         docs.append(doc)
 
-        snippet_text = ""
-        pages_text: Optional[List[str]] = None
-        total_pages = 1
+    # không commit: Document commit cùng message + job (_enqueue_job) → request bị từ chối / lỗi rollback sạch
+    return docs
+
+# ───────────────── build OCR/TextExtract appendix (job) ─────────────────
+async def _ocr_budget_kwargs(
+    ocr_mod: Any, saved_path: str, ext: str, total_tokens_used: int, n_files: int = 1,
+) -> Dict[str, Any]:
+    """PDF dài hơn số trang snippet dùng → chỉ OCR các trang đó (đầu trước, cuối sau), dừng khi đủ budget.
+    n_files > 1 (các file OCR song song): mỗi file nhận phần chia đều của OCR_MAX_APPEND_TOKENS."""
+    if not (OCR_BUDGET_MODE and ext in _PDF_EXT and hasattr(ocr_mod, "page_count")):
+        return {}
+    per_file_budget, unlimited_all = _per_file_token_budget(total_tokens_used)
+    if unlimited_all:
+        return {}
+    if n_files > 1 and (OCR_MAX_APPEND_TOKENS or 0) > 0:
+        per_file_budget = min(per_file_budget, max(256, (OCR_MAX_APPEND_TOKENS or 0) // n_files))
+    try:
+        total = int(await asyncio.to_thread(ocr_mod.page_count, saved_path) or 0)
+    except Exception:
+        return {}
+    selected, _ = _snippet_pages(total, OCR_MAX_PAGES_PER_FILE) if total > 0 else ([], "")
+    if not selected or len(selected) >= total:
+        return {}
+    return {
+        "only_pages": [p - 1 for p in selected],
+        "budget_chars": per_file_budget * OCR_BUDGET_CHARS_PER_TOKEN,
+    }
 
-        # Chính sách cho tool phân loại: chỉ OCR PDF/Ảnh bằng EasyOCR (ocr_all=True)
-        if classification_only_ocr:
-            if ext in _IMG_EXT or ext in _PDF_EXT:
-                if ocr_mod:
-                    try:
-                        old_engine = getattr(ocr_mod, "OCR_ENGINE", "auto")
-                        try:
-                            setattr(ocr_mod, "OCR_ENGINE", "easyocr")  # force EasyOCR
-                            if hasattr(ocr_mod, "extract_text_async"):
-                                res = await ocr_mod.extract_text_async(saved_path, ocr_all=True)  # type: ignore
-                            else:
-                                loop = asyncio.get_running_loop()
-                                res = await loop.run_in_executor(None, lambda: ocr_mod.extract_text(saved_path, ocr_all=True))
-                        finally:
-                            try:
-                                setattr(ocr_mod, "OCR_ENGINE", old_engine)
-                            except Exception:
-                                pass
-                    except Exception as e:
-                        logger.warning("OCR (force easyocr) error for %s: %s", fname, e)
-                        res = None
-                    text = (res.text if res and getattr(res, "ok", False) else "") if res else ""
-                    text = (text or "").strip()
-                    if text:
-                        ocr_txt_name = os.path.splitext(fname)[0] + ".txt"
-                        ocr_abs = os.path.join(base_dir, ocr_txt_name)
-                        try:
-                            with open(ocr_abs, "w", encoding="utf-8") as f:
-                                f.write(text)
-                            doc.doc_ocr_text_path = os.path.relpath(ocr_abs, start=UPLOAD_ROOT).replace(os.sep, "/")
-                            doc.doc_status = "reviewed"
-                        except Exception as e:
-                            logger.debug("Cannot write OCR txt for %s: %s", fname, e)
-                        pages_text = getattr(res, "pages_text", None) if res else None
-                        total_pages = int(getattr(res, "total_pages", 1) or 1)
-                        snippet_text = text
-            else:
-                logger.info("Classification-only-OCR: skip non OCR-able file %s", fname)
+async def _ocr_with_progress(
+    ocr_mod: Any,
+    saved_path: str,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]],
+    **kwargs: Any,
+) -> Any:
+    """OCR qua ocr_text.iter_pages_async (báo tiến độ từng trang); module cũ → extract_text_async."""
+    if on_progress is None or not hasattr(ocr_mod, "iter_pages_async"):
+        return await ocr_mod.extract_text_async(saved_path, **kwargs)
+    fname = os.path.basename(saved_path)
+    res = None
+    async for ev in ocr_mod.iter_pages_async(saved_path, **kwargs):
+        if ev.result is not None:
+            res = ev.result
+            break
+        try:
+            on_progress({"stage": "ocr", "file": fname, "page": ev.page, "done": ev.done,
+                         "planned": ev.planned, "total": ev.total})
+        except Exception:
+            pass
+    return res
 
-        else:
-            # Luồng bình thường
-            need_ocr = ext in _IMG_EXT or ext in _PDF_EXT
-            if need_ocr and ocr_mod:
+def _complete_ocr_later(ocr_mod: Any, saved_path: str, rel_txt: str, chat_id: Optional[str]) -> None:
+    """OCR đầy đủ chạy nền (priority thấp) → ghi cache OCR + thay file text của Document + chỉ mục lại."""
+    async def _run() -> None:
+        try:
+            from modules.chat.service.ocr_pool import PRIORITY_BACKGROUND
+            res = await ocr_mod.extract_text_async(saved_path, priority=PRIORITY_BACKGROUND)
+            text = (res.text or "").strip() if res is not None and getattr(res, "ok", False) else ""
+            if not text:
+                return
+            txt_abs = os.path.join(UPLOAD_ROOT, *rel_txt.split("/"))
+            await write_text_async(txt_abs, text)
+            if DOC_RETRIEVAL_ENABLED:
+                await asyncio.to_thread(
+                    _doc_index.index_document, rel_txt, text, getattr(res, "pages_text", None), chat_id=chat_id,
+                )
+        except Exception as e:
+            logger.debug("background OCR failed for %s: %s", saved_path, e)
+
+    task = asyncio.create_task(_run())
+    _OCR_BG_TASKS.add(task)
+    task.add_done_callback(_OCR_BG_TASKS.discard)
+
+async def _extract_doc(
+    doc: Document,
+    *,
+    ocr_mod: Any,
+    classification_only_ocr: bool,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]],
+    n_files: int = 1,
+) -> Tuple[str, Optional[List[str]], int]:
+    """Pipeline 1 file: OCR / extract → ghi .txt + cập nhật doc (chưa flush) → chỉ mục chunk.
+    n_files = số file của lượt (chia budget OCR). Trả (text, pages_text, total_pages)."""
+    saved_path = os.path.join(UPLOAD_ROOT, *(doc.doc_file_path or "").split("/"))
+    base_dir = os.path.dirname(saved_path)
+    fname = os.path.basename(saved_path)
+    ext = _ext_of(fname)
+
+    snippet_text = ""
+    pages_text: Optional[List[str]] = None
+    total_pages = 1
+
+    # Chính sách cho tool phân loại: chỉ OCR PDF/Ảnh bằng EasyOCR (ocr_all=True)
+    if classification_only_ocr:
+        if ext in _IMG_EXT or ext in _PDF_EXT:
+            if ocr_mod:
                 try:
+                    # ép EasyOCR cho riêng lượt này (tham số, không đụng ocr_text.OCR_ENGINE toàn cục)
                     if hasattr(ocr_mod, "extract_text_async"):
-                        res = await ocr_mod.extract_text_async(saved_path)  # type: ignore[attr-defined]
+                        res = await _ocr_with_progress(ocr_mod, saved_path, on_progress, ocr_all=True, engine="easyocr")
                     else:
                         loop = asyncio.get_running_loop()
-                        res = await loop.run_in_executor(None, lambda: ocr_mod.extract_text(saved_path))
+                        res = await loop.run_in_executor(None, lambda: ocr_mod.extract_text(saved_path, ocr_all=True))
                 except Exception as e:
-                    logger.warning("OCR error for %s: %s", fname, e)
+                    logger.warning("OCR (force easyocr) error for %s: %s", fname, e)
                     res = None
                 text = (res.text if res and getattr(res, "ok", False) else "") if res else ""
                 text = (text or "").strip()
@@ -632,8 +862,7 @@ async def _save_files_and_build_appendix(
                     ocr_txt_name = os.path.splitext(fname)[0] + ".txt"
                     ocr_abs = os.path.join(base_dir, ocr_txt_name)
                     try:
-                        with open(ocr_abs, "w", encoding="utf-8") as f:
-                            f.write(text)
+                        await write_text_async(ocr_abs, text)
                         doc.doc_ocr_text_path = os.path.relpath(ocr_abs, start=UPLOAD_ROOT).replace(os.sep, "/")
                         doc.doc_status = "reviewed"
                     except Exception as e:
@@ -641,40 +870,134 @@ async def _save_files_and_build_appendix(
                     pages_text = getattr(res, "pages_text", None) if res else None
                     total_pages = int(getattr(res, "total_pages", 1) or 1)
                     snippet_text = text
-            else:
-                if _is_text_extractable(ext):
+        else:
+            logger.info("Classification-only-OCR: skip non OCR-able file %s", fname)
+
+    else:
+        # Luồng bình thường
+        need_ocr = ext in _IMG_EXT or ext in _PDF_EXT
+        if need_ocr and ocr_mod:
+            try:
+                budget_kw = await _ocr_budget_kwargs(ocr_mod, saved_path, ext, 0, n_files)  # chia đều cho các file song song
+                if hasattr(ocr_mod, "extract_text_async"):
+                    res = await _ocr_with_progress(ocr_mod, saved_path, on_progress, **budget_kw)
+                else:
+                    loop = asyncio.get_running_loop()
+                    res = await loop.run_in_executor(None, lambda: ocr_mod.extract_text(saved_path))
+            except Exception as e:
+                logger.warning("OCR error for %s: %s", fname, e)
+                res = None
+            text = (res.text if res and getattr(res, "ok", False) else "") if res else ""
+            text = (text or "").strip()
+            if text:
+                ocr_txt_name = os.path.splitext(fname)[0] + ".txt"
+                ocr_abs = os.path.join(base_dir, ocr_txt_name)
+                try:
+                    await write_text_async(ocr_abs, text)
+                    doc.doc_ocr_text_path = os.path.relpath(ocr_abs, start=UPLOAD_ROOT).replace(os.sep, "/")
+                    doc.doc_status = "reviewed"
+                except Exception as e:
+                    logger.debug("Cannot write OCR txt for %s: %s", fname, e)
+                pages_text = getattr(res, "pages_text", None) if res else None
+                total_pages = int(getattr(res, "total_pages", 1) or 1)
+                snippet_text = text
+                if res is not None and getattr(res, "complete", True) is False and doc.doc_ocr_text_path:
+                    _complete_ocr_later(ocr_mod, saved_path, doc.doc_ocr_text_path, doc.doc_chat_id)
+        else:
+            if _is_text_extractable(ext):
+                try:
+                    loop = asyncio.get_running_loop()
+                    result = await loop.run_in_executor(
+                        None,
+                        lambda: _textex.extract_text(saved_path, ext)  # type: ignore
+                    )
+                except Exception as e:
+                    logger.warning("TextExtract error for %s: %s", fname, e)
+                    result = None
+                if result and getattr(result, "ok", False):
+                    snippet_text = (result.text or "").strip()
+                    pages_text = getattr(result, "pages_text", None)
+                    tp = getattr(result, "total_pages", None)
+                    total_pages = int(tp or (len(pages_text or []) or 1))
                     try:
-                        loop = asyncio.get_running_loop()
-                        result = await loop.run_in_executor(
-                            None,
-                            lambda: _textex.extract_text(saved_path, ext)  # type: ignore
-                        )
+                        txt_name = os.path.splitext(fname)[0] + ".txt"
+                        txt_abs = os.path.join(base_dir, txt_name)
+                        await write_text_async(txt_abs, snippet_text)
+                        doc.doc_ocr_text_path = os.path.relpath(txt_abs, start=UPLOAD_ROOT).replace(os.sep, "/")
+                        doc.doc_status = "reviewed"
                     except Exception as e:
-                        logger.warning("TextExtract error for %s: %s", fname, e)
-                        result = None
-                    if result and getattr(result, "ok", False):
-                        snippet_text = (result.text or "").strip()
-                        pages_text = getattr(result, "pages_text", None)
-                        tp = getattr(result, "total_pages", None)
-                        total_pages = int(tp or (len(pages_text or []) or 1))
-                        try:
-                            txt_name = os.path.splitext(fname)[0] + ".txt"
-                            txt_abs = os.path.join(base_dir, txt_name)
-                            with open(txt_abs, "w", encoding="utf-8") as f:
-                                f.write(snippet_text)
-                            doc.doc_ocr_text_path = os.path.relpath(txt_abs, start=UPLOAD_ROOT).replace(os.sep, "/")
-                            doc.doc_status = "reviewed"
-                        except Exception as e:
-                            logger.debug("Cannot write extract txt for %s: %s", fname, e)
+                        logger.debug("Cannot write extract txt for %s: %s", fname, e)
 
-        if snippet_text or (pages_text and any(pages_text)):
-            unlimited_all = (OCR_MAX_APPEND_TOKENS or 0) <= 0 and (OCR_MAX_APPEND_CHARS or 0) <= 0 and (OCR_SNIPPET_PER_FILE or 0) <= 0
-            if unlimited_all:
-                per_file_budget = 10**9
-            else:
-                remaining_tok = (OCR_MAX_APPEND_TOKENS or 0) - total_tokens_used if (OCR_MAX_APPEND_TOKENS or 0) > 0 else 10**9
-                per_file_hint = (OCR_SNIPPET_PER_FILE or 0) // 4 if (OCR_SNIPPET_PER_FILE or 0) > 0 else 10**9
-                per_file_budget = max(256, min(remaining_tok, max(256, per_file_hint)))
+    # chỉ mục chunk cho truy hồi ở các lượt sau (1 lần / tài liệu)
+    if snippet_text and doc.doc_ocr_text_path and DOC_RETRIEVAL_ENABLED:
+        try:
+            await asyncio.to_thread(
+                _doc_index.index_document,
+                doc.doc_ocr_text_path,
+                snippet_text,
+                pages_text if isinstance(pages_text, list) else None,
+                chat_id=doc.doc_chat_id,
+            )
+        except Exception as e:
+            logger.debug("doc index failed for %s: %s", fname, e)
+
+    return snippet_text, pages_text, total_pages
+
+async def _extract_docs(
+    docs: List[Document],
+    *,
+    classification_only_ocr: bool = False,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Tuple[str, Optional[List[str]], int]]:
+    """Chạy pipeline các file của 1 tin nhắn song song (tối đa CHAT_ATTACH_CONCURRENCY file / lúc); doc_id → kết quả."""
+    if not docs:
+        return {}
+    ocr_mod: Any = None
+    if OCR_ENABLED:
+        try:
+            from modules.chat.service import ocr_text as _ocr_mod  # type: ignore
+            ocr_mod = _ocr_mod
+        except Exception:
+            ocr_mod = None
+
+    sem = asyncio.Semaphore(CHAT_ATTACH_CONCURRENCY)
+
+    async def _one(doc: Document) -> Tuple[str, Optional[List[str]], int]:
+        async with sem:
+            try:
+                return await _extract_doc(doc, ocr_mod=ocr_mod, classification_only_ocr=classification_only_ocr,
+                                          on_progress=on_progress, n_files=len(docs))
+            except Exception as e:
+                logger.warning("extract pipeline error for %s: %s", doc.doc_file_path, e)
+                return "", None, 1
+
+    results = await asyncio.gather(*(_one(d) for d in docs))
+    return {d.doc_id: r for d, r in zip(docs, results)}
+
+async def _build_appendix(
+    *,
+    session: Any,
+    docs: List[Document],
+    classification_only_ocr: bool = False,  # Force EasyOCR khi tool = “Phân loại phòng ban”
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,  # tiến độ OCR theo trang (SSE `progress`)
+    extracted: Optional[Dict[str, Tuple[str, Optional[List[str]], int]]] = None,  # kết quả _extract_docs có sẵn
+) -> str:
+    if not docs:
+        return ""
+    if extracted is None:
+        extracted = await _extract_docs(docs, classification_only_ocr=classification_only_ocr, on_progress=on_progress)
+
+    appended_chunks: List[str] = []
+    total_tokens_used = 0
+
+    # ghép appendix tuần tự theo đúng thứ tự file (kết quả không phụ thuộc file nào OCR xong trước)
+    for doc in docs:
+        saved_path = os.path.join(UPLOAD_ROOT, *(doc.doc_file_path or "").split("/"))
+        snippet_text, pages_text, total_pages = extracted.get(doc.doc_id) or ("", None, 1)
+        budget_full = (OCR_MAX_APPEND_TOKENS or 0) > 0 and total_tokens_used >= (OCR_MAX_APPEND_TOKENS or 0)
+
+        if not budget_full and (snippet_text or (pages_text and any(pages_text))):
+            per_file_budget, unlimited_all = _per_file_token_budget(total_tokens_used)
 
             if per_file_budget > 0:
                 snip, used_tok = _build_per_file_snippet(
@@ -696,17 +1019,14 @@ async def _save_files_and_build_appendix(
         except Exception:
             session.rollback()
 
-        if (OCR_MAX_APPEND_TOKENS or 0) > 0 and total_tokens_used >= (OCR_MAX_APPEND_TOKENS or 0):
-            break
-
     session.commit()
 
     if not appended_chunks:
-        return "", docs
+        return ""
 
     merged = "\n\n".join(appended_chunks).strip()
 
-    if (OCR_MAX_APPEND_TOKENS or 0) > 0 and _approx_tokens(len(merged)) > (OCR_MAX_APPEND_TOKENS or 0):
+    if (OCR_MAX_APPEND_TOKENS or 0) > 0 and _count_tokens(merged) > (OCR_MAX_APPEND_TOKENS or 0):
         merged = _trim_to_tokens(merged, (OCR_MAX_APPEND_TOKENS or 0))
     if (OCR_MAX_APPEND_CHARS or 0) > 0 and len(merged) > (OCR_MAX_APPEND_CHARS or 0):
         merged = merged[:(OCR_MAX_APPEND_CHARS or 0)]
@@ -715,7 +1035,7 @@ async def _save_files_and_build_appendix(
             merged = merged[:cut] + " …"
 
     appendix = "\n\n---\n(Trích nội dung từ tệp đính kèm; đã rút gọn theo giới hạn)\n" + merged
-    return appendix, docs
+    return appendix
 
 # ───────────────── debug dump helpers ─────────────────
 def _base_msg_dir(chat_id: str, message_id: str) -> str:
@@ -827,42 +1147,11 @@ def _inject_latest_tool_note_block(prompt_text: str, note_line: str) -> str:
     return (prompt_text or "").rstrip() + block
 
 # ───────────────── recent transcript helpers ─────────────────
-def _strip_appendix(q: str) -> str:
-    if not q:
-        return q
-    marker = "\n\n---\n(Trích nội dung từ tệp đính kèm"
-    i = q.find(marker)
-    return q if i < 0 else q[:i].rstrip()
+_strip_appendix = _transcript.strip_appendix
 
 def _recent_chat_transcript(session: Any, chat_id: str, limit_chars: int, max_msgs: int) -> str:
-    try:
-        q = select(ChatMessage).where(ChatMessage.message_chat_id == chat_id)
-        for col in ("message_created_at", "created_at", "updated_at"):
-            if hasattr(ChatMessage, col):
-                q = q.order_by(getattr(ChatMessage, col).asc())
-                break
-        rows = session.execute(q).scalars().all()
-    except Exception:
-        rows = []
-
-    pairs = []
-    for r in rows:
-        u = _strip_appendix(r.message_question or "")
-        a = (r.message_ai_response or "").strip()
-        if not u or not a or a in ("(queued)", "(canceled)"):
-            continue
-        pairs.append(f"User: {u}\nAssistant: {a}")
-
-    if max_msgs > 0 and len(pairs) > max_msgs:
-        pairs = pairs[-max_msgs:]
-
-    text = "\n\n".join(pairs).strip()
-    if limit_chars > 0 and len(text) > limit_chars:
-        text = text[-limit_chars:]
-        cut = text.find("\n")
-        if cut > 200:
-            text = text[cut+1:]
-    return text
+    # cửa sổ cuối (DESC LIMIT trên index) + cache theo chat — xem modules/chat/service/transcript.py
+    return _transcript.recent_transcript(session, chat_id, limit_chars=limit_chars, max_msgs=max_msgs)
 
 # ─────────────── Label helpers từ RAG ───────────────
 def _norm_key(s: str) -> str:
@@ -903,15 +1192,12 @@ def _extract_allowed_labels_from_rag(rag_block: str) -> List[str]:
 
 # ───────────────── provider call (simple) ─────────────────
 async def _call_provider_simple(*, provider_model_id: str, messages: List[dict], tier: str = "low") -> Tuple[str, dict]:
-    client = get_client()
-    resp = await asyncio.get_running_loop().run_in_executor(
-        None,
-        lambda: client.chat.completions.create(
-            model=provider_model_id,
-            messages=messages,
-            temperature=0.3,
-            max_tokens=RUNPOD_MAX_TOKENS,
-        ),
+    resp = await llm.chat_completion(
+        "chat",
+        model=provider_model_id,
+        messages=messages,
+        temperature=0.3,
+        max_tokens=RUNPOD_MAX_TOKENS,
     )
     text = (resp.choices[0].message.content or "").strip()
     usage = getattr(resp, "usage", None)
@@ -921,6 +1207,48 @@ async def _call_provider_simple(*, provider_model_id: str, messages: List[dict],
     }
     return text, usage_dict
 
+async def _completion_stream(*, message_id: str, model: str, messages: List[dict]) -> Tuple[str, int, int]:
+    """
+    Đọc stream từ pool LLM dùng chung, đẩy từng delta vào buffer SSE.
+    Provider không hỗ trợ stream/stream_options (400 / 404 / 501 trước delta đầu tiên) → fallback 1 lần gọi thường;
+    lỗi khác (busy, timeout, mạng…) ném tiếp — gọi lại ngay chỉ tăng tải cho provider đang quá tải.
+    """
+    parts: List[str] = []
+    in_tok = 0
+    out_tok = 0
+    agen = llm.chat_completion_stream(
+        "chat",
+        model=model,
+        messages=messages,
+        temperature=0.3,
+        max_tokens=RUNPOD_MAX_TOKENS,
+        stream_options={"include_usage": True},
+    )
+    try:
+        async for chunk in agen:
+            usage = getattr(chunk, "usage", None)
+            if usage:
+                in_tok = getattr(usage, "prompt_tokens", None) or in_tok
+                out_tok = getattr(usage, "completion_tokens", None) or out_tok
+            choices = getattr(chunk, "choices", None) or []
+            if not choices:
+                continue
+            delta = getattr(getattr(choices[0], "delta", None), "content", None) or ""
+            if delta:
+                parts.append(delta)
+                _stream_push(message_id, delta)
+    except Exception as e:
+        if parts or not llm.is_stream_unsupported(e):
+            raise
+        logger.info("stream not available (%s) → non-stream call", e)
+        text, usage_dict = await _call_provider_simple(provider_model_id=model, messages=messages)
+        if text:
+            _stream_push(message_id, text)
+        return text, int(usage_dict.get("prompt_tokens") or 0), int(usage_dict.get("completion_tokens") or 0)
+    finally:
+        await agen.aclose()
+    return "".join(parts).strip(), in_tok, out_tok
+
 async def _call_provider_and_update(
     *,
     session: Any,
@@ -944,6 +1272,7 @@ async def _call_provider_and_update(
         except Exception:
             session.rollback()
         _set_msg_status(message_row.message_id, "ready", "(canceled)")
+        _stream_close(message_row.message_id, "(canceled)")
         _dump_json_txt(chat_row.chat_id, message_row.message_id, "model_input.json.txt", {
             "canceled": True,
             "ts": int(time.time()),
@@ -967,7 +1296,6 @@ async def _call_provider_and_update(
         session.rollback()
 
     provider_model_id = (mv.provider_model_id or RUNPOD_DEFAULT_MODEL)
-    client = get_client()
 
     sys_text = f"Reasoning: {(tier or RUNPOD_DEFAULT_REASONING or 'low').lower()}"
     user_content = (user_override or message_row.message_question or "Hi")
@@ -991,19 +1319,26 @@ async def _call_provider_and_update(
         provider_model_id, mv.model_name, mv.model_id, tier,
         chat_row.chat_user_id, chat_row.chat_id, message_row.message_id
     )
-    resp = await asyncio.get_running_loop().run_in_executor(
-        None,
-        lambda: client.chat.completions.create(
+    if CHAT_STREAM_ENABLED and message_row.message_id in _STREAMS:
+        if ack_prefix:
+            _stream_push(message_row.message_id, f"{ack_prefix}\n\n")
+        ai, in_tok, out_tok = await _completion_stream(
+            message_id=message_row.message_id,
+            model=provider_model_id,
+            messages=messages,
+        )
+    else:
+        resp = await llm.chat_completion(
+            "chat",
             model=provider_model_id,
             messages=messages,
             temperature=0.3,
             max_tokens=RUNPOD_MAX_TOKENS,
-        ),
-    )
-    ai = (resp.choices[0].message.content or "").strip()
-    usage = getattr(resp, "usage", None)
-    in_tok = getattr(usage, "prompt_tokens", None) if usage else 0
-    out_tok = getattr(usage, "completion_tokens", None) if usage else 0
+        )
+        ai = (resp.choices[0].message.content or "").strip()
+        usage = getattr(resp, "usage", None)
+        in_tok = getattr(usage, "prompt_tokens", None) if usage else 0
+        out_tok = getattr(usage, "completion_tokens", None) if usage else 0
 
     if ack_prefix:
         ai = f"{ack_prefix}\n\n{ai}".strip()
@@ -1014,6 +1349,7 @@ async def _call_provider_and_update(
     chat_row.chat_tokens_input = (chat_row.chat_tokens_input or 0) + (in_tok or 0)
     chat_row.chat_tokens_output = (chat_row.chat_tokens_output or 0) + (out_tok or 0)
     session.commit()
+    _transcript.invalidate(chat_row.chat_id)
 
     _dump_json_txt(chat_row.chat_id, message_row.message_id, "model_output.json.txt", {
         "ts": int(time.time()),
@@ -1024,17 +1360,21 @@ async def _call_provider_and_update(
         }
     })
 
+    # Báo xong cho FE trước khi tóm tắt memory (không giữ stream chờ thêm 1 lượt gọi model)
+    _set_msg_status(message_row.message_id, "ready", ai)
+    _stream_close(message_row.message_id, ai)
+
     if MEMORY_ENABLED and MEMORY_AUTO_SUMMARY and _mem and hasattr(_mem, "update_chat_summary_async"):
         try:
             await _mem.update_chat_summary_async(chat_row.chat_id, message_row.message_question or "", ai or "")
         except Exception:
             pass
 
-    _set_msg_status(message_row.message_id, "ready", ai)
     return ai
 
 # ───────────────── user info helper ─────────────────
-def _user_info(request: Request) -> dict:
+def _user_info(request: Request, session: Any = None) -> dict:
+    """Có `session` của request → dùng luôn (không mở thêm kết nối)."""
     uid = get_secure_cookie(request)
     info = {
         "id": None,
@@ -1045,7 +1385,9 @@ def _user_info(request: Request) -> dict:
     }
     if not uid:
         return info
-    session = SessionLocal()
+    own = session is None
+    if own:
+        session = SessionLocal()
     try:
         u = session.get(User, uid)
         if not u:
@@ -1063,7 +1405,8 @@ def _user_info(request: Request) -> dict:
         )
         return info
     finally:
-        session.close()
+        if own:
+            session.close()
 
 # ───────────────── tools catalog (cho FE menu) ─────────────────
 # name khớp icon bank FE: answer_mode, web_search, deep_research, doc_email_update, doc_email_routing
@@ -1301,195 +1644,330 @@ def _compose_classify_natural_prompt_fallback(
     parts.append("\n".join(guide))
     return "\n\n".join(parts).strip()
 
-# ──────────────────────────────── SEND ────────────────────────────────
-@post("/chat/api/send")
-async def chat_api_send(request: Request) -> Response:
-    uid = get_secure_cookie(request)
-    if not uid:
-        return Response(status_code=302, headers={"Location": "/auth/login"})
-
+# ───────────────── jobs (send / edit / regenerate) ─────────────────
+# Handler HTTP chỉ lưu upload + tạo ChatMessage "(queued)" + enqueue chat_jobs rồi trả message_id.
+# OCR/extract, ngữ cảnh, router, gọi model, tóm tắt memory chạy trong job (worker nhúng hoặc
+# modules/worker/chat_worker.py). Job chạy lại (retry / worker chết) → bỏ qua nếu message đã có kết quả.
+def _is_pending_answer(row: Optional[ChatMessage]) -> bool:
+    a = (row.message_ai_response or "").strip() if row else ""
+    return a in ("", "(queued)")
+
+def _job_partial_text(job: "jobs.ClaimedJob") -> Optional[str]:
+    st = _STREAMS.get(job.message_id)
+    return st["text"] if st else None
+
+def _job_on_cancel(job: "jobs.ClaimedJob") -> None:
+    # chỉ huỷ đúng job này (job mới của cùng message — edit/regenerate — vẫn chạy tiếp)
+    _cancel_inflight(job.message_id, job.job_id)
+
+def _finish_canceled(job: "jobs.ClaimedJob") -> None:
+    """Ghi "(canceled)" nếu job vẫn là job mới nhất của message và chưa có câu trả lời."""
+    mid = job.message_id
+    session = SessionLocal()
     try:
-        clen = int(request.headers.get("content-length") or "0")
-        if clen and clen > _effective_body_cap():
-            eff = _effective_body_cap()
-            return Response(
-                media_type="application/json",
-                content={
-                    "ok": False,
-                    "error": "UPLOAD_TOO_LARGE",
-                    "limit": eff,
-                    "limit_label": _fmt_bytes(eff),
-                },
-                status_code=413,
-                headers=_limit_headers(),
-            )
-    except Exception:
-        pass
+        latest = jobs.latest_for_message(session, mid)
+        if latest is not None and latest.job_id != job.job_id:
+            return
+        row = session.get(ChatMessage, mid)
+        if row is not None and not _is_pending_answer(row) and row.message_ai_response != "(canceled)":
+            return  # đã trả lời xong (cancel rơi vào lúc tóm tắt memory)
+        if row is not None and _is_pending_answer(row):
+            row.message_ai_response = "(canceled)"
+            row.message_tokens_input = 0
+            row.message_tokens_output = 0
+            session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+    finally:
+        session.close()
+    _set_msg_status(mid, "ready", "(canceled)")
+    _stream_close(mid, "(canceled)")
 
+async def _run_cancellable(job: "jobs.ClaimedJob", run: Any) -> None:
+    """
+    Chạy job như 1 task huỷ được: cancel (endpoint / cờ DB qua heartbeat) → task.cancel() → đóng HTTP stream
+    tới provider, trả slot llm_client + slot worker ngay, không chờ model sinh hết RUNPOD_MAX_TOKENS.
+    """
+    mid = job.message_id
+    if job.cancel_requested:
+        _finish_canceled(job)
+        return
+    _CANCEL_REQS.pop(mid, None)  # cờ cũ của lượt trước (cancel rồi regenerate cùng message)
+    task = asyncio.current_task()
+    _INFLIGHT.setdefault(mid, {})[job.job_id] = (job, task)  # type: ignore[assignment]
     try:
-        form = await request.form()
-    except Exception as e:
-        msg = str(e or "")
-        lower = msg.lower()
-        too_large = any(k in lower for k in ("too large", "exceed", "payload", "request body is too large", "413"))
-        status = 413 if too_large else 400
-        eff = _effective_body_cap()
-        return Response(
-            media_type="application/json",
-            content={
-                "ok": False,
-                "error": "UPLOAD_TOO_LARGE" if too_large else "UPLOAD_PARSE_FAILED",
-                "detail": msg,
-                "limit": eff,
-                "limit_label": _fmt_bytes(eff),
-                "per_file_limit": MULTIPART_MAX_FILE_SIZE or 0,
-                "per_file_limit_label": _fmt_bytes(MULTIPART_MAX_FILE_SIZE),
-                "max_files": MULTIPART_MAX_FILES or 0,
-            },
-            status_code=status,
-            headers=_limit_headers(),
-        )
+        await run(job)
+    except asyncio.CancelledError:
+        if not job.cancel_requested:
+            raise  # shutdown / mất lease
+        if task is not None and hasattr(task, "uncancel"):
+            task.uncancel()
+        logger.info("job %s canceled (msg=%s) → upstream closed", job.job_id, mid)
+        _finish_canceled(job)
+    finally:
+        tasks = _INFLIGHT.get(mid) or {}
+        tasks.pop(job.job_id, None)
+        if not tasks:
+            _INFLIGHT.pop(mid, None)
+
+def _job_on_failed(job: "jobs.ClaimedJob", error: str) -> None:
+    _set_msg_status(job.message_id, "error", None, error)
+    _stream_close(job.message_id, error=error)
+
+def _job_selected_mv(session: Any, payload: Dict[str, Any]) -> Optional[ModelVariant]:
+    mv = session.get(ModelVariant, payload.get("model_id")) if payload.get("model_id") else None
+    return mv or _get_model_variant_by_any(session, RUNPOD_DEFAULT_MODEL)
+
+def _enqueue_job(session: Any, *, kind: str, uid: str, chat_id: str, message_id: str, payload: Dict[str, Any]) -> None:
+    """Enqueue + commit cùng message / Document của request. Vượt trần lúc insert → jobs.AdmissionRejected (chưa commit gì)."""
+    if kind != "send":
+        # edit/regenerate: lượt cũ còn chờ của message này bị huỷ trong cùng transaction (không tính vào trần)
+        jobs.request_cancel(session, [message_id])
+    # đếm + insert dưới khoá advisory theo user, giữ tới commit bên dưới
+    jobs.enqueue(session, kind=kind, user_id=uid, chat_id=chat_id, message_id=message_id, payload=payload)
+    if kind != "send":
+        # lượt sinh cũ (nếu còn chạy) là vô ích → huỷ ngay
+        # (_cancel_inflight bật job.cancel_requested của task cũ trước khi huỷ → task cũ kết thúc "canceled")
+        _cancel_inflight(message_id)
+        _CANCEL_REQS.pop(message_id, None)
+        # buffer lượt cũ ("done" với câu trả lời cũ / "(canceled)") → bỏ; job mới tự _stream_open khi chạy
+        _stream_reset(message_id)
+    session.commit()
+    _transcript.invalidate(chat_id)
+    _set_msg_status(message_id, "pending")
+    jobs.wake()
 
-    text = (form.get("text") or "").strip()
-    chat_id_raw = (form.get("chat_id") or "").strip() or None
-    incoming_tool_id = (form.get("tool_id") or "").strip() or None
+def _admission_reject(uid: str) -> Optional[Response]:
+    """
+    429 + Retry-After khi user/hàng đợi đã đầy — kiểm tra sớm, không khoá (gọi trước khi đọc body upload).
+    Trần được áp nguyên tử lúc enqueue (_enqueue_job → jobs.AdmissionRejected → _busy_response).
+    """
+    session = SessionLocal()
+    try:
+        adm = jobs.admit(session, uid)
+    except SQLAlchemyError:
+        return None
+    finally:
+        session.close()
+    if adm.ok:
+        return None
+    return _busy_response(adm)
 
-    main_files = _extract_files(form, "main_files", "main_files[]", "file", "files", "upload")
-    attachments = _extract_files(form, "attachments", "attachments[]")
-    all_files = list(main_files) + list(attachments)
-
-    if MULTIPART_MAX_FILES and len(all_files) > MULTIPART_MAX_FILES:
-        return Response(
-            media_type="application/json",
-            content={
-                "ok": False,
-                "error": "TOO_MANY_FILES",
-                "count": len(all_files),
-                "max_files": MULTIPART_MAX_FILES,
-                "limit": _effective_body_cap(),
-                "limit_label": _fmt_bytes(_effective_body_cap()),
-            },
-            status_code=413,
-            headers=_limit_headers(),
-        )
-
-    if not text and not all_files:
-        return Response(
-            media_type="application/json",
-            content={"ok": False, "error": "EMPTY_MESSAGE"},
-            status_code=400,
-            headers={"Cache-Control": "no-store"},
-        )
+def _busy_response(adm: "jobs.Admission") -> Response:
+    return Response(
+        media_type="application/json",
+        content={
+            "ok": False,
+            "error": "TOO_MANY_PENDING" if adm.scope == "user" else "SERVER_BUSY",
+            "scope": adm.scope,
+            "pending": adm.pending,
+            "retry_after": adm.retry_after,
+        },
+        status_code=429,
+        headers={"Cache-Control": "no-store", "Retry-After": str(adm.retry_after)},
+    )
 
+async def _route_tier(
+    session: Any,
+    *,
+    role: str,
+    prompt: str,
+    selected_mv: ModelVariant,
+    attachments_count: int,
+) -> Tuple[str, ModelVariant]:
+    if not auto:
+        return (RUNPOD_DEFAULT_REASONING or "low").lower(), selected_mv
+    final_tier, final_mv, _ = await auto.route_and_select_variant(
+        session,
+        user_role=role,
+        prompt=prompt,
+        selected_variant=selected_mv,
+        attachments_count=attachments_count,
+    )
+    return final_tier, final_mv
+
+# ───────────────── context assembly (fan-out) ─────────────────
+@dataclass
+class _ChatContext:
+    """Ngữ cảnh dựng prompt của 1 lượt: mỗi nguồn đọc đúng 1 lần, các nguồn độc lập chạy song song."""
+    uid: str
+    chat_id: str
+    uinfo: Dict[str, Any]
+    glb: str = ""
+    recent: str = ""
+    last_doc: str = ""
+    doc_is_excerpt: bool = False
+    rag_block: str = ""
+    tool_note: str = ""
+    tools: Optional[List[Dict[str, Any]]] = None
+    timings_ms: Dict[str, float] = field(default_factory=dict)
+
+def _with_session(fn: Any) -> Any:
+    """Mỗi bước fan-out chạy trong thread riêng → session riêng (Session không thread-safe)."""
     session = SessionLocal()
-    created_new_chat = False
-    message_id: Optional[str] = None
-
     try:
-        selected_mv = _choose_model_variant(session, request)
-        if not selected_mv:
-            return Response(
-                media_type="application/json",
-                content={"ok": False, "error": "MODEL_NOT_REGISTERED", "provider_model_id": RUNPOD_DEFAULT_MODEL},
-                status_code=400,
-                headers={"Cache-Control": "no-store"},
-            )
+        return fn(session)
+    finally:
+        session.close()
 
-        chat_row: Optional[ChatHistory] = None
-        if chat_id_raw:
-            exist = session.get(ChatHistory, chat_id_raw)
-            if exist and exist.chat_user_id == uid and exist.chat_status == "active":
-                chat_row = exist
+async def _gather_context(
+    *,
+    uid: str,
+    chat_id: str,
+    uinfo: Dict[str, Any],
+    question: str,
+    want_rag: bool = False,
+    want_tool_note: bool = False,
+    want_tools: bool = False,
+    full_doc: bool = False,
+) -> _ChatContext:
+    """
+    memory / transcript / tài liệu gần nhất (+RAG, phụ thuộc tài liệu) / chú thích tool / catalog tool
+    chạy đồng thời → độ trễ trước khi gọi model ≈ bước chậm nhất thay vì tổng các bước.
+    """
+    ctx = _ChatContext(uid=uid, chat_id=chat_id, uinfo=uinfo)
 
-        if not chat_row:
-            created_new_chat = True
-            chat_row = ChatHistory(  # type: ignore[call-arg]
-                chat_id=str(uuid.uuid4()),
-                chat_user_id=uid,
-                initial_model_id=selected_mv.model_id,
-                chat_status="active",
-                chat_visibility="public",
-            )
-            session.add(chat_row)
-            session.flush()
+    def load_glb(session: Any) -> str:
+        if not (MEMORY_ENABLED and _mem and hasattr(_mem, "get_global_memory_text")):
+            return ""
+        return _mem.get_global_memory_text(session, uid) or ""
 
-        message_id = str(uuid.uuid4())
-        _set_msg_status(message_id, "pending")
+    def load_recent(session: Any) -> str:
+        return _recent_chat_transcript(session, chat_id, CHAT_RECENT_CONTEXT_CHARS, CHAT_RECENT_CONTEXT_MAX_MSGS)
 
-        # MEMORY (ghi nhớ / forget) xử lý trước
-        ack_prefix: Optional[str] = None
-        soft_ack_flag = False
-        if MEMORY_ENABLED and _mem and hasattr(_mem, "detect_memory_command"):
+    # full_doc: tool phân loại cần nguyên văn tài liệu mới nhất; còn lại chỉ lấy các đoạn liên quan câu hỏi
+    excerpt = bool(not full_doc and DOC_RETRIEVAL_ENABLED and pc and hasattr(pc, "relevant_doc_text"))
+
+    def load_doc(session: Any) -> Tuple[str, str, bool]:
+        last_doc = ""
+        is_excerpt = False
+        try:
+            if excerpt:
+                last_doc, is_excerpt = pc.relevant_doc_text(session, chat_id, question)
+                last_doc = last_doc or ""
+            elif pc and hasattr(pc, "latest_doc_text"):
+                last_doc = pc.latest_doc_text(session, chat_id, include_header=True) or ""
+        except Exception:
+            last_doc = ""
+        rag_block = ""
+        if want_rag:
+            # RAG cho phân loại (ưu tiên nội dung tệp)
+            rag_top_k = _env_int("RAG_TOP_K", 6) or 6
             try:
-                det = _mem.detect_memory_command(text)
+                raw_for_rag = (last_doc.split("]\n", 1)[1] if last_doc.startswith("[") and "]\n" in last_doc else last_doc) or _strip_appendix(question)
+                if pc and hasattr(pc, "build_tool_block_for_classify"):
+                    rag_block = pc.build_tool_block_for_classify(raw_for_rag, top_k=rag_top_k) or ""
             except Exception:
-                det = {"is_cmd": False}
+                rag_block = ""
+        return last_doc, rag_block, is_excerpt
 
-            if det.get("is_cmd"):
-                op = (det.get("op") or "save").lower()
-                payload = (det.get("payload") or "").strip()
-                rest = (det.get("rest") or "").strip()
-
-                try:
-                    can_store_flag = _mem.can_store(session, uid) if hasattr(_mem, "can_store") else True
-                except Exception:
-                    can_store_flag = True
-
-                ack = ""
-                if op == "forget" and hasattr(_mem, "forget_global_memory"):
-                    if can_store_flag:
-                        try:
-                            ack = _mem.forget_global_memory(session, uid, payload)
-                        except Exception as e:
-                            ack = f"Đã cố gắng xoá khỏi bộ nhớ nhưng gặp lỗi: {e}"
-                    else:
-                        ack = "Tính năng ghi nhớ đang tắt cho tài khoản của bạn."
-                else:
-                    if not can_store_flag:
-                        ack = "Tính năng ghi nhớ đang tắt cho tài khoản của bạn."
-                    elif payload:
-                        try:
-                            ack = _mem.save_global_memory(session, uid, payload)
-                        except Exception as e:
-                            ack = f"Đã cố gắng ghi nhớ nhưng gặp lỗi: {e}"
-                    else:
-                        ack = "Không có gì để ghi nhớ."
+    async def step(name: str, fn: Any, default: Any, *, db: bool = True) -> Any:
+        t0 = time.perf_counter()
+        try:
+            return await asyncio.to_thread(_with_session, fn) if db else await asyncio.to_thread(fn)
+        except Exception as e:
+            logger.debug("context step %s failed: %s", name, e)
+            return default
+        finally:
+            ctx.timings_ms[name] = round((time.perf_counter() - t0) * 1000.0, 1)
+
+    steps = [
+        step("memory", load_glb, ""),
+        step("recent", load_recent, ""),
+        step("doc", load_doc, ("", "", False)),
+    ]
+    if want_tool_note and LATEST_TOOL_NOTE_ENABLE:
+        steps.append(step("tool_note", lambda: _latest_tool_note_text(chat_id) or "", "", db=False))
+    if want_tools:
+        steps.append(step("tools", lambda session: _db_tools_catalog(session, uinfo), None))
+
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*steps)
+    ctx.glb, ctx.recent, (ctx.last_doc, ctx.rag_block, doc_is_excerpt) = results[0], results[1], results[2]
+    ctx.doc_is_excerpt = doc_is_excerpt and bool(ctx.last_doc)
+    rest = list(results[3:])
+    if want_tool_note and LATEST_TOOL_NOTE_ENABLE:
+        ctx.tool_note = rest.pop(0)
+    if want_tools:
+        ctx.tools = rest.pop(0)
+    ctx.timings_ms["total"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    logger.debug("[ChatAPI] context chat=%s timings=%s", chat_id, ctx.timings_ms)
+    return ctx
+
+def _pack_prompt_context(
+    mv: Optional[ModelVariant],
+    *,
+    chat_id: str,
+    message_id: str,
+    question: str,
+    fixed_prompt: str,
+    doc: str = "",
+    rag: str = "",
+    recent: str = "",
+    glb: str = "",
+) -> Any:
+    """Cắt các khối ngữ cảnh cho vừa ngân sách token của model (pc.pack_context); None → giữ nguyên."""
+    if not (pc and hasattr(pc, "pack_context")):
+        return None
+    pid = (mv.provider_model_id if mv else None) or RUNPOD_DEFAULT_MODEL
+    try:
+        packed = pc.pack_context(
+            provider_model_id=pid,
+            budget=pc.prompt_token_budget(pid, RUNPOD_MAX_TOKENS),
+            fixed_prompt=fixed_prompt,
+            question=question,
+            doc=doc,
+            rag=rag,
+            recent=recent,
+            glb=glb,
+        )
+    except Exception as e:
+        logger.debug("prompt pack failed: %s", e)
+        return None
+    logger.info(
+        "[ChatAPI] prompt pack mid=%s tokenizer=%s budget=%d used=%d %s truncated=%s dropped=%s",
+        message_id, packed.tokenizer, packed.budget, packed.total, packed.used, packed.truncated, packed.dropped,
+    )
+    _dump_json_txt(chat_id, message_id, "prompt_pack.json.txt", {
+        "ts": int(time.time()),
+        "model": pid,
+        "tokenizer": packed.tokenizer,
+        "budget": packed.budget,
+        "used": packed.used,
+        "truncated": packed.truncated,
+        "dropped": packed.dropped,
+    })
+    return packed
 
-                if not rest:
-                    action_label = "Ghi nhớ" if op != "forget" else "Quên"
-                    msg_row = ChatMessage(  # type: ignore[call-arg]
-                        message_id=message_id,
-                        message_chat_id=chat_row.chat_id,
-                        message_model_id=selected_mv.model_id,
-                        message_question=text or action_label,
-                        message_ai_response=ack,
-                        message_tokens_input=0,
-                        message_tokens_output=0,
-                    )
-                    session.add(msg_row)
-                    session.commit()
-                    _set_msg_status(message_id, "ready", ack)
-                    _dump_json_txt(chat_row.chat_id, message_id, "model_input.json.txt", {
-                        "memory_only": True,
-                        "ack": ack,
-                        "op": op,
-                        "ts": int(time.time()),
-                    })
-                    _dump_json_txt(chat_row.chat_id, message_id, "model_output.json.txt", {
-                        "memory_only": True,
-                        "ack": ack,
-                        "op": op,
-                        "ts": int(time.time()),
-                    })
-                    return Response(
-                        media_type="application/json",
-                        content={"ok": True, "chat_id": chat_row.chat_id, "message_id": message_id, "created_new_chat": created_new_chat},
-                        headers={"Cache-Control": "no-store"},
-                    )
-                else:
-                    ack_prefix = ack
-                    text = rest
-                    soft_ack_flag = True
+async def _send_job_body(job: "jobs.ClaimedJob") -> None:
+    p = job.payload or {}
+    message_id = job.message_id
+    uid = job.user_id or ""
+    session = SessionLocal()
+    try:
+        chat_row: Optional[ChatHistory] = session.get(ChatHistory, job.chat_id)
+        msg_row: Optional[ChatMessage] = session.get(ChatMessage, message_id)
+        if not chat_row or not msg_row:
+            raise RuntimeError("chat/message not found")
+        if job.attempts > 1 and not _is_pending_answer(msg_row):
+            return  # chạy lại sau crash nhưng lượt trước đã ghi xong
+        selected_mv = _job_selected_mv(session, p)
+        if not selected_mv:
+            raise RuntimeError("MODEL_NOT_REGISTERED")
+        if CHAT_STREAM_ENABLED:
+            _stream_open(message_id)
+
+        text = p.get("text") or ""
+        incoming_tool_id = p.get("tool_id") or None
+        ack_prefix = p.get("ack_prefix") or None
+        soft_ack_flag = bool(p.get("soft_ack"))
+        uinfo = p.get("uinfo") or {}
+        role = uinfo.get("role") or "guest"
+        files_count = int(p.get("files_count") or 0)
+        names_main = list(p.get("main_names") or [])
+        names_att = list(p.get("att_names") or [])
+        docs_main = [d for d in (session.get(Document, i) for i in (p.get("main_doc_ids") or [])) if d]
+        docs_att = [d for d in (session.get(Document, i) for i in (p.get("att_doc_ids") or [])) if d]
 
         # Dự đoán tool sớm (trước OCR) để áp EasyOCR-only nếu cần
         predicted_tool_name: Optional[str] = None
@@ -1503,50 +1981,31 @@ async def chat_api_send(request: Request) -> Response:
 
         is_doc_classify_early = _is_doc_classify_tool(incoming_tool_id, predicted_tool_name)
 
-        # Lưu file & build appendix (main_files / attachments)
+        # OCR/extract & build appendix (main_files / attachments) — tiến độ từng trang phát qua SSE `progress`
+        on_progress = functools.partial(_stream_progress, message_id) if CHAT_STREAM_ENABLED else None
+        # — mọi file (main + attachments) chạy song song 1 lượt, appendix ghép theo thứ tự file
+        extracted = await _extract_docs(list(docs_main) + list(docs_att), classification_only_ocr=is_doc_classify_early,
+                                        on_progress=on_progress)
         extra_tail = ""
-        docs_main: List[Document] = []
-        docs_att: List[Document] = []
-        if main_files:
-            tail_main, docs_main = await _save_files_and_build_appendix(
-                session=session,
-                uid=uid,
-                chat_row=chat_row,
-                message_id=message_id,
-                files=main_files,
-                classification_only_ocr=is_doc_classify_early,
-            )
+        if docs_main:
+            tail_main = await _build_appendix(session=session, docs=docs_main, classification_only_ocr=is_doc_classify_early,
+                                              on_progress=on_progress, extracted=extracted)
             if tail_main:
                 extra_tail += ("\n\n" + tail_main) if extra_tail else tail_main
-        if attachments:
-            tail_att, docs_att = await _save_files_and_build_appendix(
-                session=session,
-                uid=uid,
-                chat_row=chat_row,
-                message_id=message_id,
-                files=attachments,
-                classification_only_ocr=is_doc_classify_early,
-            )
+        if docs_att:
+            tail_att = await _build_appendix(session=session, docs=docs_att, classification_only_ocr=is_doc_classify_early,
+                                             on_progress=on_progress, extracted=extracted)
             if tail_att:
                 extra_tail += ("\n\n" + tail_att) if extra_tail else tail_att
 
-        if main_files or attachments:
-            try:
-                names_main = [
-                    (getattr(f, "filename", None) or getattr(f, "name", None) or "file") for f in main_files
-                ]
-                names_att = [
-                    (getattr(f, "filename", None) or getattr(f, "name", None) or "file") for f in attachments
-                ]
-                parts = []
-                if names_main:
-                    parts.append(f"Main: {', '.join(map(str, names_main))}")
-                if names_att:
-                    parts.append(f"Attachments: {', '.join(map(str, names_att))}")
-                if parts:
-                    text = f"{text}\n\n[Tệp đính kèm] " + " | ".join(parts)
-            except Exception:
-                pass
+        if names_main or names_att:
+            parts = []
+            if names_main:
+                parts.append(f"Main: {', '.join(map(str, names_main))}")
+            if names_att:
+                parts.append(f"Attachments: {', '.join(map(str, names_att))}")
+            if parts:
+                text = f"{text}\n\n[Tệp đính kèm] " + " | ".join(parts)
             if extra_tail:
                 text = (text + "\n\n" + extra_tail).strip()
 
@@ -1570,49 +2029,29 @@ async def chat_api_send(request: Request) -> Response:
             except Exception:
                 pass
 
+        # Ngữ cảnh chung (song song): memory, transcript, tài liệu gần nhất + RAG, chú thích tool, catalog tool
+        ctx = await _gather_context(
+            uid=uid,
+            chat_id=chat_row.chat_id,
+            uinfo=uinfo,
+            question=text,
+            want_rag=True,
+            want_tool_note=True,
+            want_tools=bool(not incoming_tool_id and predicted_tool_name),
+            full_doc=is_doc_classify_early,
+        )
+        glb, recent, last_doc = ctx.glb, ctx.recent, ctx.last_doc
+        rag_block = ctx.rag_block
+        latest_tool_note_line = ctx.tool_note  # chỉ dùng cho luồng thường
+
         # Nếu user chưa chọn tool → auto map theo classifier
         chosen_tool_id = incoming_tool_id
         try:
             if not chosen_tool_id and predicted_tool_name:
-                tools = _db_tools_catalog(session, _user_info(request))
-                chosen_tool_id = resolve_tool_id(tools, predicted_tool_name) or None
+                chosen_tool_id = resolve_tool_id(ctx.tools or [], predicted_tool_name) or None
         except Exception:
             pass
 
-        # Build common context
-        glb = ""
-        if MEMORY_ENABLED and _mem and hasattr(_mem, "get_global_memory_text"):
-            try:
-                glb = _mem.get_global_memory_text(session, uid) or ""
-            except Exception:
-                glb = ""
-
-        recent = _recent_chat_transcript(session, chat_row.chat_id, CHAT_RECENT_CONTEXT_CHARS, CHAT_RECENT_CONTEXT_MAX_MSGS)
-        last_doc = ""
-        if pc and hasattr(pc, "latest_doc_text"):
-            try:
-                last_doc = pc.latest_doc_text(session, chat_row.chat_id, include_header=True) or ""
-            except Exception:
-                last_doc = ""
-
-        # Chú thích kết quả tool gần nhất (chỉ dùng cho luồng thường)
-        latest_tool_note_line = ""
-        try:
-            if LATEST_TOOL_NOTE_ENABLE:
-                latest_tool_note_line = _latest_tool_note_text(chat_row.chat_id) or ""
-        except Exception:
-            latest_tool_note_line = ""
-
-        # RAG cho phân loại (ưu tiên nội dung tệp)
-        rag_top_k = _env_int("RAG_TOP_K", 6) or 6
-        rag_block = ""
-        try:
-            raw_for_rag = (last_doc.split("]\n", 1)[1] if last_doc.startswith("[") and "]\n" in last_doc else last_doc) or _strip_appendix(text)
-            if pc and hasattr(pc, "build_tool_block_for_classify"):
-                rag_block = pc.build_tool_block_for_classify(raw_for_rag, top_k=rag_top_k) or ""
-        except Exception:
-            rag_block = ""
-
         # Rút phạm vi [B] từ RAG
         allowed_labels = _extract_allowed_labels_from_rag(rag_block)
 
@@ -1643,28 +2082,13 @@ async def chat_api_send(request: Request) -> Response:
                 ).strip()
 
             # 2) Chọn model/tier
-            role = _user_info(request)["role"]
-            if not auto:
-                final_tier_default = (RUNPOD_DEFAULT_REASONING or "low").lower()
-                final_tier, final_mv = final_tier_default, selected_mv
-            else:
-                final_tier, final_mv, _ = await auto.route_and_select_variant(
-                    session,
-                    user_role=role,
-                    prompt=user_override,
-                    selected_variant=selected_mv,
-                    attachments_count=len(all_files),
-                )
-
-            # 3) Tạo message "(queued)"
-            msg_row = ChatMessage(  # type: ignore[call-arg]
-                message_id=message_id,
-                message_chat_id=chat_row.chat_id,
-                message_model_id=final_mv.model_id,
-                message_question=text or "Hi",
-                message_ai_response="(queued)",
+            final_tier, final_mv = await _route_tier(
+                session, role=role, prompt=user_override, selected_mv=selected_mv, attachments_count=files_count,
             )
-            session.add(msg_row)
+
+            # 3) Cập nhật message "(queued)"
+            msg_row.message_model_id = final_mv.model_id
+            msg_row.message_question = text or "Hi"
             session.commit()
 
             # 4) Gọi model để lấy JSON kế hoạch
@@ -1717,26 +2141,17 @@ async def chat_api_send(request: Request) -> Response:
             except Exception:
                 pass
             session.commit()
+            _transcript.invalidate(chat_row.chat_id)
+
+            _set_msg_status(message_id, "ready", summary)
+            _stream_close(message_id, summary)
 
             if MEMORY_ENABLED and MEMORY_AUTO_SUMMARY and _mem and hasattr(_mem, "update_chat_summary_async"):
                 try:
                     await _mem.update_chat_summary_async(chat_row.chat_id, msg_row.message_question or "", summary or "")
                 except Exception:
                     pass
-
-            _set_msg_status(message_id, "ready", summary)
-
-            return Response(
-                media_type="application/json",
-                content={
-                    "ok": True,
-                    "chat_id": chat_row.chat_id,
-                    "message_id": message_id,
-                    "created_new_chat": created_new_chat,
-                    "selected_tool_id": chosen_tool_id,
-                },
-                headers={"Cache-Control": "no-store"},
-            )
+            return
 
         # ───── Tool “Phân loại phòng ban” — SIMPLE (1 bước) ─────
         is_doc_classify = CLASSIFY_SIMPLE_MODE and _is_doc_classify_tool(chosen_tool_id, predicted_tool_name)
@@ -1744,6 +2159,19 @@ async def chat_api_send(request: Request) -> Response:
             # Compose prompt tự nhiên theo spec
             if pc and hasattr(pc, "compose_user_prompt_for_department_classify_natural"):
                 try:
+                    packed = _pack_prompt_context(
+                        selected_mv,
+                        chat_id=chat_row.chat_id,
+                        message_id=message_id,
+                        question=_strip_appendix(text),
+                        fixed_prompt=pc.compose_user_prompt_for_department_classify_natural(
+                            q_raw=text, last_doc_text_full="", rag_training_block="",
+                            allowed_labels=allowed_labels, global_memory_text="", recent_transcript="",
+                        ),
+                        doc=last_doc, rag=rag_block, recent=recent, glb=glb,
+                    )
+                    if packed is not None:
+                        last_doc, rag_block, recent, glb = packed.doc, packed.rag, packed.recent, packed.glb
                     user_override = pc.compose_user_prompt_for_department_classify_natural(
                         q_raw=text,
                         last_doc_text_full=last_doc,
@@ -1763,109 +2191,439 @@ async def chat_api_send(request: Request) -> Response:
                     global_memory_text=glb,
                     recent_transcript=recent,
                 )
+            # KHÔNG chèn latest_tool_note khi đang chạy tool phân loại
+        else:
+            # ───── Luồng thường (không tool phân loại / không email update) ─────
+            if pc and hasattr(pc, "compose_user_prompt"):
+                packed = _pack_prompt_context(
+                    selected_mv,
+                    chat_id=chat_row.chat_id,
+                    message_id=message_id,
+                    question=_strip_appendix(text),
+                    fixed_prompt=pc.compose_user_prompt(
+                        q_raw=text, glb_text="", recent_pairs="", last_doc_text="",
+                        last_doc_is_excerpt=ctx.doc_is_excerpt, memory_soft_ack=soft_ack_flag, classification_mode=False,
+                    ),
+                    doc=last_doc, recent=recent, glb=glb,
+                )
+                if packed is not None:
+                    last_doc, recent, glb = packed.doc, packed.recent, packed.glb
+                user_override = pc.compose_user_prompt(
+                    q_raw=text,
+                    glb_text=glb,
+                    recent_pairs=recent,
+                    last_doc_text=last_doc,
+                    last_doc_is_excerpt=ctx.doc_is_excerpt,
+                    memory_soft_ack=soft_ack_flag,
+                    classification_mode=False,
+                )
+            else:
+                user_override = (
+                    f"Câu hỏi hiện tại:\n{text}\n\n"
+                    "[NGỮ CẢNH]\n"
+                    "• Ghi nhớ cá nhân (global):\n" + (glb or "(trống)") + "\n\n"
+                    "• Một số lượt trao đổi gần đây:\n" + (recent or "(trống)")
+                ).strip()
+
+            # (tùy chọn) chèn chú thích tool gần nhất cho luồng thường
+            if LATEST_TOOL_NOTE_ENABLE and latest_tool_note_line:
+                user_override = _inject_latest_tool_note_block(user_override, latest_tool_note_line)
+
+        # Chọn model/tier
+        final_tier, final_mv = await _route_tier(
+            session, role=role, prompt=user_override, selected_mv=selected_mv, attachments_count=files_count,
+        )
+
+        msg_row.message_model_id = final_mv.model_id
+        msg_row.message_question = text or "Hi"
+        session.commit()
+
+        await _call_provider_and_update(
+            session=session,
+            mv=final_mv,
+            chat_row=chat_row,
+            message_row=msg_row,
+            tier=final_tier,
+            user_override=user_override,
+            ack_prefix=ack_prefix,
+        )
+    finally:
+        session.close()
+
+async def _rewrite_job_body(job: "jobs.ClaimedJob") -> None:
+    """edit / regenerate: message đã được đặt "(queued)" (edit: câu hỏi mới đã ghi) ở request."""
+    p = job.payload or {}
+    message_id = job.message_id
+    uid = job.user_id or ""
+    session = SessionLocal()
+    try:
+        chat_row: Optional[ChatHistory] = session.get(ChatHistory, job.chat_id)
+        msg: Optional[ChatMessage] = session.get(ChatMessage, message_id)
+        if not chat_row or not msg:
+            raise RuntimeError("chat/message not found")
+        if job.attempts > 1 and not _is_pending_answer(msg):
+            return  # chạy lại sau crash nhưng lượt trước đã ghi xong
+        selected_mv = _job_selected_mv(session, p)
+        if not selected_mv:
+            raise RuntimeError("MODEL_NOT_REGISTERED")
+        if CHAT_STREAM_ENABLED:
+            _stream_open(message_id)
+
+        regen_hint = (p.get("regen_hint") or "").strip() if job.kind == "regenerate" else ""
+        current = msg.message_question or ""
+        if regen_hint:
+            current = f"{current}\n\n[HƯỚNG DẪN REGENERATE]\n{regen_hint}"
+
+        ctx = await _gather_context(uid=uid, chat_id=chat_row.chat_id, uinfo={"role": p.get("role") or "guest"}, question=current)
+        glb, recent, last_doc = ctx.glb, ctx.recent, ctx.last_doc
+
+        if pc and hasattr(pc, "compose_user_prompt"):
+            compose_kw: Dict[str, Any] = {}
+            if job.kind == "regenerate":
+                compose_kw["extra_instructions"] = regen_hint if regen_hint else None
+            packed = _pack_prompt_context(
+                selected_mv,
+                chat_id=chat_row.chat_id,
+                message_id=message_id,
+                question=_strip_appendix(current),
+                fixed_prompt=pc.compose_user_prompt(
+                    q_raw=current, glb_text="", recent_pairs="", last_doc_text="",
+                    last_doc_is_excerpt=ctx.doc_is_excerpt, **compose_kw,
+                ),
+                doc=last_doc, recent=recent, glb=glb,
+            )
+            if packed is not None:
+                last_doc, recent, glb = packed.doc, packed.recent, packed.glb
+            user_override = pc.compose_user_prompt(
+                q_raw=current,
+                glb_text=glb,
+                recent_pairs=recent,
+                last_doc_text=last_doc,
+                last_doc_is_excerpt=ctx.doc_is_excerpt,
+                **compose_kw,
+            )
+        else:
+            user_override = (
+                "Câu hỏi hiện tại:\n"
+                f"{current}\n\n"
+                "[DỮ LIỆU TRƯỚC ĐÓ]\n"
+                "• Bộ nhớ cá nhân (global):\n"
+                f"{glb or '(trống)'}\n\n"
+                "• Các tin nhắn gần đây:\n"
+                f"{recent or '(trống)'}"
+            ).strip()
+
+        final_tier, final_mv = await _route_tier(
+            session, role=(p.get("role") or "guest"), prompt=user_override, selected_mv=selected_mv, attachments_count=0,
+        )
+        msg.message_model_id = final_mv.model_id
+        session.commit()
+
+        await _call_provider_and_update(
+            session=session,
+            mv=final_mv,
+            chat_row=chat_row,
+            message_row=msg,
+            tier=final_tier,
+            user_override=user_override,
+        )
+    finally:
+        session.close()
+
+async def _run_send_job(job: "jobs.ClaimedJob") -> None:
+    await _run_cancellable(job, _send_job_body)
+
+async def _run_rewrite_job(job: "jobs.ClaimedJob") -> None:
+    await _run_cancellable(job, _rewrite_job_body)
+
+for _kind, _run in (("send", _run_send_job), ("edit", _run_rewrite_job), ("regenerate", _run_rewrite_job)):
+    jobs.register_handler(
+        _kind,
+        _run,
+        partial=_job_partial_text,
+        on_cancel=_job_on_cancel,
+        on_failed=_job_on_failed,
+    )
+
+# ──────────────────────────────── SEND ────────────────────────────────
+async def _read_send_form(request: Request) -> Any:
+    """multipart → upload_stream.read_form (file đổ thẳng vào kho blob, vượt giới hạn là dừng đọc);
+    body khác / tắt UPLOAD_STREAMING → request.form()."""
+    ctype = request.headers.get("content-type") or ""
+    if not (UPLOAD_STREAMING and _upstream and _upstream.boundary_of(ctype)):
+        return await request.form()
+    limits = UploadLimits(
+        max_files=MULTIPART_MAX_FILES or 0,
+        per_file_bytes=MULTIPART_MAX_FILE_SIZE or 0,
+        effective_request_cap_bytes=_effective_body_cap(),
+    )
+    return await _upstream.read_form(request.stream(), ctype, limits)
+
+def _upload_rejected(e: Exception) -> Response:
+    """UploadError của parser stream → 413 / 415 / 400; Connection: close vì phần body còn lại không được đọc."""
+    if isinstance(e, TooManyFiles):
+        status, code = 413, "TOO_MANY_FILES"
+    elif isinstance(e, FileTooLarge):
+        status, code = 413, "FILE_TOO_LARGE"
+    elif isinstance(e, TotalTooLarge):
+        status, code = 413, "UPLOAD_TOO_LARGE"
+    elif isinstance(e, DisallowedType):
+        status, code = 415, "UNSUPPORTED_FILE_TYPE"
+    else:
+        status, code = 400, "UPLOAD_PARSE_FAILED"
+    eff = _effective_body_cap()
+    return Response(
+        media_type="application/json",
+        content={
+            "ok": False,
+            "error": code,
+            "detail": str(e),
+            "limit": eff,
+            "limit_label": _fmt_bytes(eff),
+            "per_file_limit": MULTIPART_MAX_FILE_SIZE or 0,
+            "per_file_limit_label": _fmt_bytes(MULTIPART_MAX_FILE_SIZE),
+            "max_files": MULTIPART_MAX_FILES or 0,
+        },
+        status_code=status,
+        headers={**_limit_headers(), "Connection": "close"},
+    )
+
+async def _discard_form(form: Any) -> None:
+    """Request bị từ chối / không dùng file sau khi đọc form stream → bỏ blob vừa ghi (chưa có tham chiếu)."""
+    if _upstream and isinstance(form, _upstream.StreamedForm):
+        try:
+            await form.discard()
+        except Exception as e:
+            logger.warning("discard streamed upload failed: %s", e)
+
+@post("/chat/api/send")
+async def chat_api_send(request: Request) -> Response:
+    uid = get_secure_cookie(request)
+    if not uid:
+        return Response(status_code=302, headers={"Location": "/auth/login"})
+
+    busy = _admission_reject(uid)
+    if busy is not None:
+        return busy
+
+    try:
+        clen = int(request.headers.get("content-length") or "0")
+        if clen and clen > _effective_body_cap():
+            eff = _effective_body_cap()
+            return Response(
+                media_type="application/json",
+                content={
+                    "ok": False,
+                    "error": "UPLOAD_TOO_LARGE",
+                    "limit": eff,
+                    "limit_label": _fmt_bytes(eff),
+                },
+                status_code=413,
+                headers=_limit_headers(),
+            )
+    except Exception:
+        pass
+
+    try:
+        form = await _read_send_form(request)
+    except Exception as e:
+        if _upstream and isinstance(e, UploadError):
+            return _upload_rejected(e)
+        msg = str(e or "")
+        lower = msg.lower()
+        too_large = any(k in lower for k in ("too large", "exceed", "payload", "request body is too large", "413"))
+        status = 413 if too_large else 400
+        eff = _effective_body_cap()
+        return Response(
+            media_type="application/json",
+            content={
+                "ok": False,
+                "error": "UPLOAD_TOO_LARGE" if too_large else "UPLOAD_PARSE_FAILED",
+                "detail": msg,
+                "limit": eff,
+                "limit_label": _fmt_bytes(eff),
+                "per_file_limit": MULTIPART_MAX_FILE_SIZE or 0,
+                "per_file_limit_label": _fmt_bytes(MULTIPART_MAX_FILE_SIZE),
+                "max_files": MULTIPART_MAX_FILES or 0,
+            },
+            status_code=status,
+            headers=_limit_headers(),
+        )
+
+    text = (form.get("text") or "").strip()
+    chat_id_raw = (form.get("chat_id") or "").strip() or None
+    incoming_tool_id = (form.get("tool_id") or "").strip() or None
+
+    main_files = _extract_files(form, "main_files", "main_files[]", "file", "files", "upload")
+    attachments = _extract_files(form, "attachments", "attachments[]")
+    all_files = list(main_files) + list(attachments)
+
+    if MULTIPART_MAX_FILES and len(all_files) > MULTIPART_MAX_FILES:
+        await _discard_form(form)
+        return Response(
+            media_type="application/json",
+            content={
+                "ok": False,
+                "error": "TOO_MANY_FILES",
+                "count": len(all_files),
+                "max_files": MULTIPART_MAX_FILES,
+                "limit": _effective_body_cap(),
+                "limit_label": _fmt_bytes(_effective_body_cap()),
+            },
+            status_code=413,
+            headers=_limit_headers(),
+        )
+
+    if not text and not all_files:
+        await _discard_form(form)
+        return Response(
+            media_type="application/json",
+            content={"ok": False, "error": "EMPTY_MESSAGE"},
+            status_code=400,
+            headers={"Cache-Control": "no-store"},
+        )
+
+    session = SessionLocal()
+    created_new_chat = False
+    message_id: Optional[str] = None
+    uploads_saved = False  # đã tạo Document tham chiếu blob → lỗi chung không tự xoá blob (có thể đã commit cùng job)
+
+    try:
+        selected_mv = _choose_model_variant(session, request)
+        if not selected_mv:
+            await _discard_form(form)
+            return Response(
+                media_type="application/json",
+                content={"ok": False, "error": "MODEL_NOT_REGISTERED", "provider_model_id": RUNPOD_DEFAULT_MODEL},
+                status_code=400,
+                headers={"Cache-Control": "no-store"},
+            )
+
+        chat_row: Optional[ChatHistory] = None
+        if chat_id_raw:
+            exist = session.get(ChatHistory, chat_id_raw)
+            if exist and exist.chat_user_id == uid and exist.chat_status == "active":
+                chat_row = exist
+
+        if not chat_row:
+            created_new_chat = True
+            chat_row = ChatHistory(  # type: ignore[call-arg]
+                chat_id=str(uuid.uuid4()),
+                chat_user_id=uid,
+                initial_model_id=selected_mv.model_id,
+                chat_status="active",
+                chat_visibility="public",
+            )
+            session.add(chat_row)
+            session.flush()
 
-            # KHÔNG chèn latest_tool_note khi đang chạy tool phân loại
-            # Chọn model/tier
-            role = _user_info(request)["role"]
-            if not auto:
-                final_tier_default = (RUNPOD_DEFAULT_REASONING or "low").lower()
-                final_tier, final_mv = final_tier_default, selected_mv
-            else:
-                final_tier, final_mv, _ = await auto.route_and_select_variant(
-                    session,
-                    user_role=role,
-                    prompt=user_override,
-                    selected_variant=selected_mv,
-                    attachments_count=len(all_files),
-                )
+        message_id = str(uuid.uuid4())
+        _set_msg_status(message_id, "pending")
 
-            msg_row = ChatMessage(  # type: ignore[call-arg]
-                message_id=message_id,
-                message_chat_id=chat_row.chat_id,
-                message_model_id=final_mv.model_id,
-                message_question=text or "Hi",
-                message_ai_response="(queued)",
-            )
-            session.add(msg_row)
-            session.commit()
+        # MEMORY (ghi nhớ / forget) xử lý trước
+        ack_prefix: Optional[str] = None
+        soft_ack_flag = False
+        if MEMORY_ENABLED and _mem and hasattr(_mem, "detect_memory_command"):
+            try:
+                det = _mem.detect_memory_command(text)
+            except Exception:
+                det = {"is_cmd": False}
 
-            await _call_provider_and_update(
-                session=session,
-                mv=final_mv,
-                chat_row=chat_row,
-                message_row=msg_row,
-                tier=final_tier,
-                user_override=user_override,
-                ack_prefix=ack_prefix,
-            )
+            if det.get("is_cmd"):
+                op = (det.get("op") or "save").lower()
+                payload = (det.get("payload") or "").strip()
+                rest = (det.get("rest") or "").strip()
 
-            return Response(
-                media_type="application/json",
-                content={
-                    "ok": True,
-                    "chat_id": chat_row.chat_id,
-                    "message_id": message_id,
-                    "created_new_chat": created_new_chat,
-                    "selected_tool_id": chosen_tool_id,
-                },
-                headers={"Cache-Control": "no-store"},
-            )
+                try:
+                    can_store_flag = _mem.can_store(session, uid) if hasattr(_mem, "can_store") else True
+                except Exception:
+                    can_store_flag = True
 
-        # ───── Luồng thường (không tool phân loại / không email update) ─────
-        if pc and hasattr(pc, "compose_user_prompt"):
-            user_override = pc.compose_user_prompt(
-                q_raw=text,
-                glb_text=glb,
-                recent_pairs=recent,
-                last_doc_text=last_doc,
-                memory_soft_ack=soft_ack_flag,
-                classification_mode=False,
-            )
-        else:
-            user_override = (
-                f"Câu hỏi hiện tại:\n{text}\n\n"
-                "[NGỮ CẢNH]\n"
-                "• Ghi nhớ cá nhân (global):\n" + (glb or "(trống)") + "\n\n"
-                "• Một số lượt trao đổi gần đây:\n" + (recent or "(trống)")
-            ).strip()
+                ack = ""
+                if op == "forget" and hasattr(_mem, "forget_global_memory"):
+                    if can_store_flag:
+                        try:
+                            ack = _mem.forget_global_memory(session, uid, payload)
+                        except Exception as e:
+                            ack = f"Đã cố gắng xoá khỏi bộ nhớ nhưng gặp lỗi: {e}"
+                    else:
+                        ack = "Tính năng ghi nhớ đang tắt cho tài khoản của bạn."
+                else:
+                    if not can_store_flag:
+                        ack = "Tính năng ghi nhớ đang tắt cho tài khoản của bạn."
+                    elif payload:
+                        try:
+                            ack = _mem.save_global_memory(session, uid, payload)
+                        except Exception as e:
+                            ack = f"Đã cố gắng ghi nhớ nhưng gặp lỗi: {e}"
+                    else:
+                        ack = "Không có gì để ghi nhớ."
 
-        # (tùy chọn) chèn chú thích tool gần nhất cho luồng thường
-        if LATEST_TOOL_NOTE_ENABLE and latest_tool_note_line:
-            user_override = _inject_latest_tool_note_block(user_override, latest_tool_note_line)
+                if not rest:
+                    action_label = "Ghi nhớ" if op != "forget" else "Quên"
+                    msg_row = ChatMessage(  # type: ignore[call-arg]
+                        message_id=message_id,
+                        message_chat_id=chat_row.chat_id,
+                        message_model_id=selected_mv.model_id,
+                        message_question=text or action_label,
+                        message_ai_response=ack,
+                        message_tokens_input=0,
+                        message_tokens_output=0,
+                    )
+                    session.add(msg_row)
+                    session.commit()
+                    await _discard_form(form)  # chỉ lệnh ghi nhớ → file kèm (nếu có) không được dùng
+                    _set_msg_status(message_id, "ready", ack)
+                    _dump_json_txt(chat_row.chat_id, message_id, "model_input.json.txt", {
+                        "memory_only": True,
+                        "ack": ack,
+                        "op": op,
+                        "ts": int(time.time()),
+                    })
+                    _dump_json_txt(chat_row.chat_id, message_id, "model_output.json.txt", {
+                        "memory_only": True,
+                        "ack": ack,
+                        "op": op,
+                        "ts": int(time.time()),
+                    })
+                    return Response(
+                        media_type="application/json",
+                        content={"ok": True, "chat_id": chat_row.chat_id, "message_id": message_id, "created_new_chat": created_new_chat},
+                        headers={"Cache-Control": "no-store"},
+                    )
+                else:
+                    ack_prefix = ack
+                    text = rest
+                    soft_ack_flag = True
 
-        # Chọn model/tier
-        role = _user_info(request)["role"]
-        if not auto:
-            final_tier_default = (RUNPOD_DEFAULT_REASONING or "low").lower()
-            final_tier, final_mv = final_tier_default, selected_mv
-        else:
-            final_tier, final_mv, _ = await auto.route_and_select_variant(
-                session,
-                user_role=role,
-                prompt=user_override,
-                selected_variant=selected_mv,
-                attachments_count=len(all_files),
-            )
+        # Lưu file (OCR/extract, ngữ cảnh, router, gọi model chạy trong job)
+        uploads_saved = True
+        docs_main = await _save_uploads(session=session, uid=uid, chat_row=chat_row, message_id=message_id, files=main_files)
+        docs_att = await _save_uploads(session=session, uid=uid, chat_row=chat_row, message_id=message_id, files=attachments)
 
         msg_row = ChatMessage(  # type: ignore[call-arg]
             message_id=message_id,
             message_chat_id=chat_row.chat_id,
-            message_model_id=final_mv.model_id,
+            message_model_id=selected_mv.model_id,
             message_question=text or "Hi",
             message_ai_response="(queued)",
         )
         session.add(msg_row)
-        session.commit()
+        session.flush()
 
-        await _call_provider_and_update(
-            session=session,
-            mv=final_mv,
-            chat_row=chat_row,
-            message_row=msg_row,
-            tier=final_tier,
-            user_override=user_override,
-            ack_prefix=ack_prefix,
-        )
+        _enqueue_job(session, kind="send", uid=uid, chat_id=chat_row.chat_id, message_id=message_id, payload={
+            "text": text,
+            "tool_id": incoming_tool_id,
+            "ack_prefix": ack_prefix,
+            "soft_ack": soft_ack_flag,
+            "uinfo": _user_info(request, session),
+            "model_id": selected_mv.model_id,
+            "files_count": len(all_files),
+            "main_names": [(getattr(f, "filename", None) or getattr(f, "name", None) or "file") for f in main_files],
+            "att_names": [(getattr(f, "filename", None) or getattr(f, "name", None) or "file") for f in attachments],
+            "main_doc_ids": [d.doc_id for d in docs_main],
+            "att_doc_ids": [d.doc_id for d in docs_att],
+        })
 
         return Response(
             media_type="application/json",
@@ -1874,13 +2632,22 @@ async def chat_api_send(request: Request) -> Response:
                 "chat_id": chat_row.chat_id,
                 "message_id": message_id,
                 "created_new_chat": created_new_chat,
-                "selected_tool_id": chosen_tool_id,
+                "selected_tool_id": incoming_tool_id,
             },
             headers={"Cache-Control": "no-store"},
         )
 
+    except jobs.AdmissionRejected as e:
+        # request song song của cùng user đã lấp trần giữa lúc kiểm tra sớm và enqueue → không commit gì
+        session.rollback()
+        await _discard_form(form)
+        if message_id:
+            _set_msg_status(message_id, "error", None, "SERVER_BUSY")
+        return _busy_response(e.admission)
     except Exception as e:
         session.rollback()
+        if not uploads_saved:
+            await _discard_form(form)  # lỗi trước khi tạo Document → blob mới chưa ai tham chiếu (còn lại: gc_blobs)
         if message_id:
             _set_msg_status(message_id, "error", None, str(e))
         logger.exception("chat_api_send failed: %s", e)
@@ -1933,6 +2700,27 @@ def chat_api_message(request: Request, message_id: str) -> Response:
                 content={"ok": True, "status": "ready", "ai_response": row.message_ai_response},
                 headers={"Cache-Control": "no-store"},
             )
+        js = jobs.state_for_message(session, message_id)
+        if js and js["status"] == "failed":
+            return Response(
+                media_type="application/json",
+                content={"ok": False, "status": "error", "error": js.get("error") or "UNKNOWN"},
+                headers={"Cache-Control": "no-store"},
+            )
+        if js:
+            st = _STREAMS.get(message_id)
+            return Response(
+                media_type="application/json",
+                content={
+                    "ok": True,
+                    "status": "pending",
+                    "job_status": js["status"],
+                    "attempts": js["attempts"],
+                    "queue_position": js.get("queue_position"),
+                    "progress": st.get("progress") if st else None,
+                },
+                headers={"Cache-Control": "no-store"},
+            )
     except SQLAlchemyError:
         pass
     finally:
@@ -1943,6 +2731,147 @@ def chat_api_message(request: Request, message_id: str) -> Response:
         headers={"Cache-Control": "no-store"},
     )
 
+def _sse(event: str, payload: dict) -> ServerSentEventMessage:
+    return ServerSentEventMessage(event=event, data=json.dumps(payload, ensure_ascii=False))
+
+def _next_db_poll(poll: float, changed: bool) -> float:
+    base = jobs.CHAT_JOB_HEARTBEAT_SEC
+    return base if changed else min(max(base, poll * 1.5), max(base, float(CHAT_STREAM_DB_POLL_MAX_SEC)))
+
+def _db_message_progress(message_id: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """(câu trả lời đã ghi, trạng thái job) — dùng khi buffer stream không nằm ở process này."""
+    session = SessionLocal()
+    try:
+        row = session.get(ChatMessage, message_id)
+        ai = (row.message_ai_response or "").strip() if row else ""
+        return ai, jobs.state_for_message(session, message_id)
+    except SQLAlchemyError:
+        return "", None
+    finally:
+        session.close()
+
+async def _sse_message_events(message_id: str) -> Any:
+    """
+    Phát lại buffer stream: `delta` (phần text mới), kết thúc bằng `done` (text cuối) hoặc `failed`.
+    Job chạy ở process khác → đọc job_partial_text (cập nhật mỗi heartbeat) cho tới khi xong.
+    Không có buffer lẫn job (message cũ) → `pending` để FE quay về poll.
+    Job retry làm text ngắn lại → gửi lại toàn bộ với `reset: true`. Job còn chờ → `queued` (vị trí hàng đợi).
+    Trước khi có text: `progress` (OCR trang N/M) — chỉ khi job chạy ở process này.
+    Đọc DB với chu kỳ giãn dần khi không có gì mới (_next_db_poll) → stream chờ lâu không poll DB mỗi heartbeat.
+    """
+    sent = 0
+    poll = jobs.CHAT_JOB_HEARTBEAT_SEC
+    last_ping = time.time()
+    last_pos: Optional[int] = None
+    last_progress: Optional[Dict[str, Any]] = None
+    while True:
+        st = _STREAMS.get(message_id)
+        if st is None:
+            ai, js = await asyncio.to_thread(_db_message_progress, message_id)
+            if ai and ai != "(queued)":
+                yield _sse("done", {"status": "ready", "ai_response": ai})
+                return
+            if not js or js["status"] in ("done", "canceled"):
+                yield _sse("pending", {"status": "pending"})
+                return
+            if js["status"] == "failed":
+                yield _sse("failed", {"status": "error", "error": js.get("error") or "UNKNOWN"})
+                return
+            changed = False
+            pos = js.get("queue_position")
+            if js["status"] == "queued" and pos != last_pos:
+                yield _sse("queued", {"status": "pending", "queue_position": pos})
+                last_pos = pos
+                last_ping = time.time()
+                changed = True
+            partial = js.get("partial_text") or ""
+            if len(partial) < sent:
+                yield _sse("delta", {"delta": partial, "reset": True})
+                sent = len(partial)
+                last_ping = time.time()
+                changed = True
+            elif len(partial) > sent:
+                yield _sse("delta", {"delta": partial[sent:]})
+                sent = len(partial)
+                last_ping = time.time()
+                changed = True
+            elif time.time() - last_ping >= CHAT_STREAM_KEEPALIVE_SEC:
+                yield ServerSentEventMessage(comment="keep-alive")
+                last_ping = time.time()
+            poll = _next_db_poll(poll, changed)
+            await asyncio.sleep(poll)
+            continue
+
+        progress = st.get("progress")
+        if progress is not None and progress is not last_progress and not st["text"]:
+            yield _sse("progress", {"status": "pending", **progress})
+            last_progress = progress
+        text = st["text"]
+        if st["done"]:
+            if st["error"]:
+                yield _sse("failed", {"status": "error", "error": st["error"]})
+            else:
+                yield _sse("done", {"status": "ready", "ai_response": text})
+            return
+        if len(text) < sent:
+            yield _sse("delta", {"delta": text, "reset": True})
+            sent = len(text)
+        elif len(text) > sent:
+            yield _sse("delta", {"delta": text[sent:]})
+            sent = len(text)
+
+        fut = asyncio.get_running_loop().create_future()
+        st["waiters"].append(fut)
+        try:
+            await asyncio.wait_for(fut, timeout=CHAT_STREAM_KEEPALIVE_SEC)
+        except asyncio.TimeoutError:
+            yield ServerSentEventMessage(comment="keep-alive")
+
+@get("/chat/api/message/{message_id:str}/stream")
+async def chat_api_message_stream(request: Request, message_id: str) -> Response:
+    uid = get_secure_cookie(request)
+    if not uid:
+        return Response(
+            media_type="application/json",
+            content={"ok": False, "error": "AUTH_REQUIRED"},
+            status_code=403,
+            headers={"Cache-Control": "no-store"},
+        )
+    # chỉ stream khi xác minh được chủ sở hữu: thiếu message / chat → 404, khác user → 403, DB lỗi → 503
+    session = SessionLocal()
+    try:
+        row = session.get(ChatMessage, message_id)
+        chat = session.get(ChatHistory, row.message_chat_id) if row else None
+    except SQLAlchemyError as e:
+        session.rollback()
+        logger.warning("stream ownership check failed (msg=%s): %s", message_id, e)
+        return Response(
+            media_type="application/json",
+            content={"ok": False, "error": "DB_UNAVAILABLE"},
+            status_code=503,
+            headers={"Cache-Control": "no-store", "Retry-After": "5"},
+        )
+    finally:
+        session.close()
+    if row is None or chat is None:
+        return Response(
+            media_type="application/json",
+            content={"ok": False, "error": "NOT_FOUND"},
+            status_code=404,
+            headers={"Cache-Control": "no-store"},
+        )
+    if chat.chat_user_id != uid:
+        return Response(
+            media_type="application/json",
+            content={"ok": False, "error": "FORBIDDEN"},
+            status_code=403,
+            headers={"Cache-Control": "no-store"},
+        )
+    return ServerSentEvent(
+        _sse_message_events(message_id),
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+
 @post("/chat/api/message/{message_id:str}/edit")
 async def chat_api_edit(request: Request, message_id: str) -> Response:
     uid = get_secure_cookie(request)
@@ -1953,6 +2882,9 @@ async def chat_api_edit(request: Request, message_id: str) -> Response:
             status_code=403,
             headers={"Cache-Control": "no-store"},
         )
+    busy = _admission_reject(uid)
+    if busy is not None:
+        return busy
     try:
         form = await request.form()
     except Exception:
@@ -2000,73 +2932,25 @@ async def chat_api_edit(request: Request, message_id: str) -> Response:
                 headers={"Cache-Control": "no-store"},
             )
 
-        glb = ""
-        if MEMORY_ENABLED and _mem and hasattr(_mem, "get_global_memory_text"):
-            try:
-                glb = _mem.get_global_memory_text(session, uid) or ""
-            except Exception:
-                glb = ""
-
-        recent = _recent_chat_transcript(session, chat_row.chat_id, CHAT_RECENT_CONTEXT_CHARS, CHAT_RECENT_CONTEXT_MAX_MSGS)
-        last_doc = ""
-        if pc and hasattr(pc, "latest_doc_text"):
-            try:
-                last_doc = pc.latest_doc_text(session, chat_row.chat_id, include_header=True) or ""
-            except Exception:
-                last_doc = ""
-
-        if pc and hasattr(pc, "compose_user_prompt"):
-            user_override = pc.compose_user_prompt(
-                q_raw=new_text,
-                glb_text=glb,
-                recent_pairs=recent,
-                last_doc_text=last_doc,
-            )
-        else:
-            user_override = (
-                "Câu hỏi hiện tại:\n"
-                f"{new_text}\n\n"
-                "[DỮ LIỆU TRƯỚC ĐÓ]\n"
-                "• Bộ nhớ cá nhân (global):\n"
-                f"{glb or '(trống)'}\n\n"
-                "• Các tin nhắn gần đây:\n"
-                f"{recent or '(trống)'}"
-            ).strip()
-
-        role = _user_info(request)["role"]
-        if not auto:
-            final_tier_default = (RUNPOD_DEFAULT_REASONING or "low").lower()
-            final_tier, final_mv = final_tier_default, selected_mv
-        else:
-            final_tier, final_mv, _ = await auto.route_and_select_variant(
-                session,
-                user_role=role,
-                prompt=user_override,
-                selected_variant=selected_mv,
-                attachments_count=0,
-            )
-
-        old_msg.message_model_id = final_mv.model_id
+        old_msg.message_model_id = selected_mv.model_id
         old_msg.message_question = new_text
         old_msg.message_ai_response = "(queued)"
         old_msg.message_tokens_input = 0
         old_msg.message_tokens_output = 0
-        session.commit()
-        _set_msg_status(message_id, "pending")
+        session.flush()
 
-        await _call_provider_and_update(
-            session=session,
-            mv=final_mv,
-            chat_row=chat_row,
-            message_row=old_msg,
-            tier=final_tier,
-            user_override=user_override,
-        )
+        _enqueue_job(session, kind="edit", uid=uid, chat_id=chat_row.chat_id, message_id=message_id, payload={
+            "role": _user_info(request, session)["role"],
+            "model_id": selected_mv.model_id,
+        })
         return Response(
             media_type="application/json",
             content={"ok": True, "chat_id": chat_row.chat_id, "message_id": message_id, "in_place": True},
             headers={"Cache-Control": "no-store"},
         )
+    except jobs.AdmissionRejected as e:
+        session.rollback()  # message giữ nguyên nội dung cũ, lượt cũ (nếu có) không bị huỷ
+        return _busy_response(e.admission)
     except Exception as e:
         session.rollback()
         _set_msg_status(message_id, "error", None, str(e))
@@ -2090,6 +2974,9 @@ async def chat_api_regenerate(request: Request, message_id: str) -> Response:
             status_code=403,
             headers={"Cache-Control": "no-store"},
         )
+    busy = _admission_reject(uid)
+    if busy is not None:
+        return busy
     try:
         form = await request.form()
     except Exception:
@@ -2139,77 +3026,25 @@ async def chat_api_regenerate(request: Request, message_id: str) -> Response:
                 headers={"Cache-Control": "no-store"},
             )
 
-        current = msg.message_question or ""
-        if regen_hint:
-            current = f"{current}\n\n[HƯỚNG DẪN REGENERATE]\n{regen_hint}"
-
-        glb = ""
-        if MEMORY_ENABLED and _mem and hasattr(_mem, "get_global_memory_text"):
-            try:
-                glb = _mem.get_global_memory_text(session, uid) or ""
-            except Exception:
-                glb = ""
-
-        recent = _recent_chat_transcript(session, chat_row.chat_id, CHAT_RECENT_CONTEXT_CHARS, CHAT_RECENT_CONTEXT_MAX_MSGS)
-        last_doc = ""
-        if pc and hasattr(pc, "latest_doc_text"):
-            try:
-                last_doc = pc.latest_doc_text(session, chat_row.chat_id, include_header=True) or ""
-            except Exception:
-                last_doc = ""
-
-        if pc and hasattr(pc, "compose_user_prompt"):
-            user_override = pc.compose_user_prompt(
-                q_raw=current,
-                glb_text=glb,
-                recent_pairs=recent,
-                last_doc_text=last_doc,
-                extra_instructions=regen_hint if regen_hint else None,
-            )
-        else:
-            user_override = (
-                "Câu hỏi hiện tại:\n"
-                f"{current}\n\n"
-                "[DỮ LIỆU TRƯỚC ĐÓ]\n"
-                "• Bộ nhớ cá nhân (global):\n"
-                f"{glb or '(trống)'}\n\n"
-                "• Các tin nhắn gần đây:\n"
-                f"{recent or '(trống)'}"
-            ).strip()
-
-        role = _user_info(request)["role"]
-        if not auto:
-            final_tier_default = (RUNPOD_DEFAULT_REASONING or "low").lower()
-            final_tier, final_mv = final_tier_default, selected_mv
-        else:
-            final_tier, final_mv, _ = await auto.route_and_select_variant(
-                session,
-                user_role=role,
-                prompt=user_override,
-                selected_variant=selected_mv,
-                attachments_count=0,
-            )
-
-        msg.message_model_id = final_mv.model_id
+        msg.message_model_id = selected_mv.model_id
         msg.message_ai_response = "(queued)"
         msg.message_tokens_input = 0
         msg.message_tokens_output = 0
-        session.commit()
-        _set_msg_status(message_id, "pending")
+        session.flush()
 
-        await _call_provider_and_update(
-            session=session,
-            mv=final_mv,
-            chat_row=chat_row,
-            message_row=msg,
-            tier=final_tier,
-            user_override=user_override,
-        )
+        _enqueue_job(session, kind="regenerate", uid=uid, chat_id=chat_row.chat_id, message_id=message_id, payload={
+            "role": _user_info(request, session)["role"],
+            "model_id": selected_mv.model_id,
+            "regen_hint": regen_hint,
+        })
         return Response(
             media_type="application/json",
             content={"ok": True, "chat_id": chat_row.chat_id, "message_id": message_id, "in_place": True},
             headers={"Cache-Control": "no-store"},
         )
+    except jobs.AdmissionRejected as e:
+        session.rollback()  # message giữ nguyên nội dung cũ, lượt cũ (nếu có) không bị huỷ
+        return _busy_response(e.admission)
     except Exception as e:
         session.rollback()
         _set_msg_status(message_id, "error", None, str(e))
@@ -2281,6 +3116,10 @@ async def chat_api_cancel(request: Request) -> Response:
             if not chat or chat.chat_user_id != uid:
                 continue
             _mark_cancel(mid)
+            try:
+                jobs.request_cancel(session, [mid])
+            except SQLAlchemyError:
+                session.rollback()
             if (row.message_ai_response or "").strip() in ("", "(queued)"):
                 row.message_ai_response = "(canceled)"
                 row.message_tokens_input = 0
@@ -0,0 +1,302 @@
+# file: src/modules/chat/service/auto_tier_local.py
+# updated: 2025-09-29 (v1.0.1)
+# changes (v1.0.1):
+#   - Log quyết định chuyển sang opt-in: AUTO_TIER_LOG_PATH mặc định rỗng (không ghi prompt người dùng ra đĩa
+#     nếu không bật); file log bị giới hạn AUTO_TIER_LOG_MAX_BYTES → xoay sang <path>.1 (giữ 1 bản cũ).
+#   - train() đọc cả <path>.1 + <path>; thiếu đường dẫn log → lỗi rõ ràng.
+# purpose:
+#   - Router tier (low/medium/high) chạy LOCAL trên CPU cho chat_auto_tier → bỏ 1 lượt gọi LLM nối tiếp
+#     trước lượt gọi thật ở phần lớn tin nhắn
+#       * Cache LRU quyết định theo hash prompt đã chuẩn hoá (regenerate / gửi lại / prompt trùng → 0 ms)
+#       * Bộ phân loại scikit-learn (TF-IDF char n-gram + LogisticRegression) học từ các quyết định của
+#         LLM router đã ghi log; chỉ hỏi LLM router khi độ tin cậy < AUTO_TIER_LOCAL_MIN_CONF
+#   - Ghi log quyết định của LLM router (JSONL) làm dữ liệu huấn luyện
+#
+# ENV:
+#   AUTO_TIER_CACHE_SIZE=2048                       # 0 = tắt cache
+#   AUTO_TIER_LOCAL_ENABLED=1
+#   AUTO_TIER_LOCAL_MODEL=models/auto_tier.pkl      # file model đã train (tự reload khi đổi mtime)
+#   AUTO_TIER_LOCAL_MIN_CONF=0.80
+#   AUTO_TIER_LOG_PATH=                             # vd. logs/auto_tier_decisions.jsonl; rỗng (mặc định) = không ghi log
+#   AUTO_TIER_LOG_MAX_BYTES=52428800                # vượt → xoay sang <path>.1; 0 = không giới hạn
+#   AUTO_TIER_LOG_MAX_CHARS=4000                    # cắt prompt khi ghi log
+#   AUTO_TIER_TRAIN_MIN_SAMPLES=200
+#
+# Train (từ thư mục src):
+#   python -m modules.chat.service.auto_tier_local --train [--log PATH] [--out PATH]
+#
+# Ghi chú:
+#   - scikit-learn là optional: thiếu → bỏ qua bước local (vẫn có cache + LLM router như cũ).
+#   - Hàm ở đây đều đồng bộ (đọc model, ghi file) → caller async chạy qua asyncio.to_thread.
+
+from __future__ import annotations
+
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import hashlib
+import logging
+import threading
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger("docaix.auto_tier_local")
+
+try:
+    from sklearn.feature_extraction.text import TfidfVectorizer  # type: ignore
+    from sklearn.linear_model import LogisticRegression  # type: ignore
+    from sklearn.model_selection import train_test_split  # type: ignore
+    from sklearn.pipeline import make_pipeline  # type: ignore
+except Exception:  # pragma: no cover
+    TfidfVectorizer = None  # type: ignore
+    LogisticRegression = None  # type: ignore
+    train_test_split = None  # type: ignore
+    make_pipeline = None  # type: ignore
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = os.getenv(name, "")
+        return int(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        v = os.getenv(name, "")
+        return float(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+AUTO_TIER_CACHE_SIZE = max(0, _env_int("AUTO_TIER_CACHE_SIZE", 2048))
+AUTO_TIER_LOCAL_ENABLED = (os.getenv("AUTO_TIER_LOCAL_ENABLED", "1").strip() != "0")
+AUTO_TIER_LOCAL_MODEL = os.getenv("AUTO_TIER_LOCAL_MODEL", os.path.join("models", "auto_tier.pkl")).strip()
+AUTO_TIER_LOCAL_MIN_CONF = _env_float("AUTO_TIER_LOCAL_MIN_CONF", 0.80)
+AUTO_TIER_LOG_PATH = os.getenv("AUTO_TIER_LOG_PATH", "").strip()
+AUTO_TIER_LOG_MAX_BYTES = max(0, _env_int("AUTO_TIER_LOG_MAX_BYTES", 50 * 1024 * 1024))
+AUTO_TIER_LOG_MAX_CHARS = max(200, _env_int("AUTO_TIER_LOG_MAX_CHARS", 4000))
+AUTO_TIER_TRAIN_MIN_SAMPLES = max(20, _env_int("AUTO_TIER_TRAIN_MIN_SAMPLES", 200))
+
+_TIERS = ("low", "medium", "high")
+_MAX_INPUT_CHARS = 8000   # khớp phần prompt mà LLM router được xem
+
+
+# ───────────────── normalize / key ─────────────────
+def normalize_prompt(prompt: str) -> str:
+    s = (prompt or "")[:_MAX_INPUT_CHARS].lower()
+    return re.sub(r"\s+", " ", s).strip()
+
+
+def prompt_key(prompt: str) -> str:
+    return hashlib.sha1(normalize_prompt(prompt).encode("utf-8", "ignore")).hexdigest()
+
+
+# ───────────────── decision cache ─────────────────
+_CACHE_LOCK = threading.Lock()
+_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_STATS: Counter = Counter()
+
+
+def cached_tier(key: str) -> Optional[str]:
+    if AUTO_TIER_CACHE_SIZE <= 0:
+        return None
+    with _CACHE_LOCK:
+        tier = _CACHE.get(key)
+        if tier is not None:
+            _CACHE.move_to_end(key)
+            _STATS["cache_hit"] += 1
+        return tier
+
+
+def remember(key: str, tier: str, source: str) -> None:
+    _STATS[source] += 1
+    if AUTO_TIER_CACHE_SIZE <= 0 or tier not in _TIERS:
+        return
+    with _CACHE_LOCK:
+        _CACHE[key] = tier
+        _CACHE.move_to_end(key)
+        while len(_CACHE) > AUTO_TIER_CACHE_SIZE:
+            _CACHE.popitem(last=False)
+
+
+def stats() -> Dict[str, int]:
+    with _CACHE_LOCK:
+        return {"cache_size": len(_CACHE), **dict(_STATS)}
+
+
+# ───────────────── decision log (dữ liệu train) ─────────────────
+_LOG_LOCK = threading.Lock()
+
+
+def _rotate_log(incoming: int) -> None:
+    """Gọi dưới _LOG_LOCK: file sắp vượt AUTO_TIER_LOG_MAX_BYTES → đổi tên thành <path>.1 (ghi đè bản cũ hơn)."""
+    if AUTO_TIER_LOG_MAX_BYTES <= 0:
+        return
+    try:
+        size = os.path.getsize(AUTO_TIER_LOG_PATH)
+    except OSError:
+        return
+    if size + incoming > AUTO_TIER_LOG_MAX_BYTES:
+        os.replace(AUTO_TIER_LOG_PATH, AUTO_TIER_LOG_PATH + ".1")
+
+
+def log_decision(prompt: str, tier: str, source: str = "llm") -> None:
+    """Ghi 1 dòng JSONL (chỉ khi bật AUTO_TIER_LOG_PATH). Ghi file đồng bộ → gọi từ thread, không từ event loop."""
+    if not AUTO_TIER_LOG_PATH or tier not in _TIERS:
+        return
+    rec = {
+        "ts": int(time.time()),
+        "tier": tier,
+        "source": source,
+        "prompt": (prompt or "")[:AUTO_TIER_LOG_MAX_CHARS],
+    }
+    line = json.dumps(rec, ensure_ascii=False) + "\n"
+    try:
+        with _LOG_LOCK:
+            os.makedirs(os.path.dirname(os.path.abspath(AUTO_TIER_LOG_PATH)), exist_ok=True)
+            _rotate_log(len(line.encode("utf-8")))
+            with open(AUTO_TIER_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(line)
+    except Exception as e:
+        logger.debug("cannot write router log: %s", e)
+
+
+# ───────────────── local model ─────────────────
+_MODEL_LOCK = threading.Lock()
+_MODEL: Dict[str, Any] = {"mtime": None, "clf": None}
+
+
+def _load_model() -> Any:
+    """Load lười + reload khi file model đổi mtime (train lại không cần restart)."""
+    if not (AUTO_TIER_LOCAL_ENABLED and AUTO_TIER_LOCAL_MODEL):
+        return None
+    try:
+        mtime = os.path.getmtime(AUTO_TIER_LOCAL_MODEL)
+    except OSError:
+        return None
+    if _MODEL["mtime"] == mtime:
+        return _MODEL["clf"]
+    with _MODEL_LOCK:
+        if _MODEL["mtime"] != mtime:
+            try:
+                with open(AUTO_TIER_LOCAL_MODEL, "rb") as f:
+                    _MODEL["clf"] = pickle.load(f)
+                logger.info("auto-tier local model loaded: %s", AUTO_TIER_LOCAL_MODEL)
+            except Exception as e:
+                logger.warning("cannot load auto-tier model %s: %s", AUTO_TIER_LOCAL_MODEL, e)
+                _MODEL["clf"] = None
+            _MODEL["mtime"] = mtime
+    return _MODEL["clf"]
+
+
+def predict(prompt: str) -> Optional[Tuple[str, float]]:
+    """(tier, độ tin cậy) từ model local; None nếu chưa có model / lỗi."""
+    clf = _load_model()
+    if clf is None:
+        return None
+    try:
+        proba = clf.predict_proba([normalize_prompt(prompt)])[0]
+        i = max(range(len(proba)), key=lambda j: proba[j])
+        return str(clf.classes_[i]), float(proba[i])
+    except Exception as e:
+        logger.debug("auto-tier local predict failed: %s", e)
+        return None
+
+
+def local_decision(prompt: str) -> Optional[str]:
+    """Tier nếu model local đủ tự tin (>= AUTO_TIER_LOCAL_MIN_CONF), ngược lại None → hỏi LLM router."""
+    res = predict(prompt)
+    if res is None:
+        return None
+    tier, conf = res
+    if tier in _TIERS and conf >= AUTO_TIER_LOCAL_MIN_CONF:
+        return tier
+    _STATS["local_low_conf"] += 1
+    return None
+
+
+# ───────────────── train ─────────────────
+def train(log_path: str = AUTO_TIER_LOG_PATH, out_path: str = AUTO_TIER_LOCAL_MODEL) -> Dict[str, Any]:
+    if make_pipeline is None:
+        raise RuntimeError("scikit-learn chưa cài (pip install scikit-learn)")
+    if not log_path:
+        raise RuntimeError("chưa có log quyết định: đặt AUTO_TIER_LOG_PATH (hoặc --log PATH)")
+    texts, labels = [], []
+    paths = [p for p in (log_path + ".1", log_path) if os.path.exists(p)]
+    if not paths:
+        raise RuntimeError(f"không tìm thấy log: {log_path}")
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    continue
+                if rec.get("source") != "llm" or rec.get("tier") not in _TIERS:
+                    continue
+                texts.append(normalize_prompt(rec.get("prompt") or ""))
+                labels.append(rec["tier"])
+    if len(texts) < AUTO_TIER_TRAIN_MIN_SAMPLES or len(set(labels)) < 2:
+        raise RuntimeError(f"chưa đủ dữ liệu: {len(texts)} mẫu, {len(set(labels))} lớp")
+
+    def _pipe() -> Any:
+        return make_pipeline(
+            TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 4), min_df=2, sublinear_tf=True, max_features=200_000),
+            LogisticRegression(max_iter=2000, class_weight="balanced"),
+        )
+
+    report: Dict[str, Any] = {"samples": len(texts), "classes": dict(Counter(labels))}
+    try:
+        x_tr, x_te, y_tr, y_te = train_test_split(texts, labels, test_size=0.2, random_state=0, stratify=labels)
+        held = _pipe().fit(x_tr, y_tr)
+        proba = held.predict_proba(x_te)
+        conf_hits = [(held.classes_[max(range(len(p)), key=lambda j: p[j])], max(p)) for p in proba]
+        covered = [(t, y) for (t, c), y in zip(conf_hits, y_te) if c >= AUTO_TIER_LOCAL_MIN_CONF]
+        report["holdout_accuracy"] = round(float(held.score(x_te, y_te)), 4)
+        report["holdout_coverage"] = round(len(covered) / max(1, len(y_te)), 4)
+        report["holdout_covered_accuracy"] = round(sum(t == y for t, y in covered) / max(1, len(covered)), 4)
+    except ValueError as e:
+        report["holdout"] = f"skipped: {e}"
+
+    clf = _pipe().fit(texts, labels)
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(clf, f)
+    os.replace(tmp, out_path)
+    report["model"] = out_path
+    return report
+
+
+__all__ = [
+    "normalize_prompt",
+    "prompt_key",
+    "cached_tier",
+    "remember",
+    "log_decision",
+    "predict",
+    "local_decision",
+    "train",
+    "stats",
+]
+
+
+if __name__ == "__main__":  # pragma: no cover
+    import argparse
+    ap = argparse.ArgumentParser(description="DocAIx auto-tier — train local router")
+    ap.add_argument("--train", action="store_true")
+    ap.add_argument("--log", default=AUTO_TIER_LOG_PATH)
+    ap.add_argument("--out", default=AUTO_TIER_LOCAL_MODEL)
+    args = ap.parse_args()
+    if not args.train:
+        ap.error("Thiếu --train")
+    try:
+        print(json.dumps(train(args.log, args.out), ensure_ascii=False, indent=2))
+    except Exception as e:
+        print(f"[auto_tier_local] train failed: {e}", file=sys.stderr)
+        sys.exit(1)
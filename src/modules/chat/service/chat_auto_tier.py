@@ -1,5 +1,16 @@
 # file: src/modules/chat/service/chat_auto_tier.py
-# updated: 2025-09-02 (v1.1.0)
+# updated: 2025-09-29 (v1.3.1)
+# changes (v1.3.1):
+#   - decide_reasoning_auto: router local (đọc / reload model, predict) và ghi log quyết định chạy qua
+#     asyncio.to_thread → không chặn event loop.
+#
+# changes (v1.3.0):
+#   - Router local trước LLM router (modules/chat/service/auto_tier_local.py): cache LRU quyết định theo hash prompt
+#     chuẩn hoá → bộ phân loại scikit-learn học từ log quyết định LLM → chỉ gọi LLM router khi độ tin cậy thấp.
+#   - Quyết định của LLM router được ghi log (JSONL) làm dữ liệu train.
+#
+# changes (v1.2.0):
+#   - LLM router gọi qua shared.llm_client (pool dùng chung, endpoint "router") thay vì OpenAI sync + executor.
 # purpose:
 #   - Router 2-pass cho reasoning tier (low/medium/high) + chọn ModelVariant tương ứng từ DB
 #   - Ưu tiên "cùng họ" với model người dùng đang chọn (provider_model_id / model_provider)
@@ -17,16 +28,20 @@ import os
 import re
 import math
 import asyncio
-from typing import TYPE_CHECKING, Optional, Tuple, List, Any
-
-# Type-only imports
-if TYPE_CHECKING:
-    from openai import OpenAI as OpenAIClient
-else:
-    OpenAIClient = Any  # type: ignore[assignment,misc]
+from typing import Optional, Tuple, List, Any
 
 from core.db.models import ModelVariant
 
+try:
+    from shared import llm_client as llm  # type: ignore
+except Exception:
+    llm = None  # type: ignore
+
+try:
+    from modules.chat.service import auto_tier_local as _local  # type: ignore
+except Exception:
+    _local = None  # type: ignore
+
 # ─────────────────────────────────────────────────────────────────────────────
 # ENV & helpers
 # ─────────────────────────────────────────────────────────────────────────────
@@ -62,27 +77,10 @@ LENGTH_HIGH_THRESHOLD_CHARS = _env_int("LENGTH_HIGH_THRESHOLD_CHARS", 1000)   #
 VERY_LONG_THRESHOLD_CHARS   = _env_int("VERY_LONG_THRESHOLD_CHARS", 8000)    # safety
 
 # ─────────────────────────────────────────────────────────────────────────────
-# OpenAI/Runpod client (lazy)
+# LLM router (pool dùng chung shared.llm_client)
 # ─────────────────────────────────────────────────────────────────────────────
-_client: Optional[OpenAIClient] = None
-def _get_client() -> Optional[OpenAIClient]:
-    global _client
-    if _client is not None:
-        return _client
-    if not AUTO_TIER_ENABLED or not RUNPOD_BASE_URL or not RUNPOD_API_KEY:
-        return None
-    try:
-        from openai import OpenAI as SDKOpenAI  # type: ignore
-    except Exception:
-        return None
-    base_url = RUNPOD_BASE_URL.rstrip("/")
-    if not base_url.endswith("/v1"):
-        base_url += "/v1"
-    try:
-        _client = SDKOpenAI(base_url=base_url, api_key=RUNPOD_API_KEY, timeout=RUNPOD_TIMEOUT)  # type: ignore
-        return _client
-    except Exception:
-        return None
+def _router_available() -> bool:
+    return bool(AUTO_TIER_ENABLED and RUNPOD_BASE_URL and RUNPOD_API_KEY and llm is not None)
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Tier helpers
@@ -218,73 +216,94 @@ _ROUTER_SYS = (
     " - Has ```code``` block OR length >= 1000 OR mentions *.pdf/*.doc(x) -> high\n"
 )
 
+def _router_request(prompt: str) -> dict:
+    return {
+        "model": (AUTO_TIER_ROUTER_MODEL or RUNPOD_DEFAULT_MODEL),
+        "messages": [
+            {"role": "system", "content": _ROUTER_SYS},
+            {"role": "user", "content": (prompt or "")[:8000]},  # cho router xem đủ ngữ cảnh & file names
+        ],
+        "temperature": 0,
+        "max_tokens": AUTO_TIER_ROUTER_MAXTOK,
+    }
+
+def _tier_from_router_output(resp: Any, prompt: str) -> str:
+    out = (resp.choices[0].message.content or "").strip().lower()
+    tier = "low"
+    if "high" in out:
+        tier = "high"
+    elif "medium" in out or "med" in out:
+        tier = "medium"
+    # HARD rules lần nữa (phòng LLM phán thấp)
+    if _force_high_rules(prompt):
+        return "high"
+    return tier
+
+def _decide_local(prompt: str) -> Tuple[Optional[str], Optional[str]]:
+    """(tier, cache key): cache LRU → model local đủ tự tin; tier None → cần hỏi LLM router."""
+    if _local is None:
+        return None, None
+    try:
+        key = _local.prompt_key(prompt)
+        tier = _local.cached_tier(key)
+        if tier:
+            return tier, key
+        tier = _local.local_decision(prompt)
+        if tier:
+            _local.remember(key, tier, "local")
+        return tier, key
+    except Exception:
+        return None, None
+
+def _remember_router(prompt: str, key: Optional[str], tier: str) -> None:
+    if _local is None:
+        return
+    try:
+        if key:
+            _local.remember(key, tier, "llm")
+        _local.log_decision(prompt, tier, "llm")
+    except Exception:
+        pass
+
 async def decide_reasoning_auto(prompt: str) -> str:
     if not AUTO_TIER_ENABLED:
         return "low"
     # HARD rules override trước khi gọi LLM để khỏi tốn call
     if _force_high_rules(prompt):
         return "high"
-
-    client = _get_client()
-    if client is None:
+    tier, key = None, None
+    if _local is not None:
+        tier, key = await asyncio.to_thread(_decide_local, prompt)
+    if tier:
+        return tier
+    if not _router_available():
         return classify_reasoning_heuristic(prompt)
-
-    def _call() -> str:
-        try:
-            resp = client.chat.completions.create(  # type: ignore[attr-defined]
-                model=(AUTO_TIER_ROUTER_MODEL or RUNPOD_DEFAULT_MODEL),
-                messages=[
-                    {"role": "system", "content": _ROUTER_SYS},
-                    {"role": "user", "content": (prompt or "")[:8000]},  # cho router xem đủ ngữ cảnh & file names
-                ],
-                temperature=0,
-                max_tokens=AUTO_TIER_ROUTER_MAXTOK,
-            )
-            out = (resp.choices[0].message.content or "").strip().lower()
-            tier = "low"
-            if "high" in out:
-                tier = "high"
-            elif "medium" in out or "med" in out:
-                tier = "medium"
-            # HARD rules lần nữa (phòng LLM phán thấp)
-            if _force_high_rules(prompt):
-                return "high"
-            return tier
-        except Exception:
-            return classify_reasoning_heuristic(prompt)
-
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, _call)
+    try:
+        resp = await llm.chat_completion("router", **_router_request(prompt))  # type: ignore[union-attr]
+        tier = _tier_from_router_output(resp, prompt)
+    except Exception:
+        return classify_reasoning_heuristic(prompt)
+    if _local is not None:
+        await asyncio.to_thread(_remember_router, prompt, key, tier)
+    return tier
 
 def decide_reasoning_auto_sync(prompt: str) -> str:
     if not AUTO_TIER_ENABLED:
         return "low"
     if _force_high_rules(prompt):
         return "high"
-    client = _get_client()
-    if client is None:
+    tier, key = _decide_local(prompt)
+    if tier:
+        return tier
+    if not _router_available():
         return classify_reasoning_heuristic(prompt)
     try:
-        resp = client.chat.completions.create(  # type: ignore[attr-defined]
-            model=(AUTO_TIER_ROUTER_MODEL or RUNPOD_DEFAULT_MODEL),
-            messages=[
-                {"role": "system", "content": _ROUTER_SYS},
-                {"role": "user", "content": (prompt or "")[:8000]},
-            ],
-            temperature=0,
-            max_tokens=AUTO_TIER_ROUTER_MAXTOK,
-        )
-        out = (resp.choices[0].message.content or "").strip().lower()
-        tier = "low"
-        if "high" in out:
-            tier = "high"
-        elif "medium" in out or "med" in out:
-            tier = "medium"
-        if _force_high_rules(prompt):
-            return "high"
-        return tier
+        resp = llm.chat_completion_sync("router", **_router_request(prompt))  # type: ignore[union-attr]
+        tier = _tier_from_router_output(resp, prompt)
     except Exception:
         return classify_reasoning_heuristic(prompt)
+    _remember_router(prompt, key, tier)
+    return tier
 
 # ─────────────────────────────────────────────────────────────────────────────
 # DB selection helpers
@@ -424,7 +443,7 @@ def route_and_select_variant_sync(
 ) -> Tuple[str, ModelVariant, str]:
     requested_tier = normalize_tier(getattr(selected_variant, "model_tier", None)) or RUNPOD_DEFAULT_REASONING
     if requested_tier == "auto":
-        if AUTO_TIER_ENABLED and _get_client() is not None:
+        if _router_available():
             tier = decide_reasoning_auto_sync(prompt)
         else:
             tier = classify_reasoning_heuristic(prompt, attachments_count=attachments_count)
@@ -0,0 +1,676 @@
+# file: src/modules/chat/service/chat_jobs.py
+# updated: 2025-09-29 (v1.1.2)
+# changes (v1.1.2):
+#   - Admission nguyên tử: enqueue() đếm + insert dưới pg_advisory_xact_lock theo user trong CÙNG transaction với
+#     job mới → N request song song của 1 user không cùng lọt qua trần (trước đây admit() và enqueue() là 2
+#     transaction riêng). Vượt trần → AdmissionRejected (caller rollback, trả 429). admit() không khoá vẫn dùng
+#     làm kiểm tra sớm trước khi đọc body upload.
+#   - CHAT_JOB_MAX_RUNNING mặc định 8 (trước: 0 = không giới hạn).
+#
+# changes (v1.1.1):
+#   - Job bị huỷ riêng lẻ (cancel / edit-regenerate thay thế lượt cũ) khi đang chạy không còn làm chết vòng worker:
+#     run_job tự xử lý CancelledError của job → đánh dấu canceled rồi claim tiếp; chỉ re-raise khi chính
+#     worker đang bị dừng (shutdown). _worker_slot log + nuốt lỗi bất ngờ của 1 job thay vì thoát vòng.
+#   - complete(..., canceled=True): ghi canceled kể cả khi cờ mới chỉ có trong RAM (chưa qua heartbeat).
+#
+# changes (v1.1.0):
+#   - Admission control: giới hạn job chờ/chạy theo user và tổng hàng đợi → send/edit/regenerate trả 429
+#     + Retry-After thay vì xếp hàng vô hạn.
+#   - Claim công bằng: round-robin theo user (ROW_NUMBER theo user), trần job đang chạy mỗi user và
+#     toàn hệ thống (mọi worker) — claim tuần tự hoá bằng pg_advisory_xact_lock nên đếm không bị vượt.
+#   - Vị trí trong hàng đợi (queue_position) theo đúng thứ tự claim.
+#
+# purpose:
+#   - Hàng đợi job bền trên Postgres cho pipeline chat (send / edit / regenerate)
+#   - HTTP handler chỉ lưu upload + tạo message "(queued)" + enqueue → trả message_id ngay
+#   - Worker (nhúng trong web process hoặc process riêng: modules/worker/chat_worker.py) claim job bằng
+#     SELECT … FOR UPDATE SKIP LOCKED → nhiều process/host chạy song song không giẫm chân nhau
+#   - Heartbeat định kỳ: gia hạn lease + ghi partial text (SSE ở process khác đọc được) + đọc cờ cancel
+#   - Lỗi → retry với backoff (tối đa job_max_attempts); worker chết giữa chừng → job "running" quá
+#     CHAT_JOB_STALE_SEC không heartbeat sẽ được claim lại (chạy lại từ đầu)
+#
+# ENV:
+#   CHAT_JOB_MAX_ATTEMPTS=3
+#   CHAT_JOB_STALE_SEC=120            # running mà không heartbeat quá ngưỡng → claim lại
+#   CHAT_JOB_HEARTBEAT_SEC=2          # chu kỳ heartbeat / flush partial text
+#   CHAT_JOB_RETRY_BASE_SEC=5         # backoff: base * 2^(attempt-1)
+#   CHAT_JOB_POLL_SEC=1               # worker rảnh → chờ bao lâu rồi claim lại
+#   CHAT_JOB_EMBEDDED_WORKERS=1       # số vòng worker chạy trong web process (0 = chỉ dùng worker riêng)
+#   CHAT_JOB_MAX_RUNNING=8            # trần job running toàn hệ thống (mọi worker); 0 = không giới hạn
+#   CHAT_JOB_USER_MAX_RUNNING=2       # trần job running của 1 user (phần còn lại chờ, user khác được chạy)
+#   CHAT_JOB_USER_MAX_PENDING=6       # queued + running của 1 user vượt ngưỡng → 429
+#   CHAT_JOB_MAX_QUEUED=500           # tổng job queued vượt ngưỡng → 429
+#   CHAT_JOB_RETRY_AFTER_SEC=15       # giá trị Retry-After khi từ chối
+#
+# Handler được module route đăng ký (register_handler) — service này không biết gì về prompt/model.
+
+from __future__ import annotations
+
+import os
+import time
+import socket
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import text, select
+
+from core.db.engine import SessionLocal
+from core.db.models import ChatJob
+
+logger = logging.getLogger("docaix.chat_jobs")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = os.getenv(name, "")
+        return int(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        v = os.getenv(name, "")
+        return float(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+CHAT_JOB_MAX_ATTEMPTS = max(1, _env_int("CHAT_JOB_MAX_ATTEMPTS", 3))
+CHAT_JOB_STALE_SEC = max(10, _env_int("CHAT_JOB_STALE_SEC", 120))
+CHAT_JOB_HEARTBEAT_SEC = max(0.2, _env_float("CHAT_JOB_HEARTBEAT_SEC", 2.0))
+CHAT_JOB_RETRY_BASE_SEC = max(0, _env_int("CHAT_JOB_RETRY_BASE_SEC", 5))
+CHAT_JOB_POLL_SEC = max(0.1, _env_float("CHAT_JOB_POLL_SEC", 1.0))
+CHAT_JOB_EMBEDDED_WORKERS = max(0, _env_int("CHAT_JOB_EMBEDDED_WORKERS", 1))
+CHAT_JOB_MAX_RUNNING = max(0, _env_int("CHAT_JOB_MAX_RUNNING", 8))
+CHAT_JOB_USER_MAX_RUNNING = max(0, _env_int("CHAT_JOB_USER_MAX_RUNNING", 2))
+CHAT_JOB_USER_MAX_PENDING = max(0, _env_int("CHAT_JOB_USER_MAX_PENDING", 6))
+CHAT_JOB_MAX_QUEUED = max(0, _env_int("CHAT_JOB_MAX_QUEUED", 500))
+CHAT_JOB_RETRY_AFTER_SEC = max(1, _env_int("CHAT_JOB_RETRY_AFTER_SEC", 15))
+
+JOB_KINDS = ("send", "edit", "regenerate")
+ACTIVE_STATUSES = ("queued", "running")
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+@dataclass
+class ClaimedJob:
+    job_id: str
+    kind: str
+    user_id: Optional[str]
+    chat_id: str
+    message_id: str
+    payload: Dict[str, Any] = field(default_factory=dict)
+    attempts: int = 1
+    max_attempts: int = CHAT_JOB_MAX_ATTEMPTS
+    cancel_requested: bool = False
+    lease_lost: bool = False
+
+
+@dataclass
+class Admission:
+    ok: bool
+    scope: Optional[str] = None       # "user" | "global" khi bị từ chối
+    pending: int = 0                  # queued + running của user
+    queued: int = 0                   # tổng queued
+    retry_after: int = 0
+
+
+class AdmissionRejected(RuntimeError):
+    """enqueue(): user / hàng đợi đã đầy tại thời điểm insert (caller rollback + trả 429)."""
+
+    def __init__(self, admission: Admission) -> None:
+        super().__init__(f"admission rejected ({admission.scope})")
+        self.admission = admission
+
+
+@dataclass
+class _Handler:
+    run: Callable[[ClaimedJob], Awaitable[None]]
+    partial: Optional[Callable[[ClaimedJob], Optional[str]]] = None
+    on_cancel: Optional[Callable[[ClaimedJob], None]] = None
+    on_failed: Optional[Callable[[ClaimedJob, str], None]] = None
+
+
+_HANDLERS: Dict[str, _Handler] = {}
+
+
+def register_handler(
+    kind: str,
+    run: Callable[[ClaimedJob], Awaitable[None]],
+    *,
+    partial: Optional[Callable[[ClaimedJob], Optional[str]]] = None,
+    on_cancel: Optional[Callable[[ClaimedJob], None]] = None,
+    on_failed: Optional[Callable[[ClaimedJob, str], None]] = None,
+) -> None:
+    """
+    run(job)            : thực thi job (raise → fail/retry)
+    partial(job)        : text đang sinh (ghi vào job_partial_text mỗi heartbeat)
+    on_cancel(job)      : cờ cancel được bật trong DB (gọi 1 lần)
+    on_failed(job, err) : hết lượt retry → báo lỗi cho message
+    """
+    _HANDLERS[kind] = _Handler(run=run, partial=partial, on_cancel=on_cancel, on_failed=on_failed)
+
+
+# ───────────────── producer side ─────────────────
+def enqueue(
+    session: Any,
+    *,
+    kind: str,
+    user_id: Optional[str],
+    chat_id: str,
+    message_id: str,
+    payload: Optional[Dict[str, Any]] = None,
+    max_attempts: Optional[int] = None,
+    admission: bool = True,
+) -> ChatJob:
+    """
+    Thêm job vào session (caller commit cùng ChatMessage "(queued)").
+    admission=True: đếm trần dưới khoá advisory theo user (giữ tới commit) → vượt trần ném AdmissionRejected.
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError(f"unknown job kind: {kind}")
+    if admission:
+        adm = admit(session, user_id, lock=True)
+        if not adm.ok:
+            raise AdmissionRejected(adm)
+    job = ChatJob(  # type: ignore[call-arg]
+        job_kind=kind,
+        job_status="queued",
+        job_user_id=user_id,
+        job_chat_id=chat_id,
+        job_message_id=message_id,
+        job_payload=payload or {},
+        job_attempts=0,
+        job_max_attempts=max_attempts or CHAT_JOB_MAX_ATTEMPTS,
+        job_cancel_requested=False,
+    )
+    session.add(job)
+    session.flush()
+    return job
+
+
+_ADMIT_LOCK_SQL = text("SELECT pg_advisory_xact_lock(hashtext('docaix.chat_jobs.admit'), hashtext(:uid))")
+
+
+def admit(session: Any, user_id: Optional[str], *, lock: bool = False) -> Admission:
+    """
+    Đếm job chờ/chạy của user + tổng hàng đợi. lock=False: kiểm tra sớm (trước cả khi đọc body upload);
+    lock=True: khoá theo user tới hết transaction → đếm + insert (enqueue) của 1 user được tuần tự hoá.
+    """
+    if lock:
+        session.execute(_ADMIT_LOCK_SQL, {"uid": user_id or ""})
+    row = session.execute(
+        text(
+            """
+            SELECT count(*) FILTER (WHERE job_user_id = :uid) AS pending,
+                   count(*) FILTER (WHERE job_status = 'queued') AS queued
+              FROM chat_jobs
+             WHERE job_status IN ('queued', 'running')
+            """
+        ),
+        {"uid": user_id},
+    ).first()
+    pending = int(row.pending or 0) if row else 0
+    queued = int(row.queued or 0) if row else 0
+    if CHAT_JOB_USER_MAX_PENDING and pending >= CHAT_JOB_USER_MAX_PENDING:
+        return Admission(ok=False, scope="user", pending=pending, queued=queued, retry_after=CHAT_JOB_RETRY_AFTER_SEC)
+    if CHAT_JOB_MAX_QUEUED and queued >= CHAT_JOB_MAX_QUEUED:
+        return Admission(ok=False, scope="global", pending=pending, queued=queued, retry_after=CHAT_JOB_RETRY_AFTER_SEC)
+    return Admission(ok=True, pending=pending, queued=queued)
+
+
+def request_cancel(session: Any, message_ids: List[str]) -> int:
+    """Job đang chờ → canceled ngay; job đang chạy → bật cờ, worker thấy ở heartbeat kế tiếp."""
+    if not message_ids:
+        return 0
+    res = session.execute(
+        text(
+            """
+            UPDATE chat_jobs
+               SET job_cancel_requested = TRUE,
+                   job_status = CASE WHEN job_status = 'queued' THEN 'canceled' ELSE job_status END,
+                   job_finished_at = CASE WHEN job_status = 'queued' THEN now() ELSE job_finished_at END,
+                   job_updated_at = now()
+             WHERE job_message_id = ANY(:mids)
+               AND job_status IN ('queued', 'running')
+            """
+        ),
+        {"mids": list(message_ids)},
+    )
+    return int(res.rowcount or 0)
+
+
+def latest_for_message(session: Any, message_id: str) -> Optional[ChatJob]:
+    return session.execute(
+        select(ChatJob)
+        .where(ChatJob.job_message_id == message_id)
+        .order_by(ChatJob.job_created_at.desc())
+        .limit(1)
+    ).scalars().first()
+
+
+_FAIR_ORDER_SQL = """
+    SELECT job_id, job_created_at,
+           ROW_NUMBER() OVER (PARTITION BY job_user_id ORDER BY job_run_after, job_created_at) AS user_rank
+      FROM chat_jobs
+     WHERE job_status = 'queued'
+"""
+
+
+def queue_position(session: Any, job_id: str) -> Optional[int]:
+    """Vị trí (1-based) của job queued theo thứ tự claim công bằng; None nếu không còn queued."""
+    row = session.execute(
+        text(
+            f"""
+            WITH q AS ({_FAIR_ORDER_SQL})
+            SELECT (SELECT 1 + count(*)
+                      FROM q
+                     WHERE (q.user_rank, q.job_created_at) < (me.user_rank, me.job_created_at)) AS pos
+              FROM q AS me
+             WHERE me.job_id = :id
+            """
+        ),
+        {"id": job_id},
+    ).first()
+    return int(row.pos) if row and row.pos is not None else None
+
+
+def state_for_message(session: Any, message_id: str) -> Optional[Dict[str, Any]]:
+    """Trạng thái job mới nhất của message (cho /chat/api/message và SSE khác process)."""
+    job = latest_for_message(session, message_id)
+    if not job:
+        return None
+    return {
+        "job_id": job.job_id,
+        "status": job.job_status,
+        "attempts": job.job_attempts,
+        "error": job.job_error,
+        "partial_text": job.job_partial_text or "",
+        "queue_position": queue_position(session, job.job_id) if job.job_status == "queued" else None,
+    }
+
+
+# ───────────────── worker side ─────────────────
+_CLAIM_LOCK_SQL = text("SELECT pg_advisory_xact_lock(hashtext('docaix.chat_jobs.claim'))")
+
+_RUNNING_COUNT_SQL = text(
+    """
+    SELECT count(*) AS n
+      FROM chat_jobs
+     WHERE job_status = 'running'
+       AND COALESCE(job_heartbeat_at, job_updated_at) >= now() - make_interval(secs => :stale)
+    """
+)
+
+# Ứng viên: queued đến hạn + running mất heartbeat (worker chết). Thứ tự: lượt của từng user (user_rank)
+# trước, thời điểm tạo sau → mỗi user lần lượt được 1 job (round-robin), không ai chiếm hết worker.
+_CLAIM_SQL = text(
+    """
+    WITH running AS (
+        SELECT job_user_id, count(*) AS n
+          FROM chat_jobs
+         WHERE job_status = 'running'
+           AND COALESCE(job_heartbeat_at, job_updated_at) >= now() - make_interval(secs => :stale)
+         GROUP BY job_user_id
+    ),
+    cand AS (
+        SELECT j.job_id, j.job_created_at,
+               ROW_NUMBER() OVER (PARTITION BY j.job_user_id ORDER BY j.job_run_after, j.job_created_at) AS user_rank,
+               COALESCE(r.n, 0) AS user_running
+          FROM chat_jobs j
+          LEFT JOIN running r ON r.job_user_id IS NOT DISTINCT FROM j.job_user_id
+         WHERE (j.job_status = 'queued' AND j.job_run_after <= now())
+            OR (j.job_status = 'running'
+                AND COALESCE(j.job_heartbeat_at, j.job_updated_at) < now() - make_interval(secs => :stale))
+    ),
+    c AS (
+        SELECT j.job_id
+          FROM chat_jobs j
+          JOIN cand ON cand.job_id = j.job_id
+         WHERE :user_cap <= 0 OR cand.user_rank + cand.user_running <= :user_cap
+         ORDER BY cand.user_rank, cand.job_created_at
+         LIMIT :lim
+         FOR UPDATE OF j SKIP LOCKED
+    )
+    UPDATE chat_jobs j
+       SET job_status = 'running',
+           job_locked_by = :worker,
+           job_heartbeat_at = now(),
+           job_attempts = j.job_attempts + 1,
+           job_updated_at = now()
+      FROM c
+     WHERE j.job_id = c.job_id
+    RETURNING j.job_id, j.job_kind, j.job_user_id, j.job_chat_id, j.job_message_id,
+              j.job_payload, j.job_attempts, j.job_max_attempts, j.job_cancel_requested
+    """
+)
+
+
+def claim(worker: str, limit: int = 1) -> List[ClaimedJob]:
+    session = SessionLocal()
+    try:
+        # Tuần tự hoá claim giữa các worker (giữ tới hết transaction) → trần running đếm chính xác
+        session.execute(_CLAIM_LOCK_SQL)
+        lim = max(1, limit)
+        if CHAT_JOB_MAX_RUNNING:
+            n = int(session.execute(_RUNNING_COUNT_SQL, {"stale": CHAT_JOB_STALE_SEC}).scalar() or 0)
+            lim = min(lim, CHAT_JOB_MAX_RUNNING - n)
+        if lim <= 0:
+            session.commit()
+            return []
+        rows = session.execute(
+            _CLAIM_SQL,
+            {
+                "stale": CHAT_JOB_STALE_SEC,
+                "lim": lim,
+                "worker": worker,
+                "user_cap": CHAT_JOB_USER_MAX_RUNNING,
+            },
+        ).all()
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return [
+        ClaimedJob(
+            job_id=r.job_id,
+            kind=r.job_kind,
+            user_id=r.job_user_id,
+            chat_id=r.job_chat_id,
+            message_id=r.job_message_id,
+            payload=dict(r.job_payload or {}),
+            attempts=int(r.job_attempts or 1),
+            max_attempts=int(r.job_max_attempts or CHAT_JOB_MAX_ATTEMPTS),
+            cancel_requested=bool(r.job_cancel_requested),
+        )
+        for r in rows
+    ]
+
+
+def heartbeat(job_id: str, worker: str, partial_text: Optional[str] = None) -> Optional[bool]:
+    """
+    Gia hạn lease (+ ghi partial text). Trả cờ cancel; None = mất lease (job đã bị process khác claim
+    lại hoặc bị huỷ khi còn queued) → worker nên dừng.
+    """
+    session = SessionLocal()
+    try:
+        row = session.execute(
+            text(
+                """
+                UPDATE chat_jobs
+                   SET job_heartbeat_at = now(),
+                       job_partial_text = COALESCE(:partial, job_partial_text),
+                       job_updated_at = now()
+                 WHERE job_id = :id AND job_locked_by = :worker AND job_status = 'running'
+                RETURNING job_cancel_requested
+                """
+            ),
+            {"id": job_id, "worker": worker, "partial": partial_text},
+        ).first()
+        session.commit()
+        return None if row is None else bool(row.job_cancel_requested)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def complete(job_id: str, worker: str, *, canceled: bool = False) -> None:
+    """Kết thúc job: done, hoặc canceled nếu cờ cancel đã bật (trong DB hoặc `canceled` từ process này)."""
+    session = SessionLocal()
+    try:
+        session.execute(
+            text(
+                """
+                UPDATE chat_jobs
+                   SET job_status = CASE WHEN job_cancel_requested OR :canceled THEN 'canceled' ELSE 'done' END,
+                       job_cancel_requested = job_cancel_requested OR :canceled,
+                       job_finished_at = now(),
+                       job_updated_at = now()
+                 WHERE job_id = :id AND job_locked_by = :worker
+                """
+            ),
+            {"id": job_id, "worker": worker, "canceled": bool(canceled)},
+        )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def fail(job: ClaimedJob, worker: str, error: str, *, retry: bool = True) -> str:
+    """Còn lượt → queued lại sau backoff; hết lượt / không retry → failed. Trả status mới."""
+    retry = retry and not job.cancel_requested and job.attempts < job.max_attempts
+    delay = CHAT_JOB_RETRY_BASE_SEC * (2 ** max(0, job.attempts - 1)) if retry else 0
+    status = "queued" if retry else "failed"
+    session = SessionLocal()
+    try:
+        session.execute(
+            text(
+                """
+                UPDATE chat_jobs
+                   SET job_status = :status,
+                       job_error = :error,
+                       job_locked_by = NULL,
+                       job_partial_text = NULL,
+                       job_run_after = now() + make_interval(secs => :delay),
+                       job_finished_at = CASE WHEN :status = 'failed' THEN now() ELSE NULL END,
+                       job_updated_at = now()
+                 WHERE job_id = :id AND job_locked_by = :worker
+                """
+            ),
+            {"id": job.job_id, "worker": worker, "status": status, "error": (error or "")[:4000], "delay": delay},
+        )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return status
+
+
+async def _heartbeat_loop(job: ClaimedJob, worker: str, handler: _Handler, task: "asyncio.Task[Any]") -> None:
+    last_partial: Optional[str] = None
+    while True:
+        await asyncio.sleep(CHAT_JOB_HEARTBEAT_SEC)
+        partial = None
+        if handler.partial:
+            try:
+                partial = handler.partial(job)
+            except Exception:
+                partial = None
+            if partial == last_partial:
+                partial = None
+            else:
+                last_partial = partial
+        try:
+            flag = await asyncio.to_thread(heartbeat, job.job_id, worker, partial)
+        except Exception as e:
+            logger.warning("heartbeat failed (job=%s): %s", job.job_id, e)
+            continue
+        if flag is None:
+            logger.warning("lost lease on job %s → stop", job.job_id)
+            job.lease_lost = True
+            task.cancel()
+            return
+        if flag and not job.cancel_requested:
+            job.cancel_requested = True
+            if handler.on_cancel:
+                try:
+                    handler.on_cancel(job)
+                except Exception:
+                    pass
+
+
+async def run_job(job: ClaimedJob, worker: str) -> None:
+    handler = _HANDLERS.get(job.kind)
+    if handler is None:
+        await asyncio.to_thread(fail, job, worker, f"no handler for kind '{job.kind}'", retry=False)
+        return
+    if job.attempts > job.max_attempts:
+        # job "running" bị claim lại sau crash nhưng đã hết lượt
+        await asyncio.to_thread(fail, job, worker, "max attempts exceeded", retry=False)
+        if handler.on_failed:
+            handler.on_failed(job, "max attempts exceeded")
+        return
+    if job.cancel_requested and handler.on_cancel:
+        handler.on_cancel(job)
+
+    task = asyncio.ensure_future(handler.run(job))
+    hb = asyncio.ensure_future(_heartbeat_loop(job, worker, handler, task))
+    try:
+        await task
+    except asyncio.CancelledError:
+        if _stopping():
+            raise  # chính worker bị huỷ (shutdown) → task job đã bị huỷ theo, job được claim lại sau
+        if job.lease_lost:
+            # lease mất → process khác đã tiếp quản, không ghi gì thêm
+            return
+        # chỉ task của job bị huỷ (cancel / bị edit-regenerate thay thế) → job kết thúc, worker chạy tiếp
+        job.cancel_requested = True
+        logger.info("job %s (%s, msg=%s) canceled while running", job.job_id, job.kind, job.message_id)
+        await asyncio.to_thread(complete, job.job_id, worker, canceled=True)
+        return
+    except Exception as e:
+        logger.exception("job %s (%s, msg=%s) failed: %s", job.job_id, job.kind, job.message_id, e)
+        status = await asyncio.to_thread(fail, job, worker, str(e))
+        if status == "failed" and handler.on_failed:
+            try:
+                handler.on_failed(job, str(e))
+            except Exception:
+                pass
+        return
+    finally:
+        hb.cancel()
+    await asyncio.to_thread(complete, job.job_id, worker, canceled=job.cancel_requested)
+
+
+def _stopping() -> bool:
+    """True khi task hiện tại (vòng worker) đang bị cancel từ ngoài, khác với việc chỉ task job bị huỷ."""
+    me = asyncio.current_task()
+    cancelling = getattr(me, "cancelling", None)
+    if cancelling is not None:
+        return bool(cancelling())
+    # Python < 3.11: không phân biệt được → dựa vào cờ stop của worker nhúng
+    stop = _LOCAL.get("stop")
+    return stop is not None and stop.is_set()
+
+
+# ───────────────── worker loop ─────────────────
+_LOCAL: Dict[str, Any] = {"wake": None, "tasks": [], "stop": None}
+
+
+def wake() -> None:
+    """Gọi sau khi commit job mới (cùng process) → worker nhúng claim ngay, không chờ hết POLL."""
+    ev = _LOCAL.get("wake")
+    if ev is not None:
+        try:
+            ev.set()
+        except Exception:
+            pass
+
+
+async def _worker_slot(worker: str, stop: asyncio.Event, wake_ev: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            jobs = await asyncio.to_thread(claim, worker, 1)
+        except Exception as e:
+            logger.warning("claim failed: %s", e)
+            jobs = []
+        if not jobs:
+            wake_ev.clear()
+            try:
+                await asyncio.wait_for(wake_ev.wait(), timeout=CHAT_JOB_POLL_SEC)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        for job in jobs:
+            t0 = time.perf_counter()
+            try:
+                await run_job(job, worker)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # lỗi ngoài handler (ghi DB fail/complete…) → job được claim lại khi hết lease, vòng vẫn chạy
+                logger.exception("job %s: worker error: %s", job.job_id, e)
+                continue
+            logger.info(
+                "job %s kind=%s msg=%s attempt=%d took %.0f ms",
+                job.job_id, job.kind, job.message_id, job.attempts, (time.perf_counter() - t0) * 1000.0,
+            )
+
+
+async def run_worker_loop(*, concurrency: int = 1, stop: Optional[asyncio.Event] = None) -> None:
+    """Chạy `concurrency` vòng claim/run song song tới khi `stop` được set."""
+    worker = worker_id()
+    stop = stop or asyncio.Event()
+    wake_ev = asyncio.Event()
+    _LOCAL["wake"] = wake_ev
+    logger.info("chat job worker %s started (concurrency=%d)", worker, concurrency)
+    try:
+        await asyncio.gather(*[_worker_slot(worker, stop, wake_ev) for _ in range(max(1, concurrency))])
+    finally:
+        _LOCAL["wake"] = None
+
+
+async def start_embedded_workers() -> None:
+    """on_startup: chạy CHAT_JOB_EMBEDDED_WORKERS vòng worker trong web process."""
+    if CHAT_JOB_EMBEDDED_WORKERS <= 0 or _LOCAL.get("tasks"):
+        return
+    stop = asyncio.Event()
+    _LOCAL["stop"] = stop
+    _LOCAL["tasks"] = [asyncio.create_task(run_worker_loop(concurrency=CHAT_JOB_EMBEDDED_WORKERS, stop=stop))]
+
+
+async def stop_embedded_workers() -> None:
+    """on_shutdown: dừng claim; job đang chạy bị huỷ → worker khác claim lại khi hết CHAT_JOB_STALE_SEC."""
+    stop = _LOCAL.get("stop")
+    if stop is not None:
+        stop.set()
+    tasks = list(_LOCAL.get("tasks") or [])
+    _LOCAL["tasks"] = []
+    for t in tasks:
+        t.cancel()
+    for t in tasks:
+        try:
+            await t
+        except BaseException:
+            pass
+
+
+__all__ = [
+    "Admission",
+    "AdmissionRejected",
+    "ClaimedJob",
+    "JOB_KINDS",
+    "ACTIVE_STATUSES",
+    "worker_id",
+    "register_handler",
+    "enqueue",
+    "admit",
+    "queue_position",
+    "request_cancel",
+    "latest_for_message",
+    "state_for_message",
+    "claim",
+    "heartbeat",
+    "complete",
+    "fail",
+    "run_job",
+    "wake",
+    "run_worker_loop",
+    "start_embedded_workers",
+    "stop_embedded_workers",
+]
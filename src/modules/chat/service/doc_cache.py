@@ -0,0 +1,296 @@
+# file: src/modules/chat/service/doc_cache.py
+# updated: 2025-09-28 (v1.0.1)
+# purpose:
+#   - Quản lý cache kết quả trích xuất tài liệu trên đĩa (OCR_CACHE_DIR) — trước đây chỉ tăng, không giới hạn,
+#     không biết hit rate:
+#       * mỗi entry = 1 file nén zlib (JSON) theo namespace: <root>/<ns>/<key[:2]>/<key>.json.z
+#       * giới hạn dung lượng (OCR_CACHE_MAX_MB) + xoá theo LRU thời điểm truy cập (mtime, được "touch" mỗi lần hit)
+#       * entry định dạng cũ (<sha1>.txt + .json chép lại pages_text) được chuyển sang dạng nén khi đọc lại
+#         (ocr_text); chưa đọc lại thì vẫn tính dung lượng và bị evict theo LRU
+#       * compact(): dọn file .tmp mồ côi / entry hỏng / thư mục rỗng rồi evict về dưới ngưỡng
+#       * stats(): hit / miss / byte đọc-ghi / evict theo namespace + dung lượng & số entry của lần quét gần nhất
+#   - Dùng chung cho OCR cả file ("ocr"), OCR theo trang ("pages"), text_extract ("textex")… → 1 ngưỡng dung lượng
+#     cho cả thư mục
+#
+# ENV:
+#   OCR_CACHE_DIR=data/ocr_cache
+#   OCR_CACHE_MAX_MB=2048          # 0 = không giới hạn
+#   OCR_CACHE_EVICT_TO=0.9         # evict tới khi còn <= tỉ lệ này của ngưỡng (tránh evict liên tục)
+#   OCR_CACHE_ZLIB_LEVEL=6
+#
+# Dọn tay (từ thư mục src):
+#   python -m modules.chat.service.doc_cache [--compact] [--root PATH]
+#
+# Ghi chú:
+#   - Nhiều process (worker OCR) ghi chung 1 thư mục: mỗi process tự đếm byte đã ghi từ lần quét gần nhất;
+#     vượt ngưỡng → quét lại thật rồi evict. Entry bị process khác xoá giữa chừng → coi như miss.
+#   - Counter hit / miss là của process hiện tại.
+
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import zlib
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("docaix.doc_cache")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = os.getenv(name, "")
+        return int(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        v = os.getenv(name, "")
+        return float(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+OCR_CACHE_DIR = os.path.abspath(os.getenv("OCR_CACHE_DIR", "data/ocr_cache"))
+OCR_CACHE_MAX_MB = max(0, _env_int("OCR_CACHE_MAX_MB", 2048))
+OCR_CACHE_EVICT_TO = min(1.0, max(0.1, _env_float("OCR_CACHE_EVICT_TO", 0.9)))
+OCR_CACHE_ZLIB_LEVEL = min(9, max(1, _env_int("OCR_CACHE_ZLIB_LEVEL", 6)))
+
+_SUFFIX = ".json.z"
+_TMP_MAX_AGE = 3600   # .tmp cũ hơn 1h → process ghi đã chết
+
+
+class DocCache:
+    """Cache entry JSON nén trong 1 thư mục gốc, có ngưỡng dung lượng + LRU theo mtime."""
+
+    def __init__(self, root: str, max_bytes: int) -> None:
+        self.root = os.path.abspath(root)
+        self.max_bytes = max(0, int(max_bytes))
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Counter] = {}
+        self._scanned: Optional[Tuple[int, int]] = None   # (bytes, entries) lần quét gần nhất
+        self._written_since_scan = 0
+        self._evictions = 0
+        self._evicted_bytes = 0
+
+    # ───────── paths ─────────
+    def path(self, ns: str, key: str) -> str:
+        return os.path.join(self.root, ns, key[:2], key + _SUFFIX)
+
+    def _count(self, ns: str, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats.setdefault(ns, Counter())[name] += n
+
+    # ───────── get / put ─────────
+    def get(self, ns: str, key: str) -> Optional[Dict[str, Any]]:
+        path = self.path(ns, key)
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+            obj = json.loads(zlib.decompress(raw).decode("utf-8"))
+        except FileNotFoundError:
+            self._count(ns, "misses")
+            return None
+        except Exception as e:
+            logger.debug("bad cache entry %s: %s", path, e)
+            self._count(ns, "misses")
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)   # thời điểm truy cập cho LRU (atime thường bị tắt trên server)
+        except OSError:
+            pass
+        self._count(ns, "hits")
+        self._count(ns, "bytes_read", len(raw))
+        return obj if isinstance(obj, dict) else None
+
+    def put(self, ns: str, key: str, obj: Dict[str, Any]) -> Optional[str]:
+        path = self.path(ns, key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            data = zlib.compress(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), OCR_CACHE_ZLIB_LEVEL)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning("cannot write cache entry %s: %s", path, e)
+            self._remove(tmp)
+            return None
+        self._count(ns, "puts")
+        self._count(ns, "bytes_written", len(data))
+        self._maybe_evict(len(data))
+        return path
+
+    def delete(self, ns: str, key: str) -> None:
+        self._remove(self.path(ns, key))
+
+    @staticmethod
+    def _remove(path: str) -> int:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except OSError:
+            return 0
+
+    # ───────── size / eviction ─────────
+    def _scan(self) -> List[Tuple[float, int, str]]:
+        """(mtime, size, path) của mọi file dưới root (trừ .tmp) — file định dạng cũ (.txt/.json) cũng tính
+        vào dung lượng và bị evict theo LRU như entry thường (chưa được đọc lại để chuyển sang dạng nén)."""
+        out: List[Tuple[float, int, str]] = []
+        for dirpath, _dirs, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                p = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                out.append((st.st_mtime, st.st_size, p))
+        return out
+
+    def _maybe_evict(self, added: int) -> None:
+        if self.max_bytes <= 0:
+            return
+        with self._lock:
+            self._written_since_scan += added
+            known = self._scanned[0] if self._scanned else None
+            due = known is None or (known + self._written_since_scan) > self.max_bytes
+        if due:
+            self.evict()
+
+    def evict(self, target_bytes: Optional[int] = None) -> Tuple[int, int]:
+        """Quét thư mục, xoá entry truy cập lâu nhất tới khi tổng <= target (mặc định max * EVICT_TO)."""
+        entries = self._scan()
+        total = sum(e[1] for e in entries)
+        removed = freed = 0
+        limit = self.max_bytes if target_bytes is None else target_bytes
+        if limit > 0 and total > limit:
+            goal = int(limit * OCR_CACHE_EVICT_TO) if target_bytes is None else target_bytes
+            entries.sort()
+            for _mtime, size, p in entries:
+                if total - freed <= goal:
+                    break
+                freed += self._remove(p)
+                removed += 1
+            logger.info("doc cache %s: evicted %d entries (%.1f MB)", self.root, removed, freed / 1048576.0)
+        with self._lock:
+            self._scanned = (total - freed, len(entries) - removed)
+            self._written_since_scan = 0
+            self._evictions += removed
+            self._evicted_bytes += freed
+        return removed, freed
+
+    def refresh(self) -> None:
+        """Quét lại dung lượng / số entry (không xoá gì)."""
+        entries = self._scan()
+        with self._lock:
+            self._scanned = (sum(e[1] for e in entries), len(entries))
+            self._written_since_scan = 0
+
+    def compact(self) -> Dict[str, int]:
+        """Dọn .tmp mồ côi, entry không giải nén được, thư mục rỗng; rồi evict về dưới ngưỡng."""
+        now = time.time()
+        tmp_removed = bad_removed = dirs_removed = 0
+        for dirpath, _dirs, files in os.walk(self.root, topdown=False):
+            for name in files:
+                p = os.path.join(dirpath, name)
+                if name.endswith(".tmp"):
+                    try:
+                        if now - os.path.getmtime(p) > _TMP_MAX_AGE:
+                            self._remove(p)
+                            tmp_removed += 1
+                    except OSError:
+                        pass
+                elif name.endswith(_SUFFIX):
+                    try:
+                        with open(p, "rb") as f:
+                            zlib.decompress(f.read())
+                    except Exception:
+                        self._remove(p)
+                        bad_removed += 1
+            if dirpath != self.root:
+                try:
+                    os.rmdir(dirpath)   # chỉ thành công khi rỗng
+                    dirs_removed += 1
+                except OSError:
+                    pass
+        removed, freed = self.evict()
+        return {
+            "tmp_removed": tmp_removed,
+            "bad_removed": bad_removed,
+            "dirs_removed": dirs_removed,
+            "evicted": removed,
+            "evicted_bytes": freed,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            by_ns = {ns: dict(c) for ns, c in self._stats.items()}
+            scanned = self._scanned
+            out: Dict[str, Any] = {
+                "root": self.root,
+                "max_bytes": self.max_bytes,
+                "size_bytes": (scanned[0] + self._written_since_scan) if scanned else None,
+                "entries": scanned[1] if scanned else None,
+                "evictions": self._evictions,
+                "evicted_bytes": self._evicted_bytes,
+                "namespaces": by_ns,
+            }
+        hits = sum(c.get("hits", 0) for c in by_ns.values())
+        misses = sum(c.get("misses", 0) for c in by_ns.values())
+        out["hit_rate"] = round(hits / (hits + misses), 4) if (hits + misses) else None
+        return out
+
+
+_CACHES: Dict[str, DocCache] = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def get_cache(root: Optional[str] = None) -> DocCache:
+    """DocCache của thư mục gốc (mặc định OCR_CACHE_DIR) — 1 instance / thư mục / process."""
+    r = os.path.abspath(root or OCR_CACHE_DIR)
+    with _CACHES_LOCK:
+        c = _CACHES.get(r)
+        if c is None:
+            c = _CACHES[r] = DocCache(r, OCR_CACHE_MAX_MB * 1024 * 1024)
+        return c
+
+
+def stats() -> Dict[str, Any]:
+    with _CACHES_LOCK:
+        caches = list(_CACHES.values())
+    return {c.root: c.stats() for c in caches}
+
+
+__all__ = [
+    "DocCache",
+    "get_cache",
+    "stats",
+]
+
+
+if __name__ == "__main__":  # pragma: no cover
+    import argparse
+    ap = argparse.ArgumentParser(description="DocAIx doc cache — dung lượng / dọn dẹp")
+    ap.add_argument("--root", default=OCR_CACHE_DIR)
+    ap.add_argument("--compact", action="store_true")
+    args = ap.parse_args()
+    cache = get_cache(args.root)
+    try:
+        report: Dict[str, Any] = cache.compact() if args.compact else {}
+        if not args.compact:
+            cache.refresh()
+        report.update(cache.stats())
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    except Exception as e:
+        print(f"[doc_cache] failed: {e}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,296 @@
+# file: src/modules/chat/service/doc_index.py
+# updated: 2025-09-12 (v1.0.0)
+# purpose:
+#   - Chỉ mục chunk cho tài liệu trong 1 chat → mỗi câu hỏi chỉ lấy top-k đoạn liên quan trên TẤT CẢ tài liệu
+#     của chat, thay vì dán full text tài liệu mới nhất vào mỗi lượt (pc.latest_doc_text)
+#   - Chunk 1 lần lúc upload (sau OCR / extract): <txt>.chunks.json cạnh file text; tài liệu cũ chưa có →
+#     chunk lười ở lần truy vấn đầu rồi ghi lại
+#   - BM25 thuần Python (không dependency): token = âm tiết đã bỏ dấu + bigram âm tiết (từ ghép tiếng Việt)
+#   - Cache chỉ mục đã token hoá theo chat (LRU); stamp = danh sách (doc_id, đường dẫn text) của chat
+#
+# ENV:
+#   DOC_RETRIEVAL_ENABLED=1
+#   DOC_CHUNK_WORDS=220              # số từ mỗi chunk
+#   DOC_CHUNK_OVERLAP=40             # số từ gối đầu giữa 2 chunk liên tiếp
+#   DOC_RETRIEVE_TOP_K=6
+#   DOC_INDEX_CACHE_CHATS=128
+#
+# Ghi chú:
+#   - Không có đoạn nào khớp (câu hỏi kiểu "tóm tắt giúp") → trả các chunk đầu của tài liệu mới nhất.
+#   - Tool "Phân loại phòng ban" vẫn cần FULL text tài liệu mới nhất → caller dùng pc.latest_doc_text.
+
+from __future__ import annotations
+
+import os
+import re
+import json
+import math
+import logging
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from core.db.models import Document
+
+logger = logging.getLogger("docaix.doc_index")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = os.getenv(name, "")
+        return int(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+UPLOAD_ROOT = os.path.abspath(os.getenv("UPLOAD_ROOT", os.path.join("uploads")))
+DOC_RETRIEVAL_ENABLED = (os.getenv("DOC_RETRIEVAL_ENABLED", "1").strip() != "0")
+DOC_CHUNK_WORDS = max(40, _env_int("DOC_CHUNK_WORDS", 220))
+DOC_CHUNK_OVERLAP = max(0, min(DOC_CHUNK_WORDS // 2, _env_int("DOC_CHUNK_OVERLAP", 40)))
+DOC_RETRIEVE_TOP_K = max(1, _env_int("DOC_RETRIEVE_TOP_K", 6))
+DOC_INDEX_CACHE_CHATS = max(0, _env_int("DOC_INDEX_CACHE_CHATS", 128))
+
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+_CHUNKS_SUFFIX = ".chunks.json"
+_FORMAT_VERSION = 1
+
+
+# ───────────────── tokenize ─────────────────
+def _norm(s: str) -> str:
+    s = unicodedata.normalize("NFD", s or "")
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = s.replace("đ", "d").replace("Đ", "d").lower()
+    return re.sub(r"[^\w]+", " ", s, flags=re.UNICODE)
+
+
+def _terms(s: str) -> List[str]:
+    syl = [t for t in _norm(s).split() if len(t) >= 2 or t.isdigit()]
+    return syl + [f"{a}_{b}" for a, b in zip(syl, syl[1:])]
+
+
+# ───────────────── chunking ─────────────────
+def _split_words(text: str, page: Optional[int]) -> List[Dict[str, Any]]:
+    words = (text or "").split()
+    if not words:
+        return []
+    step = max(1, DOC_CHUNK_WORDS - DOC_CHUNK_OVERLAP)
+    out: List[Dict[str, Any]] = []
+    for start in range(0, len(words), step):
+        piece = words[start:start + DOC_CHUNK_WORDS]
+        out.append({"p": page, "t": " ".join(piece)})
+        if start + DOC_CHUNK_WORDS >= len(words):
+            break
+    return out
+
+
+def chunk_text(text: str, pages_text: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """Chunk theo trang (nếu có) rồi theo cửa sổ từ; giữ số trang để trích dẫn."""
+    chunks: List[Dict[str, Any]] = []
+    if pages_text and any((p or "").strip() for p in pages_text):
+        for i, page in enumerate(pages_text, start=1):
+            chunks.extend(_split_words(page or "", i))
+    else:
+        chunks.extend(_split_words(text or "", None))
+    return chunks
+
+
+def _chunks_path(rel_txt: str) -> str:
+    return os.path.join(UPLOAD_ROOT, *rel_txt.split("/")) + _CHUNKS_SUFFIX
+
+
+def index_document(
+    rel_txt: str,
+    text: str,
+    pages_text: Optional[List[str]] = None,
+    *,
+    chat_id: Optional[str] = None,
+) -> int:
+    """Gọi lúc upload (sau khi ghi file text của Document) → ghi <txt>.chunks.json. Trả số chunk."""
+    if not rel_txt:
+        return 0
+    invalidate(chat_id)
+    chunks = chunk_text(text, pages_text)
+    path = _chunks_path(rel_txt)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"v": _FORMAT_VERSION, "chunks": chunks}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.debug("cannot write chunks for %s: %s", rel_txt, e)
+    return len(chunks)
+
+
+def _load_chunks(rel_txt: str) -> List[Dict[str, Any]]:
+    path = _chunks_path(rel_txt)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict) and data.get("v") == _FORMAT_VERSION:
+            return list(data.get("chunks") or [])
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.debug("bad chunks file %s: %s", path, e)
+    # tài liệu cũ (trước khi có chỉ mục) → chunk lười từ file text rồi ghi lại
+    try:
+        with open(os.path.join(UPLOAD_ROOT, *rel_txt.split("/")), "r", encoding="utf-8") as f:
+            body = f.read()
+    except Exception:
+        return []
+    index_document(rel_txt, body)
+    return chunk_text(body)
+
+
+# ───────────────── per-chat index ─────────────────
+@dataclass
+class _Chunk:
+    doc_id: str
+    label: str
+    seq: int
+    page: Optional[int]
+    text: str
+    tf: Counter
+    length: int
+
+
+@dataclass
+class _ChatIndex:
+    stamp: Tuple[Tuple[str, str], ...]
+    latest_doc_id: Optional[str]
+    chunks: List[_Chunk] = field(default_factory=list)
+    df: Counter = field(default_factory=Counter)
+    avgdl: float = 0.0
+
+
+@dataclass
+class Hit:
+    doc_id: str
+    label: str
+    seq: int
+    page: Optional[int]
+    text: str
+    score: float
+
+
+_LOCK = threading.Lock()
+_CACHE: "OrderedDict[str, _ChatIndex]" = OrderedDict()
+
+
+def invalidate(chat_id: Optional[str]) -> None:
+    if not chat_id:
+        return
+    with _LOCK:
+        _CACHE.pop(chat_id, None)
+
+
+def _chat_docs(session: Any, chat_id: str) -> List[Tuple[str, str, str]]:
+    rows = session.execute(
+        select(Document.doc_id, Document.doc_title, Document.doc_ocr_text_path)
+        .where(Document.doc_chat_id == chat_id)
+        .order_by(Document.doc_created_at.desc())
+    ).all()
+    return [(r[0], r[1] or "", (r[2] or "").strip()) for r in rows if (r[2] or "").strip()]
+
+
+def _build(docs: List[Tuple[str, str, str]]) -> _ChatIndex:
+    idx = _ChatIndex(stamp=tuple((d[0], d[2]) for d in docs), latest_doc_id=docs[0][0] if docs else None)
+    total = 0
+    for doc_id, title, rel_txt in docs:
+        label = os.path.basename(rel_txt) if not title else f"{title} ({os.path.basename(rel_txt)})"
+        for seq, c in enumerate(_load_chunks(rel_txt)):
+            terms = _terms(c.get("t") or "")
+            if not terms:
+                continue
+            tf = Counter(terms)
+            idx.chunks.append(_Chunk(doc_id, label, seq, c.get("p"), c.get("t") or "", tf, len(terms)))
+            idx.df.update(tf.keys())
+            total += len(terms)
+    idx.avgdl = (total / len(idx.chunks)) if idx.chunks else 0.0
+    return idx
+
+
+def _index_for(session: Any, chat_id: str) -> _ChatIndex:
+    docs = _chat_docs(session, chat_id)
+    stamp = tuple((d[0], d[2]) for d in docs)
+    with _LOCK:
+        idx = _CACHE.get(chat_id)
+        if idx is not None and idx.stamp == stamp:
+            _CACHE.move_to_end(chat_id)
+            return idx
+    idx = _build(docs)
+    if DOC_INDEX_CACHE_CHATS > 0:
+        with _LOCK:
+            _CACHE[chat_id] = idx
+            _CACHE.move_to_end(chat_id)
+            while len(_CACHE) > DOC_INDEX_CACHE_CHATS:
+                _CACHE.popitem(last=False)
+    return idx
+
+
+def retrieve(session: Any, chat_id: str, question: str, *, top_k: Optional[int] = None) -> List[Hit]:
+    """Top-k chunk theo BM25 trên mọi tài liệu của chat; không khớp → các chunk đầu của tài liệu mới nhất."""
+    k = max(1, top_k or DOC_RETRIEVE_TOP_K)
+    idx = _index_for(session, chat_id)
+    if not idx.chunks:
+        return []
+    q_terms = set(_terms(question))
+    n = len(idx.chunks)
+    scored: List[Tuple[float, _Chunk]] = []
+    for c in idx.chunks:
+        s = 0.0
+        for t in q_terms:
+            f = c.tf.get(t)
+            if not f:
+                continue
+            dfv = idx.df[t]
+            idf = math.log(1.0 + (n - dfv + 0.5) / (dfv + 0.5))
+            s += idf * f * (_BM25_K1 + 1) / (f + _BM25_K1 * (1 - _BM25_B + _BM25_B * c.length / (idx.avgdl or 1.0)))
+        if s > 0:
+            scored.append((s, c))
+    if scored:
+        scored.sort(key=lambda x: x[0], reverse=True)
+        picked = scored[:k]
+    else:
+        picked = [(0.0, c) for c in idx.chunks if c.doc_id == idx.latest_doc_id][:k]
+    return [Hit(c.doc_id, c.label, c.seq, c.page, c.text, round(s, 4)) for s, c in picked]
+
+
+def format_hits(hits: List[Hit]) -> str:
+    """Nhóm theo tài liệu, giữ thứ tự xuất hiện trong tài liệu để model đọc liền mạch."""
+    if not hits:
+        return ""
+    by_doc: "OrderedDict[str, List[Hit]]" = OrderedDict()
+    for h in hits:
+        by_doc.setdefault(h.doc_id, []).append(h)
+    blocks: List[str] = []
+    for items in by_doc.values():
+        lines = [f"[{items[0].label}]"]
+        for h in sorted(items, key=lambda x: x.seq):
+            where = f"p{h.page} · đoạn {h.seq + 1}" if h.page else f"đoạn {h.seq + 1}"
+            lines.append(f"({where}) {h.text}")
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+
+def relevant_text(session: Any, chat_id: str, question: str, *, top_k: Optional[int] = None) -> str:
+    if not (DOC_RETRIEVAL_ENABLED and chat_id):
+        return ""
+    return format_hits(retrieve(session, chat_id, question, top_k=top_k))
+
+
+__all__ = [
+    "DOC_RETRIEVAL_ENABLED",
+    "Hit",
+    "chunk_text",
+    "index_document",
+    "retrieve",
+    "format_hits",
+    "relevant_text",
+    "invalidate",
+]
@@ -1,5 +1,7 @@
 # file: src/modules/chat/service/email_scheduler.py
-# updated: 2025-09-03 (v1.0.0)
+# updated: 2025-09-10 (v1.0.1)
+# changes (v1.0.1):
+#   - _recent_transcript dùng modules/chat/service/transcript.py (cửa sổ cuối + cache) thay vì load cả chat.
 # purpose:
 #   - Service cho tool "Cập nhật email" (DOC_EMAIL_UPDATE)
 #   - Chức năng chính:
@@ -51,6 +53,8 @@ from core.db.models import (
     User,
 )
 
+from modules.chat.service import transcript as _transcript
+
 log = logging.getLogger("docaix.email_scheduler")
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -790,31 +794,11 @@ def _recent_transcript(session, chat_id: str, limit_chars: int = 20000, max_msgs
     """
     Tiện ích gom transcript (User/Assistant) cho prompt. Chỉ dùng khi cần fallback.
     (Nếu đã có modules.chat.service.prompt_compose thì gọi bên đó)
+    Chỉ đọc cửa sổ cuối của chat + cache theo chat (xem modules/chat/service/transcript.py).
     """
-    try:
-        q = select(ChatMessage).where(ChatMessage.message_chat_id == chat_id)
-        if hasattr(ChatMessage, "message_created_at"):
-            q = q.order_by(ChatMessage.message_created_at.asc())
-        rs = session.execute(q).scalars().all()
-    except Exception:
-        rs = []
-
-    pairs: List[str] = []
-    for r in rs:
-        u = (r.message_question or "").strip()
-        a = (r.message_ai_response or "").strip()
-        if not u or not a or a in ("(queued)", "(canceled)"):
-            continue
-        pairs.append(f"User: {u}\nAssistant: {a}")
-    if max_msgs > 0 and len(pairs) > max_msgs:
-        pairs = pairs[-max_msgs:]
-    text = "\n\n".join(pairs)
-    if limit_chars > 0 and len(text) > limit_chars:
-        text = text[-limit_chars:]
-        cut = text.find("\n")
-        if cut > 200:
-            text = text[cut+1:]
-    return text
+    return _transcript.recent_transcript(
+        session, chat_id, limit_chars=limit_chars, max_msgs=max_msgs, strip_attachments=False,
+    )
 
 
 def collect_email_update_context(
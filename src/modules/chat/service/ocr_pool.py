@@ -0,0 +1,287 @@
+# file: src/modules/chat/service/ocr_pool.py
+# updated: 2025-09-29 (v1.1.1)
+# changes (v1.1.1):
+#   - Trang PDF của ocr_text.iter_pages_async cũng là job của pool này (chung hàng đợi ưu tiên + trần OCR_JOB_WORKERS).
+#   - _run_extract ép engine qua ocr_text.engine_override (theo thread) thay vì gán ocr_text.OCR_ENGINE.
+# changes (v1.1.0):
+#   - stats(): RSS đỉnh theo job (OCRResult.peak_rss_mb) — rss_p95_mb / rss_max_mb trong lịch sử gần nhất.
+#   - Cộng số trang theo bậc OCR (PageInfo.tier) của job chạy trong worker vào ocr_text.ocr_stats().
+# purpose:
+#   - Pool process RIÊNG cho OCR (extract_text) — không còn đẩy OCR vào default executor của asyncio
+#     (dùng chung với file I/O / to_thread khác) → 1 đợt upload scan không chặn request không liên quan
+#   - Mỗi worker nạp Tesseract + EasyOCR 1 lần lúc khởi động (ocr_text.warm_engines); on_startup gửi
+#     job "ping" để spawn đủ worker trước → không request nào phải trả chi phí load model lần đầu
+#   - Hàng đợi ưu tiên của riêng pool: upload chat tương tác (PRIORITY_INTERACTIVE) trước re-OCR nền
+#     (PRIORITY_BACKGROUND); cùng mức → FIFO. Tối đa OCR_JOB_WORKERS job đang chạy, phần còn lại chờ ở đây
+#   - Metrics: độ sâu hàng đợi (theo mức ưu tiên), job đang chạy, thời gian chờ / chạy từng job
+#
+# ENV:
+#   OCR_POOL_ENABLED=1
+#   OCR_JOB_WORKERS=2               # số process OCR (mỗi process giữ 1 bộ model)
+#   OCR_JOB_HISTORY=200             # số job gần nhất giữ timing cho stats()
+#
+# Ghi chú:
+#   - Pool dùng context "spawn" (an toàn với fitz / torch). OCR_PAGE_WORKERS (song song theo trang) được
+#     chia đều cho các worker để tổng số process không vượt số core.
+#   - Engine của lượt (engine= của caller, mặc định OCR_ENGINE) được chụp lúc submit, gửi kèm job.
+#   - Pool hỏng (worker chết) → job đó chạy lại trong thread hiện tại; lần submit sau tạo pool mới.
+
+from __future__ import annotations
+
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("docaix.ocr_pool")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = os.getenv(name, "")
+        return int(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+OCR_POOL_ENABLED = (os.getenv("OCR_POOL_ENABLED", "1").strip() != "0")
+OCR_JOB_WORKERS = max(1, _env_int("OCR_JOB_WORKERS", 2))
+OCR_JOB_HISTORY = max(10, _env_int("OCR_JOB_HISTORY", 200))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+class OcrPoolUnavailable(RuntimeError):
+    """Không tạo / gửi được job vào pool (caller chạy OCR trong process hiện tại)."""
+
+
+# ───────────────── worker side ─────────────────
+def _init_worker(page_workers: int) -> None:
+    from modules.chat.service import ocr_text
+    ocr_text.OCR_PAGE_WORKERS = max(1, page_workers)
+    ocr_text.warm_engines()
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _run_extract(engine: str, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Any:
+    from modules.chat.service import ocr_text
+    # override theo thread: khi chạy fallback trong thread của process cha không đổi OCR_ENGINE của lượt khác
+    with ocr_text.engine_override(engine):
+        return ocr_text.extract_text(*args, **kwargs)
+
+
+# ───────────────── parent side ─────────────────
+@dataclass(order=True)
+class _Job:
+    priority: int
+    seq: int
+    fn: Callable[..., Any] = field(compare=False)
+    args: Tuple[Any, ...] = field(compare=False)
+    label: str = field(compare=False, default="")
+    outer: Future = field(compare=False, default_factory=Future)
+    enqueued: float = field(compare=False, default_factory=time.perf_counter)
+
+
+class OcrPool:
+    """ProcessPoolExecutor + hàng đợi ưu tiên phía cha (executor chỉ nhận tối đa `workers` job một lúc)."""
+
+    def __init__(self, workers: int) -> None:
+        self.workers = max(1, workers)
+        self._lock = threading.RLock()  # done-callback có thể chạy ngay trong submit()
+        self._heap: List[_Job] = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._executor: Any = None
+        self._done = 0
+        self._failed = 0
+        self._history: deque = deque(maxlen=OCR_JOB_HISTORY)
+
+    def _ensure_executor(self) -> Any:
+        if self._executor is None:
+            import multiprocessing as _mp
+            from concurrent.futures import ProcessPoolExecutor
+            from modules.chat.service import ocr_text
+            page_workers = max(1, ocr_text.OCR_PAGE_WORKERS // self.workers)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=_mp.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(page_workers,),
+            )
+            logger.info("OCR pool started: workers=%d page_workers=%d", self.workers, page_workers)
+        return self._executor
+
+    def submit(self, fn: Callable[..., Any], *args: Any, priority: int = PRIORITY_INTERACTIVE, label: str = "") -> Future:
+        job = _Job(priority=int(priority), seq=next(self._seq), fn=fn, args=args, label=label)
+        with self._lock:
+            heapq.heappush(self._heap, job)
+            self._dispatch_locked()
+        return job.outer
+
+    def _dispatch_locked(self) -> None:
+        while self._heap and self._running < self.workers:
+            job = heapq.heappop(self._heap)
+            if not job.outer.set_running_or_notify_cancel():
+                continue  # caller đã huỷ khi còn trong hàng đợi
+            started = time.perf_counter()
+            try:
+                inner = self._ensure_executor().submit(job.fn, *job.args)
+            except Exception as e:
+                self._executor = None
+                self._finish_locked(job, started, error=OcrPoolUnavailable(str(e)))
+                continue
+            self._running += 1
+            inner.add_done_callback(lambda f, job=job, started=started: self._on_done(job, started, f))
+
+    def _on_done(self, job: _Job, started: float, inner: Future) -> None:
+        err = inner.exception()
+        with self._lock:
+            self._running -= 1
+            if isinstance(err, BrokenProcessPool):
+                self._executor = None  # lần dispatch sau tạo pool mới
+            self._finish_locked(job, started, error=err, result=None if err else inner.result())
+            self._dispatch_locked()
+
+    def _finish_locked(self, job: _Job, started: float, *, error: Optional[BaseException] = None, result: Any = None) -> None:
+        now = time.perf_counter()
+        rec = {
+            "label": job.label,
+            "priority": job.priority,
+            "wait_ms": round((started - job.enqueued) * 1000.0, 1),
+            "run_ms": round((now - started) * 1000.0, 1),
+            "ok": error is None,
+            "rss_mb": getattr(result, "peak_rss_mb", None),
+        }
+        self._history.append(rec)
+        if error is None:
+            self._done += 1
+            job.outer.set_result(result)
+        else:
+            self._failed += 1
+            job.outer.set_exception(error)
+        if job.label:
+            logger.info("OCR job %s prio=%d wait=%.0fms run=%.0fms ok=%s",
+                        job.label, job.priority, rec["wait_ms"], rec["run_ms"], rec["ok"])
+
+    def warm(self) -> None:
+        """Spawn đủ worker (initializer nạp engine) mà không chờ kết quả."""
+        for _ in range(self.workers):
+            self.submit(_ping, priority=PRIORITY_BACKGROUND)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            by_prio: Dict[int, int] = {}
+            for j in self._heap:
+                by_prio[j.priority] = by_prio.get(j.priority, 0) + 1
+            recent = [r for r in self._history if r["label"]]
+            waits = sorted(r["wait_ms"] for r in recent)
+            runs = sorted(r["run_ms"] for r in recent)
+            rss = sorted(r["rss_mb"] for r in recent if r.get("rss_mb") is not None)
+
+            def _p95(xs: List[float]) -> float:
+                return xs[min(len(xs) - 1, int(len(xs) * 0.95))] if xs else 0.0
+
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "queued": len(self._heap),
+                "queued_by_priority": by_prio,
+                "done": self._done,
+                "failed": self._failed,
+                "wait_avg_ms": round(sum(waits) / len(waits), 1) if waits else 0.0,
+                "wait_p95_ms": round(_p95(waits), 1),
+                "run_avg_ms": round(sum(runs) / len(runs), 1) if runs else 0.0,
+                "run_p95_ms": round(_p95(runs), 1),
+                "rss_p95_mb": round(_p95(rss), 1),   # RSS đỉnh / job → chọn OCR_JOB_WORKERS theo RAM
+                "rss_max_mb": rss[-1] if rss else 0.0,
+                "recent": recent[-20:],
+            }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            ex, self._executor = self._executor, None
+            pending, self._heap = self._heap, []
+        for j in pending:
+            j.outer.cancel()
+        if ex is not None:
+            try:
+                ex.shutdown(wait=False, cancel_futures=True)
+            except Exception:
+                pass
+
+
+_POOL: Optional[OcrPool] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> OcrPool:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = OcrPool(OCR_JOB_WORKERS)
+        return _POOL
+
+
+async def extract_text(*args: Any, priority: int = PRIORITY_INTERACTIVE, engine: Optional[str] = None, **kwargs: Any) -> Any:
+    """ocr_text.extract_text chạy trên pool OCR; pool tắt / hỏng → chạy trong thread như cũ."""
+    from modules.chat.service import ocr_text
+    eng = engine or ocr_text.OCR_ENGINE
+    if OCR_POOL_ENABLED:
+        label = os.path.basename(str(args[0])) if args else str(kwargs.get("file_path") or "")
+        try:
+            fut = get_pool().submit(_run_extract, eng, args, kwargs, priority=priority, label=label)
+            res = await asyncio.wrap_future(fut)
+            # bậc OCR đếm trong worker → cộng dồn vào ocr_text.ocr_stats() của process cha
+            if not getattr(res, "cache_hit", True):
+                ocr_text._TIER_STATS.update(p.tier for p in (res.pages or []) if p.tier)
+            return res
+        except (OcrPoolUnavailable, BrokenProcessPool) as e:
+            logger.warning("OCR pool unavailable (%s) → in-process OCR", e)
+    return await asyncio.to_thread(_run_extract, eng, args, kwargs)
+
+
+def stats() -> Dict[str, Any]:
+    return get_pool().stats() if _POOL is not None else {"workers": OCR_JOB_WORKERS, "running": 0, "queued": 0}
+
+
+async def start() -> None:
+    """on_startup: spawn + nạp model cho các worker OCR ngay khi app lên."""
+    if OCR_POOL_ENABLED:
+        try:
+            get_pool().warm()
+        except Exception as e:
+            logger.warning("OCR pool warm-up failed: %s", e)
+
+
+async def stop() -> None:
+    """on_shutdown."""
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown()
+
+
+__all__ = [
+    "PRIORITY_INTERACTIVE",
+    "PRIORITY_BACKGROUND",
+    "OcrPoolUnavailable",
+    "OcrPool",
+    "get_pool",
+    "extract_text",
+    "stats",
+    "start",
+    "stop",
+]
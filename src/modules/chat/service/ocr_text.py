@@ -1,5 +1,61 @@
 # file: modules/chat/service/ocr_text.py
-# updated: 2025-08-31 (v2.2.0)
+# updated: 2025-09-29 (v2.13.3)
+# changes (v2.13.3):
+#   - OSD (tesserocr) dùng instance riêng với OEM.TESSERACT_ONLY: osd.traineddata chỉ có model legacy, OEM LSTM
+#     (OCR_VI_OEM) không init được → trước đây OSD luôn hỏng và bị nuốt im lặng. Lỗi OSD giờ log debug.
+# changes (v2.13.2):
+#   - iter_pages_async: trang PDF cần OCR là job của pool OCR dùng chung (ocr_pool: hàng đợi ưu tiên + trần
+#     OCR_JOB_WORKERS) thay vì pool trang riêng / thread không giới hạn; priority= như extract_text_async.
+#     Pool tắt / hỏng → OCR trang trong thread của process hiện tại.
+#   - Engine theo lượt là override theo thread (engine_override / _engine()) thay cho gán OCR_ENGINE toàn cục:
+#     nhánh thread (_ocr_pdf_page_isolated, ocr_pool chạy trong thread) cũng dùng đúng engine= của caller.
+# changes (v2.13.1):
+#   - extract_text_async / iter_pages_async nhận engine= (None → OCR_ENGINE): caller ép engine theo từng lượt
+#     mà không phải sửa biến toàn cục (nhiều tin nhắn OCR song song không giẫm nhau).
+# changes (v2.13.0):
+#   - Khoá cache cả file: file upload là tham chiếu tới kho blob (shared.file_storage) → dùng sha256 trong tên blob,
+#     không đọc lại cả file để băm sha1; cùng nội dung từ chat / user khác → trúng cùng 1 entry. File thường giữ sha1.
+# changes (v2.12.0):
+#   - Cache OCR qua doc_cache: 1 entry nén / file (meta + pages_text, full text chỉ lưu khi khác bản ghép lại),
+#     trang OCR là namespace "pages" cùng thư mục → chung ngưỡng OCR_CACHE_MAX_MB + LRU + stats hit/miss/byte.
+#     Entry định dạng cũ (.txt + .json) chuyển đổi khi đọc lại. Bỏ OCR_PAGE_CACHE_DIR (nay là <OCR_CACHE_DIR>/pages).
+#     OCRResult.text_path / meta_path = đường dẫn entry nén.
+# changes (v2.11.0):
+#   - Budget bộ nhớ theo job (OCR_JOB_MEM_MB): _mem_plan giảm số trang OCR đồng thời rồi mới hạ pixel limit
+#     (sàn OCR_MEM_MIN_PIXELS); trang OCR theo đợt bằng đúng số đó. Ladder trong _ocr_pdf_page nhả pixmap bậc
+#     trước trước khi render bậc sau (1 pixmap / lúc); sau mỗi trang trả store ảnh của MuPDF.
+#   - RSS đỉnh: PageInfo.rss_mb (đo trong process OCR trang), OCRResult.peak_rss_mb + meta + log theo job.
+# changes (v2.10.0):
+#   - Pipeline ảnh 1 buffer numpy từ render tới engine: _pix_to_array là view trên bộ nhớ pixmap (thay _pix_to_pil),
+#     xoay OSD bằng np.rot90, upscale / gray / deskew / Otsu / sharpen trên ndarray (threshold + addWeighted in-place),
+#     engine nhận thẳng ndarray gray. Bỏ các vòng PIL ↔ BGR copy nguyên trang và MORPH_OPEN 1x1 (đồng nhất).
+# changes (v2.9.0):
+#   - Backend Tesseract chọn được (OCR_TESS_BACKEND=pytesseract|tesserocr|auto): tesserocr giữ PyTessBaseAPI sống
+#     theo (lang, oem) cho từng thread/worker (model `vie` nạp 1 lần trong warm_engines), ảnh grayscale truyền thẳng
+#     qua SetImageBytes — bỏ fork `tesseract` + ghi PNG tạm mỗi trang × mỗi PSM. Mặc định vẫn pytesseract để đo so sánh.
+# changes (v2.8.0):
+#   - OCR trang theo bậc: lượt rẻ ở OCR_FAST_DPI (150), chấp nhận khi _fast_pass_ok (conf, độ dài, tỉ lệ dấu
+#     tiếng Việt qua _vi_quality_metrics); không đạt → DPI đầy đủ → engine khác → render 1.5x như cũ.
+#     PageInfo.tier + meta "tiers" + ocr_stats() đếm số trang theo bậc.
+# changes (v2.7.0):
+#   - Cache OCR theo TRANG (OCR_PAGE_CACHE, OCR_PAGE_CACHE_DIR): khoá = blake2b(pixel trang đã render + engine /
+#     ngôn ngữ / DPI / cấu hình upscale & PSM), kiểm tra trước _ocr_with_backend_pil (PDF scan + ảnh). Bản sửa /
+#     thêm trang và trang mẫu lặp lại không phải OCR lại; cache cả file (sha1) vẫn giữ nguyên.
+# changes (v2.6.0):
+#   - iter_pages_async: OCR PDF dạng stream — PageEvent theo từng trang xong (tiến độ N/M cho FE), event cuối
+#     mang OCRResult (ghi cache như extract_text). Tách _pdf_classify / _pdf_assemble / _pdf_postprocess /
+#     _read_cache / _finish_result để extract_text và bản stream dùng chung.
+# changes (v2.5.0):
+#   - extract_text(only_pages=..., budget_chars=...): OCR theo budget của caller — chỉ các trang được chọn (theo
+#     thứ tự ưu tiên), dừng khi đủ ký tự; kết quả complete=False, không ghi cache. page_count() để caller
+#     chọn trang trước khi OCR.
+# changes (v2.4.0):
+#   - extract_text_async chạy trên pool OCR riêng (ocr_pool: hàng đợi ưu tiên, worker nạp sẵn engine) thay
+#     cho default executor; warm_engines() làm initializer cho worker OCR + worker OCR theo trang.
+# changes (v2.3.0):
+#   - PDF scan: các trang cần OCR (render + OCR + retry engine / render lại 1.5x) chạy song song trên pool
+#     process (spawn, OCR_PAGE_WORKERS); trang có text layer vẫn đọc tuần tự. Kết quả ghép đúng thứ tự trang
+#     → page_spans / pages_text trong cache không đổi. EasyOCR GPU mặc định 1 worker (OCR_PAGE_WORKERS_GPU).
 # notes:
 #   - Keep OCR returning full pages_text & spans; trimming policy handled by caller (chat_api)
 #   - Default PAGE_MARK_ENABLE=0 to match .env (no per-page headers inside pages_text)
@@ -8,9 +64,11 @@
 
 from __future__ import annotations
 
-import os, re, sys, math, json, time, asyncio, hashlib, logging, unicodedata
+import os, re, sys, math, json, time, atexit, asyncio, hashlib, logging, threading, unicodedata
+from collections import Counter
+from contextlib import contextmanager
 from dataclasses import dataclass, asdict
-from typing import Any, TYPE_CHECKING
+from typing import Any, AsyncIterator, TYPE_CHECKING
 
 if TYPE_CHECKING:
     # ✅ type-hint đúng, không dùng module như type để tránh Pylance cảnh báo
@@ -22,10 +80,11 @@ else:
     CVMat = Any
 
 __all__ = [
-    "OCRResult", "PageInfo",
-    "extract_text", "extract_text_async",
+    "OCRResult", "PageInfo", "PageEvent",
+    "extract_text", "extract_text_async", "iter_pages_async", "page_count",
     "page_for_pos", "pages_for_range", "guess_pages_from_snippet",
     "cer", "wer",
+    "warm_engines", "shutdown_page_pool", "ocr_stats", "engine_override",
 ]
 
 logger = logging.getLogger("docaix.ocr")
@@ -62,6 +121,11 @@ try:
 except Exception:
     pytesseract = None  # type: ignore
 
+try:
+    import tesserocr  # type: ignore
+except Exception:
+    tesserocr = None  # type: ignore
+
 try:
     import easyocr  # type: ignore
 except Exception:
@@ -96,15 +160,41 @@ OCR_VI_PSM = (os.getenv("OCR_VI_PSM", "6").strip() or "6")
 _ocr_psm_env = os.getenv("OCR_PSM_LIST", "6")
 OCR_PSM_LIST = [s.strip() for s in re.split(r"[,\s]+", _ocr_psm_env) if s.strip()]
 OCR_MIN_DPI = max(200, int(os.getenv("OCR_MIN_DPI", "260")))
+# Adaptive: lượt rẻ ở DPI thấp, chỉ trang không đạt mới lên DPI đầy đủ / engine khác / render 1.5x
+OCR_FAST_DPI = int(os.getenv("OCR_FAST_DPI", "150"))                  # 0 = tắt lượt rẻ
+OCR_FAST_MIN_CONF = float(os.getenv("OCR_FAST_MIN_CONF", "0.80"))     # thang 0..1 (tesseract tự quy đổi)
+OCR_FAST_MIN_DIACRITIC = float(os.getenv("OCR_FAST_MIN_DIACRITIC", "0.08"))  # chỉ xét khi lang có "vie"
 OCR_MAX_PAGES = int(os.getenv("OCR_MAX_PAGES", "200"))  # Giới hạn OCR nội bộ
 OCR_FORCE_OCR_ALL = os.getenv("OCR_FORCE_OCR_ALL", "0").strip() == "1"
 OCR_TEXT_THRESHOLD = int(os.getenv("OCR_TEXT_THRESHOLD", "40"))
 OCR_PIXEL_LIMIT = int(os.getenv("OCR_PIXEL_LIMIT", str(17_000_000)))
+# Budget bộ nhớ cho buffer trang của 1 job OCR (MB, 0 = tắt): giới hạn số trang OCR đồng thời, rồi mới hạ
+# pixel limit (không dưới OCR_MEM_MIN_PIXELS) để tổng buffer ước lượng nằm trong budget
+OCR_JOB_MEM_MB = int(os.getenv("OCR_JOB_MEM_MB", "0"))
+OCR_MEM_MIN_PIXELS = int(os.getenv("OCR_MEM_MIN_PIXELS", str(4_000_000)))
 OCR_CACHE_DIR = os.path.abspath(os.getenv("OCR_CACHE_DIR", "data/ocr_cache"))
+OCR_PAGE_CACHE = os.getenv("OCR_PAGE_CACHE", "1").strip() != "0"   # cache theo pixel từng trang
 OCR_DEBUG = os.getenv("OCR_DEBUG", "0").strip() == "1"
 
 # Backend policy
 OCR_ENGINE = (os.getenv("OCR_ENGINE", "auto").strip().lower() or "auto")
+_ENGINE_LOCAL = threading.local()   # engine ép theo lượt cho thread hiện tại (OCR_ENGINE toàn cục giữ nguyên)
+
+def _engine() -> str:
+    return getattr(_ENGINE_LOCAL, "engine", None) or OCR_ENGINE
+
+@contextmanager
+def engine_override(engine: str | None):
+    """Ép engine cho mọi OCR chạy trong thread hiện tại (None → OCR_ENGINE); thread / lượt khác không bị ảnh hưởng."""
+    prev = getattr(_ENGINE_LOCAL, "engine", None)
+    _ENGINE_LOCAL.engine = engine
+    try:
+        yield
+    finally:
+        _ENGINE_LOCAL.engine = prev
+# Tesseract chạy qua đâu: "pytesseract" (subprocess + file ảnh tạm mỗi lần gọi) | "tesserocr" (API trong process,
+# model nạp 1 lần / worker, ảnh truyền thẳng từ bộ nhớ) | "auto" (tesserocr nếu cài được, không thì pytesseract)
+OCR_TESS_BACKEND = (os.getenv("OCR_TESS_BACKEND", "pytesseract").strip().lower() or "pytesseract")
 EASYOCR_LANGS = [s.strip() for s in (os.getenv("EASYOCR_LANGS", "vi,en").split(",")) if s.strip()]
 EASYOCR_GPU = os.getenv("EASYOCR_GPU", "1").strip() != "0"
 OCR_AUTO_GPU_FIRST = os.getenv("OCR_AUTO_GPU_FIRST", "1").strip() != "0"
@@ -153,6 +243,8 @@ class PageInfo:
     dpi: int | None = None
     note: str | None = None
     avg_conf: float | None = None
+    tier: str | None = None   # 'fast' | 'full' | 'alt' | 'upscale' | 'cache' (trang OCR)
+    rss_mb: float | None = None  # RSS đỉnh (MB) của process đã OCR trang này
 
 @dataclass
 class OCRResult:
@@ -174,9 +266,22 @@ class OCRResult:
     diacritic_ratio: float | None = None
     ascii_word_ratio: float | None = None
     error: str | None = None
+    complete: bool = True  # False → OCR theo budget (chỉ 1 phần trang), không ghi cache
+    peak_rss_mb: float | None = None  # RSS đỉnh (MB) của job: max trên các process đã xử lý trang
     def to_json(self) -> str:
         return json.dumps(asdict(self), ensure_ascii=False, indent=2)
 
+@dataclass
+class PageEvent:
+    """1 trang vừa xong trong iter_pages_async; event cuối mang `result` (OCRResult đầy đủ / theo budget)."""
+    page: int                # 1-based (0 ở event cuối)
+    total: int
+    done: int                # số trang đã xong / planned
+    planned: int             # số trang sẽ xử lý (theo only_pages)
+    text: str = ""           # text trang (đã chuẩn hoá, chưa lọc chéo trang)
+    source: str = ""
+    result: OCRResult | None = None
+
 # ── Helpers ───────────────────────────────────────────────────────────────────
 def _ensure_dir(p: str) -> None:
     try:
@@ -188,11 +293,6 @@ def _read_text(p: str) -> str:
     with open(p, "r", encoding="utf-8") as f:
         return f.read()
 
-def _write_text(p: str, t: str) -> None:
-    _ensure_dir(os.path.dirname(p))
-    with open(p, "w", encoding="utf-8", newline="\n") as f:
-        f.write(t)
-
 def _sha1_file(path: str, buf: int = 1024 * 1024) -> str:
     h = hashlib.sha1()
     with open(path, "rb") as f:
@@ -258,18 +358,32 @@ def _vi_ocr_looks_bad(txt: str, lang_combo: str) -> bool:
     d, a = _vi_quality_metrics(txt)
     return (len(txt) >= 80) and (a > 0.95) and (d < 0.02)
 
+def _fast_pass_ok(txt: str, conf: float | None, lang_combo: str) -> bool:
+    """Chấp nhận kết quả lượt DPI thấp: đủ ký tự, conf đủ cao (nếu có), tiếng Việt có dấu hợp lý."""
+    t = (txt or "").strip()
+    if len(t) < MIN_CHARS_FALLBACK:
+        return False
+    if conf is not None:
+        c = float(conf) / 100.0 if float(conf) > 1.0 else float(conf)
+        if c < OCR_FAST_MIN_CONF:
+            return False
+    if "vie" in (lang_combo or ""):
+        if _vi_ocr_looks_bad(t, lang_combo):
+            return False
+        d, _ = _vi_quality_metrics(t)
+        if d < OCR_FAST_MIN_DIACRITIC:
+            return False
+    return True
+
 # ── OpenCV/PIL preprocessing & Upscale ────────────────────────────────────────
-def _pil_to_cv(img: PILImage) -> CVMat:
+# Ảnh trang đi qua pipeline dưới dạng MỘT ndarray uint8 (RGB H×W×3, sau tiền xử lý là gray H×W): render → view
+# thẳng trên bộ nhớ pixmap (_pix_to_array) → xoay OSD (np.rot90, view) → upscale → gray / deskew / threshold
+# (in-place khi được) → engine. Không còn vòng pixmap → numpy → PIL → numpy/BGR → PIL, mỗi bước copy cả trang.
+def _as_rgb_array(img: PILImage | CVMat) -> CVMat:
     import numpy as _np
-    if cv2 is None:
-        return _np.array(img)  # type: ignore[return-value]
-    return cv2.cvtColor(_np.array(img), cv2.COLOR_RGB2BGR)  # type: ignore[attr-defined]
-
-def _cv_to_pil(arr: CVMat) -> PILImage:
-    if cv2 is None or Image is None:
-        from PIL import Image as _Image  # type: ignore
-        return _Image.fromarray(arr)  # type: ignore[arg-type]
-    return Image.fromarray(cv2.cvtColor(arr, cv2.COLOR_BGR2RGB))  # type: ignore[attr-defined]
+    if isinstance(img, _np.ndarray):
+        return img
+    return _np.asarray(img if img.mode == "RGB" else img.convert("RGB"))
 
 def _deskew_cv(gray: CVMat) -> tuple[CVMat, float]:
     assert cv2 is not None
@@ -281,40 +395,45 @@ def _deskew_cv(gray: CVMat) -> tuple[CVMat, float]:
     angle = rect[-1]
     if angle < -45:
         angle = 90 + angle
+    if abs(angle) < 1e-3:
+        return gray, 0.0
     M = cv2.getRotationMatrix2D((gray.shape[1] / 2, gray.shape[0] / 2), angle, 1.0)  # type: ignore[attr-defined]
     rot = cv2.warpAffine(gray, M, (gray.shape[1], gray.shape[0]), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)  # type: ignore[attr-defined]
     return rot, float(angle)
 
-def _preprocess_vi(img: PILImage) -> tuple[PILImage, dict]:
+def _preprocess_vi(img: CVMat) -> tuple[CVMat, dict]:
+    """RGB/gray ndarray → gray ndarray đã deskew + Otsu + sharpen (engine nhận thẳng, không đổi lại RGB)."""
+    import numpy as _np
     dbg = {"deskew_deg": 0.0, "method": "pil"}
     if cv2 is not None:
         dbg["method"] = "cv2"
-        cv = _pil_to_cv(img)
-        gray = cv2.cvtColor(cv, cv2.COLOR_BGR2GRAY)  # type: ignore[attr-defined]
+        # buffer gray là bản sở hữu duy nhất (1/3 trang RGB) → mọi bước sau ghi đè lên nó
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else _np.array(img)  # type: ignore[attr-defined]
         gray, deg = _deskew_cv(gray)
         dbg["deskew_deg"] = float(deg)
-        _, bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)  # type: ignore[attr-defined]
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, 1))  # type: ignore[attr-defined]
-        bw = cv2.morphologyEx(bw, cv2.MORPH_OPEN, kernel, iterations=1)  # type: ignore[attr-defined]
-        blur = cv2.GaussianBlur(bw, (0, 0), 1.0)  # type: ignore[attr-defined]
-        sharp = cv2.addWeighted(bw, 1.4, blur, -0.4, 0)  # type: ignore[attr-defined]
-        out = _cv_to_pil(cv2.cvtColor(sharp, cv2.COLOR_GRAY2BGR))  # type: ignore[attr-defined]
+        cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU, dst=gray)  # type: ignore[attr-defined]
+        # (MORPH_OPEN kernel 1x1 trước đây là phép đồng nhất → bỏ)
+        blur = cv2.GaussianBlur(gray, (0, 0), 1.0)  # type: ignore[attr-defined]
+        cv2.addWeighted(gray, 1.4, blur, -0.4, 0, dst=gray)  # type: ignore[attr-defined]
+        out = gray
     else:
-        out = img.convert("L")
+        pil = Image.fromarray(img).convert("L")  # type: ignore[union-attr]
         try:
             if ImageOps:
-                out = ImageOps.autocontrast(out, cutoff=1)
+                pil = ImageOps.autocontrast(pil, cutoff=1)
             if ImageFilter:
-                out = out.filter(ImageFilter.SHARPEN)
+                pil = pil.filter(ImageFilter.SHARPEN)
         except Exception:
             pass
+        out = _np.asarray(pil)
     return out, dbg
 
-def _maybe_upscale(img: PILImage) -> tuple[PILImage, dict]:
-    dbg = {"factor": 1.0, "before": img.size, "after": img.size, "reason": ""}
-    if not OCR_UPSCALE_ENABLE or Image is None:
+def _maybe_upscale(img: CVMat) -> tuple[CVMat, dict]:
+    import numpy as _np
+    h, w = img.shape[:2]
+    dbg = {"factor": 1.0, "before": (w, h), "after": (w, h), "reason": ""}
+    if not OCR_UPSCALE_ENABLE or (Image is None and cv2 is None):
         return img, dbg
-    w, h = img.size
     min_side = min(w, h)
     if min_side >= OCR_UPSCALE_MIN_SIDE:
         dbg["reason"] = "big-enough"
@@ -335,15 +454,12 @@ def _maybe_upscale(img: PILImage) -> tuple[PILImage, dict]:
     if factor <= 1.01:
         dbg["reason"] = "pixel/side-limited"
         return img, dbg
-    try:
-        if OCR_UPSCALE_ALGO.startswith("cv2") and cv2 is not None:
-            inter = cv2.INTER_LANCZOS4 if OCR_UPSCALE_ALGO.endswith("lanczos4") else cv2.INTER_CUBIC
-            out = _cv_to_pil(cv2.resize(_pil_to_cv(img), (nw, nh), interpolation=inter))  # type: ignore[attr-defined]
-        else:
-            res = Image.LANCZOS if OCR_UPSCALE_ALGO.startswith("pil") else Image.BICUBIC
-            out = img.resize((nw, nh), res)
-    except Exception:
-        out = img.resize((nw, nh), Image.LANCZOS if Image else None)  # type: ignore[arg-type]
+    if (OCR_UPSCALE_ALGO.startswith("cv2") and cv2 is not None) or Image is None:
+        inter = cv2.INTER_LANCZOS4 if OCR_UPSCALE_ALGO.endswith("lanczos4") else cv2.INTER_CUBIC  # type: ignore[union-attr]
+        out = cv2.resize(img, (nw, nh), interpolation=inter)  # type: ignore[union-attr]
+    else:
+        res = Image.LANCZOS if OCR_UPSCALE_ALGO.startswith("pil") else Image.BICUBIC
+        out = _np.asarray(Image.fromarray(img).resize((nw, nh), res))
     dbg.update({"factor": float(factor), "after": (nw, nh), "reason": "small"})
     return out, dbg
 
@@ -359,43 +475,119 @@ def _tess_cfg(psm: str | None = None) -> str:
         cfg += f' --user-patterns "{up}"'
     return cfg
 
-def _osd_rotate(img: PILImage) -> tuple[PILImage, int | None]:
-    if pytesseract is None:
+def _tess_backend() -> str | None:
+    """Backend Tesseract thực dùng theo OCR_TESS_BACKEND (thiếu tesserocr → pytesseract)."""
+    if OCR_TESS_BACKEND in ("tesserocr", "auto") and tesserocr is not None:
+        return "tesserocr"
+    return "pytesseract" if pytesseract is not None else None
+
+def _tess_available() -> bool:
+    return _tess_backend() is not None
+
+# API tesserocr giữ sống theo (lang, oem) cho từng thread (PyTessBaseAPI không thread-safe). Worker OCR là
+# process riêng → mỗi worker nạp model `vie` đúng 1 lần; PSM đổi bằng SetPageSegMode, không cần Init lại.
+_TESS_API_LOCAL = threading.local()
+
+def _tess_api(lang: str, oem: Any = None) -> Any:
+    """Một PyTessBaseAPI / thread cho mỗi (lang, oem); oem=None → OCR_VI_OEM."""
+    if oem is None:
+        oem = OCR_VI_OEM
+    apis = getattr(_TESS_API_LOCAL, "apis", None)
+    if apis is None:
+        apis = _TESS_API_LOCAL.apis = {}
+    key = (lang, oem)
+    api = apis.get(key)
+    if api is None:
+        init_vars = {}
+        uw = os.getenv("OCR_VI_USER_WORDS", "").strip()
+        up = os.getenv("OCR_VI_USER_PATTERNS", "").strip()
+        if uw and os.path.isfile(uw):
+            init_vars["user_words_file"] = uw
+        if up and os.path.isfile(up):
+            init_vars["user_patterns_file"] = up
+        kw: dict[str, Any] = {"lang": lang, "oem": oem, "variables": init_vars}
+        if TESSDATA_PREFIX:
+            kw["path"] = TESSDATA_PREFIX
+        api = tesserocr.PyTessBaseAPI(**kw)  # type: ignore[union-attr]
+        for name, val in (("preserve_interword_spaces", "1"), ("tessedit_do_invert", "1"), ("user_defined_dpi", "400")):
+            api.SetVariable(name, val)
+        apis[key] = api
+    return api
+
+def _tess_set_image(api: Any, img: CVMat) -> None:
+    """Đưa buffer pixel (gray hoặc RGB ndarray) thẳng vào API — không encode PNG, không file tạm."""
+    import numpy as _np
+    arr = _np.ascontiguousarray(img, dtype=_np.uint8)
+    h, w = arr.shape[:2]
+    bpp = 1 if arr.ndim == 2 else arr.shape[2]
+    api.SetImageBytes(arr.tobytes(), w, h, bpp, w * bpp)
+
+def _osd_rotate(img: CVMat) -> tuple[CVMat, int | None]:
+    backend = _tess_backend()
+    if backend is None:
         return img, None
     try:
-        osd = pytesseract.image_to_osd(img)  # type: ignore[attr-defined]
-        m = re.search(r"Rotate: (\d+)", osd or "")
-        if m:
+        if backend == "tesserocr":
+            api = _tess_api("osd", oem=tesserocr.OEM.TESSERACT_ONLY)  # type: ignore[union-attr]  # osd: chỉ model legacy
+            api.SetPageSegMode(tesserocr.PSM.OSD_ONLY)  # type: ignore[union-attr]
+            _tess_set_image(api, img)
+            osd = api.DetectOrientationScript() or {}
+            orient = osd.get("orient_deg")
+            if orient is None:
+                return img, None
+            deg = (360 - int(orient)) % 360  # = "Rotate:" của image_to_osd
+        else:
+            osd = pytesseract.image_to_osd(img)  # type: ignore[attr-defined]
+            m = re.search(r"Rotate: (\d+)", osd or "")
+            if not m:
+                return img, None
             deg = int(m.group(1)) % 360
-            if deg and Image:
-                return img.rotate(360 - deg, expand=True), deg
-            return img, 0
-    except Exception:
-        pass
+        if deg:
+            import numpy as _np
+            # = PIL rotate(360 - deg, expand=True); rot90 là view → chỉ copy 1 lần cho buffer liền mạch
+            return _np.ascontiguousarray(_np.rot90(img, k=((360 - deg) // 90) % 4)), deg
+        return img, 0
+    except Exception as e:
+        logger.debug("OSD failed (%s): %s", backend, e)
     return img, None
 
-def _ocr_pil_tesseract(img: PILImage, *, lang: str) -> tuple[str, float | None]:
-    if pytesseract is None:
-        raise RuntimeError("pytesseract chưa sẵn sàng.")
-    img_rot, _ = _osd_rotate(img)
+def _tesserocr_read(pre: CVMat, *, lang: str, psm: str) -> tuple[str, float | None]:
+    api = _tess_api(lang)
+    api.SetPageSegMode(int(psm))
+    _tess_set_image(api, pre)
+    txt = api.GetUTF8Text() or ""
+    conf = api.MeanTextConf()  # 0..100 như image_to_data
+    return txt, (float(conf) if conf is not None and conf >= 0 else None)
+
+def _pytesseract_read(pre: CVMat, *, lang: str, psm: str) -> tuple[str, float | None]:
+    cfg = _tess_cfg(psm)
+    txt = pytesseract.image_to_string(pre, lang=lang, config=cfg) or ""  # type: ignore[attr-defined]
+    conf_val = None
+    try:
+        data = pytesseract.image_to_data(pre, lang=lang, config=cfg, output_type=pytesseract.Output.DICT)  # type: ignore[attr-defined]
+        confs = [float(c) for c in (data.get("conf") or []) if c not in ("-1", -1)]
+        if confs:
+            conf_val = sum(confs) / len(confs)
+    except Exception:
+        pass
+    return txt, conf_val
+
+def _ocr_pil_tesseract(img: CVMat, *, lang: str) -> tuple[str, float | None]:
+    backend = _tess_backend()
+    if backend is None:
+        raise RuntimeError("pytesseract / tesserocr chưa sẵn sàng.")
+    read = _tesserocr_read if backend == "tesserocr" else _pytesseract_read
+    img_rot, _ = _osd_rotate(_as_rgb_array(img))
     pre, _ = _preprocess_vi(img_rot)
+    _mem_sample()
     last_txt, last_conf = "", None
     for psm in (OCR_PSM_LIST or [OCR_VI_PSM, "6"]):
-        cfg = _tess_cfg(psm)
         try:
-            txt = pytesseract.image_to_string(pre, lang=lang, config=cfg) or ""  # type: ignore[attr-defined]
-            conf_val = None
-            try:
-                data = pytesseract.image_to_data(pre, lang=lang, config=cfg, output_type=pytesseract.Output.DICT)  # type: ignore[attr-defined]
-                confs = [float(c) for c in (data.get("conf") or []) if c not in ("-1", -1)]
-                if confs:
-                    conf_val = sum(confs) / len(confs)
-            except Exception:
-                pass
+            txt, conf_val = read(pre, lang=lang, psm=psm)
             if (conf_val or -1) > (last_conf or -1) or len(txt) > len(last_txt):
                 last_txt, last_conf = txt, conf_val
         except Exception as e:
-            logger.debug("PSM %s failed: %s", psm, e)
+            logger.debug("PSM %s failed (%s): %s", psm, backend, e)
             continue
     return last_txt, last_conf
 
@@ -412,12 +604,32 @@ def _gpu_diag() -> dict:
         "easyocr_imported": easyocr is not None,
         "EASYOCR_GPU": EASYOCR_GPU,
         "OCR_ENGINE": OCR_ENGINE,
+        "tess_backend": _tess_backend(),
         "AUTO_GPU_FIRST": OCR_AUTO_GPU_FIRST,
     }
     if OCR_DEBUG:
         logger.debug("GPU DIAG: %s", info)
     return info
 
+def warm_engines() -> None:
+    """Nạp Tesseract + EasyOCR 1 lần (initializer của worker OCR) → job đầu tiên không chịu cold-start."""
+    st = time.perf_counter()
+    backend = _tess_backend()
+    try:
+        if backend == "tesserocr":
+            for lang in dict.fromkeys((OCR_PDF_LANG, OCR_IMG_LANG)):
+                _tess_api(lang)
+        elif backend == "pytesseract":
+            pytesseract.get_tesseract_version()
+    except Exception as e:
+        logger.debug("tesseract warm-up failed (%s): %s", backend, e)
+    if easyocr is not None and OCR_ENGINE != "tesseract":
+        try:
+            _get_easyocr_reader(EASYOCR_LANGS, EASYOCR_GPU)
+        except Exception as e:
+            logger.debug("easyocr warm-up failed: %s", e)
+    logger.info("OCR engines warm in %.1fs (pid=%d)", time.perf_counter() - st, os.getpid())
+
 def _get_easyocr_reader(langs: list[str], gpu: bool):
     global _EASY_READER, _EASY_READER_KEY
     if easyocr is None:
@@ -438,17 +650,17 @@ def _langs_for_easyocr(lang_combo: str | None) -> list[str]:
     mapped = [c for c in mapped if c in {"vi", "en"}]
     return mapped or EASYOCR_LANGS
 
-def _easyocr_input_from_pil(img: PILImage):
-    import numpy as _np
-    arr = _np.asarray(img)
+def _easyocr_input_from_pil(img: PILImage | CVMat):
+    arr = _as_rgb_array(img)
     # EasyOCR (qua OpenCV) dùng BGR; nếu có cv2, convert RGB->BGR
     if cv2 is not None and arr.ndim == 3 and arr.shape[2] == 3:
         arr = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)  # type: ignore[attr-defined]
     return arr
 
-def _easyocr_read_pil(img: PILImage, langs: list[str], paragraph: bool | None = None) -> tuple[str, float | None]:
+def _easyocr_read_pil(img: PILImage | CVMat, langs: list[str], paragraph: bool | None = None) -> tuple[str, float | None]:
     reader = _get_easyocr_reader(langs, EASYOCR_GPU)
     np_img = _easyocr_input_from_pil(img)
+    _mem_sample()
 
     par = EASYOCR_PARAGRAPH if paragraph is None else bool(paragraph)
 
@@ -477,13 +689,14 @@ def _easyocr_read_pil(img: PILImage, langs: list[str], paragraph: bool | None =
 
     return txt, avg
 
-def _ocr_with_backend_pil(img: PILImage, *, lang_combo: str) -> tuple[str, float | None, str]:
-    img, _ = _maybe_upscale(img)
+def _ocr_with_backend_pil(img: PILImage | CVMat, *, lang_combo: str) -> tuple[str, float | None, str]:
+    img, _ = _maybe_upscale(_as_rgb_array(img))
 
     # forced backends
-    if OCR_ENGINE == "easyocr":
+    engine = _engine()
+    if engine == "easyocr":
         txt, conf = _easyocr_read_pil(img, _langs_for_easyocr(lang_combo)); used = "easyocr"
-        if len((txt or "").strip()) < MIN_CHARS_FALLBACK and pytesseract is not None:
+        if len((txt or "").strip()) < MIN_CHARS_FALLBACK and _tess_available():
             t2, c2 = _ocr_pil_tesseract(img, lang=lang_combo)
             if len(t2) > len(txt):
                 txt, conf, used = t2, c2, "tesseract"
@@ -491,7 +704,7 @@ def _ocr_with_backend_pil(img: PILImage, *, lang_combo: str) -> tuple[str, float
             logger.debug("Backend forced: %s", used)
         return txt, conf, used
 
-    if OCR_ENGINE == "tesseract":
+    if engine == "tesseract":
         txt, conf = _ocr_pil_tesseract(img, lang=lang_combo); used = "tesseract"
         if len((txt or "").strip()) < MIN_CHARS_FALLBACK and easyocr is not None:
             t2, c2 = _easyocr_read_pil(img, _langs_for_easyocr(lang_combo), paragraph=False)
@@ -512,7 +725,7 @@ def _ocr_with_backend_pil(img: PILImage, *, lang_combo: str) -> tuple[str, float
             except Exception as e:
                 if OCR_DEBUG:
                     logger.debug("EasyOCR GPU failed → fallback: %s", e)
-        if chosen is None and pytesseract is not None:
+        if chosen is None and _tess_available():
             try:
                 t, c = _ocr_pil_tesseract(img, lang=lang_combo)
                 chosen = (t, c, "tesseract")
@@ -523,7 +736,7 @@ def _ocr_with_backend_pil(img: PILImage, *, lang_combo: str) -> tuple[str, float
             t, c = _easyocr_read_pil(img, _langs_for_easyocr(lang_combo))
             chosen = (t, c, "easyocr")
     else:
-        if pytesseract is not None:
+        if _tess_available():
             try:
                 t, c = _ocr_pil_tesseract(img, lang=lang_combo)
                 chosen = (t, c, "tesseract")
@@ -540,7 +753,7 @@ def _ocr_with_backend_pil(img: PILImage, *, lang_combo: str) -> tuple[str, float
 
     # ✅ min-chars fallback trong chế độ auto
     if len((txt or "").strip()) < MIN_CHARS_FALLBACK:
-        if used == "easyocr" and pytesseract is not None:
+        if used == "easyocr" and _tess_available():
             t2, c2 = _ocr_pil_tesseract(img, lang=lang_combo)
             if len(t2) > len(txt):
                 txt, conf, used = t2, c2, "tesseract"
@@ -780,53 +993,348 @@ def _post_process(text: str) -> str:
     return out
 
 # ── Page header helper ────────────────────────────────────────────────────────
-def _wrap_page_header(i: int, total: int, body: str) -> str:
-    if not PAGE_MARK_ENABLE:
+def _wrap_page_header(i: int, total: int, body: str, *, enable: bool | None = None, fmt: str | None = None) -> str:
+    if not (PAGE_MARK_ENABLE if enable is None else enable):
         return (body or "").strip()
     try:
-        header = PAGE_MARK_FMT.format(i=i, total=total)
+        header = (fmt or PAGE_MARK_FMT).format(i=i, total=total)
     except Exception:
         header = f"=== [PAGE {i}/{total}] ==="
     body = (body or "").strip()
     return header + ("\n" + body if body else "")
 
+# ── Page cache (content-addressed) ────────────────────────────────────────────
+# Khoá = hash pixel trang đã render + cấu hình ảnh hưởng kết quả OCR (engine, ngôn ngữ, upscale, PSM…) →
+# bản sửa / thêm trang của cùng công văn, trang bìa / letterhead lặp lại chỉ OCR 1 lần.
+_PAGE_CACHE_VERSION = 1
+_TIER_STATS: Counter = Counter()   # số trang OCR theo bậc (process hiện tại)
+
+def ocr_stats() -> dict[str, Any]:
+    return {"tiers": dict(_TIER_STATS), "cache": _doc_cache().stats()}
+
+def _page_cache_salt(lang: str) -> bytes:
+    cfg = [
+        _PAGE_CACHE_VERSION, _engine(), lang, EASYOCR_LANGS, EASYOCR_PARAGRAPH, MIN_CHARS_FALLBACK,
+        OCR_AUTO_GPU_FIRST, _gpu_easyocr_path(_engine()), _tess_backend(), OCR_VI_OEM, OCR_VI_PSM, OCR_PSM_LIST,
+        OCR_UPSCALE_ENABLE, OCR_UPSCALE_MIN_SIDE, OCR_UPSCALE_MAX_SIDE, OCR_UPSCALE_MAX_PIXELS,
+        OCR_UPSCALE_FACTOR_MAX, OCR_UPSCALE_ALGO, OCR_FAST_MIN_CONF, OCR_FAST_MIN_DIACRITIC,
+    ]
+    return json.dumps(cfg, ensure_ascii=False).encode("utf-8")
+
+def _page_key(pixels: Any, shape: tuple[int, ...], lang: str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    h.update(_page_cache_salt(lang))
+    h.update(repr(shape).encode("ascii"))
+    h.update(pixels)
+    return h.hexdigest()
+
+def _page_cache_get(key: str) -> tuple[str, float | None, str, str | None, float | None] | None:
+    """(txt, conf, engine, tier, zoom) đã cache (doc_cache ns "pages" — chung ngưỡng dung lượng với cache cả file)."""
+    d = _doc_cache().get("pages", key)
+    if d is None:
+        return None
+    return str(d.get("t") or ""), d.get("c"), str(d.get("u") or "cache"), d.get("k"), d.get("z")
+
+def _page_cache_put(
+    key: str, txt: str, conf: float | None, used: str, *, tier: str | None = None, zoom: float | None = None,
+) -> None:
+    _doc_cache().put("pages", key, {"t": txt or "", "c": None if conf is None else float(conf), "u": used, "k": tier, "z": zoom})
+
 # ── Core: PDF & Image ─────────────────────────────────────────────────────────
+# ── Memory budget / RSS ───────────────────────────────────────────────────────
+# Ước lượng byte đỉnh / pixel khi OCR 1 trang: pixmap RGB 3 + bản upscale / BGR cho EasyOCR 3 + gray 1 + blur 1
+_BYTES_PER_PIXEL = 8
+_MEM_LOCAL = threading.local()
+
+def _rss_mb() -> float | None:
+    """RSS hiện tại của process (MB); không đọc được /proc → ru_maxrss (đỉnh từ lúc process chạy)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1048576.0, 1)
+    except Exception:
+        pass
+    try:
+        import resource
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    except Exception:
+        return None
+
+def _mem_reset() -> None:
+    _MEM_LOCAL.peak = None
+
+def _mem_sample() -> None:
+    """Gọi tại các điểm buffer trang đang sống (sau render / tiền xử lý) → giữ RSS lớn nhất của trang."""
+    cur = _rss_mb()
+    peak = getattr(_MEM_LOCAL, "peak", None)
+    if cur is not None and (peak is None or cur > peak):
+        _MEM_LOCAL.peak = cur
+
+def _mem_peak() -> float | None:
+    return getattr(_MEM_LOCAL, "peak", None)
+
+def _mem_plan(workers: int, pixel_limit: int) -> tuple[int, int]:
+    """(số trang OCR đồng thời, pixel limit) vừa OCR_JOB_MEM_MB: bớt trang song song trước, rồi hạ pixel limit."""
+    if OCR_JOB_MEM_MB <= 0:
+        return workers, pixel_limit
+    budget_px = OCR_JOB_MEM_MB * 1024 * 1024 // _BYTES_PER_PIXEL
+    w = max(1, min(workers, budget_px // max(1, pixel_limit)))
+    limit = max(OCR_MEM_MIN_PIXELS, min(pixel_limit, budget_px // w))
+    if w < workers or limit < pixel_limit:
+        logger.info("OCR mem budget %d MB → %d page(s) in flight, pixel limit %d", OCR_JOB_MEM_MB, w, limit)
+    return w, limit
+
+def _release_page_memory() -> None:
+    """Sau mỗi trang (khi có budget): trả store ảnh đã decode của MuPDF để RSS không phình theo số trang."""
+    if OCR_JOB_MEM_MB > 0 and fitz is not None:
+        try:
+            fitz.TOOLS.store_shrink(100)
+        except Exception:
+            pass
+
 def _eff_zoom_with_limit(zoom: float, w: float, h: float, limit: int) -> float:
     est = int(w * zoom) * int(h * zoom)
     if est <= limit:
         return zoom
     return zoom * math.sqrt(limit / max(1, est))
 
-def _pdf_extract_text_or_ocr(
-    file_path: str,
-    *,
-    lang: str,
-    dpi: int,
-    max_pages: int,
-    ocr_all: bool,
-    text_threshold: int,
-    pixel_limit: int,
-) -> tuple[str, list[PageInfo], int, int, str, list[dict[str, int]], list[str]]:
+def _pix_to_array(pix: Any) -> CVMat:
+    """View ndarray (H, W, 3) trên chính bộ nhớ pixmap — không copy. Giữ `pix` sống tới khi OCR xong."""
+    import numpy as _np
+    arr = _np.frombuffer(getattr(pix, "samples_mv", None) or pix.samples, dtype=_np.uint8)
+    arr = arr.reshape(pix.h, pix.w, pix.n)
+    return arr[:, :, :3] if pix.n == 4 else arr  # bỏ alpha nếu có
+
+def _render(pg: Any, zoom: float) -> Any:
+    return pg.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False, colorspace=fitz.csRGB)
+
+def _ocr_pdf_page(pg: Any, i: int, *, lang: str, base_zoom: float, pixel_limit: int) -> tuple[str, PageInfo, str]:
     """
-    Trả về:
-      - full (chưa hậu xử lý),
-      - pages_info,
-      - total, ocr_pages, engine_mix,
-      - page_spans (chưa trim),
-      - parts_noheader: list[str] (text theo trang, KHÔNG header, CHƯA hậu xử lý)
+    Render + OCR 1 trang PDF theo bậc (fast → full → engine khác → render 1.5x). Trả (body, PageInfo, engine).
+    Mỗi lúc chỉ giữ 1 pixmap: buffer bậc trước được nhả (pix = None) trước khi render bậc sau.
     """
+    st = time.perf_counter()
+    _mem_reset()
+    bbox = pg.rect
+    eff = _eff_zoom_with_limit(base_zoom, bbox.width, bbox.height, pixel_limit)
+    first = min(eff, OCR_FAST_DPI / 72.0) if OCR_FAST_DPI > 0 else eff
+    if first >= eff * 0.95:
+        first = eff
+    pix = _render(pg, first)
+    _mem_sample()
+
+    key = _page_key(getattr(pix, "samples_mv", None) or pix.samples, (pix.width, pix.height, pix.n), lang) if OCR_PAGE_CACHE else None
+    hit = _page_cache_get(key) if key else None
+    if hit is not None:
+        txt, conf, used, zoom_used = hit[0], hit[1], hit[2], (hit[4] or first)
+        tier = "cache"
+    else:
+        txt, tier, zoom_used = None, "fast", first
+        if first < eff:
+            txt, conf, used = _ocr_with_backend_pil(_pix_to_array(pix), lang_combo=lang)
+            if not _fast_pass_ok(txt, conf, lang):
+                txt = pix = None  # nhả buffer lượt rẻ trước khi render DPI đầy đủ
+                pix = _render(pg, eff)
+                _mem_sample()
+        if txt is None:
+            txt, conf, used, tier, retry = _ocr_full_page(_pix_to_array(pix), lang=lang)
+            zoom_used = eff
+            if retry:
+                eff2 = min(_eff_zoom_with_limit(eff * 1.5, bbox.width, bbox.height, pixel_limit), 400.0 / 72.0)
+                if eff2 > eff * 1.01:
+                    pix = None  # nhả buffer DPI đầy đủ trước khi render 1.5x
+                    try:
+                        pix = _render(pg, eff2)
+                        _mem_sample()
+                        t2, c2, u2 = _ocr_with_backend_pil(_pix_to_array(pix), lang_combo=lang)
+                        if _vi_retry_score(t2) >= _vi_retry_score(txt):
+                            txt, conf, used, tier, zoom_used = t2, c2, u2, "upscale", eff2
+                    except Exception:
+                        pass
+        if key:
+            _page_cache_put(key, txt, conf, used, tier=tier, zoom=zoom_used)
+    pix = None
+
+    body = (txt or "").strip()
+
+    if DROP_NOISE_PAGES:
+        d, a = _vi_quality_metrics(body)
+        if len(body) >= NOISE_MINLEN and a >= NOISE_ASCII_RATIO and d <= NOISE_DIACRITIC:
+            body = ""
+
+    info = PageInfo(
+        index=i,
+        source="ocr",
+        chars=len(body),
+        secs=time.perf_counter() - st,
+        dpi=int(72 * zoom_used),
+        avg_conf=None if conf is None else float(conf),
+        note=used,
+        tier=tier,
+        rss_mb=_mem_peak(),
+    )
+    return body, info, used
+
+def _vi_retry_score(s: str) -> float:
+    d, a = _vi_quality_metrics(s)
+    return d - 0.2 * max(0.0, a - 0.9)
+
+def _ocr_full_page(arr: CVMat, *, lang: str) -> tuple[str, float | None, str, str, bool]:
+    """OCR trang DPI đầy đủ; VI “rác” → thử engine khác. (txt, conf, engine, tier, retry) — retry: nên render 1.5x."""
+    txt, conf, used = _ocr_with_backend_pil(arr, lang_combo=lang)
+    if not _vi_ocr_looks_bad(txt, lang):
+        return txt, conf, used, "full", False
+    alt_txt, alt_conf, alt_used = txt, conf, used
+    try:
+        if used == "tesseract" and easyocr is not None:
+            alt_txt, alt_conf = _easyocr_read_pil(arr, _langs_for_easyocr(lang)); alt_used = "easyocr"
+        elif used == "easyocr" and _tess_available():
+            alt_txt, alt_conf = _ocr_pil_tesseract(arr, lang=lang); alt_used = "tesseract"
+    except Exception:
+        pass
+    if (_vi_retry_score(alt_txt) > _vi_retry_score(txt)) or (len(alt_txt) > len(txt) * 1.2):
+        return alt_txt, alt_conf, alt_used, "alt", False
+    return txt, conf, used, "full", True
+
+# ── Page-parallel OCR (process pool) ─────────────────────────────────────────
+# Mỗi trang cần OCR là 1 task độc lập (render + OCR + retry) → chạy trên pool process (spawn: an toàn với
+# fitz/torch, không fork trạng thái luồng). Worker giữ PDF đang mở để các trang kế tiếp không phải mở lại.
+OCR_PAGE_WORKERS = max(1, int(os.getenv("OCR_PAGE_WORKERS", str(max(1, min(8, (os.cpu_count() or 2) - 1))))))
+OCR_PAGE_WORKERS_GPU = max(1, int(os.getenv("OCR_PAGE_WORKERS_GPU", "1")))   # EasyOCR GPU: GPU đã song song sẵn
+OCR_PARALLEL_MIN_PAGES = max(2, int(os.getenv("OCR_PARALLEL_MIN_PAGES", "2")))
+
+_PAGE_POOL: Any = None
+_PAGE_POOL_LOCK = threading.Lock()
+_WORKER_DOC: dict[tuple[str, float, int], Any] = {}
+
+def _gpu_easyocr_path(engine: str) -> bool:
+    if not (EASYOCR_GPU and easyocr is not None and torch is not None):
+        return False
+    try:
+        if not torch.cuda.is_available():  # type: ignore[attr-defined]
+            return False
+    except Exception:
+        return False
+    return engine == "easyocr" or (engine == "auto" and OCR_AUTO_GPU_FIRST)
+
+def _page_workers(engine: str) -> int:
+    return OCR_PAGE_WORKERS_GPU if _gpu_easyocr_path(engine) else OCR_PAGE_WORKERS
+
+def _get_page_pool(workers: int) -> Any:
+    global _PAGE_POOL
+    with _PAGE_POOL_LOCK:
+        if _PAGE_POOL is None:
+            import multiprocessing as _mp
+            from concurrent.futures import ProcessPoolExecutor
+            _PAGE_POOL = ProcessPoolExecutor(
+                max_workers=workers, mp_context=_mp.get_context("spawn"), initializer=warm_engines,
+            )
+            atexit.register(shutdown_page_pool)
+        return _PAGE_POOL
+
+def shutdown_page_pool() -> None:
+    global _PAGE_POOL
+    with _PAGE_POOL_LOCK:
+        pool, _PAGE_POOL = _PAGE_POOL, None
+    if pool is not None:
+        try:
+            pool.shutdown(wait=False, cancel_futures=True)
+        except Exception:
+            pass
+
+def _worker_open_pdf(file_path: str) -> Any:
+    st = os.stat(file_path)
+    key = (file_path, st.st_mtime, st.st_size)
+    doc = _WORKER_DOC.get(key)
+    if doc is None:
+        for old in _WORKER_DOC.values():
+            try:
+                old.close()
+            except Exception:
+                pass
+        _WORKER_DOC.clear()
+        doc = fitz.open(file_path)
+        _WORKER_DOC[key] = doc
+    return doc
+
+def _ocr_pdf_page_task(file_path: str, i: int, lang: str, base_zoom: float, pixel_limit: int, engine: str) -> tuple[int, str, PageInfo, str]:
+    """Chạy trong process worker (pool trang / pool OCR). engine truyền tường minh: caller ép engine theo lượt."""
+    st = time.perf_counter()
+    try:
+        pg = _worker_open_pdf(file_path).load_page(i)
+        with engine_override(engine):
+            body, info, used = _ocr_pdf_page(pg, i, lang=lang, base_zoom=base_zoom, pixel_limit=pixel_limit)
+        pg = None
+        _release_page_memory()
+        return i, body, info, used
+    except Exception as e:
+        return i, "", PageInfo(index=i, source="error", chars=0, secs=time.perf_counter() - st, note=str(e)), "error"
+
+def _ocr_pdf_page_isolated(
+    file_path: str, i: int, lang: str, base_zoom: float, pixel_limit: int, engine: str | None = None,
+) -> tuple[int, str, PageInfo, str]:
+    """Bản chạy trong thread của process hiện tại: tự mở/đóng PDF (không dùng doc cache của worker)."""
+    st = time.perf_counter()
+    try:
+        doc = fitz.open(file_path)
+        try:
+            with engine_override(engine):
+                body, info, used = _ocr_pdf_page(doc.load_page(i), i, lang=lang, base_zoom=base_zoom, pixel_limit=pixel_limit)
+        finally:
+            doc.close()
+            _release_page_memory()
+        return i, body, info, used
+    except Exception as e:
+        return i, "", PageInfo(index=i, source="error", chars=0, secs=time.perf_counter() - st, note=str(e)), "error"
+
+def _ocr_pages_parallel(
+    file_path: str, indices: list[int], *, lang: str, base_zoom: float, pixel_limit: int, workers: int,
+) -> dict[int, tuple[str, PageInfo, str]] | None:
+    """None → pool không dùng được (caller chạy tuần tự)."""
+    try:
+        pool = _get_page_pool(workers)
+        futs = [
+            pool.submit(_ocr_pdf_page_task, file_path, i, lang, base_zoom, pixel_limit, _engine())
+            for i in indices
+        ]
+        out: dict[int, tuple[str, PageInfo, str]] = {}
+        for f in futs:
+            i, body, info, used = f.result()
+            out[i] = (body, info, used)
+        return out
+    except Exception as e:
+        logger.warning("Parallel OCR unavailable (%s) → sequential", e)
+        shutdown_page_pool()
+        return None
+
+_BUDGET_NOTE = "budget"
+
+def page_count(file_path: str) -> int:
+    """Số trang (PDF) — rẻ, không render; ảnh = 1."""
+    if not _is_pdf(file_path):
+        return 1
+    if fitz is None:
+        return 0
+    doc = fitz.open(file_path)
+    try:
+        return len(doc)
+    finally:
+        doc.close()
+
+def _pdf_open(file_path: str, *, dpi: int, max_pages: int) -> tuple[Any, int, float]:
     if fitz is None:
         raise RuntimeError("PyMuPDF (fitz) chưa được cài, không thể xử lý PDF.")
     doc = fitz.open(file_path)
     total = min(len(doc), max_pages)
-    pages: list[PageInfo] = []
-    parts_wrapped: list[str] = []
-    parts_noheader: list[str] = []
-    ocr_pages = 0
-    engines = []
     base_zoom = max(dpi / 72.0, (OCR_UPSCALE_TARGET_DPI / 72.0) if OCR_UPSCALE_ENABLE else 1.0)
-    base_zoom = max(1.0, base_zoom)
+    return doc, total, max(1.0, base_zoom)
+
+def _pdf_order(total: int, only_pages: list[int] | None) -> list[int]:
+    return list(dict.fromkeys(i for i in only_pages if 0 <= i < total)) if only_pages is not None else list(range(total))
 
+def _pdf_classify(
+    doc: Any, total: int, order: list[int], *, ocr_all: bool, text_threshold: int,
+) -> tuple[list[tuple[str, PageInfo, str] | None], list[int]]:
+    """Trang có text layer → đọc luôn (slots[i]); trang cần OCR → ocr_idx (giữ thứ tự `order`)."""
     def _need_ocr(pg: Any) -> bool:
         if ocr_all:
             return True
@@ -836,103 +1344,42 @@ def _pdf_extract_text_or_ocr(
         except Exception:
             return True
 
-    for i in range(total):
-        pg = doc.load_page(i)
+    slots: list[tuple[str, PageInfo, str] | None] = [None] * total
+    ocr_idx: list[int] = []
+    for i in order:
         st = time.perf_counter()
         try:
+            pg = doc.load_page(i)
             if not _need_ocr(pg):
                 txt = pg.get_text("text") or ""
-                parts_wrapped.append(_wrap_page_header(i + 1, total, txt))
-                parts_noheader.append((txt or "").strip())
-                engines.append("fitz.text")
-                pages.append(PageInfo(index=i, source="pdf-text", chars=len(txt), secs=time.perf_counter() - st, note="fitz.text"))
-                continue
-
-            if Image is None:
-                parts_wrapped.append(_wrap_page_header(i + 1, total, ""))
-                parts_noheader.append("")
-                pages.append(PageInfo(index=i, source="skipped", chars=0, secs=time.perf_counter() - st, note="NO_IMAGE_LIB"))
-                engines.append("skipped")
-                continue
-
-            bbox = pg.rect
-            eff = _eff_zoom_with_limit(base_zoom, bbox.width, bbox.height, pixel_limit)
-            pix = pg.get_pixmap(matrix=fitz.Matrix(eff, eff), alpha=False, colorspace=fitz.csRGB)
-
-            # ✅ PNG-less path: dựng PIL Image trực tiếp từ buffer pixmap (nhanh hơn)
-            import numpy as _np
-            _arr = _np.frombuffer(pix.samples, dtype=_np.uint8)
-            _arr = _arr.reshape(pix.h, pix.w, pix.n)
-            if pix.n == 4:
-                _arr = _arr[:, :, :3]  # bỏ alpha nếu có
-            pil = Image.fromarray(_arr, mode="RGB")
-
-            txt, conf, used = _ocr_with_backend_pil(pil, lang_combo=lang)
-
-            # VI “rác” → thử engine khác hoặc upscale lần 2
-            if _vi_ocr_looks_bad(txt, lang):
-                alt_txt, alt_conf, alt_used = txt, conf, used
-                try:
-                    if used == "tesseract" and easyocr is not None:
-                        alt_txt, alt_conf = _easyocr_read_pil(pil, _langs_for_easyocr(lang)); alt_used = "easyocr"
-                    elif used == "easyocr" and pytesseract is not None:
-                        alt_txt, alt_conf = _ocr_pil_tesseract(pil, lang=lang); alt_used = "tesseract"
-                except Exception:
-                    pass
-
-                def _score(s: str) -> float:
-                    d, a = _vi_quality_metrics(s)
-                    return d - 0.2 * max(0.0, a - 0.9)
-
-                if (_score(alt_txt) > _score(txt)) or (len(alt_txt) > len(txt) * 1.2):
-                    txt, conf, used = alt_txt, alt_conf, alt_used
-                else:
-                    try:
-                        eff2 = min(_eff_zoom_with_limit(eff * 1.5, bbox.width, bbox.height, pixel_limit), 400.0 / 72.0)
-                        if eff2 > eff * 1.01:
-                            pix2 = pg.get_pixmap(matrix=fitz.Matrix(eff2, eff2), alpha=False, colorspace=fitz.csRGB)
-                            _arr2 = _np.frombuffer(pix2.samples, dtype=_np.uint8).reshape(pix2.h, pix2.w, pix2.n)
-                            if pix2.n == 4:
-                                _arr2 = _arr2[:, :, :3]
-                            pil2 = Image.fromarray(_arr2, mode="RGB")
-                            t2, c2, u2 = _ocr_with_backend_pil(pil2, lang_combo=lang)
-                            if _score(t2) >= _score(txt):
-                                txt, conf, used = t2, c2, u2
-                    except Exception:
-                        pass
-
-            body = (txt or "").strip()
-
-            if DROP_NOISE_PAGES:
-                d, a = _vi_quality_metrics(body)
-                if len(body) >= NOISE_MINLEN and a >= NOISE_ASCII_RATIO and d <= NOISE_DIACRITIC:
-                    body = ""
+                slots[i] = (txt, PageInfo(index=i, source="pdf-text", chars=len(txt), secs=time.perf_counter() - st, note="fitz.text"), "fitz.text")
+            elif Image is None:
+                slots[i] = ("", PageInfo(index=i, source="skipped", chars=0, secs=time.perf_counter() - st, note="NO_IMAGE_LIB"), "skipped")
+            else:
+                ocr_idx.append(i)
+        except Exception as e:
+            slots[i] = ("", PageInfo(index=i, source="error", chars=0, secs=time.perf_counter() - st, note=str(e)), "error")
+    return slots, ocr_idx
 
-            parts_wrapped.append(_wrap_page_header(i + 1, total, body))
-            parts_noheader.append(body)
+def _pdf_assemble(
+    slots: list[tuple[str, PageInfo, str] | None], total: int,
+) -> tuple[str, list[PageInfo], int, int, str, list[dict[str, int]], list[str]]:
+    """Ghép kết quả từng trang (đúng thứ tự) → full + pages_info + spans + parts_noheader (chưa hậu xử lý)."""
+    pages: list[PageInfo] = []
+    parts_wrapped: list[str] = []
+    parts_noheader: list[str] = []
+    ocr_pages = 0
+    engines = []
+    for i in range(total):
+        body, info, used = slots[i] or ("", PageInfo(index=i, source="skipped", chars=0, secs=0.0, note=_BUDGET_NOTE), "skipped")
+        parts_wrapped.append(_wrap_page_header(i + 1, total, body))
+        parts_noheader.append((body or "").strip())
+        pages.append(info)
+        engines.append(used)
+        if info.source == "ocr":
             ocr_pages += 1
-            engines.append(used)
-            pages.append(
-                PageInfo(
-                    index=i,
-                    source="ocr",
-                    chars=len(body),
-                    secs=time.perf_counter() - st,
-                    dpi=int(72 * eff),
-                    avg_conf=None if conf is None else float(conf),
-                    note=used,
-                )
-            )
             if OCR_DEBUG:
                 logger.debug("Page %d/%d used %s", i + 1, total, used)
-        except Exception as e:
-            engines.append("error")
-            pages.append(PageInfo(index=i, source="error", chars=0, secs=time.perf_counter() - st, note=str(e)))
-            parts_wrapped.append(_wrap_page_header(i + 1, total, ""))
-            parts_noheader.append("")
-            continue
-
-    doc.close()
 
     parts_wrapped = _apply_post_filters(parts_wrapped)
 
@@ -962,9 +1409,67 @@ def _pdf_extract_text_or_ocr(
 
     page_spans = [_adjust_span(s) for s in spans_tmp]
 
-    pdf_text_pages = max(0, total - ocr_pages)
     return full, pages, total, ocr_pages, "+".join(sorted(set(engines)) or ["unknown"]), page_spans, parts_noheader
 
+def _pdf_extract_text_or_ocr(
+    file_path: str,
+    *,
+    lang: str,
+    dpi: int,
+    max_pages: int,
+    ocr_all: bool,
+    text_threshold: int,
+    pixel_limit: int,
+    only_pages: list[int] | None = None,
+    budget_chars: int = 0,
+) -> tuple[str, list[PageInfo], int, int, str, list[dict[str, int]], list[str]]:
+    """
+    Trả về:
+      - full (chưa hậu xử lý),
+      - pages_info,
+      - total, ocr_pages, engine_mix,
+      - page_spans (chưa trim),
+      - parts_noheader: list[str] (text theo trang, KHÔNG header, CHƯA hậu xử lý)
+    Trang có text layer đọc tuần tự (rẻ); trang cần OCR chạy song song trên pool process, ghép lại đúng thứ tự.
+    only_pages (0-based, theo thứ tự ưu tiên) / budget_chars: chỉ xử lý các trang đó, dừng khi đủ ký tự; trang
+    không xử lý → PageInfo(source="skipped", note=_BUDGET_NOTE), text rỗng.
+    """
+    doc, total, base_zoom = _pdf_open(file_path, dpi=dpi, max_pages=max_pages)
+
+    # 1) phân loại trang: text layer / cần OCR (chỉ các trang trong only_pages nếu caller giới hạn)
+    slots, ocr_idx = _pdf_classify(doc, total, _pdf_order(total, only_pages), ocr_all=ocr_all, text_threshold=text_threshold)
+
+    # 2) OCR: song song nếu đủ trang, ngược lại (hoặc pool lỗi) tuần tự trong process hiện tại.
+    #    budget_chars > 0 → OCR theo từng đợt (= số worker) đúng thứ tự `order`, dừng khi đã đủ ký tự.
+    #    OCR_JOB_MEM_MB > 0 → cũng theo đợt = số trang được phép OCR đồng thời (pool có thể lớn hơn).
+    workers, pixel_limit = _mem_plan(_page_workers(_engine()), pixel_limit)
+    workers = min(workers, len(ocr_idx))
+    wave = max(1, workers) if (budget_chars > 0 or OCR_JOB_MEM_MB > 0) else max(1, len(ocr_idx))
+    got = sum(len(x[0]) for x in slots if x)
+    pos = 0
+    while pos < len(ocr_idx) and not (budget_chars > 0 and got >= budget_chars):
+        batch = ocr_idx[pos:pos + wave]
+        pos += wave
+        done: dict[int, tuple[str, PageInfo, str]] | None = None
+        if workers > 1 and len(batch) >= OCR_PARALLEL_MIN_PAGES:
+            done = _ocr_pages_parallel(file_path, batch, lang=lang, base_zoom=base_zoom, pixel_limit=pixel_limit, workers=workers)
+        if done is None:
+            done = {}
+            for i in batch:
+                st = time.perf_counter()
+                try:
+                    done[i] = _ocr_pdf_page(doc.load_page(i), i, lang=lang, base_zoom=base_zoom, pixel_limit=pixel_limit)
+                except Exception as e:
+                    done[i] = ("", PageInfo(index=i, source="error", chars=0, secs=time.perf_counter() - st, note=str(e)), "error")
+                _release_page_memory()
+        for i, res in done.items():
+            slots[i] = res
+            got += len(res[0])
+    doc.close()
+
+    # 3) ghép theo đúng thứ tự trang
+    return _pdf_assemble(slots, total)
+
 def _image_ocr(file_path: str, *, lang: str) -> tuple[str, list[PageInfo], int, int, str, list[str]]:
     if Image is None:
         raise RuntimeError("Thiếu Pillow để OCR ảnh.")
@@ -976,7 +1481,14 @@ def _image_ocr(file_path: str, *, lang: str) -> tuple[str, list[PageInfo], int,
                 img = ImageOps.exif_transpose(img)
         except Exception:
             pass
-        txt, conf, used = _ocr_with_backend_pil(img, lang_combo=lang)
+        key = _page_key(img.tobytes(), (img.width, img.height, 3), lang) if OCR_PAGE_CACHE else None
+        hit = _page_cache_get(key) if key else None
+        if hit is not None:
+            txt, conf, used = hit[0], hit[1], hit[2]
+        else:
+            txt, conf, used = _ocr_with_backend_pil(img, lang_combo=lang)
+            if key:
+                _page_cache_put(key, txt, conf, used)
     secs = time.perf_counter() - st
     body = (txt or "").strip()
     wrapped = _wrap_page_header(1, 1, body) if PAGE_MARK_ENABLE else body
@@ -990,177 +1502,220 @@ def _image_ocr(file_path: str, *, lang: str) -> tuple[str, list[PageInfo], int,
     )
 
 # ── Public API ────────────────────────────────────────────────────────────────
-def extract_text(
-    file_path: str,
-    *,
-    lang: str | None = None,
-    dpi: int | None = None,
-    max_pages: int | None = None,
-    ocr_all: bool | None = None,
-    cache_dir: str | None = None,
-    write_meta: bool = True,  # kept for API compatibility (unused externally)
-    ext: str | None = None,   # ditto
-) -> OCRResult:
-    if not os.path.isfile(file_path):
-        raise FileNotFoundError(file_path)
-    _lang = (lang or (OCR_PDF_LANG if _is_pdf(file_path) else OCR_IMG_LANG)).strip() or "vie+eng"
-    _dpi = int(dpi or OCR_MIN_DPI)
-    _max = int(max_pages or OCR_MAX_PAGES)
-    _ocr_all = bool(OCR_FORCE_OCR_ALL if ocr_all is None else ocr_all)
-    _cache = os.path.abspath(cache_dir or OCR_CACHE_DIR)
+_CACHE_NS = "ocr"     # namespace kết quả OCR cả file trong doc_cache (trang: "pages")
 
-    sha1 = _sha1_file(file_path)
-    base = os.path.join(_cache, sha1[:2], sha1)
-    text_path = base + ".txt"
-    meta_path = base + ".json"
-    _ensure_dir(os.path.dirname(text_path))
+def _doc_cache(root: str | None = None) -> Any:
+    from modules.chat.service import doc_cache
+    return doc_cache.get_cache(root or OCR_CACHE_DIR)
 
-    # cache
-    if os.path.exists(text_path):
-        try:
-            text_cached = _read_text(text_path)
-            total_pages = ocr_pages = pdf_text_pages = 0
-            engine = "cache"
-            pages: list[PageInfo] = []
-            avg_conf = None
-            page_spans: list[dict[str, int]] | None = None
-            pages_text: list[str] | None = None
-            if os.path.exists(meta_path):
-                try:
-                    with open(meta_path, "r", encoding="utf-8") as mf:
-                        meta = json.load(mf)
-                    total_pages = _safe_int(meta.get("total_pages"), 0)
-                    ocr_pages = _safe_int(meta.get("ocr_pages"), 0)
-                    pdf_text_pages = _safe_int(meta.get("pdf_text_pages"), 0)
-                    engine = str(meta.get("engine") or "cache")
-                    avg_conf = meta.get("avg_confidence", None)
-                    page_spans = meta.get("page_spans")
-                    raw_pages = meta.get("pages") or []
-                    for p in raw_pages:
-                        pages.append(
-                            PageInfo(
-                                index=_safe_int(p.get("index"), 0),
-                                source=str(p.get("source") or ""),
-                                chars=_safe_int(p.get("chars"), 0),
-                                secs=float(p.get("secs") or 0.0),
-                                dpi=_safe_int_or_none(p.get("dpi")),
-                                note=p.get("note"),
-                                avg_conf=p.get("avg_conf"),
-                            )
-                        )
-                    # Ưu tiên đọc sẵn pages_text; nếu không có, dựng lại từ spans
-                    pages_text = meta.get("pages_text")
-                    if (not pages_text) and page_spans:
-                        pages_text = []
-                        for s in page_spans:
-                            seg = text_cached[s["start"] : s["end"]]
-                            if PAGE_MARK_ENABLE and seg.startswith("="):
-                                seg = seg.split("\n", 1)[1] if "\n" in seg else ""
-                            pages_text.append(seg.strip())
-                    # Đồng bộ độ dài nếu cần
-                    if pages_text and total_pages and len(pages_text) != total_pages:
-                        # co giãn an toàn
-                        if len(pages_text) > total_pages:
-                            pages_text = pages_text[:total_pages]
-                        else:
-                            pages_text = pages_text + [""] * (total_pages - len(pages_text))
-                except Exception:
-                    pass
-            dia, asc = _vi_quality_metrics(text_cached)
-            return OCRResult(
-                True,
-                text_cached,
-                text_path,
-                True,
-                total_pages,
-                ocr_pages,
-                pdf_text_pages,
-                pages,
-                engine,
-                is_pdf=_is_pdf(file_path),
-                page_spans=page_spans,
-                pages_text=pages_text,
-                meta_path=meta_path if os.path.exists(meta_path) else None,
-                avg_confidence=avg_conf,
-                diacritic_ratio=dia,
-                ascii_word_ratio=asc,
-            )
-        except Exception:
-            pass
-
-    # run
+def _content_key(file_path: str) -> str:
+    """Khoá cache theo nội dung: file là tham chiếu tới kho blob upload → sha256 có sẵn trong tên blob
+    (không đọc lại file); file thường → sha1 như trước."""
     try:
-        if _is_pdf(file_path):
-            full_raw, pages, total, ocrn, engine, page_spans, parts_noheader = _pdf_extract_text_or_ocr(
-                file_path,
-                lang=_lang,
-                dpi=_dpi,
-                max_pages=_max,
-                ocr_all=_ocr_all,
-                text_threshold=OCR_TEXT_THRESHOLD,
-                pixel_limit=OCR_PIXEL_LIMIT,
-            )
-            pdf_text_pages = max(0, total - ocrn)
-            # Hậu xử lý theo TRANG để có pages_text
-            pages_text_pp: list[str] = []
-            for body in parts_noheader:
-                t = _normalize_vi_text(body)
-                t = _post_process(t) if POST_ENABLE else t
-                pages_text_pp.append(t)
-            # Build full text từ pages_text_pp (kèm header theo config)
-            joined_parts = [_wrap_page_header(i + 1, total, pages_text_pp[i]) for i in range(total)]
-            text_norm = "\n\n".join(joined_parts).strip()
-            # Cập nhật spans dựa trên text đã hậu xử lý
-            spans_fixed: list[dict[str, int]] = []
-            pos = 0
-            for i, part in enumerate(joined_parts):
-                start = pos
-                pos += len(part)
-                spans_fixed.append({"page": i + 1, "start": start, "end": pos})
-                if i < len(joined_parts) - 1:
-                    pos += 2  # cho "\n\n"
-            page_spans = spans_fixed
-        elif _is_image(file_path):
-            full_raw, pages, total, ocrn, engine, parts_noheader = _image_ocr(file_path, lang=_lang)
-            pdf_text_pages = 0
-            # Hậu xử lý 1 trang
-            t = _normalize_vi_text(parts_noheader[0])
-            t = _post_process(t) if POST_ENABLE else t
-            pages_text_pp = [t]
-            text_norm = _wrap_page_header(1, 1, t) if PAGE_MARK_ENABLE else t
-            page_spans = [{"page": 1, "start": 0, "end": len(text_norm)}]
-        else:
-            raise RuntimeError("Định dạng tệp không hỗ trợ OCR.")
-    except Exception as e:
-        logger.exception("OCR failed: %s", e)
+        from shared.file_storage import blob_digest
+        digest = blob_digest(file_path)
+    except Exception:
+        digest = None
+    return digest or _sha1_file(file_path)
+
+def _cache_paths(file_path: str, cache_dir: str | None) -> tuple[str, str]:
+    """(khoá nội dung file, thư mục gốc cache OCR)."""
+    return _content_key(file_path), os.path.abspath(cache_dir or OCR_CACHE_DIR)
+
+def _join_pages(pages_text: list[str], mark: list[Any] | None = None) -> str:
+    """Dựng lại full text từ pages_text (như _pdf_postprocess) — entry cache không lưu text trùng lặp."""
+    enable, fmt = (mark or [PAGE_MARK_ENABLE, PAGE_MARK_FMT])[:2]
+    total = len(pages_text)
+    return "\n\n".join(_wrap_page_header(i + 1, total, t, enable=enable, fmt=fmt) for i, t in enumerate(pages_text)).strip()
+
+def _pages_from_meta(raw_pages: list[dict[str, Any]]) -> list[PageInfo]:
+    return [
+        PageInfo(
+            index=_safe_int(p.get("index"), 0),
+            source=str(p.get("source") or ""),
+            chars=_safe_int(p.get("chars"), 0),
+            secs=float(p.get("secs") or 0.0),
+            dpi=_safe_int_or_none(p.get("dpi")),
+            note=p.get("note"),
+            avg_conf=p.get("avg_conf"),
+            tier=p.get("tier"),
+            rss_mb=p.get("rss_mb"),
+        )
+        for p in raw_pages or []
+    ]
+
+def _legacy_entry(root: str, sha1: str) -> dict[str, Any] | None:
+    """Cache định dạng cũ (<sha1>.txt + <sha1>.json chép lại pages_text) → entry mới; xoá file cũ sau khi chuyển."""
+    base = os.path.join(root, sha1[:2], sha1)
+    text_path, meta_path = base + ".txt", base + ".json"
+    if not os.path.exists(text_path):
+        return None
+    try:
+        text_cached = _read_text(text_path)
+        meta: dict[str, Any] = {}
+        if os.path.exists(meta_path):
+            try:
+                with open(meta_path, "r", encoding="utf-8") as mf:
+                    meta = json.load(mf) or {}
+            except Exception:
+                meta = {}
+        total_pages = _safe_int(meta.get("total_pages"), 0)
+        page_spans = meta.get("page_spans")
+        # Ưu tiên đọc sẵn pages_text; nếu không có, dựng lại từ spans
+        pages_text = meta.pop("pages_text", None)
+        if (not pages_text) and page_spans:
+            pages_text = []
+            for sp in page_spans:
+                seg = text_cached[sp["start"] : sp["end"]]
+                if PAGE_MARK_ENABLE and seg.startswith("="):
+                    seg = seg.split("\n", 1)[1] if "\n" in seg else ""
+                pages_text.append(seg.strip())
+        # Đồng bộ độ dài nếu cần
+        if pages_text and total_pages and len(pages_text) != total_pages:
+            if len(pages_text) > total_pages:
+                pages_text = pages_text[:total_pages]
+            else:
+                pages_text = pages_text + [""] * (total_pages - len(pages_text))
+        meta["pages_text"] = pages_text
+        meta["text"] = text_cached
+    except Exception:
+        return None
+    return meta
+
+def _read_cache(file_path: str, root: str, sha1: str) -> OCRResult | None:
+    """Kết quả OCR đầy đủ đã cache (doc_cache ns "ocr"; định dạng cũ → chuyển đổi); None nếu chưa có / hỏng."""
+    cache = _doc_cache(root)
+    entry = cache.get(_CACHE_NS, sha1)
+    if entry is None:
+        entry = _legacy_entry(root, sha1)
+        if entry is None:
+            return None
+        _cache_put_entry(cache, sha1, entry)
+        for ext in (".txt", ".json"):
+            try:
+                os.remove(os.path.join(root, sha1[:2], sha1 + ext))
+            except OSError:
+                pass
+    try:
+        pages_text = entry.get("pages_text")
+        text_cached = entry.get("text")
+        if text_cached is None:
+            text_cached = _join_pages(pages_text or [], entry.get("mark"))
+        dia, asc = _vi_quality_metrics(text_cached)
+        path = cache.path(_CACHE_NS, sha1)
         return OCRResult(
-            False,
-            "",
-            None,
-            False,
-            0,
-            0,
-            0,
-            [],
-            engine=f"error:{type(e).__name__}",
+            True,
+            text_cached,
+            path,
+            True,
+            _safe_int(entry.get("total_pages"), 0),
+            _safe_int(entry.get("ocr_pages"), 0),
+            _safe_int(entry.get("pdf_text_pages"), 0),
+            _pages_from_meta(entry.get("pages") or []),
+            str(entry.get("engine") or "cache"),
             is_pdf=_is_pdf(file_path),
-            page_spans=None,
-            pages_text=None,
-            meta_path=None,
-            avg_confidence=None,
-            diacritic_ratio=None,
-            ascii_word_ratio=None,
-            error=str(e),
+            page_spans=entry.get("page_spans"),
+            pages_text=pages_text,
+            meta_path=path,
+            avg_confidence=entry.get("avg_confidence", None),
+            diacritic_ratio=dia,
+            ascii_word_ratio=asc,
+            peak_rss_mb=entry.get("peak_rss_mb"),
         )
+    except Exception:
+        pass
+    return None
 
+def _cache_put_entry(cache: Any, sha1: str, entry: dict[str, Any]) -> str | None:
+    """Ghi entry; text trùng với pages_text ghép lại → bỏ (chỉ giữ pages_text + cấu hình header trang)."""
+    entry = dict(entry)
+    pages_text = entry.get("pages_text")
+    entry["mark"] = [PAGE_MARK_ENABLE, PAGE_MARK_FMT]
+    if pages_text is not None and entry.get("text") == _join_pages(pages_text, entry["mark"]):
+        entry["text"] = None
+    return cache.put(_CACHE_NS, sha1, entry)
+
+def _pdf_postprocess(total: int, parts_noheader: list[str]) -> tuple[str, list[dict[str, int]], list[str]]:
+    """Hậu xử lý theo trang → (text_norm, page_spans, pages_text)."""
+    # Hậu xử lý theo TRANG để có pages_text
+    pages_text_pp: list[str] = []
+    for body in parts_noheader:
+        t = _normalize_vi_text(body)
+        t = _post_process(t) if POST_ENABLE else t
+        pages_text_pp.append(t)
+    # Build full text từ pages_text_pp (kèm header theo config)
+    joined_parts = [_wrap_page_header(i + 1, total, pages_text_pp[i]) for i in range(total)]
+    text_norm = "\n\n".join(joined_parts).strip()
+    # Cập nhật spans dựa trên text đã hậu xử lý
+    spans_fixed: list[dict[str, int]] = []
+    pos = 0
+    for i, part in enumerate(joined_parts):
+        start = pos
+        pos += len(part)
+        spans_fixed.append({"page": i + 1, "start": start, "end": pos})
+        if i < len(joined_parts) - 1:
+            pos += 2  # cho "\n\n"
+    page_spans = spans_fixed
+    return text_norm, page_spans, pages_text_pp
+
+def _finish_result(
+    file_path: str,
+    *,
+    sha1: str,
+    root: str,
+    lang: str,
+    dpi: int,
+    max_pages: int,
+    ocr_all: bool,
+    text_norm: str,
+    pages: list[PageInfo],
+    total: int,
+    ocrn: int,
+    pdf_text_pages: int,
+    engine: str,
+    page_spans: list[dict[str, int]] | None,
+    pages_text_pp: list[str],
+    partial: bool,
+) -> OCRResult:
+    """Metrics + ghi cache (trừ khi partial) → OCRResult."""
     # Metrics
+    tiers = Counter(p.tier for p in pages if p.tier)
+    if tiers:
+        _TIER_STATS.update(tiers)
+        logger.info("OCR tiers %s: %s", os.path.basename(file_path), dict(tiers))
+    peak = max([r for r in [_rss_mb(), *(p.rss_mb for p in pages)] if r is not None], default=None)
+    if peak is not None:
+        logger.info("OCR peak RSS %s: %.0f MB (%d pages)", os.path.basename(file_path), peak, total)
     dia, asc = _vi_quality_metrics(text_norm)
     confs = [p.avg_conf for p in pages if p.source in ("ocr", "image-ocr") and isinstance(p.avg_conf, (int, float))]
     avg_conf_tot = (sum(float(c) for c in confs) / len(confs)) if confs else None
 
-    # Cache write
+    if partial:
+        # chỉ 1 phần trang → không ghi cache (lượt OCR đầy đủ chạy nền sẽ ghi)
+        return OCRResult(
+            True,
+            text_norm,
+            None,
+            False,
+            total,
+            ocrn,
+            pdf_text_pages,
+            pages,
+            engine,
+            is_pdf=True,
+            page_spans=page_spans,
+            pages_text=pages_text_pp,
+            meta_path=None,
+            avg_confidence=avg_conf_tot,
+            diacritic_ratio=dia,
+            ascii_word_ratio=asc,
+            complete=False,
+            peak_rss_mb=peak,
+        )
+
+    # Cache write: 1 entry nén (meta + pages_text; full text chỉ lưu khi khác bản ghép từ pages_text)
+    entry_path: str | None = None
     try:
-        _write_text(text_path, text_norm)
         meta_obj = {
             "file_name": os.path.basename(file_path),
             "sha1": sha1,
@@ -1168,14 +1723,17 @@ def extract_text(
             "total_pages": total,
             "ocr_pages": ocrn,
             "pdf_text_pages": pdf_text_pages,
+            "tiers": dict(tiers),
+            "peak_rss_mb": peak,
             "pages": [asdict(p) for p in pages],
             "page_spans": page_spans,    # ✅ lưu map trang → offset
             "pages_text": pages_text_pp, # ✅ lưu text theo trang (đÃ hậu xử lý)
+            "text": text_norm,
             "created_at": int(time.time()),
-            "lang": _lang,
-            "dpi": _dpi,
-            "max_pages": _max,
-            "ocr_all": _ocr_all,
+            "lang": lang,
+            "dpi": dpi,
+            "max_pages": max_pages,
+            "ocr_all": ocr_all,
             "python": sys.version.split()[0],
             "avg_confidence": avg_conf_tot,
             "diacritic_ratio": dia,
@@ -1201,17 +1759,14 @@ def extract_text(
             },
             "diag": _gpu_diag() if OCR_DEBUG else None,
         }
-        _ensure_dir(os.path.dirname(meta_path))
-        with open(meta_path, "w", encoding="utf-8") as f:
-            json.dump(meta_obj, f, ensure_ascii=False, indent=2)
+        entry_path = _cache_put_entry(_doc_cache(root), sha1, meta_obj)
     except Exception as e:
         logger.warning("Không thể ghi cache OCR: %s", e)
-        meta_path = None  # noqa: F841
 
     return OCRResult(
         True,
         text_norm,
-        text_path,
+        entry_path,
         False,
         total,
         ocrn,
@@ -1221,11 +1776,108 @@ def extract_text(
         is_pdf=_is_pdf(file_path),
         page_spans=page_spans,
         pages_text=pages_text_pp,
-        meta_path=meta_path if ("meta_path" in locals() and meta_path and os.path.exists(meta_path)) else None,
+        meta_path=entry_path,
         avg_confidence=avg_conf_tot,
         diacritic_ratio=dia,
         ascii_word_ratio=asc,
         error=None,
+        peak_rss_mb=peak,
+    )
+
+def extract_text(
+    file_path: str,
+    *,
+    lang: str | None = None,
+    dpi: int | None = None,
+    max_pages: int | None = None,
+    ocr_all: bool | None = None,
+    cache_dir: str | None = None,
+    write_meta: bool = True,  # kept for API compatibility (unused externally)
+    ext: str | None = None,   # ditto
+    only_pages: list[int] | None = None,  # PDF: chỉ OCR các trang này (0-based, theo thứ tự ưu tiên)
+    budget_chars: int | None = None,      # PDF: dừng khi đã đủ chừng này ký tự
+) -> OCRResult:
+    if not os.path.isfile(file_path):
+        raise FileNotFoundError(file_path)
+    _lang = (lang or (OCR_PDF_LANG if _is_pdf(file_path) else OCR_IMG_LANG)).strip() or "vie+eng"
+    _dpi = int(dpi or OCR_MIN_DPI)
+    _max = int(max_pages or OCR_MAX_PAGES)
+    _ocr_all = bool(OCR_FORCE_OCR_ALL if ocr_all is None else ocr_all)
+
+    sha1, root = _cache_paths(file_path, cache_dir)
+
+    cached = _read_cache(file_path, root, sha1)
+    if cached is not None:
+        return cached
+
+    # run
+    try:
+        if _is_pdf(file_path):
+            full_raw, pages, total, ocrn, engine, page_spans, parts_noheader = _pdf_extract_text_or_ocr(
+                file_path,
+                lang=_lang,
+                dpi=_dpi,
+                max_pages=_max,
+                ocr_all=_ocr_all,
+                text_threshold=OCR_TEXT_THRESHOLD,
+                pixel_limit=OCR_PIXEL_LIMIT,
+                only_pages=only_pages,
+                budget_chars=int(budget_chars or 0),
+            )
+            partial = any(p.source == "skipped" and p.note == _BUDGET_NOTE for p in pages)
+            pdf_text_pages = max(0, total - ocrn)
+            text_norm, page_spans, pages_text_pp = _pdf_postprocess(total, parts_noheader)
+        elif _is_image(file_path):
+            full_raw, pages, total, ocrn, engine, parts_noheader = _image_ocr(file_path, lang=_lang)
+            pdf_text_pages = 0
+            # Hậu xử lý 1 trang
+            t = _normalize_vi_text(parts_noheader[0])
+            t = _post_process(t) if POST_ENABLE else t
+            pages_text_pp = [t]
+            partial = False
+            text_norm = _wrap_page_header(1, 1, t) if PAGE_MARK_ENABLE else t
+            page_spans = [{"page": 1, "start": 0, "end": len(text_norm)}]
+        else:
+            raise RuntimeError("Định dạng tệp không hỗ trợ OCR.")
+    except Exception as e:
+        logger.exception("OCR failed: %s", e)
+        return OCRResult(
+            False,
+            "",
+            None,
+            False,
+            0,
+            0,
+            0,
+            [],
+            engine=f"error:{type(e).__name__}",
+            is_pdf=_is_pdf(file_path),
+            page_spans=None,
+            pages_text=None,
+            meta_path=None,
+            avg_confidence=None,
+            diacritic_ratio=None,
+            ascii_word_ratio=None,
+            error=str(e),
+        )
+
+    return _finish_result(
+        file_path,
+        sha1=sha1,
+        root=root,
+        lang=_lang,
+        dpi=_dpi,
+        max_pages=_max,
+        ocr_all=_ocr_all,
+        text_norm=text_norm,
+        pages=pages,
+        total=total,
+        ocrn=ocrn,
+        pdf_text_pages=pdf_text_pages,
+        engine=engine,
+        page_spans=page_spans,
+        pages_text_pp=pages_text_pp,
+        partial=partial,
     )
 
 # ── Page span helpers (dùng trong RAG/QA) ─────────────────────────────────────
@@ -1265,9 +1917,151 @@ def guess_pages_from_snippet(text: str, page_spans: list[dict[str, int]] | None,
     return pages_for_range(page_spans, max(0, pos - fuzz), min(len(text), pos + len(probe) + fuzz))
 
 # ── Async ─────────────────────────────────────────────────────────────────────
-async def extract_text_async(*args, **kwargs) -> OCRResult:
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: extract_text(*args, **kwargs))
+async def extract_text_async(*args, priority: int = 0, engine: str | None = None, **kwargs) -> OCRResult:
+    """OCR trên pool process riêng (ocr_pool, engine đã nạp sẵn); priority nhỏ = chạy trước; engine=None → OCR_ENGINE."""
+    from modules.chat.service import ocr_pool
+    return await ocr_pool.extract_text(*args, priority=priority, engine=engine or OCR_ENGINE, **kwargs)
+
+def _page_preview(body: str) -> str:
+    t = _normalize_vi_text(body or "")
+    return (_post_process(t) if POST_ENABLE else t).strip()
+
+async def iter_pages_async(
+    file_path: str,
+    *,
+    lang: str | None = None,
+    dpi: int | None = None,
+    max_pages: int | None = None,
+    ocr_all: bool | None = None,
+    cache_dir: str | None = None,
+    only_pages: list[int] | None = None,
+    budget_chars: int | None = None,
+    engine: str | None = None,
+    priority: int = 0,
+) -> AsyncIterator[PageEvent]:
+    """
+    OCR dạng stream: phát PageEvent khi từng trang xong (trang text layer trước, trang OCR theo thứ tự hoàn
+    thành) → caller báo tiến độ "trang N/M" và dừng sớm. Event cuối mang OCRResult (giống extract_text:
+    ghi cache nếu đủ trang; budget_chars đầy → dừng, complete=False). Ảnh / cache hit → 1 lượt.
+    Trang cần OCR chạy trên pool OCR dùng chung (ocr_pool) với `priority`, như extract_text_async.
+    """
+    from concurrent.futures.process import BrokenProcessPool
+    from modules.chat.service import ocr_pool
+
+    if not _is_pdf(file_path):
+        res = await extract_text_async(
+            file_path, lang=lang, ocr_all=ocr_all, cache_dir=cache_dir, engine=engine, priority=priority,
+        )
+        yield PageEvent(1, 1, 1, 1, (res.pages_text or [res.text])[0] if res.ok else "", res.engine, result=res)
+        return
+    if not os.path.isfile(file_path):
+        raise FileNotFoundError(file_path)
+    _lang = (lang or OCR_PDF_LANG).strip() or "vie+eng"
+    _dpi = int(dpi or OCR_MIN_DPI)
+    _max = int(max_pages or OCR_MAX_PAGES)
+    _ocr_all = bool(OCR_FORCE_OCR_ALL if ocr_all is None else ocr_all)
+    _budget = int(budget_chars or 0)
+    engine = engine or OCR_ENGINE
+
+    sha1, root = await asyncio.to_thread(_cache_paths, file_path, cache_dir)
+    cached = await asyncio.to_thread(_read_cache, file_path, root, sha1)
+    if cached is not None:
+        yield PageEvent(0, cached.total_pages, cached.total_pages, cached.total_pages, result=cached)
+        return
+
+    def _classify() -> tuple[int, float, list[int], list[tuple[str, PageInfo, str] | None], list[int]]:
+        doc, total, base_zoom = _pdf_open(file_path, dpi=_dpi, max_pages=_max)
+        try:
+            order = _pdf_order(total, only_pages)
+            slots, ocr_idx = _pdf_classify(doc, total, order, ocr_all=_ocr_all, text_threshold=OCR_TEXT_THRESHOLD)
+            return total, base_zoom, order, slots, ocr_idx
+        finally:
+            doc.close()
+
+    total, base_zoom, order, slots, ocr_idx = await asyncio.to_thread(_classify)
+    planned = len(order)
+    done = 0
+    got = 0
+    for i in order:
+        if slots[i] is not None:
+            done += 1
+            got += len(slots[i][0])
+            yield PageEvent(i + 1, total, done, planned, _page_preview(slots[i][0]), slots[i][1].source)
+
+    # cửa sổ tối đa `workers` trang đang OCR; budget đầy → không gửi thêm.
+    # Mỗi trang là 1 job của pool OCR dùng chung → chung hàng đợi ưu tiên + trần OCR_JOB_WORKERS process với
+    # extract_text_async (1 PDF scan dài không chiếm thêm process / chen trước job ưu tiên cao hơn).
+    workers, pixel_limit = _mem_plan(max(1, _page_workers(engine)), OCR_PIXEL_LIMIT)
+    pool = ocr_pool.get_pool() if ocr_pool.OCR_POOL_ENABLED else None
+    if pool is not None:
+        workers = min(workers, pool.workers)
+    label = os.path.basename(file_path)
+    queue = list(ocr_idx)
+    inflight: dict[asyncio.Future, int] = {}
+
+    def _submit(i: int) -> None:
+        if pool is not None:
+            fut = asyncio.wrap_future(pool.submit(
+                _ocr_pdf_page_task, file_path, i, _lang, base_zoom, pixel_limit, engine,
+                priority=priority, label=f"{label}#p{i + 1}",
+            ))
+        else:
+            fut = asyncio.ensure_future(asyncio.to_thread(
+                _ocr_pdf_page_isolated, file_path, i, _lang, base_zoom, pixel_limit, engine,
+            ))
+        inflight[fut] = i
+
+    try:
+        while queue or inflight:
+            while queue and len(inflight) < workers and not (_budget > 0 and got >= _budget):
+                _submit(queue.pop(0))
+            if not inflight:
+                break
+            finished, _ = await asyncio.wait(list(inflight), return_when=asyncio.FIRST_COMPLETED)
+            for fut in finished:
+                i = inflight.pop(fut)
+                try:
+                    _, body, info, used = fut.result()
+                except (ocr_pool.OcrPoolUnavailable, BrokenProcessPool) as e:
+                    # pool OCR hỏng → trang này + các trang còn lại OCR trong thread
+                    if pool is not None:
+                        logger.warning("OCR pool unavailable (%s) → in-process page OCR", e)
+                        pool = None
+                    queue.insert(0, i)
+                    continue
+                except Exception as e:
+                    body, info, used = "", PageInfo(index=i, source="error", chars=0, secs=0.0, note=str(e)), "error"
+                slots[i] = (body, info, used)
+                done += 1
+                got += len(body)
+                yield PageEvent(i + 1, total, done, planned, _page_preview(body), info.source)
+    finally:
+        for fut in inflight:
+            fut.cancel()
+
+    def _finish() -> OCRResult:
+        full_raw, pages, tot, ocrn, eng, page_spans, parts_noheader = _pdf_assemble(slots, total)
+        text_norm, page_spans, pages_text_pp = _pdf_postprocess(tot, parts_noheader)
+        return _finish_result(
+            file_path,
+            sha1=sha1,
+            root=root,
+            lang=_lang,
+            dpi=_dpi,
+            max_pages=_max,
+            ocr_all=_ocr_all,
+            text_norm=text_norm,
+            pages=pages,
+            total=tot,
+            ocrn=ocrn,
+            pdf_text_pages=max(0, tot - ocrn),
+            engine=eng,
+            page_spans=page_spans,
+            pages_text_pp=pages_text_pp,
+            partial=any(p.source == "skipped" and p.note == _BUDGET_NOTE for p in pages),
+        )
+
+    yield PageEvent(0, total, done, planned, result=await asyncio.to_thread(_finish))
 
 # ── Metrics (optional) ────────────────────────────────────────────────────────
 def _lev_ed(r: str, h: str) -> int:
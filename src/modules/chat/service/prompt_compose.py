@@ -1,4 +1,22 @@
 # file: src/modules/chat/service/prompt_compose.py
+# updated: 2025-09-29 (v1.5.1)
+# changes (v1.5.1):
+#   - relevant_doc_text() trả (text, is_excerpt): fallback full text tài liệu gần nhất không còn bị gắn nhãn
+#     "các đoạn liên quan" ở caller.
+#
+# updated: 2025-09-12 (v1.5.0)
+# changes (v1.5.0):
+#   - relevant_doc_text(): top-k đoạn liên quan tới câu hỏi trên mọi tài liệu của chat (doc_index, BM25 trên
+#     chunk đã tạo lúc upload) thay cho full text tài liệu mới nhất ở luồng thường; fallback latest_doc_text.
+#   - compose_user_prompt(last_doc_is_excerpt=True) đổi nhãn khối tài liệu cho đúng nội dung.
+#
+# updated: 2025-09-11 (v1.4.0)
+# changes (v1.4.0):
+#   - Đóng gói ngữ cảnh theo ngân sách token (pack_context): đếm bằng tokenizer của ModelVariant
+#     (shared/tokenizer.py) thay vì len/4; lấp ngân sách theo ưu tiên hướng dẫn → câu hỏi → tài liệu →
+#     RAG → transcript → memory; trả số token đã dùng của từng khối.
+#   - prompt_token_budget(): cửa sổ model − max_tokens đầu ra − PROMPT_TOKEN_RESERVE.
+#
 # updated: 2025-09-03 (v1.3.0)
 # changes (v1.3.0):
 #   - SIMPLE MODE cho “Phân loại phòng ban”: thêm compose_user_prompt_for_department_classify_natural()
@@ -18,15 +36,23 @@ from __future__ import annotations
 import os
 import re
 import json
-from typing import Any, Optional, List, Dict
+from dataclasses import dataclass, field
+from typing import Any, Optional, List, Dict, Tuple
 from sqlalchemy import select
 
+from shared import tokenizer as _tok
+
 try:
     from core.db.models import Document
 except Exception:
     # Cho phép import module ngay cả khi môi trường dev thiếu models
     Document = None  # type: ignore
 
+try:
+    from modules.chat.service import doc_index as _doc_index
+except Exception:
+    _doc_index = None  # type: ignore
+
 # Tích hợp email_scheduler (nếu module khả dụng)
 try:
     from modules.chat.service import email_scheduler as es
@@ -35,11 +61,16 @@ except Exception:
 
 UPLOAD_ROOT = os.path.abspath(os.getenv("UPLOAD_ROOT", os.path.join("uploads")))
 DEFAULT_RAG_TOP_K = int(os.getenv("RAG_TOP_K", "6") or "6")
+PROMPT_TOKEN_RESERVE = int(os.getenv("PROMPT_TOKEN_RESERVE", "512") or "512")      # chừa cho system/template chat
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "0") or "0")            # >0: trần cứng cho USER prompt
+PROMPT_TOKEN_MIN_BUDGET = int(os.getenv("PROMPT_TOKEN_MIN_BUDGET", "4096") or "4096")
+PROMPT_PACK_MIN_BLOCK = int(os.getenv("PROMPT_PACK_MIN_BLOCK", "64") or "64")      # phần còn lại < ngưỡng → bỏ khối
 
 __all__ = [
     # Helpers chung
     "strip_appendix",
     "latest_doc_text",
+    "relevant_doc_text",
     "dedup_recent_pairs_against_doc",
     "build_tool_block_for_classify",
     "compose_user_prompt",
@@ -49,6 +80,10 @@ __all__ = [
     "latest_pinned_attachment_text",
     "compose_email_update_user_prompt_from_db",
     "compose_email_update_user_prompt",
+    # Ngân sách token
+    "PackedContext",
+    "prompt_token_budget",
+    "pack_context",
 ]
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -188,6 +223,23 @@ def latest_doc_text(session: Any, chat_id: str, *, include_header: bool = True)
     label = os.path.basename(rel_txt)
     return f"[{label}]\n{body}"
 
+def relevant_doc_text(
+    session: Any, chat_id: str, question: str, *, top_k: Optional[int] = None,
+) -> Tuple[str, bool]:
+    """
+    Các đoạn liên quan tới câu hỏi trên TẤT CẢ tài liệu của chat (chỉ mục chunk — doc_index).
+    Chỉ mục tắt / chưa có tài liệu nào chunk được → fallback full text tài liệu gần nhất.
+    Trả (text, is_excerpt): is_excerpt=False khi text là full text của fallback.
+    """
+    if _doc_index is not None and _doc_index.DOC_RETRIEVAL_ENABLED:
+        try:
+            text = _doc_index.relevant_text(session, chat_id, strip_appendix(question or ""), top_k=top_k)
+            if text:
+                return text, True
+        except Exception:
+            pass
+    return latest_doc_text(session, chat_id, include_header=True), False
+
 # ──────────────────────────────────────────────────────────────────────────────
 # III. Hỗ trợ RAG “Phân loại văn bản” (tùy chọn)
 # ──────────────────────────────────────────────────────────────────────────────
@@ -227,6 +279,7 @@ def compose_user_prompt(
     glb_text: str,
     recent_pairs: str,
     last_doc_text: str = "",
+    last_doc_is_excerpt: bool = False,
     memory_soft_ack: bool = False,
     extra_instructions: Optional[str] = None,
     # “classification_mode” giữ để tương thích ngược; mặc định KHÔNG dùng.
@@ -237,7 +290,7 @@ def compose_user_prompt(
     Hợp nhất “Câu hỏi hiện tại” + “Ngữ cảnh” vào 1 USER prompt (không ép định dạng).
     Nội dung:
       - Câu hỏi hiện tại
-      - Dữ liệu text thô của file văn bản gần nhất (nếu có)
+      - Dữ liệu text thô của file văn bản gần nhất, hoặc các đoạn liên quan (last_doc_is_excerpt)
       - Dữ liệu bộ nhớ Global
       - Đoạn chat gần đây
     """
@@ -245,7 +298,10 @@ def compose_user_prompt(
 
     ctx_chunks: list[str] = []
     if last_doc_text:
-        ctx_chunks.append("• Trích tệp gần đây nhất (raw, full):\n" + last_doc_text)
+        if last_doc_is_excerpt:
+            ctx_chunks.append("• Các đoạn liên quan trong tệp của hội thoại (trích theo câu hỏi):\n" + last_doc_text)
+        else:
+            ctx_chunks.append("• Trích tệp gần đây nhất (raw, full):\n" + last_doc_text)
 
     ctx_chunks.append("• Ghi nhớ cá nhân (global):\n" + (glb_text.strip() if (glb_text or "").strip() else "(trống)"))
 
@@ -578,3 +634,82 @@ def compose_email_update_user_prompt_from_db(
 
     full_text = latest_pinned_attachment_text(session, chat_id, include_header=True, prefer_main_when_empty=True)
     return compose_email_update_user_prompt(ctx, attachment_full_text=full_text, extra_instructions=extra_instructions)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# VII. Đóng gói ngữ cảnh theo ngân sách token
+# ──────────────────────────────────────────────────────────────────────────────
+
+# (khối, phía giữ khi phải cắt) — theo thứ tự ưu tiên sau hướng dẫn + câu hỏi
+_PACK_ORDER = (
+    ("doc", "head"),
+    ("rag", "head"),
+    ("recent", "tail"),   # transcript: giữ các lượt mới nhất
+    ("glb", "head"),
+)
+
+
+@dataclass
+class PackedContext:
+    doc: str = ""
+    rag: str = ""
+    recent: str = ""
+    glb: str = ""
+    budget: int = 0
+    tokenizer: str = ""
+    used: Dict[str, int] = field(default_factory=dict)       # token từng khối (sau khi cắt)
+    truncated: List[str] = field(default_factory=list)
+    dropped: List[str] = field(default_factory=list)
+
+    @property
+    def total(self) -> int:
+        return sum(self.used.values())
+
+
+def prompt_token_budget(provider_model_id: Optional[str], max_output_tokens: int) -> int:
+    """Số token tối đa cho USER prompt: cửa sổ model − đầu ra − phần chừa (trần PROMPT_TOKEN_BUDGET nếu đặt)."""
+    budget = _tok.context_window(provider_model_id) - max(0, int(max_output_tokens or 0)) - PROMPT_TOKEN_RESERVE
+    budget = max(PROMPT_TOKEN_MIN_BUDGET, budget)
+    if PROMPT_TOKEN_BUDGET > 0:
+        budget = min(budget, PROMPT_TOKEN_BUDGET)
+    return budget
+
+
+def pack_context(
+    *,
+    provider_model_id: Optional[str],
+    budget: int,
+    fixed_prompt: str,
+    question: str = "",
+    doc: str = "",
+    rag: str = "",
+    recent: str = "",
+    glb: str = "",
+) -> PackedContext:
+    """
+    Lấp ngân sách theo ưu tiên: hướng dẫn + câu hỏi (fixed_prompt = prompt compose với các khối rỗng,
+    luôn giữ) → tài liệu → RAG → transcript → memory. Khối không vừa thì cắt; phần còn lại quá nhỏ thì bỏ.
+    """
+    tok = _tok.for_model(provider_model_id)
+    out = PackedContext(budget=budget, tokenizer=tok.name)
+    q_tok = tok.count(question or "")
+    out.used["question"] = q_tok
+    out.used["instructions"] = max(0, tok.count(fixed_prompt or "") - q_tok)
+    left = budget - out.total
+
+    blocks = {"doc": doc or "", "rag": rag or "", "recent": recent or "", "glb": glb or ""}
+    for name, keep in _PACK_ORDER:
+        text = blocks[name].strip()
+        if not text:
+            continue
+        n = tok.count(text)
+        if n > left:
+            if left < PROMPT_PACK_MIN_BLOCK:
+                out.dropped.append(name)
+                continue
+            text = tok.truncate(text, left, keep=keep)
+            n = tok.count(text)
+            out.truncated.append(name)
+        setattr(out, name, text)
+        out.used[name] = n
+        left -= n
+    return out
@@ -1,5 +1,10 @@
 # file: src/modules/chat/service/text_extract.py
-# updated: 2025-08-31 (v1.3.1)
+# updated: 2025-09-28 (v1.4.0)
+# changes (v1.4.0):
+#   - Cache kết quả theo nội dung (TEXTEX_CACHE=1): khoá = sha256 file (blob upload → có sẵn) + đuôi + TEXTEX_VERSION
+#     + các giới hạn đọc; lưu qua doc_cache namespace "textex" trong OCR_CACHE_DIR → chung ngưỡng dung lượng / LRU /
+#     stats với cache OCR. Upload lại cùng file (báo cáo tháng, bảng tính lớn) không phải parse lại.
+#     Chỉ cache kết quả ok; text trùng với pages_text ghép lại thì không lưu 2 lần. Hit → meta["cache"] = "hit".
 # purpose:
 #   - Trích xuất văn bản thô từ: DOC/DOCX/RTF/ODT, XLS/XLSX/CSV/ODS,
 #     PPT/PPTX/ODP, TXT/SVG và nhiều file mã nguồn phổ biến (kể cả .ipynb).
@@ -17,15 +22,20 @@ import os
 import re
 import csv
 import json
+import hashlib
+import logging
 import zipfile
 from dataclasses import dataclass
-from typing import Optional, List, Dict, Iterable
+from typing import Any, Optional, List, Dict, Iterable
 
 __all__ = [
     "extract_text", "SimpleResult",
     "DOCS", "SHEETS", "SLIDES", "CODE", "OTHERS",
+    "TEXTEX_VERSION",
 ]
 
+logger = logging.getLogger("docaix.text_extract")
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Cấu hình (có thể tinh chỉnh bằng ENV)
 # ──────────────────────────────────────────────────────────────────────────────
@@ -43,6 +53,11 @@ XLSX_CELL_LIMIT          = _env_int("TEXTEX_XLSX_CELL_LIMIT", 20000)
 PPTX_SLIDE_LIMIT         = _env_int("TEXTEX_PPTX_SLIDE_LIMIT", 500)
 CSV_SNIFF_BYTES          = _env_int("TEXTEX_CSV_SNIFF_BYTES", 128 * 1024)
 ODF_XML_STRIP            = True  # gọn XML → text
+TEXTEX_CACHE             = os.getenv("TEXTEX_CACHE", "1").strip() != "0"
+
+# Đổi khi logic trích xuất đổi output → entry cache cũ tự hết hiệu lực
+TEXTEX_VERSION = "1.4.0"
+_CACHE_NS = "textex"
 
 @dataclass
 class SimpleResult:
@@ -422,6 +437,58 @@ CODE = {
 }
 OTHERS = {"txt", "svg", "log"}
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Cache theo nội dung (doc_cache, chung thư mục + ngưỡng với cache OCR)
+# ──────────────────────────────────────────────────────────────────────────────
+def _cache_key(path: str, e: str) -> Optional[str]:
+    try:
+        from shared.file_storage import file_digest
+        digest = file_digest(path)
+    except Exception:
+        return None
+    limits = (READ_MAX_BYTES, CSV_ROW_LIMIT, XLS_CELL_LIMIT, XLSX_CELL_LIMIT, PPTX_SLIDE_LIMIT, CSV_SNIFF_BYTES)
+    raw = f"{digest}|{e}|{TEXTEX_VERSION}|{limits}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def _cache() -> Any:
+    from modules.chat.service import doc_cache
+    return doc_cache.get_cache()
+
+def _cache_get(key: str) -> Optional[SimpleResult]:
+    try:
+        entry = _cache().get(_CACHE_NS, key)
+    except Exception as ex:
+        logger.debug("textex cache read failed: %s", ex)
+        return None
+    if not entry or entry.get("v") != TEXTEX_VERSION:
+        return None
+    pages = entry.get("pages_text")
+    text = entry.get("text")
+    if text is None:
+        text = _normalize_spaces(entry.get("sep", "\n").join(pages or []))
+    meta = dict(entry.get("meta") or {})
+    meta["cache"] = "hit"
+    return SimpleResult(ok=True, text=text, pages_text=pages, total_pages=entry.get("total_pages"), meta=meta)
+
+def _cache_put(key: str, res: SimpleResult) -> None:
+    entry: Dict[str, Any] = {
+        "v": TEXTEX_VERSION,
+        "pages_text": res.pages_text,
+        "total_pages": res.total_pages,
+        "meta": res.meta or {},
+    }
+    # text = pages_text ghép lại (xlsx / pptx / odp…) → chỉ lưu cách ghép
+    for sep in ("\n", "\n\n"):
+        if res.pages_text and _normalize_spaces(sep.join(res.pages_text)) == res.text:
+            entry["sep"] = sep
+            break
+    else:
+        entry["text"] = res.text
+    try:
+        _cache().put(_CACHE_NS, key, entry)
+    except Exception as ex:
+        logger.debug("textex cache write failed: %s", ex)
+
 def extract_text(path: str, ext: Optional[str] = None) -> SimpleResult:
     """
     Trả về SimpleResult:
@@ -429,11 +496,22 @@ def extract_text(path: str, ext: Optional[str] = None) -> SimpleResult:
         - text: str (toàn bộ text rút ra — có thể rỗng)
         - pages_text: List[str] hoặc None (nếu có khái niệm 'trang')
         - total_pages: int hoặc None
-        - meta: dict phụ (kind/…)
+        - meta: dict phụ (kind/…; "cache": "hit" khi lấy từ cache)
     Không raise exception ra ngoài.
     """
     e = (ext or os.path.splitext(path)[1][1:] or "").lower()
 
+    key = _cache_key(path, e) if TEXTEX_CACHE else None
+    if key:
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+    res = _extract_uncached(path, e)
+    if key and res.ok:
+        _cache_put(key, res)
+    return res
+
+def _extract_uncached(path: str, e: str) -> SimpleResult:
     try:
         if e in {"docx"}:
             txt = _docx(path)
@@ -0,0 +1,194 @@
+# file: src/modules/chat/service/transcript.py
+# updated: 2025-09-10 (v1.0.0)
+# purpose:
+#   - Transcript gần đây (User/Assistant) cho prompt, dùng chung chat_api + email_scheduler
+#   - Chỉ đọc CỬA SỔ CUỐI của chat: ORDER BY message_created_at DESC LIMIT n trên index
+#     ix_chat_messages_chat_created (message_chat_id, message_created_at DESC) → chi phí theo cửa sổ,
+#     không theo độ dài chat (trước đây load toàn bộ ChatMessage rồi bỏ gần hết)
+#   - Cache theo chat (LRU) text transcript đã format; hợp lệ khi "stamp" của chat không đổi:
+#       * chat_histories.chat_updated_at — trigger trg_sync_chat_tokens bump mỗi khi chat_messages
+#         INSERT/UPDATE/DELETE (kể cả từ process khác: worker riêng / web khác)
+#       * invalidate(chat_id) — gọi ngay sau khi ghi message trong process này
+#
+# ENV:
+#   TRANSCRIPT_CACHE_CHATS=512       # số chat giữ trong cache (0 = tắt cache)
+#   TRANSCRIPT_PAGE_SLACK=8          # đọc thêm bấy nhiêu dòng mỗi trang (bù message queued/canceled bị lọc)
+#
+# Ghi chú:
+#   - Kết quả giống hệt cách cũ: lấy tối đa max_msgs cặp hợp lệ cuối cùng, cắt đầu theo limit_chars.
+#   - Dừng đọc sớm khi đã đủ max_msgs cặp hoặc đủ limit_chars ký tự (phần cũ hơn đằng nào cũng bị cắt).
+
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select, tuple_
+
+from core.db.models import ChatHistory, ChatMessage
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = os.getenv(name, "")
+        return int(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+TRANSCRIPT_CACHE_CHATS = max(0, _env_int("TRANSCRIPT_CACHE_CHATS", 512))
+TRANSCRIPT_PAGE_SLACK = max(0, _env_int("TRANSCRIPT_PAGE_SLACK", 8))
+
+# câu trả lời "chưa có" → không đưa vào transcript
+_PENDING_ANSWERS = ("(queued)", "(canceled)")
+_APPENDIX_MARKER = "\n\n---\n(Trích nội dung từ tệp đính kèm"
+
+
+def strip_appendix(q: str) -> str:
+    """Bỏ phần trích tệp đính kèm đã nối vào câu hỏi."""
+    if not q:
+        return q
+    i = q.find(_APPENDIX_MARKER)
+    return q if i < 0 else q[:i].rstrip()
+
+
+# ───────────────── cache ─────────────────
+@dataclass
+class _Entry:
+    stamp: Any
+    key: Tuple[int, int, bool]
+    text: str
+
+
+_LOCK = threading.Lock()
+_CACHE: "OrderedDict[str, _Entry]" = OrderedDict()
+_STATS: Dict[str, int] = {"hits": 0, "misses": 0}
+
+
+def invalidate(chat_id: Optional[str]) -> None:
+    """Gọi sau khi thêm/sửa message của chat (process hiện tại)."""
+    if not chat_id:
+        return
+    with _LOCK:
+        _CACHE.pop(chat_id, None)
+
+
+def stats() -> Dict[str, int]:
+    with _LOCK:
+        return {"size": len(_CACHE), **_STATS}
+
+
+def _cache_get(chat_id: str, stamp: Any, key: Tuple[int, int, bool]) -> Optional[str]:
+    with _LOCK:
+        e = _CACHE.get(chat_id)
+        if e is None or e.key != key or e.stamp != stamp:
+            _STATS["misses"] += 1
+            return None
+        _CACHE.move_to_end(chat_id)
+        _STATS["hits"] += 1
+        return e.text
+
+
+def _cache_put(chat_id: str, stamp: Any, key: Tuple[int, int, bool], text: str) -> None:
+    if TRANSCRIPT_CACHE_CHATS <= 0:
+        return
+    with _LOCK:
+        _CACHE[chat_id] = _Entry(stamp=stamp, key=key, text=text)
+        _CACHE.move_to_end(chat_id)
+        while len(_CACHE) > TRANSCRIPT_CACHE_CHATS:
+            _CACHE.popitem(last=False)
+
+
+def _stamp(session: Any, chat_id: str) -> Any:
+    row = session.execute(
+        select(ChatHistory.chat_updated_at).where(ChatHistory.chat_id == chat_id)
+    ).first()
+    return row[0] if row else None
+
+
+# ───────────────── windowed load ─────────────────
+def _load_pairs(session: Any, chat_id: str, max_msgs: int, limit_chars: int, strip: bool) -> List[str]:
+    """Đọc lùi theo trang (keyset trên created_at, message_id) tới khi đủ cặp / đủ ký tự / hết dòng."""
+    page = (max_msgs if max_msgs > 0 else 50) + TRANSCRIPT_PAGE_SLACK
+    pairs_desc: List[str] = []
+    total_chars = 0
+    cursor: Optional[Tuple[Any, str]] = None
+    while True:
+        q = (
+            select(ChatMessage.message_id, ChatMessage.message_created_at,
+                   ChatMessage.message_question, ChatMessage.message_ai_response)
+            .where(ChatMessage.message_chat_id == chat_id)
+            .order_by(ChatMessage.message_created_at.desc(), ChatMessage.message_id.desc())
+            .limit(page)
+        )
+        if cursor is not None:
+            q = q.where(tuple_(ChatMessage.message_created_at, ChatMessage.message_id) < cursor)
+        rows = session.execute(q).all()
+        for mid, created, question, answer in rows:
+            u = question or ""
+            u = strip_appendix(u) if strip else u.strip()
+            a = (answer or "").strip()
+            if not u or not a or a in _PENDING_ANSWERS:
+                continue
+            pair = f"User: {u}\nAssistant: {a}"
+            pairs_desc.append(pair)
+            total_chars += len(pair) + 2
+            if max_msgs > 0 and len(pairs_desc) >= max_msgs:
+                return pairs_desc[::-1]
+            if limit_chars > 0 and total_chars > limit_chars:
+                return pairs_desc[::-1]
+        if len(rows) < page:
+            return pairs_desc[::-1]
+        last = rows[-1]
+        cursor = (last[1], last[0])
+
+
+def _format(pairs: List[str], limit_chars: int) -> str:
+    text = "\n\n".join(pairs).strip()
+    if limit_chars > 0 and len(text) > limit_chars:
+        text = text[-limit_chars:]
+        cut = text.find("\n")
+        if cut > 200:
+            text = text[cut+1:]
+    return text
+
+
+def recent_transcript(
+    session: Any,
+    chat_id: str,
+    *,
+    limit_chars: int,
+    max_msgs: int,
+    strip_attachments: bool = True,
+) -> str:
+    """Transcript max_msgs cặp hợp lệ cuối cùng (cũ → mới), tối đa limit_chars ký tự."""
+    if not chat_id:
+        return ""
+    key = (int(max_msgs), int(limit_chars), bool(strip_attachments))
+    try:
+        stamp = _stamp(session, chat_id)
+    except Exception:
+        stamp = None
+    if stamp is not None:
+        hit = _cache_get(chat_id, stamp, key)
+        if hit is not None:
+            return hit
+    try:
+        pairs = _load_pairs(session, chat_id, max_msgs, limit_chars, strip_attachments)
+    except Exception:
+        return ""
+    text = _format(pairs, limit_chars)
+    if stamp is not None:
+        _cache_put(chat_id, stamp, key, text)
+    return text
+
+
+__all__ = [
+    "strip_appendix",
+    "recent_transcript",
+    "invalidate",
+    "stats",
+]
@@ -0,0 +1,319 @@
+# file: src/modules/chat/service/upload_stream.py
+# updated: 2025-09-29 (v1.0.1)
+# changes (v1.0.1):
+#   - discard() / lỗi giữa chừng: xoá blob qua file_storage.remove_blob_async — chỉ xoá khi không request nào khác
+#     dùng lại blob đó (kiểm tra dưới khoá kho), không chặn event loop; phần sót lại do gc_blobs dọn.
+# purpose:
+#   - Đọc multipart/form-data THEO STREAM cho /chat/api/send thay cho request.form(): trước đây cả body được nhận
+#     + spool xong rồi mới kiểm tra giới hạn → upload quá cỡ vẫn chiếm băng thông / đĩa / RAM worker tới hết
+#       * giới hạn áp ngay khi byte tới: số file, đuôi file cho phép (khi gặp header part), dung lượng từng file,
+#         tổng body, kích thước / số field text → vượt là dừng đọc, ném lỗi (caller trả 413 / 415 + Connection: close)
+#       * phần file đổ thẳng vào kho blob (shared.file_storage.BlobWriter: ghi + sha256 cùng lượt) → _save_uploads
+#         chỉ còn tạo tham chiếu, không đọc / ghi lại
+#       * lỗi giữa chừng → bỏ blob vừa tạo trong request (blob có sẵn / đã được request khác dùng lại giữ nguyên)
+#   - Parser thuần Python (không dependency), trạng thái: preamble → headers → body → … → epilogue
+#
+# ENV:
+#   UPLOAD_ALLOWED_EXTS=                 # rỗng = save_documents.ALLOWED_EXTS (khớp accept của FE); "*" = không lọc
+#   UPLOAD_STREAM_MAX_FIELD_BYTES=2097152  # mỗi field text (tin nhắn, chat_id…)
+#   UPLOAD_STREAM_MAX_FIELDS=100
+#
+# Ghi chú:
+#   - Lỗi dùng lại các exception của save_documents (TooManyFiles / FileTooLarge / TotalTooLarge / DisallowedType);
+#     body hỏng → UploadError.
+#   - Kết quả (StreamedForm) có get() / getlist() như form của Litestar → code đọc form cũ dùng được nguyên.
+
+from __future__ import annotations
+
+import os
+import re
+import logging
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+
+from modules.chat.service.save_documents import (
+    ALLOWED_EXTS,
+    DisallowedType,
+    FileTooLarge,
+    TooManyFiles,
+    TotalTooLarge,
+    UploadError,
+    UploadLimits,
+)
+
+logger = logging.getLogger("docaix.upload_stream")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = os.getenv(name, "")
+        return int(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+def _allowed_exts() -> Optional[Set[str]]:
+    raw = os.getenv("UPLOAD_ALLOWED_EXTS", "").strip()
+    if raw == "*":
+        return None
+    if not raw:
+        return set(ALLOWED_EXTS)
+    return {e.strip().lstrip(".").lower() for e in raw.split(",") if e.strip()}
+
+
+UPLOAD_ALLOWED_EXTS = _allowed_exts()
+UPLOAD_STREAM_MAX_FIELD_BYTES = max(1024, _env_int("UPLOAD_STREAM_MAX_FIELD_BYTES", 2 * 1024 * 1024))
+UPLOAD_STREAM_MAX_FIELDS = max(1, _env_int("UPLOAD_STREAM_MAX_FIELDS", 100))
+
+_MAX_HEADER_BYTES = 16 * 1024
+_BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+_PARAM_RE = re.compile(r';\s*([\w*-]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+
+# ───────────────── result ─────────────────
+@dataclass
+class StreamedFile:
+    """1 file đã nằm trong kho blob; _save_uploads dùng thẳng .blob (không đọc lại)."""
+    field_name: str
+    filename: str
+    content_type: str
+    blob: Any          # shared.file_storage.StoredBlob
+
+    @property
+    def size(self) -> int:
+        return self.blob.size
+
+
+@dataclass
+class StreamedForm:
+    fields: Dict[str, List[Any]] = field(default_factory=dict)
+    files: List[StreamedFile] = field(default_factory=list)
+
+    def getlist(self, name: str) -> List[Any]:
+        return list(self.fields.get(name) or [])
+
+    def get(self, name: str, default: Any = None) -> Any:
+        vals = self.fields.get(name)
+        return vals[0] if vals else default
+
+    async def discard(self) -> None:
+        """Bỏ blob mới tạo bởi request này (request bị từ chối sau khi đã đọc xong form)."""
+        from shared.file_storage import remove_blob_async
+        files, self.files = self.files, []
+        for f in files:
+            await remove_blob_async(f.blob)
+
+
+def boundary_of(content_type: str) -> Optional[bytes]:
+    if "multipart/form-data" not in (content_type or "").lower():
+        return None
+    m = _BOUNDARY_RE.search(content_type)
+    return m.group(1).strip().encode("latin-1") if m else None
+
+
+def _decode(raw: bytes) -> str:
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("latin-1")
+
+
+def _disposition(headers: Dict[str, str]) -> Dict[str, str]:
+    params: Dict[str, str] = {}
+    for k, v in _PARAM_RE.findall(";" + headers.get("content-disposition", "").split(";", 1)[-1]):
+        v = v.strip()
+        if len(v) >= 2 and v[0] == v[-1] == '"':
+            v = v[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+        params[k.lower()] = v
+    star = params.get("filename*")
+    if star and "''" in star:
+        # RFC 5987: UTF-8''t%C3%AAn.pdf
+        from urllib.parse import unquote
+        enc, _, val = star.partition("''")
+        params["filename"] = unquote(val, encoding=enc or "utf-8", errors="replace")
+    return params
+
+
+# ───────────────── parser ─────────────────
+class _StreamParser:
+    def __init__(self, boundary: bytes, limits: UploadLimits, allowed_exts: Optional[Set[str]]) -> None:
+        self.delim = b"\r\n--" + boundary
+        self.limits = limits
+        self.allowed_exts = allowed_exts
+        self.form = StreamedForm()
+        self.received = 0
+        self._buf = bytearray(b"\r\n")   # body bắt đầu bằng "--boundary" (không có CRLF) → chuẩn hoá
+        self._state = "preamble"
+        self._n_fields = 0
+        self._part: Optional[Dict[str, Any]] = None
+        self._writer: Any = None
+
+    # ── part lifecycle ──
+    async def _start_part(self, raw_headers: bytes) -> None:
+        headers: Dict[str, str] = {}
+        for line in _decode(raw_headers).split("\r\n"):
+            k, sep, v = line.partition(":")
+            if sep:
+                headers[k.strip().lower()] = v.strip()
+        disp = _disposition(headers)
+        name = disp.get("name") or ""
+        filename = disp.get("filename")
+        if filename is None:
+            self._n_fields += 1
+            if self._n_fields > UPLOAD_STREAM_MAX_FIELDS:
+                raise UploadError(f"Too many form fields (> {UPLOAD_STREAM_MAX_FIELDS})")
+            self._part = {"name": name, "data": bytearray()}
+            return
+
+        filename = filename.replace("\\", "/").split("/")[-1]
+        if not filename:
+            # <input type=file> để trống → part rỗng, bỏ qua
+            self._part = {"name": name, "skip": True}
+            return
+        lim = self.limits
+        if lim.max_files > 0 and len(self.form.files) + 1 > lim.max_files:
+            raise TooManyFiles(f"Too many files: > {lim.max_files}")
+        ext = os.path.splitext(filename)[1].lstrip(".").lower()
+        if self.allowed_exts is not None and ext not in self.allowed_exts:
+            raise DisallowedType(f'File type ".{ext}" is not allowed: {filename}')
+
+        from shared.file_storage import BlobWriter
+        self._writer = BlobWriter()
+        self._part = {
+            "name": name,
+            "filename": filename,
+            "content_type": headers.get("content-type") or "application/octet-stream",
+        }
+
+    async def _part_data(self, data: bytes) -> None:
+        part = self._part
+        if part is None or not data or part.get("skip"):
+            return
+        if self._writer is None:
+            part["data"] += data
+            if len(part["data"]) > UPLOAD_STREAM_MAX_FIELD_BYTES:
+                raise UploadError(f'Form field "{part["name"]}" too large')
+            return
+        per_file = self.limits.per_file_bytes
+        if per_file > 0 and self._writer.size + len(data) > per_file:
+            raise FileTooLarge(f'File "{part["filename"]}" exceeds per-file limit {per_file} bytes')
+        await self._writer.write(data)
+
+    async def _end_part(self) -> None:
+        part, self._part = self._part, None
+        if part is None or part.get("skip"):
+            return
+        if self._writer is None:
+            self.form.fields.setdefault(part["name"], []).append(_decode(bytes(part["data"])))
+            return
+        writer, self._writer = self._writer, None
+        blob = await writer.commit()
+        f = StreamedFile(part["name"], part["filename"], part["content_type"], blob)
+        self.form.files.append(f)
+        self.form.fields.setdefault(part["name"], []).append(f)
+
+    # ── byte stream ──
+    async def feed(self, chunk: bytes) -> None:
+        self.received += len(chunk)
+        cap = self.limits.effective_request_cap_bytes
+        if cap > 0 and self.received > cap:
+            raise TotalTooLarge(f"Request body exceeds {cap} bytes")
+        self._buf += chunk
+        await self._drain()
+
+    async def _drain(self) -> None:
+        buf, delim = self._buf, self.delim
+        while True:
+            if self._state in ("preamble", "body"):
+                idx = buf.find(delim)
+                if idx < 0:
+                    # giữ lại đuôi có thể là đầu của delimiter
+                    keep = len(delim) - 1
+                    if len(buf) > keep:
+                        if self._state == "body":
+                            await self._part_data(bytes(buf[:-keep]))
+                        del buf[:-keep]
+                    return
+                if self._state == "body":
+                    await self._part_data(bytes(buf[:idx]))
+                    await self._end_part()
+                del buf[:idx + len(delim)]
+                self._state = "delim"
+            elif self._state == "delim":
+                if len(buf) < 2:
+                    return
+                if buf[:2] == b"--":
+                    self._state = "epilogue"
+                    buf.clear()
+                    return
+                # transport padding (khoảng trắng) trước CRLF
+                eol = buf.find(b"\r\n")
+                if eol < 0:
+                    if len(buf) > 1024:
+                        raise UploadError("Malformed multipart boundary line")
+                    return
+                if buf[:eol].strip(b" \t"):
+                    raise UploadError("Malformed multipart boundary line")
+                del buf[:eol + 2]
+                self._state = "headers"
+            elif self._state == "headers":
+                end = buf.find(b"\r\n\r\n")
+                if end < 0:
+                    if len(buf) > _MAX_HEADER_BYTES:
+                        raise UploadError("Multipart part headers too large")
+                    return
+                raw = bytes(buf[:end])
+                del buf[:end + 4]
+                await self._start_part(raw)
+                self._state = "body"
+            else:  # epilogue
+                buf.clear()
+                return
+
+    async def finish(self) -> StreamedForm:
+        if self._state != "epilogue":
+            raise UploadError("Unexpected end of multipart body")
+        return self.form
+
+    async def abort(self) -> None:
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            await writer.discard()
+        await self.form.discard()
+
+
+async def read_form(
+    chunks: AsyncIterator[bytes],
+    content_type: str,
+    limits: UploadLimits,
+    *,
+    allowed_exts: Optional[Set[str]] = UPLOAD_ALLOWED_EXTS,
+) -> StreamedForm:
+    """
+    Đọc multipart theo stream (vd. request.stream()), áp giới hạn ngay khi byte tới.
+    Vượt giới hạn / body hỏng → UploadError (subclass tương ứng); blob đã ghi trong request bị xoá.
+    """
+    boundary = boundary_of(content_type)
+    if not boundary:
+        raise UploadError("Missing multipart boundary")
+    parser = _StreamParser(boundary, limits, allowed_exts)
+    try:
+        async for chunk in chunks:
+            if chunk:
+                await parser.feed(chunk)
+        form = await parser.finish()
+    except BaseException as e:
+        await parser.abort()
+        if isinstance(e, UploadError):
+            logger.info("multipart rejected after %d bytes: %s", parser.received, e)
+        raise
+    return form
+
+
+__all__ = [
+    "UPLOAD_ALLOWED_EXTS",
+    "StreamedFile",
+    "StreamedForm",
+    "boundary_of",
+    "read_form",
+]
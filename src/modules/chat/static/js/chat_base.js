@@ -1,12 +1,17 @@
 // file: src/modules/chat/static/js/chat_base.js
-// updated: 2025-09-02
-// changes: + CSRF warm-up + retry 403 cho send/edit/redo/model list/select; giữ nguyên UI & logic
+// updated: 2025-09-29
+// changes: + tiến độ OCR trước khi có text: SSE `progress` / poll `data.progress` → "OCR {file}: trang {done}/{planned}"
+//          + STOP/ESC gửi đúng message_ids[] cho /chat/api/cancel (trước đây luôn rỗng)
+//          + 429 (hàng đợi đầy) → toast kèm Retry-After; hiện vị trí hàng đợi "(queued #N)"
+//          + SSE delta `reset` (job chạy lại → thay toàn bộ text đang hiển thị)
+//          + SSE stream câu trả lời (/chat/api/message/{id}/stream, fallback poll)
+//          + CSRF warm-up + retry 403 cho send/edit/redo/model list/select; giữ nguyên UI & logic
 
 (function () {
     'use strict';
     if (window.__CHAT_BASE_APPLIED__) return;
     window.__CHAT_BASE_APPLIED__ = true;
-    window.__CHAT_BASE_VER__ = '3.48';
+    window.__CHAT_BASE_VER__ = '3.49';
 
     /* ===== Polyfill CSS.escape ===== */
     (function ensureCssEscape() {
@@ -401,13 +406,38 @@
         return base + jitter;
     }
     function markCanceledBubbles() {
+        const mids = [];
         document.querySelectorAll('.message-bubble.ai[data-state="pending"]').forEach(el => {
             const md = el.querySelector('.markdown[data-md="1"]') || el.querySelector('.message-content .markdown[data-md="1"]');
             if (md) { md.textContent = '(canceled)'; md.dataset.mdProcessed = '0'; }
             el.setAttribute('data-state', 'canceled');
             el.classList.remove('italic');
             el.style.opacity = '';
+            const mid = (el.id || '').replace(/^msg-/, '').replace(/-ai$/, '');
+            if (mid && !/^tmp/i.test(mid)) mids.push(mid);
         });
+        return mids; // message_id thật (bỏ bubble tạm chưa có id) → gửi BE huỷ
+    }
+    /* ===== Vị trí hàng đợi (job chưa chạy) — chỉ đổi placeholder khi chưa có text ===== */
+    function showQueuePos(messageId, pos) {
+        const el = $id('msg-' + messageId + '-ai'); if (!el || el.getAttribute('data-state') === 'canceled') return;
+        const md = el.querySelector('.markdown[data-md="1"]') || el.querySelector('.message-content .markdown[data-md="1"]');
+        if (!md || md.dataset.mdProcessed === '1') return;
+        md.textContent = pos ? `(queued #${pos})` : '(queued)';
+    }
+    /* ===== Tiến độ OCR (job đang đọc tệp, model chưa sinh) — cùng quy tắc placeholder như showQueuePos ===== */
+    function showProgress(messageId, p) {
+        if (!p || p.stage !== 'ocr') return;
+        const el = $id('msg-' + messageId + '-ai'); if (!el || el.getAttribute('data-state') === 'canceled') return;
+        const md = el.querySelector('.markdown[data-md="1"]') || el.querySelector('.message-content .markdown[data-md="1"]');
+        if (!md || md.dataset.mdProcessed === '1') return;
+        md.textContent = `OCR ${p.file || ''}: trang ${p.done ?? 0}/${p.planned || p.total || '?'}`;
+    }
+    function busyToast(res, data) {
+        const sec = Number(data?.retry_after || res.headers.get('Retry-After') || 0);
+        const wait = sec ? ` Thử lại sau ~${sec}s.` : '';
+        if (data?.scope === 'user') showToast('Bạn đang có quá nhiều câu hỏi chờ trả lời.' + wait, 'warning', 6000);
+        else showToast('Hệ thống đang quá tải.' + wait, 'warning', 6000);
     }
     function pollAI(messageId, tries = 0) {
         if (!messageId) return;
@@ -427,6 +457,8 @@
                     }
                     NET.abort(label);
                 } else {
+                    if (data && data.queue_position) showQueuePos(messageId, data.queue_position);
+                    else if (data && data.progress) showProgress(messageId, data.progress);
                     if (tries > 80) {
                         const el = document.getElementById('msg-' + messageId + '-ai');
                         if (el) {
@@ -449,10 +481,66 @@
                 NET.trackTimer(setTimeout(() => pollAI(messageId, tries + 1), delay));
             });
     }
+    /* ===== Stream AI (SSE) — token dần; lỗi/không hỗ trợ → quay về poll ===== */
+    function resolveStreamURL(mid) {
+        try {
+            const group = document.querySelector(`.message-group[data-message-id="${CSS.escape(mid)}"]`);
+            const dataUrl = group?.dataset?.streamUrl;
+            return dataUrl || (`/chat/api/message/${encodeURIComponent(mid)}/stream`);
+        } catch { return `/chat/api/message/${encodeURIComponent(mid)}/stream`; }
+    }
+    function streamAI(messageId) {
+        if (!messageId) return;
+        if (typeof window.EventSource === 'undefined') { pollAI(messageId, 0); return; }
+        const bubble = $id('msg-' + messageId + '-ai');
+        if (bubble && bubble.getAttribute('data-state') === 'canceled') return;
+
+        const label = `poll:${messageId}`;
+        const ctrl = NET.make(label);
+        let es; try { es = new EventSource(resolveStreamURL(messageId)); } catch { pollAI(messageId, 0); return; }
+        let acc = '', raf = 0, finished = false;
+        const close = () => { finished = true; try { es.close(); } catch { } if (raf) { cancelAnimationFrame(raf); raf = 0; } };
+        try { ctrl.signal?.addEventListener?.('abort', close); } catch { }
+        const render = () => {
+            raf = 0;
+            const el = $id('msg-' + messageId + '-ai'); if (!el || el.getAttribute('data-state') === 'canceled') return;
+            el.classList.remove('italic'); el.style.opacity = ''; // giữ data-state="pending" để ESC/cancel vẫn bắt được
+            const md = el.querySelector('.markdown[data-md="1"]') || el.querySelector('.message-content .markdown[data-md="1"]');
+            if (md) { md.innerHTML = mdToHtml(acc); md.dataset.mdProcessed = '1'; }
+            const sc = $id('chat-scroll'); if (sc && sc.scrollHeight - sc.scrollTop - sc.clientHeight < 120) sc.scrollTop = sc.scrollHeight;
+        };
+        const parse = (e) => { try { return JSON.parse(e.data || '{}'); } catch { return {}; } };
+        es.addEventListener('delta', (e) => {
+            const d = parse(e);
+            acc = d.reset ? (d.delta || '') : acc + (d.delta || '');  // reset: job chạy lại (retry)
+            if (!raf) raf = requestAnimationFrame(render);
+        });
+        es.addEventListener('done', (e) => {
+            close(); NET.abort(label);
+            const el = $id('msg-' + messageId + '-ai');
+            if (el && el.getAttribute('data-state') !== 'canceled') {
+                activateReplyBubble(el, parse(e).ai_response || acc);
+                const sc = $id('chat-scroll'); try { sc.scrollTo({ top: sc.scrollHeight, behavior: 'smooth' }); } catch { sc.scrollTop = sc.scrollHeight; }
+            }
+        });
+        es.addEventListener('failed', () => {
+            close(); NET.abort(label);
+            const el = $id('msg-' + messageId + '-ai'); if (!el) return;
+            const md = el.querySelector('.markdown[data-md="1"]') || el.querySelector('.message-content .markdown[data-md="1"]');
+            if (md) { md.textContent = acc ? acc + '\n\n(failed)' : '(failed)'; md.dataset.mdProcessed = '0'; }
+            el.setAttribute('data-state', 'canceled'); el.classList.remove('italic'); el.style.opacity = '';
+        });
+        es.addEventListener('queued', (e) => { if (!acc) showQueuePos(messageId, parse(e).queue_position); });
+        es.addEventListener('progress', (e) => { if (!acc) showProgress(messageId, parse(e)); });
+        es.addEventListener('pending', () => { close(); pollAI(messageId, 0); });
+        es.onerror = () => { if (finished) return; close(); if (NET.get(label)) pollAI(messageId, 0); };
+    }
+    function followAI(messageId) { streamAI(messageId); }
+
     function bootstrapQueued() {
         document.querySelectorAll('[id^="msg-"][id$="-ai"].italic').forEach((el) => {
             if (el.getAttribute('data-state') === 'canceled') return;
-            const mid = el.id.replace(/^msg-/, '').replace(/-ai$/, ''); if (mid) pollAI(mid, 0);
+            const mid = el.id.replace(/^msg-/, '').replace(/-ai$/, ''); if (mid) followAI(mid);
         });
     }
     bootstrapQueued();
@@ -751,7 +839,7 @@
                 let res = await fetch('/chat/api/send', { method: 'POST', body: fd, signal: ctrl.signal });
                 if (res.status === 403) { await warmUpCSRF(); res = await fetch('/chat/api/send', { method: 'POST', body: fd, signal: ctrl.signal }); } // NEW retry
                 const data = await res.json().catch(() => ({}));
-                if (!res.ok || data?.ok === false) { showToast('Gửi lại thất bại.', 'error'); aEl.classList.remove('italic'); aEl.style.opacity = ''; if (md) md.textContent = '(failed)'; return; }
+                if (!res.ok || data?.ok === false) { if (res.status === 429) busyToast(res, data); else showToast('Gửi lại thất bại.', 'error'); aEl.classList.remove('italic'); aEl.style.opacity = ''; if (md) md.textContent = '(failed)'; return; }
                 if (data?.chat_id) { CURRENT_CHAT_ID = data.chat_id; const root = $id('chat-root'); if (root) { root.dataset.chatId = CURRENT_CHAT_ID; root.dataset.ChatId = CURRENT_CHAT_ID; } if (data?.created_new_chat) history.pushState({}, '', '/chat/' + CURRENT_CHAT_ID); else if (!parseChatIdFromURL()) history.replaceState({}, '', '/chat/' + CURRENT_CHAT_ID); }
                 const newId = data?.message_id;
                 if (newId) {
@@ -760,7 +848,7 @@
                     const qGroup = oldQ?.closest?.('.message-group'); const aGroup = oldA?.closest?.('.message-group');
                     [qGroup, aGroup].forEach(g => { if (!g) return; g.setAttribute('data-message-id', newId); const act = g.querySelector('.message-actions'); if (act) { act.removeAttribute('data-inited'); act.querySelector('.action-buttons')?.remove(); } injectActions(g); });
                     try { document.body.dispatchEvent(new CustomEvent('chat:message-id-assigned', { bubbles: true, detail: { temp_id: mid, message_id: newId } })); } catch { }
-                    pollAI(newId, 0);
+                    followAI(newId);
                 }
                 showToast('Đã gửi.', 'success');
             } else {
@@ -769,14 +857,14 @@
                 let res = await fetch(resolveEditURL(mid), { method: 'POST', body: fd, signal: ctrl.signal });
                 if (res.status === 403) { await warmUpCSRF(); res = await fetch(resolveEditURL(mid), { method: 'POST', body: fd, signal: ctrl.signal }); } // NEW retry
                 const data = await res.json().catch(() => ({}));
-                if (!res.ok || data?.ok === false) { showToast('Chỉnh sửa thất bại.', 'error'); aEl.classList.remove('italic'); aEl.style.opacity = ''; if (md) md.textContent = '(failed)'; return; }
+                if (!res.ok || data?.ok === false) { if (res.status === 429) busyToast(res, data); else showToast('Chỉnh sửa thất bại.', 'error'); aEl.classList.remove('italic'); aEl.style.opacity = ''; if (md) md.textContent = '(failed)'; return; }
                 const newId = data?.message_id;
                 if (newId && newId !== mid) {
                     qEl.id = 'msg-' + newId + '-q'; aEl.id = 'msg-' + newId + '-ai';
                     const qGroup = qEl.closest('.message-group'); const aGroup = aEl.closest('.message-group');
                     [qGroup, aGroup].forEach(g => { if (!g) return; g.setAttribute('data-message-id', newId); const act = g.querySelector('.message-actions'); if (act) { act.removeAttribute('data-inited'); act.querySelector('.action-buttons')?.remove(); } injectActions(g); });
-                    pollAI(newId, 0);
-                } else { pollAI(mid, 0); }
+                    followAI(newId);
+                } else { followAI(mid); }
                 showToast('Đã gửi lại.', 'success');
             }
         } catch {
@@ -838,7 +926,7 @@
             let res = await fetch(resolveRedoURL(mid, btn), { method: 'POST', body: new FormData(), signal: ctrl.signal });
             if (res.status === 403) { await warmUpCSRF(); res = await fetch(resolveRedoURL(mid, btn), { method: 'POST', body: new FormData(), signal: ctrl.signal }); } // NEW retry
             const data = await res.json().catch(() => ({}));
-            if (!res.ok || data?.ok === false) { showToast('Không tạo lại được phản hồi.', 'error'); aEl.classList.remove('italic'); aEl.style.opacity = ''; if (md) md.textContent = '(failed)'; return; }
+            if (!res.ok || data?.ok === false) { if (res.status === 429) busyToast(res, data); else showToast('Không tạo lại được phản hồi.', 'error'); aEl.classList.remove('italic'); aEl.style.opacity = ''; if (md) md.textContent = '(failed)'; return; }
             clearHistoryAfter(mid);
             const newId = data?.message_id;
             if (newId && newId !== mid) {
@@ -846,8 +934,8 @@
                 aEl.id = 'msg-' + newId + '-ai';
                 const qGroup = qEl?.closest?.('.message-group'); const aGroup = aEl?.closest?.('.message-group');
                 [qGroup, aGroup].forEach(g => { if (!g) return; g.setAttribute('data-message-id', newId); const act = g.querySelector('.message-actions'); if (act) { act.removeAttribute('data-inited'); act.querySelector('.action-buttons')?.remove(); } injectActions(g); });
-                pollAI(newId, 0);
-            } else { pollAI(mid, 0); }
+                followAI(newId);
+            } else { followAI(mid); }
             showToast('Đang tạo lại…', 'success');
         } catch {
             showToast('Mất kết nối khi tạo lại.', 'error'); aEl.classList.remove('italic'); aEl.style.opacity = '';
@@ -1093,15 +1181,15 @@
                 let res = await fetch(resolveRedoURL(mid, btn), { method: 'POST', body: fd, signal: ctrl.signal });
                 if (res.status === 403) { await warmUpCSRF(); res = await fetch(resolveRedoURL(mid, btn), { method: 'POST', body: fd, signal: ctrl.signal }); } // NEW retry
                 const data = await res.json().catch(() => ({}));
-                if (!res.ok || data?.ok === false) { showToast('Không tạo lại được phản hồi.', 'error'); aEl.classList.remove('italic'); aEl.style.opacity = ''; if (md) md.textContent = '(failed)'; return; }
+                if (!res.ok || data?.ok === false) { if (res.status === 429) busyToast(res, data); else showToast('Không tạo lại được phản hồi.', 'error'); aEl.classList.remove('italic'); aEl.style.opacity = ''; if (md) md.textContent = '(failed)'; return; }
                 clearHistoryAfter(mid);
                 const newId = data?.message_id;
                 if (newId && newId !== mid) {
                     const qEl = document.getElementById('msg-' + mid + '-q'); if (qEl) qEl.id = 'msg-' + newId + '-q';
                     aEl.id = 'msg-' + newId + '-ai';
                     [qEl?.closest('.message-group'), aEl.closest('.message-group')].forEach(g => { if (!g) return; g.setAttribute('data-message-id', newId); const act = g.querySelector('.message-actions'); if (act) { act.removeAttribute('data-inited'); act.querySelector('.action-buttons')?.remove(); } injectActions(g); });
-                    pollAI(newId, 0);
-                } else { pollAI(mid, 0); }
+                    followAI(newId);
+                } else { followAI(mid); }
                 showToast('Đang tạo lại…', 'success');
             } catch {
                 showToast('Mất kết nối khi tạo lại.', 'error'); aEl.classList.remove('italic'); aEl.style.opacity = '';
@@ -1196,8 +1284,8 @@
             e.preventDefault();
             try { TTS.stop(); } catch { }
             NET.abortAll('user_cancel');
-            markCanceledBubbles();
-            try { document.body.dispatchEvent(new Event('chat:cancel')); } catch { }
+            const mids = markCanceledBubbles();
+            try { document.body.dispatchEvent(new CustomEvent('chat:cancel', { bubbles: true, detail: { mids } })); } catch { }
             showToast('Đã dừng tạo sinh.', 'success', 1500);
             return;
         }
@@ -1224,15 +1312,16 @@
     }, true);
 
     // Lắng nghe event chat:cancel từ nơi khác phát ra (TASK2) + gọi BE hủy job
-    document.addEventListener('chat:cancel', () => {
+    document.addEventListener('chat:cancel', (e) => {
         try { TTS.stop(); } catch { }
         NET.abortAll('user_cancel');
-        markCanceledBubbles();
+        // gom message_id TRƯỚC khi đổi data-state (trước đây đánh dấu trước → danh sách gửi BE luôn rỗng)
+        const mids = new Set([...(e?.detail?.mids || []), ...markCanceledBubbles()]);
+        if (!mids.size) return;
         // thông báo BE (best-effort, không đưa vào NET để khỏi bị abort chính nó)
         try {
             const fd = new FormData();
             if (CURRENT_CHAT_ID) fd.append('chat_id', CURRENT_CHAT_ID);
-            const mids = Array.from(document.querySelectorAll('.message-bubble.ai[data-state="pending"]')).map(el => (el.id || '').replace(/^msg-/, '').replace(/-ai$/, ''));
             mids.forEach(m => fd.append('message_ids[]', m));
             fetch('/chat/api/cancel', { method: 'POST', body: fd, credentials: 'same-origin', headers: withDefaults({}) }).catch(() => { });
         } catch { }
@@ -1306,6 +1395,7 @@
                     const is403 = (res.status === 403) || /csrf/i.test(detailTxt);
                     const is413 = (res.status === 413) || err === 'UPLOAD_TOO_LARGE';
                     if (is403) showToast('Phiên làm việc đã hết hạn. Hãy đăng xuất tài khoản rồi đăng nhập lại!', 'warning');
+                    else if (res.status === 429) busyToast(res, data);
                     else if (is413) {
                         const lim = Number(data?.limit || 0);
                         const limMB = lim ? Math.max(1, Math.round(lim / (1024 * 1024))) : null;
@@ -1333,7 +1423,7 @@
                     const qGroup = q?.closest?.('.message-group'); const aGroup = a?.closest?.('.message-group');
                     [qGroup, aGroup].forEach(g => { if (!g) return; g.setAttribute('data-message-id', data.message_id); const act = g.querySelector('.message-actions'); if (act) { act.removeAttribute('data-inited'); act.querySelector('.action-buttons')?.remove(); } injectActions(g); });
                     try { document.body.dispatchEvent(new CustomEvent('chat:message-id-assigned', { bubbles: true, detail: { temp_id: tempId, message_id: data.message_id } })); } catch { }
-                    pollAI(data.message_id, 0);
+                    followAI(data.message_id);
                 }
 
                 if (inputEl) inputEl.value = '';
@@ -1,5 +1,8 @@
 # file: src/modules/memory/service/memory.py
-# updated: 2025-09-02 (v1.4.0)
+# updated: 2025-09-06 (v1.5.0)
+# changes (v1.5.0):
+#   - Gọi model qua shared.llm_client (pool dùng chung, endpoint "memory"); tóm tắt per-chat chạy async thật
+#     (trước đây gọi OpenAI sync ngay trên event loop).
 # purpose:
 #   - Phát hiện lệnh “Ghi nhớ …” (save) & “Quên …” (forget) – hỗ trợ VI/EN
 #   - Lưu/xoá bộ nhớ global trong user_settings.setting_remembered_summary (tôn trọng flags)
@@ -20,7 +23,8 @@ from typing import Optional, Tuple, List
 
 from sqlalchemy import select
 from sqlalchemy.orm import Session
-from openai import OpenAI
+
+from shared import llm_client as llm
 
 from core.db.models import UserSettings
 
@@ -56,24 +60,10 @@ _CMD_FORGET_RE = re.compile(
 # Logger
 logger = logging.getLogger("docaix.memory")
 
-_client: Optional[OpenAI] = None
-
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Helpers
 # ──────────────────────────────────────────────────────────────────────────────
-def _get_client() -> OpenAI:
-    global _client
-    if _client is None:
-        if not RUNPOD_BASE_URL or not RUNPOD_API_KEY:
-            raise RuntimeError("RUNPOD_BASE_URL / RUNPOD_API_KEY chưa cấu hình.")
-        base_url = RUNPOD_BASE_URL.rstrip("/")
-        if not base_url.endswith("/v1"):
-            base_url += "/v1"
-        _client = OpenAI(base_url=base_url, api_key=RUNPOD_API_KEY, timeout=RUNPOD_TIMEOUT)
-    return _client
-
-
 def _utc_now_iso() -> str:
     return dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
@@ -244,7 +234,6 @@ def _summarize_memory_braced(raw_text: str) -> str:
         return _heuristic_shrink(raw_text, max_chars=200)
 
     try:
-        client = _get_client()
         sys_msg = {"role": "system", "content": "Reasoning: low"}
         user_msg = {
             "role": "user",
@@ -256,7 +245,8 @@ def _summarize_memory_braced(raw_text: str) -> str:
                 "- Trả duy nhất theo định dạng: {{ nội dung }}\n"
             ),
         }
-        resp = client.chat.completions.create(
+        resp = llm.chat_completion_sync(
+            "memory",
             model=RUNPOD_DEFAULT_MODEL,
             messages=[sys_msg, user_msg],
             temperature=0,
@@ -270,8 +260,8 @@ def _summarize_memory_braced(raw_text: str) -> str:
         return _heuristic_shrink(raw_text, max_chars=200)
 
 
-def _summarize_chat_line_braced(prev_c: str, user_text: str, ai_text: str) -> str:
-    prompt = (
+def _chat_line_prompt(prev_c: str, user_text: str, ai_text: str) -> str:
+    return (
         "[TÓM TẮT CŨ]\n"
         f"{prev_c}\n\n"
         "[TRAO ĐỔI MỚI]\n"
@@ -282,28 +272,50 @@ def _summarize_chat_line_braced(prev_c: str, user_text: str, ai_text: str) -> st
         "Không giải thích. Trả về duy nhất trong: { ... }"
     )
 
+
+def _chat_line_fallback(prev_c: str, user_text: str, ai_text: str) -> str:
+    merged = ((prev_c + " | ") if prev_c else "") + f"U:{user_text} A:{ai_text}"
+    return _heuristic_shrink(merged, max_chars=240)
+
+
+def _chat_line_request(prev_c: str, user_text: str, ai_text: str) -> dict:
+    return {
+        "model": RUNPOD_DEFAULT_MODEL,
+        "messages": [
+            {"role": "system", "content": "Reasoning: low"},
+            {"role": "user", "content": _chat_line_prompt(prev_c, user_text, ai_text)},
+        ],
+        "temperature": 0,
+        "max_tokens": min(128, RUNPOD_MAX_TOKENS),
+    }
+
+
+def _summarize_chat_line_braced(prev_c: str, user_text: str, ai_text: str) -> str:
     if not RUNPOD_BASE_URL or not RUNPOD_API_KEY:
-        merged = ((prev_c + " | ") if prev_c else "") + f"U:{user_text} A:{ai_text}"
-        return _heuristic_shrink(merged, max_chars=240)
+        return _chat_line_fallback(prev_c, user_text, ai_text)
 
     try:
-        client = _get_client()
-        resp = client.chat.completions.create(
-            model=RUNPOD_DEFAULT_MODEL,
-            messages=[
-                {"role": "system", "content": "Reasoning: low"},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0,
-            max_tokens=min(128, RUNPOD_MAX_TOKENS),
-        )
+        resp = llm.chat_completion_sync("memory", **_chat_line_request(prev_c, user_text, ai_text))
         out = (resp.choices[0].message.content or "").strip()
         got = _extract_braced(out)
         return got or _heuristic_shrink(out, max_chars=240)
     except Exception as e:
         logger.debug("summarize_chat_line_braced error: %s", e)
-        merged = ((prev_c + " | ") if prev_c else "") + f"U:{user_text} A:{ai_text}"
-        return _heuristic_shrink(merged, max_chars=240)
+        return _chat_line_fallback(prev_c, user_text, ai_text)
+
+
+async def _summarize_chat_line_braced_async(prev_c: str, user_text: str, ai_text: str) -> str:
+    if not RUNPOD_BASE_URL or not RUNPOD_API_KEY:
+        return _chat_line_fallback(prev_c, user_text, ai_text)
+
+    try:
+        resp = await llm.chat_completion("memory", **_chat_line_request(prev_c, user_text, ai_text))
+        out = (resp.choices[0].message.content or "").strip()
+        got = _extract_braced(out)
+        return got or _heuristic_shrink(out, max_chars=240)
+    except Exception as e:
+        logger.debug("summarize_chat_line_braced_async error: %s", e)
+        return _chat_line_fallback(prev_c, user_text, ai_text)
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -475,7 +487,7 @@ def _write_chat_summary(chat_id: str, summary: str) -> None:
 async def update_chat_summary_async(chat_id: str, user_text: str, ai_text: str) -> None:
     try:
         prev, _ = _read_chat_summary(chat_id)
-        new_c = _summarize_chat_line_braced(prev, user_text, ai_text)
+        new_c = await _summarize_chat_line_braced_async(prev, user_text, ai_text)
         if MEMORY_CHAT_MAX_CHARS > 0 and len(new_c) > MEMORY_CHAT_MAX_CHARS:
             new_c = _heuristic_shrink(new_c, max_chars=MEMORY_CHAT_MAX_CHARS)
         _write_chat_summary(chat_id, new_c)
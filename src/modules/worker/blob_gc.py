@@ -0,0 +1,111 @@
+# file: src/modules/worker/blob_gc.py
+# updated: 2025-09-29 (v1.0.1)
+# changes (v1.0.1):
+#   - Nạp .env như web process trước khi đọc UPLOAD_ROOT / UPLOAD_BLOB_DIR: chạy từ cron thiếu .env trước đây
+#     resolve đường dẫn trong DB sai thư mục → không blob nào được tính là còn tham chiếu.
+#   - Không đường dẫn nào trong DB tồn tại trên đĩa (UPLOAD_ROOT sai) → dừng, không xoá gì.
+# purpose:
+#   - Dọn kho blob upload (shared.file_storage, UPLOAD_BLOB_DIR): xoá blob không còn bản ghi nào tham chiếu
+#     (chat bị xoá → Document CASCADE, request lỗi / bị từ chối sau khi đã ghi blob…)
+#   - Tham chiếu = mọi đường dẫn file trong DB trỏ vào kho (documents, document_attachments,
+#     scheduled_email_attachments, projects) → digest lấy từ symlink (không đọc nội dung)
+#   - Blob trẻ hơn BLOB_GC_MIN_AGE_SEC hoặc vừa được dùng lại (mtime mới) luôn được giữ → request đang dở
+#     chưa kịp commit Document không bị mất file
+#
+# Chạy:  python -m modules.worker.blob_gc [--dry-run]     (từ thư mục src; cron / systemd timer mỗi ngày)
+#
+# ENV:
+#   UPLOAD_ROOT=./uploads             # resolve đường dẫn tương đối trong DB
+#   UPLOAD_BLOB_DIR=                  # mặc định <UPLOAD_ROOT>/blobs
+#   BLOB_GC_MIN_AGE_SEC=86400
+#   BLOB_GC_LOG_LEVEL=INFO
+
+from __future__ import annotations
+
+import os
+import sys
+import logging
+from typing import Any, Iterator, Set
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+try:
+    from sqlalchemy import select
+    from core.db.engine import SessionLocal
+    from core.db.models import Document, DocumentAttachment, Project, ScheduledEmailAttachment
+except Exception as e:  # pragma: no cover
+    raise RuntimeError(f"[blob_gc] Missing DB layer: {e}") from e
+
+from shared.file_storage import UPLOAD_BLOB_DIR, BLOB_GC_MIN_AGE_SEC, blob_digest, gc_blobs
+
+LOG = logging.getLogger("docaix.blob_gc")
+logging.basicConfig(
+    level=os.getenv("BLOB_GC_LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+
+UPLOAD_ROOT = os.path.abspath(os.getenv("UPLOAD_ROOT", os.path.join("uploads")))
+
+_PATH_COLUMNS = (
+    Document.doc_file_path,
+    DocumentAttachment.attachment_file_path,
+    ScheduledEmailAttachment.att_file_path,
+    Project.project_file_path,
+)
+
+
+def _db_paths(session: Any) -> Iterator[str]:
+    for col in _PATH_COLUMNS:
+        for (p,) in session.execute(select(col).where(col.isnot(None))).yield_per(1000):
+            if p:
+                yield p
+
+
+def referenced_digests(session: Any) -> Set[str]:
+    """Digest của mọi blob còn được DB tham chiếu (đường dẫn tương đối tính theo UPLOAD_ROOT)."""
+    out: Set[str] = set()
+    total = found = 0
+    for p in _db_paths(session):
+        path = p if os.path.isabs(p) else os.path.join(UPLOAD_ROOT, p)
+        total += 1
+        if os.path.lexists(path):
+            found += 1
+        digest = blob_digest(path, UPLOAD_BLOB_DIR)
+        if digest:
+            out.add(digest)
+    if total and not found:
+        raise RuntimeError(f"none of {total} DB file paths exist under UPLOAD_ROOT={UPLOAD_ROOT} — wrong UPLOAD_ROOT?")
+    return out
+
+
+def run_once(*, dry_run: bool = False) -> dict:
+    session = SessionLocal()
+    try:
+        # đọc tham chiếu TRƯỚC khi quét: blob được dùng lại sau thời điểm này đã bị chạm (mtime mới) → giữ
+        refs = referenced_digests(session)
+    finally:
+        session.close()
+    stats = gc_blobs(refs, blob_dir=UPLOAD_BLOB_DIR, min_age_sec=BLOB_GC_MIN_AGE_SEC, dry_run=dry_run)
+    LOG.info(
+        "blob gc%s: scanned=%d referenced=%d recent=%d removed=%d freed=%d bytes tmp_removed=%d",
+        " (dry-run)" if dry_run else "",
+        stats["scanned"], stats["referenced"], stats["recent"], stats["removed"], stats["bytes_freed"],
+        stats["tmp_removed"],
+    )
+    return stats
+
+
+def main() -> None:
+    dry_run = "--dry-run" in sys.argv[1:]
+    LOG.info("Blob GC started (blob_dir=%s, min_age=%ds, dry_run=%s)", UPLOAD_BLOB_DIR, BLOB_GC_MIN_AGE_SEC, dry_run)
+    try:
+        run_once(dry_run=dry_run)
+    except Exception as e:
+        LOG.exception("Blob GC failed: %s", e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
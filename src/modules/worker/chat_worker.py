@@ -0,0 +1,76 @@
+# file: src/modules/worker/chat_worker.py
+# updated: 2025-09-29 (v1.0.1)
+# changes (v1.0.1):
+#   - Nạp .env giống web process (main.py: load_dotenv(override=True)) trước khi import module đọc ENV lúc import
+#     (chat_jobs, chat_api, llm_client…) → worker riêng dùng đúng DB / model / CHAT_JOB_* như web.
+# purpose:
+#   - Worker chạy job chat (send / edit / regenerate) từ bảng chat_jobs, tách khỏi web process
+#   - Nhiều process/host chạy song song được: claim bằng SELECT … FOR UPDATE SKIP LOCKED
+#   - Worker chết giữa chừng → job được process khác claim lại sau CHAT_JOB_STALE_SEC
+#
+# Chạy:  python -m modules.worker.chat_worker     (từ thư mục src)
+#   Web tier nên đặt CHAT_JOB_EMBEDDED_WORKERS=0 khi đã có worker riêng.
+#
+# ENV:
+#   CHAT_WORKER_CONCURRENCY=4        # số job chạy song song trong process này
+#   CHAT_WORKER_LOG_LEVEL=INFO
+#   (xem thêm CHAT_JOB_* trong modules/chat/service/chat_jobs.py)
+#
+# Ghi chú:
+#   - SSE của FE nằm ở web process → đọc job_partial_text (ghi mỗi heartbeat) thay cho buffer RAM.
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+try:
+    from modules.chat.service import chat_jobs as jobs
+    # import route module để đăng ký handler send/edit/regenerate
+    from modules.chat.routes import chat_api  # noqa: F401
+except Exception as e:  # pragma: no cover
+    raise RuntimeError(f"[chat_worker] Cannot load chat job handlers: {e}") from e
+
+from shared import llm_client
+from shared import tokenizer
+
+LOG = logging.getLogger("docaix.chat_worker")
+logging.basicConfig(
+    level=os.getenv("CHAT_WORKER_LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+
+CONCURRENCY = max(1, int(os.getenv("CHAT_WORKER_CONCURRENCY", "4") or "4"))
+
+
+async def _run() -> None:
+    await tokenizer.warm_async([os.getenv("RUNPOD_DEFAULT_MODEL", "openai/gpt-oss-20b").strip()])
+    try:
+        await jobs.run_worker_loop(concurrency=CONCURRENCY)
+    finally:
+        await llm_client.aclose()
+
+
+def main() -> None:
+    LOG.info("Chat worker started (worker=%s, concurrency=%d, stale=%ds)",
+             jobs.worker_id(), CONCURRENCY, jobs.CHAT_JOB_STALE_SEC)
+    try:
+        asyncio.run(_run())
+    except KeyboardInterrupt:
+        LOG.info("Chat worker stopped by user (SIGINT).")
+    except Exception as e:
+        LOG.exception("Fatal error in chat worker loop: %s", e)
+        # Phòng trường hợp supervisor (systemd/docker) restart
+        time.sleep(jobs.CHAT_JOB_POLL_SEC)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
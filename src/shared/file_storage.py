@@ -1,17 +1,42 @@
 # file: src/shared/file_storage.py
-# updated: 2025-08-31
+# updated: 2025-09-29
 # purpose:
 #   - Helpers lưu tệp upload an toàn (sanitize tên file, chống path traversal)
 #   - Bảo đảm thư mục, ghi theo stream (async/sync), tránh lỗi tên QUÁ DÀI trên Windows
 #   - Tự thêm hậu tố -1, -2... nếu trùng tên
+#   - Kho blob theo nội dung (UPLOAD_BLOB_DIR/<sha256[:2]>/<sha256>): store_blob_async đọc upload ĐÚNG 1 lần —
+#     vừa ghi vừa băm; nội dung đã có → bỏ bản vừa ghi (0 byte thêm). link_blob tạo tham chiếu theo chat
+#     (symlink tương đối → hardlink → copy), blob_digest lấy lại sha256 từ tham chiếu mà không đọc file
+#   - Không chặn event loop: dò tên / open / write / fsync chạy trong pool thread riêng (FS_IO_WORKERS),
+#     chunk FS_CHUNK_SIZE, fsync theo FS_FSYNC (hoặc tham số fsync=)
+#   - BlobWriter: ghi blob từ chuỗi chunk (parser multipart stream) — không cần upload object
+#   - file_digest: sha256 nội dung cho cache theo nội dung (blob → có sẵn, file thường → băm)
+#   - write_text_async: ghi file .txt đi kèm tài liệu (kết quả OCR / extract) nguyên tử trong pool I/O
+#   - Xoá blob an toàn: commit / xoá blob chạy dưới khoá kho (flock <blob_dir>/.lock + lock trong process);
+#     blob trùng nội dung được "chạm" (mtime tăng) khi request khác dùng lại → remove_blob chỉ xoá blob mà
+#     KHÔNG ai dùng lại kể từ lúc mình tạo; phần còn lại (chat bị xoá, request lỗi…) do gc_blobs quét
+#     (blob không còn Document nào tham chiếu và cũ hơn BLOB_GC_MIN_AGE_SEC) — xem modules/worker/blob_gc.py
 
 from __future__ import annotations
 
 import os
 import re
+import time
+import uuid
 import shutil
 import asyncio
-from typing import Any, Callable
+import hashlib
+import functools
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+try:  # POSIX: khoá kho blob giữa các process (web + worker)
+    import fcntl
+except Exception:  # pragma: no cover - Windows: chỉ khoá trong process
+    fcntl = None  # type: ignore[assignment]
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Cấu hình (có thể override qua ENV)
@@ -27,6 +52,19 @@ _WINDOWS_RESERVED = {
     *(f"COM{i}" for i in range(1, 10)),
     *(f"LPT{i}" for i in range(1, 10)),
 }
+# Kho blob theo nội dung (mặc định <UPLOAD_ROOT>/blobs)
+UPLOAD_BLOB_DIR = os.path.abspath(
+    os.getenv("UPLOAD_BLOB_DIR", "").strip() or os.path.join(os.getenv("UPLOAD_ROOT", "uploads"), "blobs")
+)
+_HEX64_RE = re.compile(r"^[0-9a-f]{64}$")
+# Pool thread riêng cho ghi upload (không dùng chung default executor của asyncio)
+FS_IO_WORKERS = max(1, int(os.getenv("FS_IO_WORKERS", "4")))
+# Kích thước chunk đọc/ghi mặc định
+FS_CHUNK_SIZE = max(64 * 1024, int(os.getenv("FS_CHUNK_SIZE", str(1024 * 1024))))
+# 1 = fsync file (và thư mục blob sau khi rename) trước khi trả về; 0 = để OS tự flush
+FS_FSYNC = os.getenv("FS_FSYNC", "0").strip() == "1"
+# gc_blobs: blob (và file tạm .part) trẻ hơn ngưỡng này không bị xoá — che request đang dở chưa kịp ghi Document
+BLOB_GC_MIN_AGE_SEC = max(0, int(os.getenv("BLOB_GC_MIN_AGE_SEC", str(24 * 3600))))
 # ──────────────────────────────────────────────────────────────────────────────
 
 
@@ -152,12 +190,165 @@ def infer_filename(upload: Any, fallback: str = "file.bin") -> str:
     return fallback
 
 
+# ──────────────────────────────────────────────────────────────────────────────
+# I/O đĩa ngoài event loop: open / write / fsync / dò tên file chạy trong pool thread riêng
+_IO_POOL: Optional[ThreadPoolExecutor] = None
+_IO_POOL_LOCK = threading.Lock()
+
+
+def _io_executor() -> ThreadPoolExecutor:
+    global _IO_POOL
+    with _IO_POOL_LOCK:
+        if _IO_POOL is None:
+            _IO_POOL = ThreadPoolExecutor(max_workers=FS_IO_WORKERS, thread_name_prefix="fs-io")
+        return _IO_POOL
+
+
+async def _run_io(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor(), functools.partial(fn, *args, **kwargs))
+
+
+async def stop_io_pool() -> None:
+    """on_shutdown: chờ các lượt ghi đang dở rồi đóng pool."""
+    global _IO_POOL
+    with _IO_POOL_LOCK:
+        pool, _IO_POOL = _IO_POOL, None
+    if pool is not None:
+        await asyncio.to_thread(pool.shutdown, True)
+
+
+def _fsync_dir(path: str) -> None:
+    # Windows không mở được thư mục để fsync → bỏ qua
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class _FileSink:
+    """File đích (chỉ dùng trong pool I/O): ghi chunk, băm tuỳ chọn, flush + fsync theo policy khi đóng."""
+
+    def __init__(self, path: str, *, hasher: Any = None, fsync: bool = False) -> None:
+        self.path = path
+        self.hasher = hasher
+        self.fsync = fsync
+        self.size = 0
+        self._f = open(path, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8", "ignore")
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+        self._f.write(chunk)
+        self.size += len(chunk)
+
+    def pump(self, read: Callable[[int], Any], chunk_size: int) -> None:
+        # nguồn sync (file spool của UploadFile, file-like) → đọc + ghi trọn trong 1 lượt thread
+        while True:
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+            self.write(chunk)
+
+    def close(self) -> None:
+        if self._f.closed:
+            return
+        try:
+            self._f.flush()
+            if self.fsync:
+                os.fsync(self._f.fileno())
+        finally:
+            self._f.close()
+
+    def discard(self) -> None:
+        try:
+            self._f.close()
+        except Exception:
+            pass
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+async def _drain_upload(upload: Any, sink: _FileSink, chunk_size: int) -> None:
+    """
+    Đọc upload theo từng chunk vào sink: async read() (UploadFile) → file-like gốc (.file) → read() sync → .body.
+    Mọi lượt ghi đĩa (và đọc nguồn sync) chạy trong pool I/O.
+    """
+    # Ưu tiên dùng API UploadFile nếu có
+    read: Callable[..., Any] | None = getattr(upload, "read", None)
+    if asyncio.iscoroutinefunction(read):
+        # UploadFile.read is async
+        while True:
+            chunk = await upload.read(chunk_size)  # type: ignore[call-arg]
+            if not chunk:
+                break
+            await _run_io(sink.write, chunk)
+        return
+
+    # Thử truy cập file-like gốc
+    src = getattr(upload, "file", None)
+    if hasattr(src, "read"):
+        read = src.read
+    if callable(read):
+        # read() sync
+        await _run_io(sink.pump, read, chunk_size)
+        return
+
+    # Fallback: thử thuộc tính body (bytes nhỏ)
+    data = getattr(upload, "body", b"")
+    if not isinstance(data, (bytes, bytearray)):
+        raise TypeError("Unsupported upload object: missing readable interface")
+    if data:
+        await _run_io(sink.write, bytes(data))
+
+
+async def _close_upload(upload: Any) -> None:
+    # Đóng upload nếu có (không bắt buộc)
+    close = getattr(upload, "close", None)
+    try:
+        if asyncio.iscoroutinefunction(close):
+            await close()  # type: ignore[misc]
+        elif callable(close):
+            close()  # type: ignore[misc]
+    except Exception:
+        # an toàn: bỏ qua lỗi khi đóng
+        pass
+
+
+def _prepare_dest(dest_path: str, make_unique: bool) -> str:
+    dest_dir = os.path.dirname(dest_path)
+    ensure_dir(dest_dir)
+
+    # Chuẩn hoá & rút gọn tên (nhỡ caller không dùng safe_filename)
+    base = os.path.basename(dest_path)
+    base = _sanitize_base(base)
+    base = _fit_name_for_dir(dest_dir, base)
+
+    # Build lại đường dẫn (chặn traversal)
+    dest_path = _safe_join(dest_dir, base)
+
+    if make_unique:
+        dest_path = _unique_path(dest_path)
+    return dest_path
+
+
 async def save_upload_async(
     upload: Any,
     dest_path: str,
     *,
-    chunk_size: int = 1024 * 1024,
+    chunk_size: int = FS_CHUNK_SIZE,
     make_unique: bool = False,
+    fsync: Optional[bool] = None,
 ) -> str:
     """
     Lưu một đối tượng upload (Litestar/Starlette UploadFile hoặc file-like) xuống đĩa theo stream.
@@ -166,68 +357,337 @@ async def save_upload_async(
     - Tự rút gọn tên để KHÔNG vượt quá FS_MAX_TOTAL_PATH (khắc phục lỗi Windows MAX_PATH)
     - Tránh ghi đè nếu make_unique=True
     - Hỗ trợ cả async read() (UploadFile) lẫn sync read()/file-like
+    - Không chặn event loop: dò tên / open / write / fsync chạy trong pool I/O (FS_IO_WORKERS)
+    - fsync=None → theo FS_FSYNC
 
     Trả về đường dẫn tuyệt đối đã lưu.
     """
     if not dest_path:
         raise ValueError("dest_path is required")
 
-    dest_dir = os.path.dirname(dest_path)
-    ensure_dir(dest_dir)
+    dest_path = await _run_io(_prepare_dest, dest_path, make_unique)
+    do_fsync = FS_FSYNC if fsync is None else bool(fsync)
 
-    # Chuẩn hoá & rút gọn tên (nhỡ caller không dùng safe_filename)
-    base = os.path.basename(dest_path)
-    base = _sanitize_base(base)
-    base = _fit_name_for_dir(dest_dir, base)
+    # Ghi theo stream
+    sink = await _run_io(_FileSink, dest_path, fsync=do_fsync)
+    try:
+        await _drain_upload(upload, sink, chunk_size)
+        await _run_io(sink.close)
+    except BaseException:
+        await asyncio.shield(_run_io(sink.discard))
+        raise
+    finally:
+        await _close_upload(upload)
 
-    # Build lại đường dẫn (chặn traversal)
-    dest_path = _safe_join(dest_dir, base)
+    return os.path.abspath(dest_path)
 
-    if make_unique:
-        dest_path = _unique_path(dest_path)
 
-    # Ưu tiên dùng API UploadFile nếu có
-    read: Callable[..., Any] | None = getattr(upload, "read", None)
-    close = getattr(upload, "close", None)
-    is_async_read = asyncio.iscoroutinefunction(read)
+def _write_text_atomic(path: str, text: str, fsync: bool) -> None:
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"   # tmp riêng → 2 lượt ghi cùng file không giẫm nhau
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+    if fsync:
+        _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+async def write_text_async(path: str, text: str, *, fsync: Optional[bool] = None) -> str:
+    """
+    Ghi file text UTF-8 nguyên tử (tmp + os.replace) trong pool I/O — cho file .txt đi kèm tài liệu (OCR / extract).
+    Người đọc luôn thấy bản cũ hoặc bản mới đầy đủ. fsync=None → theo FS_FSYNC. Trả về đường dẫn tuyệt đối.
+    """
+    do_fsync = FS_FSYNC if fsync is None else bool(fsync)
+    await _run_io(_write_text_atomic, path, text, do_fsync)
+    return os.path.abspath(path)
 
-    # Ghi theo stream
-    with open(dest_path, "wb") as out:
-        if is_async_read:
-            # UploadFile.read is async
-            while True:
-                chunk = await upload.read(chunk_size)  # type: ignore[call-arg]
-                if not chunk:
-                    break
-                out.write(chunk)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Kho blob theo nội dung (content-addressed)
+@dataclass
+class StoredBlob:
+    digest: str        # sha256 hex
+    path: str          # đường dẫn tuyệt đối của blob
+    size: int
+    existed: bool      # nội dung đã có sẵn trong kho → không tốn thêm byte nào
+    mtime_ns: int = 0  # mtime blob ngay sau commit; khác đi → request khác đã dùng lại blob
+
+
+def blob_path(digest: str, blob_dir: Optional[str] = None) -> str:
+    root = os.path.abspath(blob_dir or UPLOAD_BLOB_DIR)
+    return os.path.join(root, digest[:2], digest)
+
+
+_BLOB_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def _blob_lock(root: str) -> Iterator[None]:
+    """Khoá kho blob cho commit / xoá (đoạn găng rất ngắn: stat + rename / unlink)."""
+    with _BLOB_LOCK:
+        if fcntl is None:
+            yield
+            return
+        ensure_dir(root)
+        fd = os.open(os.path.join(root, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # đóng fd → nhả flock
+
+
+def _touch_blob(path: str) -> int:
+    """Đánh dấu blob vừa được dùng lại: mtime tăng ngặt (kể cả khi đồng hồ chưa nhích) → trả mtime mới."""
+    st = os.stat(path)
+    mtime = max(time.time_ns(), st.st_mtime_ns + 1)
+    os.utime(path, ns=(st.st_atime_ns, mtime))
+    return os.stat(path).st_mtime_ns
+
+
+def _open_blob_tmp(root: str, fsync: bool) -> _FileSink:
+    tmp_dir = os.path.join(root, "tmp")
+    ensure_dir(tmp_dir)
+    return _FileSink(os.path.join(tmp_dir, f"{uuid.uuid4().hex}.part"), hasher=hashlib.sha256(), fsync=fsync)
+
+
+def _commit_blob(sink: _FileSink, root: str) -> StoredBlob:
+    sink.close()
+    digest = sink.hasher.hexdigest()
+    dest = blob_path(digest, root)
+    with _blob_lock(root):
+        existed = os.path.exists(dest)
+        if existed:
+            os.remove(sink.path)
+            # chạm blob: remove_blob của request đã tạo nó sẽ không xoá, gc_blobs coi là còn mới
+            mtime_ns = _touch_blob(dest)
         else:
-            # Thử truy cập file-like gốc
-            src = getattr(upload, "file", None)
-            if hasattr(src, "read"):
-                shutil.copyfileobj(src, out, length=chunk_size)
-            elif callable(read):
-                # read() sync
-                while True:
-                    chunk = read(chunk_size)  # type: ignore[misc]
-                    if not chunk:
-                        break
-                    out.write(chunk)
-            else:
-                # Fallback: thử thuộc tính body (bytes nhỏ)
-                data = getattr(upload, "body", b"")
-                if isinstance(data, (bytes, bytearray)):
-                    out.write(data)
-                else:
-                    raise TypeError("Unsupported upload object: missing readable interface")
+            ensure_dir(os.path.dirname(dest))
+            os.replace(sink.path, dest)
+            if sink.fsync:
+                _fsync_dir(os.path.dirname(dest))
+            mtime_ns = os.stat(dest).st_mtime_ns
+    return StoredBlob(digest=digest, path=dest, size=sink.size, existed=existed, mtime_ns=mtime_ns)
 
-    # Đóng upload nếu có (không bắt buộc)
+
+async def store_blob_async(
+    upload: Any,
+    *,
+    blob_dir: Optional[str] = None,
+    chunk_size: int = FS_CHUNK_SIZE,
+    fsync: Optional[bool] = None,
+) -> StoredBlob:
+    """
+    Ghi upload vào kho blob, băm sha256 trong CÙNG lượt đọc (không đọc lại upload hay file đã ghi).
+
+    - Ghi ra file tạm trong kho (cùng ổ đĩa → rename nguyên tử), xong mới biết digest
+    - Blob đã tồn tại (cùng nội dung từ chat / user khác) → xoá file tạm, dùng blob cũ
+    - Ghi + băm chạy trong pool I/O như save_upload_async; fsync=None → theo FS_FSYNC
+    """
+    root = os.path.abspath(blob_dir or UPLOAD_BLOB_DIR)
+    do_fsync = FS_FSYNC if fsync is None else bool(fsync)
+
+    sink = await _run_io(_open_blob_tmp, root, do_fsync)
     try:
-        if asyncio.iscoroutinefunction(close):
-            await close()  # type: ignore[misc]
-        elif callable(close):
-            close()  # type: ignore[misc]
-    except Exception:
-        # an toàn: bỏ qua lỗi khi đóng
-        pass
+        await _drain_upload(upload, sink, chunk_size)
+        return await _run_io(_commit_blob, sink, root)
+    except BaseException:
+        await asyncio.shield(_run_io(sink.discard))
+        raise
+    finally:
+        await _close_upload(upload)
 
+
+class BlobWriter:
+    """
+    Ghi 1 blob theo từng chunk khi nguồn không phải upload object (vd. parser multipart dạng stream):
+    gom chunk nhỏ tới chunk_size rồi mới ghi (ít lượt nhảy sang pool I/O), băm sha256 trong lúc ghi.
+    """
+
+    def __init__(
+        self,
+        *,
+        blob_dir: Optional[str] = None,
+        chunk_size: int = FS_CHUNK_SIZE,
+        fsync: Optional[bool] = None,
+    ) -> None:
+        self.root = os.path.abspath(blob_dir or UPLOAD_BLOB_DIR)
+        self.chunk_size = max(1, int(chunk_size))
+        self.fsync = FS_FSYNC if fsync is None else bool(fsync)
+        self.size = 0
+        self._buf = bytearray()
+        self._sink: Optional[_FileSink] = None
+
+    async def _flush(self) -> None:
+        if self._sink is None:
+            self._sink = await _run_io(_open_blob_tmp, self.root, self.fsync)
+        if self._buf:
+            data, self._buf = bytes(self._buf), bytearray()
+            await _run_io(self._sink.write, data)
+
+    async def write(self, chunk: bytes) -> None:
+        self._buf += chunk
+        self.size += len(chunk)
+        if len(self._buf) >= self.chunk_size:
+            await self._flush()
+
+    async def commit(self) -> StoredBlob:
+        await self._flush()
+        assert self._sink is not None
+        return await _run_io(_commit_blob, self._sink, self.root)
+
+    async def discard(self) -> None:
+        self._buf = bytearray()
+        if self._sink is not None:
+            await _run_io(self._sink.discard)
+
+
+def remove_blob(blob: StoredBlob) -> bool:
+    """
+    Bỏ blob do request này tạo khi request bị từ chối / huỷ giữa chừng. Chỉ xoá khi chắc chắn không ai tham chiếu:
+    blob có sẵn từ trước → giữ; request khác đã dùng lại (mtime đổi kể từ commit) → giữ, để gc_blobs quyết định.
+    Trả True nếu đã xoá.
+    """
+    if blob.existed or not blob.mtime_ns:
+        return False
+    root = os.path.dirname(os.path.dirname(blob.path))
+    with _blob_lock(root):
+        try:
+            if os.stat(blob.path).st_mtime_ns != blob.mtime_ns:
+                return False
+            os.remove(blob.path)
+        except OSError:
+            return False
+    return True
+
+
+async def remove_blob_async(blob: StoredBlob) -> bool:
+    """remove_blob trong pool I/O (chờ khoá kho không chặn event loop)."""
+    return await _run_io(remove_blob, blob)
+
+
+def gc_blobs(
+    referenced: Iterable[str],
+    *,
+    blob_dir: Optional[str] = None,
+    min_age_sec: int = BLOB_GC_MIN_AGE_SEC,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    """
+    Quét kho blob, xoá blob có digest KHÔNG nằm trong `referenced` và cũ hơn min_age_sec (mtime — blob được dùng
+    lại thì mtime mới), cùng file tạm tmp/*.part bị bỏ dở. Mỗi blob kiểm tra lại mtime + xoá dưới khoá kho
+    → request đang dùng lại blob đó (đã chạm) không bị mất.
+    Tham chiếu dạng hardlink / copy vẫn đọc được sau khi blob bị xoá (dữ liệu không phụ thuộc blob).
+    """
+    root = os.path.abspath(blob_dir or UPLOAD_BLOB_DIR)
+    keep = set(referenced)
+    cutoff_ns = time.time_ns() - int(min_age_sec) * 1_000_000_000
+    stats = {"scanned": 0, "referenced": 0, "recent": 0, "removed": 0, "bytes_freed": 0, "tmp_removed": 0}
+    if not os.path.isdir(root):
+        return stats
+
+    for sub in sorted(os.listdir(root)):
+        d = os.path.join(root, sub)
+        if sub == "tmp":
+            for name in os.listdir(d) if os.path.isdir(d) else []:
+                p = os.path.join(d, name)
+                try:
+                    if name.endswith(".part") and os.stat(p).st_mtime_ns < cutoff_ns:
+                        if not dry_run:
+                            os.remove(p)
+                        stats["tmp_removed"] += 1
+                except OSError:
+                    pass
+            continue
+        if len(sub) != 2 or not os.path.isdir(d):
+            continue
+        for name in os.listdir(d):
+            if not _HEX64_RE.match(name):
+                continue
+            stats["scanned"] += 1
+            if name in keep:
+                stats["referenced"] += 1
+                continue
+            p = os.path.join(d, name)
+            with _blob_lock(root):
+                try:
+                    st = os.stat(p)
+                    if st.st_mtime_ns >= cutoff_ns:
+                        stats["recent"] += 1
+                        continue
+                    if not dry_run:
+                        os.remove(p)
+                except OSError:
+                    continue
+            stats["removed"] += 1
+            stats["bytes_freed"] += int(st.st_size)
+    return stats
+
+
+def link_blob(blob: str, dest_path: str, *, make_unique: bool = False) -> str:
+    """
+    Tạo tham chiếu tới blob tại dest_path (tên hiển thị theo chat): symlink tương đối → hardlink → copy.
+    Tên được chuẩn hoá / rút gọn / chống traversal như save_upload_async. Trả về đường dẫn tuyệt đối.
+    """
+    if not dest_path:
+        raise ValueError("dest_path is required")
+
+    dest_path = _prepare_dest(dest_path, make_unique)
+
+    try:
+        # tương đối → di chuyển cả UPLOAD_ROOT không làm gãy link
+        os.symlink(os.path.relpath(blob, os.path.dirname(dest_path)), dest_path)
+    except FileExistsError:
+        raise
+    except (OSError, NotImplementedError):
+        # Windows không có quyền symlink / FS không hỗ trợ
+        try:
+            os.link(blob, dest_path)
+        except FileExistsError:
+            raise
+        except OSError:
+            shutil.copyfile(blob, dest_path)
     return os.path.abspath(dest_path)
+
+
+async def link_blob_async(blob: str, dest_path: str, *, make_unique: bool = False) -> str:
+    """link_blob trong pool I/O (dò tên trùng + tạo link không chặn event loop)."""
+    return await _run_io(link_blob, blob, dest_path, make_unique=make_unique)
+
+
+def blob_digest(path: str, blob_dir: Optional[str] = None) -> Optional[str]:
+    """
+    sha256 của file nếu nó là blob / symlink tới blob trong kho (chỉ đọc link, không đọc nội dung);
+    file thường (upload cũ, hardlink / copy fallback) → None.
+    """
+    try:
+        real = os.path.realpath(path)
+    except OSError:
+        return None
+    root = os.path.realpath(blob_dir or UPLOAD_BLOB_DIR)
+    name = os.path.basename(real)
+    if not _HEX64_RE.match(name) or os.path.dirname(os.path.dirname(real)) != root:
+        return None
+    return name
+
+
+def file_digest(path: str, blob_dir: Optional[str] = None, *, chunk_size: int = FS_CHUNK_SIZE) -> str:
+    """sha256 nội dung file: tham chiếu tới kho blob → lấy từ tên blob (không đọc); file thường → băm theo stream."""
+    digest = blob_digest(path, blob_dir)
+    if digest:
+        return digest
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(chunk_size)
+            if not b:
+                break
+            h.update(b)
+    return h.hexdigest()
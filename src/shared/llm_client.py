@@ -0,0 +1,354 @@
+# file: src/shared/llm_client.py
+# updated: 2025-09-29 (v1.0.2)
+# changes (v1.0.2):
+#   - is_stream_unsupported: 400 chỉ tính khi nội dung lỗi nhắc tới `stream` / `stream_options`; 400 khác
+#     (prompt quá dài, tham số sai, …) không fallback (gọi lại không stream cũng hỏng y như vậy). 404 / 501 giữ nguyên.
+# changes (v1.0.1):
+#   - is_stream_unsupported(exc): chỉ lỗi 400 / 404 / 501 của chính request stream mới nghĩa là provider không
+#     hỗ trợ stream / stream_options → caller mới được fallback sang gọi thường; busy / timeout / lỗi mạng thì không.
+# purpose:
+#   - MỘT lớp client LLM dùng chung cho cả process (chat_api, memory, chat_auto_tier, …)
+#   - AsyncOpenAI trên httpx.AsyncClient (keep-alive pool) → không còn đẩy call blocking vào default executor
+#   - Giới hạn số request đang bay theo "endpoint" logic (chat / router / memory / email …)
+#   - Metrics: inflight, waiting, số call/lỗi, thời gian chờ slot (avg / max / p95)
+#   - Sync client (httpx.Client pool) cho các đường sync còn lại (vd: memory.save_global_memory)
+#
+# ENV:
+#   RUNPOD_BASE_URL, RUNPOD_API_KEY, RUNPOD_TIMEOUT=60
+#   LLM_MAX_INFLIGHT=16                 # mặc định cho mọi endpoint
+#   LLM_MAX_INFLIGHT_<ENDPOINT>=...     # vd: LLM_MAX_INFLIGHT_CHAT=12, LLM_MAX_INFLIGHT_ROUTER=32
+#   LLM_HTTP_MAX_CONNECTIONS=64
+#   LLM_HTTP_MAX_KEEPALIVE=20
+#   LLM_HTTP_KEEPALIVE_EXPIRY=30        # giây
+#   LLM_QUEUE_TIMEOUT_SEC=0             # >0: chờ slot quá lâu → LLMBusyError
+#
+# Ghi chú:
+#   - Giới hạn async (asyncio.Semaphore) và sync (threading.BoundedSemaphore) tách riêng nhưng cùng cấu hình.
+#   - Async client gắn với event loop đang chạy; đổi loop (script/test) → tự tạo lại.
+
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+logger = logging.getLogger("docaix.llm_client")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = os.getenv(name, "")
+        return int(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+RUNPOD_BASE_URL = (os.getenv("RUNPOD_BASE_URL", "").strip() or "")
+RUNPOD_API_KEY = (os.getenv("RUNPOD_API_KEY", "").strip() or "")
+RUNPOD_TIMEOUT = _env_int("RUNPOD_TIMEOUT", 60)
+
+LLM_MAX_INFLIGHT = max(1, _env_int("LLM_MAX_INFLIGHT", 16))
+LLM_HTTP_MAX_CONNECTIONS = max(1, _env_int("LLM_HTTP_MAX_CONNECTIONS", 64))
+LLM_HTTP_MAX_KEEPALIVE = max(0, _env_int("LLM_HTTP_MAX_KEEPALIVE", 20))
+LLM_HTTP_KEEPALIVE_EXPIRY = max(1, _env_int("LLM_HTTP_KEEPALIVE_EXPIRY", 30))
+LLM_QUEUE_TIMEOUT_SEC = max(0, _env_int("LLM_QUEUE_TIMEOUT_SEC", 0))
+
+
+class LLMBusyError(RuntimeError):
+    """Chờ slot endpoint quá LLM_QUEUE_TIMEOUT_SEC."""
+
+
+# mã lỗi của request stream=True cho biết provider không hỗ trợ stream / stream_options
+_STREAM_UNSUPPORTED_STATUS = (404, 501)
+
+
+def is_stream_unsupported(exc: BaseException) -> bool:
+    """True nếu lỗi của chat_completion_stream nghĩa là "không stream được" (nên thử lại 1 lần không stream)."""
+    if isinstance(exc, (LLMBusyError, asyncio.TimeoutError, httpx.TimeoutException)):
+        return False
+    status = getattr(exc, "status_code", None)
+    if status == 400:
+        detail = f"{getattr(exc, 'message', None) or exc} {getattr(exc, 'body', None) or ''}".lower()
+        return "stream" in detail  # gồm cả "stream_options"
+    return status in _STREAM_UNSUPPORTED_STATUS
+
+
+def is_configured() -> bool:
+    return bool(RUNPOD_BASE_URL and RUNPOD_API_KEY)
+
+
+def _base_url() -> str:
+    if not is_configured():
+        raise RuntimeError("RUNPOD_BASE_URL / RUNPOD_API_KEY chưa cấu hình.")
+    base_url = RUNPOD_BASE_URL.rstrip("/")
+    if not base_url.endswith("/v1"):
+        base_url += "/v1"
+    return base_url
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def endpoint_limit(endpoint: str) -> int:
+    key = "LLM_MAX_INFLIGHT_" + (endpoint or "default").strip().upper()
+    return max(1, _env_int(key, LLM_MAX_INFLIGHT))
+
+
+# ───────────────── metrics ─────────────────
+_METRICS_LOCK = threading.Lock()
+_METRICS: Dict[str, Dict[str, Any]] = {}
+
+
+def _m(endpoint: str) -> Dict[str, Any]:
+    m = _METRICS.get(endpoint)
+    if m is None:
+        m = {
+            "limit": endpoint_limit(endpoint),
+            "inflight": 0,
+            "waiting": 0,
+            "calls": 0,
+            "errors": 0,
+            "wait_total_ms": 0.0,
+            "wait_max_ms": 0.0,
+            "recent_waits_ms": deque(maxlen=512),
+        }
+        _METRICS[endpoint] = m
+    return m
+
+
+def _on_wait_start(endpoint: str) -> None:
+    with _METRICS_LOCK:
+        _m(endpoint)["waiting"] += 1
+
+
+def _on_acquired(endpoint: str, waited_sec: float) -> None:
+    ms = waited_sec * 1000.0
+    with _METRICS_LOCK:
+        m = _m(endpoint)
+        m["waiting"] -= 1
+        m["inflight"] += 1
+        m["calls"] += 1
+        m["wait_total_ms"] += ms
+        m["wait_max_ms"] = max(m["wait_max_ms"], ms)
+        m["recent_waits_ms"].append(ms)
+    if ms > 1000:
+        logger.info("LLM endpoint=%s waited %.0f ms for a slot", endpoint, ms)
+
+
+def _on_wait_abort(endpoint: str) -> None:
+    with _METRICS_LOCK:
+        _m(endpoint)["waiting"] -= 1
+
+
+def _on_released(endpoint: str, failed: bool) -> None:
+    with _METRICS_LOCK:
+        m = _m(endpoint)
+        m["inflight"] -= 1
+        if failed:
+            m["errors"] += 1
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    """Snapshot metrics theo endpoint (dùng cho log/admin)."""
+    out: Dict[str, Dict[str, Any]] = {}
+    with _METRICS_LOCK:
+        for ep, m in _METRICS.items():
+            waits = sorted(m["recent_waits_ms"])
+            p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+            out[ep] = {
+                "limit": m["limit"],
+                "inflight": m["inflight"],
+                "waiting": m["waiting"],
+                "calls": m["calls"],
+                "errors": m["errors"],
+                "wait_avg_ms": round(m["wait_total_ms"] / m["calls"], 1) if m["calls"] else 0.0,
+                "wait_max_ms": round(m["wait_max_ms"], 1),
+                "wait_p95_ms": round(p95, 1),
+            }
+    return out
+
+
+# ───────────────── async client + slots ─────────────────
+_ASYNC: Dict[str, Any] = {"loop": None, "client": None, "sems": {}}
+
+
+def _async_state() -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    if _ASYNC["loop"] is not loop:
+        _ASYNC["loop"] = loop
+        _ASYNC["client"] = None
+        _ASYNC["sems"] = {}
+    return _ASYNC
+
+
+def get_async_client() -> AsyncOpenAI:
+    st = _async_state()
+    if st["client"] is None:
+        http = httpx.AsyncClient(limits=_limits(), timeout=httpx.Timeout(RUNPOD_TIMEOUT))
+        st["client"] = AsyncOpenAI(
+            base_url=_base_url(),
+            api_key=RUNPOD_API_KEY,
+            timeout=RUNPOD_TIMEOUT,
+            http_client=http,
+        )
+    return st["client"]
+
+
+def _async_sem(endpoint: str) -> asyncio.Semaphore:
+    sems = _async_state()["sems"]
+    sem = sems.get(endpoint)
+    if sem is None:
+        sem = asyncio.Semaphore(endpoint_limit(endpoint))
+        sems[endpoint] = sem
+    return sem
+
+
+@asynccontextmanager
+async def slot(endpoint: str) -> AsyncIterator[None]:
+    """Giữ 1 slot của endpoint trong suốt block (kể cả khi đọc stream)."""
+    sem = _async_sem(endpoint)
+    t0 = time.perf_counter()
+    _on_wait_start(endpoint)
+    try:
+        if LLM_QUEUE_TIMEOUT_SEC > 0:
+            await asyncio.wait_for(sem.acquire(), timeout=LLM_QUEUE_TIMEOUT_SEC)
+        else:
+            await sem.acquire()
+    except asyncio.TimeoutError:
+        _on_wait_abort(endpoint)
+        raise LLMBusyError(f"LLM endpoint '{endpoint}' busy")
+    except BaseException:
+        _on_wait_abort(endpoint)
+        raise
+    _on_acquired(endpoint, time.perf_counter() - t0)
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        sem.release()
+        _on_released(endpoint, failed)
+
+
+async def chat_completion(endpoint: str, **kwargs: Any) -> Any:
+    """client.chat.completions.create(**kwargs) trong giới hạn của endpoint."""
+    async with slot(endpoint):
+        return await get_async_client().chat.completions.create(**kwargs)
+
+
+async def chat_completion_stream(endpoint: str, **kwargs: Any) -> AsyncIterator[Any]:
+    """Stream chunk; giữ slot tới khi đọc xong/đóng generator (đóng generator → đóng HTTP stream)."""
+    async with slot(endpoint):
+        stream = await get_async_client().chat.completions.create(stream=True, **kwargs)
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            try:
+                await stream.close()
+            except Exception:
+                pass
+
+
+# ───────────────── sync client + slots ─────────────────
+_SYNC_LOCK = threading.Lock()
+_SYNC: Dict[str, Any] = {"client": None, "sems": {}}
+
+
+def get_sync_client() -> OpenAI:
+    with _SYNC_LOCK:
+        if _SYNC["client"] is None:
+            http = httpx.Client(limits=_limits(), timeout=httpx.Timeout(RUNPOD_TIMEOUT))
+            _SYNC["client"] = OpenAI(
+                base_url=_base_url(),
+                api_key=RUNPOD_API_KEY,
+                timeout=RUNPOD_TIMEOUT,
+                http_client=http,
+            )
+        return _SYNC["client"]
+
+
+def _sync_sem(endpoint: str) -> threading.BoundedSemaphore:
+    with _SYNC_LOCK:
+        sem = _SYNC["sems"].get(endpoint)
+        if sem is None:
+            sem = threading.BoundedSemaphore(endpoint_limit(endpoint))
+            _SYNC["sems"][endpoint] = sem
+        return sem
+
+
+@contextmanager
+def slot_sync(endpoint: str) -> Iterator[None]:
+    sem = _sync_sem(endpoint)
+    t0 = time.perf_counter()
+    _on_wait_start(endpoint)
+    ok = sem.acquire(timeout=LLM_QUEUE_TIMEOUT_SEC) if LLM_QUEUE_TIMEOUT_SEC > 0 else sem.acquire()
+    if not ok:
+        _on_wait_abort(endpoint)
+        raise LLMBusyError(f"LLM endpoint '{endpoint}' busy")
+    _on_acquired(endpoint, time.perf_counter() - t0)
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        sem.release()
+        _on_released(endpoint, failed)
+
+
+def chat_completion_sync(endpoint: str, **kwargs: Any) -> Any:
+    with slot_sync(endpoint):
+        return get_sync_client().chat.completions.create(**kwargs)
+
+
+async def aclose() -> None:
+    """Đóng pool (on_shutdown)."""
+    client = _ASYNC.get("client")
+    _ASYNC.update({"loop": None, "client": None, "sems": {}})
+    if client is not None:
+        try:
+            await client.close()
+        except Exception:
+            pass
+    with _SYNC_LOCK:
+        sc = _SYNC.get("client")
+        _SYNC["client"] = None
+    if sc is not None:
+        try:
+            sc.close()
+        except Exception:
+            pass
+
+
+__all__ = [
+    "LLMBusyError",
+    "is_stream_unsupported",
+    "is_configured",
+    "endpoint_limit",
+    "get_async_client",
+    "get_sync_client",
+    "slot",
+    "slot_sync",
+    "chat_completion",
+    "chat_completion_stream",
+    "chat_completion_sync",
+    "stats",
+    "aclose",
+]
@@ -0,0 +1,253 @@
+# file: src/shared/tokenizer.py
+# updated: 2025-09-29 (v1.0.1)
+# changes (v1.0.1):
+#   - tiktoken có trong requirements.txt (trước đây thiếu → mặc định o200k_base luôn rơi về ước lượng byte/3).
+#   - Tokenizer là lớp trừu tượng (count / _cut); ước lượng byte là backend riêng _ApproxTokenizer,
+#     encode / decode chỉ có ở backend id token thật (_IdsTokenizer).
+#   - warm_async(): nạp sẵn tokenizer mặc định + TOKENIZER_MAP lúc startup trong thread — tiktoken.get_encoding
+#     có thể tải file BPE qua mạng lần đầu, không để xảy ra đồng bộ trên event loop trong request.
+# purpose:
+#   - Đếm / cắt token sát với tokenizer thật của từng ModelVariant (thay cho ước lượng len(text)/4 —
+#     lệch nhiều với tiếng Việt có dấu → prompt tràn cửa sổ model hoặc phí ngữ cảnh)
+#   - Tokenizer được cache theo spec (1 lần load / process), chọn theo provider_model_id:
+#       * TOKENIZER_MAP (JSON) cấu hình tường minh: {"openai/gpt-oss-20b": "tiktoken:o200k_base",
+#                                                   "Qwen/Qwen2.5-7B-Instruct": "hf:/models/qwen2.5"}
+#       * mặc định: họ gpt-oss / gpt-4o / o-series → tiktoken o200k_base; còn lại → cl100k_base
+#       * thiếu thư viện / không load được → ước lượng theo byte UTF-8 (bảo thủ với tiếng Việt)
+#   - Cửa sổ ngữ cảnh theo model: MODEL_CONTEXT_TOKENS (mặc định) + MODEL_CONTEXT_TOKENS_MAP (JSON)
+#
+# ENV:
+#   TOKENIZER_MAP='{}'                  # provider_model_id → "tiktoken:<encoding>" | "hf:<path|repo>" | "approx"
+#   TOKENIZER_HF_LOCAL_ONLY=1           # hf: chỉ đọc file local (không tải mạng trong request)
+#   MODEL_CONTEXT_TOKENS=131072         # gpt-oss
+#   MODEL_CONTEXT_TOKENS_MAP='{}'       # provider_model_id → số token cửa sổ
+#
+# Ghi chú:
+#   - tiktoken / transformers là optional; thiếu → "approx" (log 1 lần / spec nhờ lru_cache).
+
+from __future__ import annotations
+
+import os
+import json
+import math
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger("docaix.tokenizer")
+
+try:
+    import tiktoken  # type: ignore
+except Exception:  # pragma: no cover
+    tiktoken = None  # type: ignore
+
+try:
+    from transformers import AutoTokenizer  # type: ignore
+except Exception:  # pragma: no cover
+    AutoTokenizer = None  # type: ignore
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        v = os.getenv(name, "")
+        return int(v.strip()) if v and v.strip() else default
+    except Exception:
+        return default
+
+
+def _env_json(name: str) -> Dict[str, Any]:
+    try:
+        v = json.loads(os.getenv(name, "") or "{}")
+        return v if isinstance(v, dict) else {}
+    except Exception:
+        logger.warning("%s is not valid JSON — ignored", name)
+        return {}
+
+
+TOKENIZER_MAP: Dict[str, str] = {str(k): str(v) for k, v in _env_json("TOKENIZER_MAP").items()}
+TOKENIZER_HF_LOCAL_ONLY = (os.getenv("TOKENIZER_HF_LOCAL_ONLY", "1").strip() != "0")
+MODEL_CONTEXT_TOKENS = max(1024, _env_int("MODEL_CONTEXT_TOKENS", 131072))
+MODEL_CONTEXT_TOKENS_MAP: Dict[str, int] = {}
+for _k, _v in _env_json("MODEL_CONTEXT_TOKENS_MAP").items():
+    try:
+        MODEL_CONTEXT_TOKENS_MAP[str(_k)] = int(_v)
+    except Exception:
+        pass
+
+_ELLIPSIS = " …"          # đánh dấu cắt cuối (giữ đầu)
+_ELLIPSIS_HEAD = "…\n"     # đánh dấu cắt đầu (giữ cuối)
+
+
+# ───────────────── tokenizer backends ─────────────────
+class Tokenizer(ABC):
+    """Giao diện chung: count() + truncate() (cắt theo token, giữ đầu / cuối)."""
+
+    name = "abstract"
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        ...
+
+    @abstractmethod
+    def _cut(self, text: str, n: int, keep: str) -> str:
+        """Phần đầu (keep="head") / cuối (keep="tail") của text vừa n token."""
+
+    def truncate(self, text: str, max_tokens: int, *, keep: str = "head") -> str:
+        """Cắt còn tối đa max_tokens (keep="head": giữ đầu, "tail": giữ cuối) + đánh dấu " …"."""
+        if not text or max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        if keep == "tail":
+            cut = self._cut(text, max(0, max_tokens - self.count(_ELLIPSIS_HEAD)), keep)
+            nl = cut.find("\n")
+            if 0 <= nl < 200:
+                cut = cut[nl + 1:]
+            return (_ELLIPSIS_HEAD + cut.lstrip()) if cut else ""
+        cut = self._cut(text, max(0, max_tokens - self.count(_ELLIPSIS)), keep)
+        sp = cut.rfind(" ")
+        if sp > 120:
+            cut = cut[:sp]
+        return (cut.rstrip() + _ELLIPSIS) if cut else ""
+
+
+class _ApproxTokenizer(Tokenizer):
+    """Ước lượng theo byte UTF-8: ~3 byte/token (chữ Việt có dấu 2–3 byte/ký tự) — luôn dư chứ không thiếu."""
+
+    name = "approx"
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return math.ceil(len(text.encode("utf-8", "ignore")) / 3)
+
+    def _cut(self, text: str, n: int, keep: str) -> str:
+        # chia đôi trên số ký tự tới khi vừa n token
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            part = text[:mid] if keep != "tail" else text[len(text) - mid:]
+            if self.count(part) <= n:
+                lo = mid
+            else:
+                hi = mid - 1
+        return text[:lo] if keep != "tail" else text[len(text) - lo:]
+
+
+class _IdsTokenizer(Tokenizer):
+    """Backend có encode/decode thật → đếm/cắt đúng trên id token."""
+
+    @abstractmethod
+    def encode(self, text: str) -> List[int]:
+        ...
+
+    @abstractmethod
+    def decode(self, ids: List[int]) -> str:
+        ...
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self.encode(text))
+
+    def _cut(self, text: str, n: int, keep: str) -> str:
+        ids = self.encode(text)
+        part = ids[:n] if keep != "tail" else ids[len(ids) - n:] if n > 0 else []
+        return self.decode(part).replace("�", "")
+
+
+class _TiktokenTokenizer(_IdsTokenizer):
+    def __init__(self, encoding: str) -> None:
+        self._enc = tiktoken.get_encoding(encoding)  # type: ignore[union-attr]
+        self.name = f"tiktoken:{encoding}"
+
+    def encode(self, text: str) -> List[int]:
+        return self._enc.encode(text, disallowed_special=())
+
+    def decode(self, ids: List[int]) -> str:
+        return self._enc.decode(ids)
+
+
+class _HFTokenizer(_IdsTokenizer):
+    def __init__(self, path: str) -> None:
+        self._tok = AutoTokenizer.from_pretrained(path, local_files_only=TOKENIZER_HF_LOCAL_ONLY)  # type: ignore[union-attr]
+        self.name = f"hf:{path}"
+
+    def encode(self, text: str) -> List[int]:
+        return self._tok.encode(text, add_special_tokens=False)
+
+    def decode(self, ids: List[int]) -> str:
+        return self._tok.decode(ids, skip_special_tokens=True)
+
+
+_APPROX = _ApproxTokenizer()
+
+
+def _default_spec(provider_model_id: str) -> str:
+    m = (provider_model_id or "").lower()
+    if any(k in m for k in ("gpt-oss", "gpt-4o", "gpt-4.1", "o200k", "/o1", "/o3", "/o4")):
+        return "tiktoken:o200k_base"
+    return "tiktoken:cl100k_base"
+
+
+@lru_cache(maxsize=32)
+def _load(spec: str) -> Tokenizer:
+    kind, _, arg = spec.partition(":")
+    try:
+        if kind == "tiktoken":
+            if tiktoken is None:
+                raise RuntimeError("tiktoken not installed")
+            return _TiktokenTokenizer(arg or "cl100k_base")
+        if kind == "hf":
+            if AutoTokenizer is None:
+                raise RuntimeError("transformers not installed")
+            return _HFTokenizer(arg)
+    except Exception as e:
+        logger.warning("tokenizer %s unavailable (%s) — using byte estimate", spec, e)
+    return _APPROX
+
+
+def spec_for(provider_model_id: Optional[str]) -> str:
+    pid = (provider_model_id or "").strip()
+    return TOKENIZER_MAP.get(pid) or _default_spec(pid)
+
+
+def for_model(provider_model_id: Optional[str]) -> Tokenizer:
+    """Tokenizer (đã cache) của 1 ModelVariant.provider_model_id."""
+    return _load(spec_for(provider_model_id))
+
+
+def context_window(provider_model_id: Optional[str]) -> int:
+    return MODEL_CONTEXT_TOKENS_MAP.get((provider_model_id or "").strip(), MODEL_CONTEXT_TOKENS)
+
+
+def _warm_specs(provider_model_ids: Iterable[Optional[str]] = ()) -> List[str]:
+    specs = {"tiktoken:o200k_base", "tiktoken:cl100k_base", *TOKENIZER_MAP.values()}
+    specs.update(spec_for(pid) for pid in provider_model_ids if pid)
+    return sorted(specs)
+
+
+def warm(provider_model_ids: Iterable[Optional[str]] = ()) -> List[str]:
+    """Nạp sẵn (vào cache _load) tokenizer mặc định, mọi spec trong TOKENIZER_MAP và của các model truyền vào."""
+    return [_load(spec).name for spec in _warm_specs(provider_model_ids)]
+
+
+async def warm_async(provider_model_ids: Iterable[Optional[str]] = ()) -> None:
+    """on_startup: warm() trong thread (tiktoken có thể tải file BPE lần đầu) — request sau không chặn event loop."""
+    try:
+        names = await asyncio.to_thread(warm, list(provider_model_ids))
+        logger.info("tokenizers ready: %s", ", ".join(names))
+    except Exception as e:
+        logger.warning("tokenizer warm-up failed: %s", e)
+
+
+__all__ = [
+    "Tokenizer",
+    "spec_for",
+    "for_model",
+    "context_window",
+    "warm",
+    "warm_async",
+]
@@ -0,0 +1,10 @@
+# file: src/tests/conftest.py
+# Chạy từ src/:  python -m pytest -q
+# Module cần DB / web (sqlalchemy, litestar…) tự skip qua pytest.importorskip khi môi trường chưa cài.
+
+import os
+import sys
+
+_SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
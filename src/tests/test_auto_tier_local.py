@@ -0,0 +1,33 @@
+# file: src/tests/test_auto_tier_local.py
+# Log quyết định router: opt-in (mặc định không ghi), xoay file khi vượt AUTO_TIER_LOG_MAX_BYTES.
+
+import json
+
+from modules.chat.service import auto_tier_local as atl
+
+
+def test_log_disabled_by_default(tmp_path, monkeypatch):
+    monkeypatch.delenv("AUTO_TIER_LOG_PATH", raising=False)
+    import importlib
+    fresh = importlib.reload(atl)
+    try:
+        assert fresh.AUTO_TIER_LOG_PATH == ""
+        monkeypatch.chdir(tmp_path)
+        fresh.log_decision("xin chào", "low")
+        assert list(tmp_path.iterdir()) == []
+    finally:
+        importlib.reload(atl)
+
+
+def test_log_rotates_at_max_bytes(tmp_path, monkeypatch):
+    path = tmp_path / "logs" / "decisions.jsonl"
+    monkeypatch.setattr(atl, "AUTO_TIER_LOG_PATH", str(path))
+    monkeypatch.setattr(atl, "AUTO_TIER_LOG_MAX_BYTES", 300)
+    for i in range(10):
+        atl.log_decision(f"prompt số {i} " + "x" * 40, "medium")
+
+    rotated = tmp_path / "logs" / "decisions.jsonl.1"
+    assert rotated.exists()
+    assert path.stat().st_size <= 300 and rotated.stat().st_size <= 300
+    recs = [json.loads(l) for p in (rotated, path) for l in p.read_text(encoding="utf-8").splitlines()]
+    assert recs[-1]["prompt"].startswith("prompt số 9") and all(r["tier"] == "medium" for r in recs)
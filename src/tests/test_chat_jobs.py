@@ -0,0 +1,152 @@
+# file: src/tests/test_chat_jobs.py
+# Hồi quy: job bị huỷ khi đang chạy (cancel / edit-regenerate thay thế) không được làm chết vòng worker.
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("dotenv")
+pytest.importorskip("psycopg2")
+
+from modules.chat.service import chat_jobs  # noqa: E402
+
+
+@pytest.fixture
+def db_calls(monkeypatch):
+    calls = []
+    monkeypatch.setattr(chat_jobs, "heartbeat", lambda *a, **kw: False)
+    monkeypatch.setattr(chat_jobs, "complete", lambda job_id, worker, canceled=False: calls.append(("complete", job_id, canceled)))
+    monkeypatch.setattr(chat_jobs, "fail", lambda job, worker, error, retry=True: calls.append(("fail", job.job_id, error)) or "failed")
+    monkeypatch.setattr(chat_jobs, "CHAT_JOB_HEARTBEAT_SEC", 0.01)
+    yield calls
+    chat_jobs._HANDLERS.pop("send", None)
+
+
+def _job(job_id="j1"):
+    return chat_jobs.ClaimedJob(job_id=job_id, kind="send", user_id="u", chat_id="c", message_id="m")
+
+
+def test_run_job_cancel_while_running_marks_canceled(db_calls):
+    started = asyncio.Event()
+    inner = {}
+
+    async def run(job):
+        inner["task"] = asyncio.current_task()
+        started.set()
+        await asyncio.sleep(3600)
+
+    chat_jobs.register_handler("send", run)
+
+    async def main():
+        job = _job()
+        t = asyncio.ensure_future(chat_jobs.run_job(job, "w"))
+        await started.wait()
+        inner["task"].cancel()     # huỷ riêng task của job (như _cancel_inflight)
+        await t                    # không được ném CancelledError ra vòng worker
+        return job
+
+    job = asyncio.run(main())
+    assert job.cancel_requested
+    assert db_calls == [("complete", "j1", True)]
+
+
+def test_run_job_reraises_when_worker_is_stopped(db_calls):
+    started = asyncio.Event()
+
+    async def run(job):
+        started.set()
+        await asyncio.sleep(3600)
+
+    chat_jobs.register_handler("send", run)
+
+    async def main():
+        t = asyncio.ensure_future(chat_jobs.run_job(_job(), "w"))
+        await started.wait()
+        t.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await t
+
+    asyncio.run(main())
+    assert db_calls == []
+
+
+def test_worker_slot_survives_superseded_job(db_calls, monkeypatch):
+    queue = [_job("j1"), _job("j2")]
+    ran = []
+
+    def claim(worker, limit=1):
+        return [queue.pop(0)] if queue else []
+
+    monkeypatch.setattr(chat_jobs, "claim", claim)
+    monkeypatch.setattr(chat_jobs, "CHAT_JOB_POLL_SEC", 0.01)
+
+    async def run(job):
+        ran.append(job.job_id)
+        if job.job_id == "j1":
+            asyncio.current_task().cancel()   # lượt cũ bị edit/regenerate huỷ giữa chừng
+        await asyncio.sleep(0)
+
+    chat_jobs.register_handler("send", run)
+
+    async def main():
+        stop = asyncio.Event()
+        slot = asyncio.ensure_future(chat_jobs._worker_slot("w", stop, asyncio.Event()))
+        for _ in range(200):
+            if len(ran) == 2:
+                break
+            await asyncio.sleep(0.01)
+        assert not slot.done()
+        stop.set()
+        await asyncio.wait_for(slot, 1)
+
+    asyncio.run(main())
+    assert ran == ["j1", "j2"]
+    assert ("complete", "j1", True) in db_calls
+    assert ("complete", "j2", False) in db_calls
+
+
+class _Row:
+    def __init__(self, pending, queued):
+        self.pending, self.queued = pending, queued
+
+
+class _Session:
+    """Session giả: ghi lại câu lệnh; đếm trả về số job chờ/chạy hiện có của user."""
+
+    def __init__(self, pending=0, queued=0):
+        self.sql, self.added = [], []
+        self.row = _Row(pending, queued)
+
+    def execute(self, stmt, params=None):
+        self.sql.append((str(stmt), params))
+        row = self.row
+        return type("R", (), {"first": lambda self: row})()
+
+    def add(self, obj):
+        self.added.append(obj)
+
+    def flush(self):
+        pass
+
+
+@pytest.fixture
+def fake_job_model(monkeypatch):
+    monkeypatch.setattr(chat_jobs, "ChatJob", lambda **kw: kw)
+    monkeypatch.setattr(chat_jobs, "CHAT_JOB_USER_MAX_PENDING", 2)
+
+
+def test_enqueue_counts_under_user_lock_then_inserts(fake_job_model):
+    s = _Session(pending=1)
+    job = chat_jobs.enqueue(s, kind="send", user_id="u1", chat_id="c", message_id="m")
+    assert "pg_advisory_xact_lock" in s.sql[0][0] and s.sql[0][1] == {"uid": "u1"}
+    assert "count(*)" in s.sql[1][0]
+    assert s.added == [job] and job["job_status"] == "queued"
+
+
+def test_enqueue_rejects_when_user_full(fake_job_model):
+    s = _Session(pending=2)
+    with pytest.raises(chat_jobs.AdmissionRejected) as ei:
+        chat_jobs.enqueue(s, kind="edit", user_id="u1", chat_id="c", message_id="m")
+    assert ei.value.admission.scope == "user" and ei.value.admission.retry_after > 0
+    assert s.added == []
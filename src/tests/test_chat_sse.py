@@ -0,0 +1,59 @@
+# file: src/tests/test_chat_sse.py
+# SSE đọc tiến độ từ DB: chu kỳ poll giãn dần khi không có gì mới, về lại heartbeat khi có thay đổi.
+# Regenerate / edit: buffer của lượt trước không được phát lại thành `done`.
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("litestar")
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("dotenv")
+
+from modules.chat.routes import chat_api  # noqa: E402
+
+
+def test_db_poll_backs_off_and_resets(monkeypatch):
+    monkeypatch.setattr(chat_api.jobs, "CHAT_JOB_HEARTBEAT_SEC", 2.0)
+    monkeypatch.setattr(chat_api, "CHAT_STREAM_DB_POLL_MAX_SEC", 10)
+
+    poll, seen = 2.0, []
+    for _ in range(8):
+        poll = chat_api._next_db_poll(poll, changed=False)
+        seen.append(poll)
+    assert seen[0] == 3.0 and seen == sorted(seen) and seen[-1] == 10.0
+    assert chat_api._next_db_poll(poll, changed=True) == 2.0
+
+
+class _Session:
+    def commit(self):
+        pass
+
+
+def test_regenerate_drops_stale_stream(monkeypatch):
+    mid = "m-regen"
+    chat_api._stream_open(mid)
+    chat_api._stream_close(mid, "câu trả lời cũ")
+
+    for name in ("request_cancel", "enqueue", "wake"):
+        monkeypatch.setattr(chat_api.jobs, name, lambda *a, **k: None)
+    monkeypatch.setattr(chat_api._transcript, "invalidate", lambda *a, **k: None)
+    monkeypatch.setattr(chat_api, "_set_msg_status", lambda *a, **k: None)
+    monkeypatch.setattr(
+        chat_api,
+        "_db_message_progress",
+        lambda _mid: ("(queued)", {"status": "queued", "queue_position": 1, "partial_text": ""}),
+    )
+
+    chat_api._enqueue_job(_Session(), kind="regenerate", uid="u", chat_id="c", message_id=mid, payload={})
+    assert mid not in chat_api._STREAMS
+
+    async def first_event():
+        gen = chat_api._sse_message_events(mid)
+        try:
+            return await gen.__anext__()
+        finally:
+            await gen.aclose()
+
+    ev = asyncio.run(first_event())
+    assert ev.event == "queued"
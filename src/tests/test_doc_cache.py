@@ -0,0 +1,86 @@
+# file: src/tests/test_doc_cache.py
+# Cache trích xuất trên đĩa: round-trip nén, hit/miss, evict theo LRU (mtime, được chạm khi hit), compact.
+
+import os
+import time
+
+from modules.chat.service.doc_cache import DocCache
+
+
+def _obj(i):
+    return {"i": i, "text": os.urandom(1500).hex()}   # ~3 KB, nén không đáng kể
+
+
+def _age(cache, ns, key, sec):
+    p = cache.path(ns, key)
+    t = time.time() - sec
+    os.utime(p, (t, t))
+
+
+def test_put_get_roundtrip_and_stats(tmp_path):
+    c = DocCache(str(tmp_path), 0)
+    obj = {"text": "Công văn số 12/UBND", "pages_text": ["a", "b"]}
+    path = c.put("ocr", "ab12cd", obj)
+    assert path == c.path("ocr", "ab12cd") and path.endswith(".json.z")
+    assert c.get("ocr", "ab12cd") == obj
+    assert c.get("ocr", "missing") is None
+
+    st = c.stats()
+    ns = st["namespaces"]["ocr"]
+    assert ns["hits"] == 1 and ns["misses"] == 1 and ns["puts"] == 1
+    assert ns["bytes_read"] == ns["bytes_written"] == os.path.getsize(path)
+    assert st["hit_rate"] == 0.5
+
+
+def test_corrupt_entry_is_a_miss_and_removed(tmp_path):
+    c = DocCache(str(tmp_path), 0)
+    p = c.put("pages", "ff00", {"x": 1})
+    with open(p, "wb") as f:
+        f.write(b"not zlib")
+    assert c.get("pages", "ff00") is None
+    assert not os.path.exists(p)
+
+
+def test_evicts_least_recently_used_first(tmp_path):
+    c = DocCache(str(tmp_path), 0)
+    for i in range(5):
+        c.put("ocr", f"k{i}", _obj(i))
+        _age(c, "ocr", f"k{i}", 1000 - i * 100)   # k0 cũ nhất … k4 mới nhất
+    c.get("ocr", "k0")                            # hit → k0 thành mới nhất
+    size = os.path.getsize(c.path("ocr", "k1"))
+
+    removed, freed = c.evict(target_bytes=int(size * 3.5))
+    assert removed == 2 and freed > 0
+    left = {k for k in ("k0", "k1", "k2", "k3", "k4") if os.path.exists(c.path("ocr", k))}
+    assert left == {"k0", "k3", "k4"}
+    assert c.stats()["evictions"] == 2
+
+
+def test_put_over_limit_evicts_below_threshold(tmp_path):
+    probe = DocCache(str(tmp_path / "probe"), 0)
+    size = os.path.getsize(probe.put("ocr", "p", _obj(0)))
+    c = DocCache(str(tmp_path / "c"), max_bytes=size * 4)
+    for i in range(10):
+        c.put("textex", f"k{i:02d}", _obj(i))
+        _age(c, "textex", f"k{i:02d}", 1000 - i)
+    st = c.stats()
+    assert st["size_bytes"] <= c.max_bytes and st["evictions"] >= 6
+    assert os.path.exists(c.path("textex", "k09"))   # entry vừa ghi không bị evict
+
+
+def test_compact_cleans_tmp_bad_entries_and_empty_dirs(tmp_path):
+    c = DocCache(str(tmp_path), 0)
+    good = c.put("ocr", "aa01", {"ok": True})
+    bad = c.path("ocr", "bb02")
+    os.makedirs(os.path.dirname(bad))
+    with open(bad, "wb") as f:
+        f.write(b"garbage")
+    stale = good + ".123.456.tmp"
+    with open(stale, "wb") as f:
+        f.write(b"half")
+    os.utime(stale, (time.time() - 7200, time.time() - 7200))
+
+    res = c.compact()
+    assert res["tmp_removed"] == 1 and res["bad_removed"] == 1 and res["dirs_removed"] >= 1
+    assert os.path.exists(good) and not os.path.exists(bad) and not os.path.exists(stale)
+    assert not os.path.exists(os.path.dirname(bad))
@@ -0,0 +1,74 @@
+# file: src/tests/test_doc_index.py
+# doc_index: chunk theo trang / cửa sổ từ, xếp hạng BM25 trên mọi tài liệu của chat, fallback khi không khớp.
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from modules.chat.service import doc_index as di  # noqa: E402
+
+
+@pytest.fixture
+def chat(tmp_path, monkeypatch):
+    monkeypatch.setattr(di, "UPLOAD_ROOT", str(tmp_path))
+    docs = []
+
+    def add(doc_id, title, text, pages_text=None):
+        rel = f"chat/c1/{doc_id}.txt"
+        (tmp_path / "chat" / "c1").mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text(text, encoding="utf-8")
+        di.index_document(rel, text, pages_text, chat_id="c1")
+        docs.insert(0, (doc_id, title, rel))   # mới nhất trước, như _chat_docs
+
+    monkeypatch.setattr(di, "_chat_docs", lambda session, chat_id: list(docs))
+    di.invalidate("c1")
+    yield add
+    di.invalidate("c1")
+
+
+def test_chunk_text_windows_and_pages(monkeypatch):
+    monkeypatch.setattr(di, "DOC_CHUNK_WORDS", 40)
+    monkeypatch.setattr(di, "DOC_CHUNK_OVERLAP", 10)
+    words = " ".join(f"w{i}" for i in range(100))
+    chunks = di.chunk_text(words)
+    assert [c["t"].split()[0] for c in chunks] == ["w0", "w30", "w60"]
+    assert chunks[-1]["t"].split()[-1] == "w99" and all(c["p"] is None for c in chunks)
+    paged = di.chunk_text(words, ["trang một", "", "trang ba"])
+    assert [(c["p"], c["t"]) for c in paged] == [(1, "trang một"), (3, "trang ba")]
+
+
+def test_terms_fold_diacritics_and_add_bigrams():
+    assert di._terms("Hợp đồng lao động") == [
+        "hop", "dong", "lao", "dong", "hop_dong", "dong_lao", "lao_dong",
+    ]
+
+
+def test_bm25_ranks_matching_document_across_chat(chat):
+    chat("d1", "Hợp đồng", "Hợp đồng lao động quy định thời gian thử việc và mức lương cơ bản của người lao động.")
+    chat("d2", "Biên bản", "Biên bản họp giao ban tuần về kế hoạch mua sắm thiết bị văn phòng.")
+    chat("d3", "Quyết định", "Quyết định khen thưởng cá nhân có thành tích xuất sắc trong năm.")
+
+    hits = di.retrieve(None, "c1", "mức lương thử việc bao nhiêu?", top_k=2)
+    assert hits and hits[0].doc_id == "d1"
+    assert all(h.score > 0 for h in hits)
+
+    hits = di.retrieve(None, "c1", "kế hoạch mua sắm thiết bị", top_k=1)
+    assert [h.doc_id for h in hits] == ["d2"]
+
+    text = di.relevant_text(None, "c1", "khen thưởng")
+    assert text.startswith("[Quyết định (d3.txt)]") and "(đoạn 1)" in text
+
+
+def test_no_match_falls_back_to_latest_document(chat):
+    chat("d1", "", "Nội dung tài liệu cũ.")
+    chat("d2", "", "Nội dung tài liệu mới nhất.")
+    hits = di.retrieve(None, "c1", "xyz", top_k=3)
+    assert [h.doc_id for h in hits] == ["d2"] and hits[0].score == 0.0
+
+
+def test_index_is_cached_until_documents_change(chat):
+    chat("d1", "", "alpha beta gamma")
+    first = di._index_for(None, "c1")
+    assert di._index_for(None, "c1") is first
+    chat("d2", "", "delta epsilon")
+    assert di._index_for(None, "c1") is not first
@@ -0,0 +1,109 @@
+# file: src/tests/test_file_storage.py
+# Kho blob theo nội dung: ghi + băm 1 lượt, tham chiếu link_blob / blob_digest, xoá an toàn, gc_blobs.
+
+import asyncio
+import hashlib
+import os
+
+from shared import file_storage as fs
+
+
+def _store(blob_dir, data: bytes) -> "fs.StoredBlob":
+    async def go():
+        w = fs.BlobWriter(blob_dir=str(blob_dir), chunk_size=4)
+        for i in range(0, len(data), 3):
+            await w.write(data[i:i + 3])
+        return await w.commit()
+    return asyncio.run(go())
+
+
+def _age(path, sec):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns - sec * 1_000_000_000))
+
+
+def test_blob_writer_hashes_and_dedups(tmp_path):
+    data = b"hello blob store" * 10
+    a = _store(tmp_path, data)
+    assert a.digest == hashlib.sha256(data).hexdigest()
+    assert a.path == fs.blob_path(a.digest, str(tmp_path))
+    assert a.size == len(data) and not a.existed
+    with open(a.path, "rb") as f:
+        assert f.read() == data
+
+    b = _store(tmp_path, data)
+    assert b.existed and b.path == a.path
+    assert os.listdir(tmp_path / "tmp") == []
+
+
+def test_link_blob_and_blob_digest(tmp_path):
+    blob_dir = tmp_path / "blobs"
+    blob = _store(blob_dir, b"%PDF-1.7 test")
+    dest = tmp_path / "chat" / "c1" / "m1" / "báo cáo.pdf"
+
+    p1 = fs.link_blob(blob.path, str(dest), make_unique=True)
+    p2 = fs.link_blob(blob.path, str(dest), make_unique=True)
+    assert p1 != p2 and os.path.basename(p2).endswith("-1.pdf")
+    for p in (p1, p2):
+        with open(p, "rb") as f:
+            assert f.read() == b"%PDF-1.7 test"
+        if os.path.islink(p):
+            assert fs.blob_digest(p, str(blob_dir)) == blob.digest
+        assert fs.file_digest(p, str(blob_dir)) == blob.digest
+
+    plain = tmp_path / "plain.txt"
+    plain.write_bytes(b"x")
+    assert fs.blob_digest(str(plain), str(blob_dir)) is None
+    assert fs.file_digest(str(plain), str(blob_dir)) == hashlib.sha256(b"x").hexdigest()
+
+
+def test_remove_blob_keeps_blob_reused_by_another_request(tmp_path):
+    a = _store(tmp_path, b"shared content")
+    b = _store(tmp_path, b"shared content")   # request khác dùng lại blob trước khi a bị từ chối
+    assert b.existed
+    assert fs.remove_blob(a) is False
+    assert os.path.exists(a.path)
+    assert fs.remove_blob(b) is False          # blob có sẵn không bao giờ bị xoá bởi request dùng lại
+
+
+def test_remove_blob_deletes_unshared_new_blob(tmp_path):
+    a = _store(tmp_path, b"only mine")
+    assert fs.remove_blob(a) is True
+    assert not os.path.exists(a.path)
+
+
+def test_gc_blobs_removes_only_old_unreferenced(tmp_path):
+    keep = _store(tmp_path, b"referenced")
+    old = _store(tmp_path, b"orphan")
+    young = _store(tmp_path, b"just uploaded")
+    for blob in (keep, old):
+        _age(blob.path, 3600)
+    stale_tmp = tmp_path / "tmp" / "dead.part"
+    stale_tmp.write_bytes(b"...")
+    _age(stale_tmp, 3600)
+
+    dry = fs.gc_blobs({keep.digest}, blob_dir=str(tmp_path), min_age_sec=600, dry_run=True)
+    assert dry["removed"] == 1 and os.path.exists(old.path)
+
+    stats = fs.gc_blobs({keep.digest}, blob_dir=str(tmp_path), min_age_sec=600)
+    assert stats["scanned"] == 3
+    assert stats["referenced"] == 1 and stats["recent"] == 1 and stats["removed"] == 1
+    assert stats["bytes_freed"] == len(b"orphan") and stats["tmp_removed"] == 1
+    assert os.path.exists(keep.path) and os.path.exists(young.path)
+    assert not os.path.exists(old.path) and not stale_tmp.exists()
+
+
+def test_reuse_refreshes_blob_against_gc(tmp_path):
+    a = _store(tmp_path, b"old but reused")
+    _age(a.path, 3600)
+    _store(tmp_path, b"old but reused")       # upload mới trùng nội dung → chạm blob
+    stats = fs.gc_blobs(set(), blob_dir=str(tmp_path), min_age_sec=600)
+    assert stats["removed"] == 0 and os.path.exists(a.path)
+
+
+def test_write_text_async_replaces_atomically(tmp_path):
+    p = tmp_path / "doc.txt"
+    p.write_text("cũ", encoding="utf-8")
+    out = asyncio.run(fs.write_text_async(str(p), "nội dung OCR mới"))
+    assert out == str(p) and p.read_text(encoding="utf-8") == "nội dung OCR mới"
+    assert os.listdir(tmp_path) == ["doc.txt"]
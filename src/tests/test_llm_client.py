@@ -0,0 +1,41 @@
+# file: src/tests/test_llm_client.py
+# Chỉ lỗi "không hỗ trợ stream" mới được fallback sang gọi thường.
+
+import asyncio
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+openai = pytest.importorskip("openai")
+
+from shared import llm_client as llm  # noqa: E402
+
+
+def _status_error(code, message="err", body=None):
+    req = httpx.Request("POST", "http://llm/v1/chat/completions")
+    return openai.APIStatusError(message, response=httpx.Response(code, request=req), body=body)
+
+
+@pytest.mark.parametrize("code", [404, 501])
+def test_stream_unsupported_statuses(code):
+    assert llm.is_stream_unsupported(_status_error(code))
+
+
+def test_bad_request_falls_back_only_when_about_streaming():
+    assert llm.is_stream_unsupported(_status_error(400, "Unrecognized request argument supplied: stream_options"))
+    assert llm.is_stream_unsupported(_status_error(400, body={"error": {"message": "stream is not supported"}}))
+    assert not llm.is_stream_unsupported(_status_error(400, "This model's maximum context length is 8192 tokens"))
+    assert not llm.is_stream_unsupported(_status_error(400))
+
+
+@pytest.mark.parametrize("code", [429, 500, 502, 503])
+def test_overload_and_server_errors_do_not_fall_back(code):
+    assert not llm.is_stream_unsupported(_status_error(code))
+
+
+def test_busy_and_timeouts_do_not_fall_back():
+    req = httpx.Request("POST", "http://llm/v1/chat/completions")
+    assert not llm.is_stream_unsupported(llm.LLMBusyError("busy"))
+    assert not llm.is_stream_unsupported(asyncio.TimeoutError())
+    assert not llm.is_stream_unsupported(openai.APITimeoutError(request=req))
+    assert not llm.is_stream_unsupported(RuntimeError("boom"))
@@ -0,0 +1,108 @@
+# file: src/tests/test_ocr_text.py
+# iter_pages_async: trang OCR đi qua pool OCR dùng chung (priority + engine của lượt); pool hỏng → thread, vẫn đúng engine.
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+from modules.chat.service import ocr_pool
+from modules.chat.service import ocr_text as ot
+
+
+class _FakeDoc:
+    def close(self):
+        pass
+
+
+class _FakePool:
+    def __init__(self, workers=2, broken=False):
+        self.workers = workers
+        self.broken = broken
+        self.jobs = []
+
+    def submit(self, fn, *args, priority=0, label=""):
+        self.jobs.append((fn, args, priority, label))
+        fut = Future()
+        if self.broken:
+            fut.set_exception(ocr_pool.OcrPoolUnavailable("dead"))
+        else:
+            fut.set_result(fn(*args))
+        return fut
+
+
+_ENGINES = []
+
+
+def _page(file_path, i, lang, base_zoom, pixel_limit, engine=None):
+    eng = engine or ot._engine()
+    _ENGINES.append(eng)
+    info = ot.PageInfo(index=i, source="ocr", chars=5, secs=0.0, note=eng)
+    return i, f"trang{i}", info, eng
+
+
+@pytest.fixture
+def scanned_pdf(tmp_path, monkeypatch):
+    path = tmp_path / "scan.pdf"
+    path.write_bytes(b"%PDF-1.4")
+    monkeypatch.setattr(ot, "_is_pdf", lambda p: True)
+    monkeypatch.setattr(ot, "_cache_paths", lambda p, d: ("sha", str(tmp_path)))
+    monkeypatch.setattr(ot, "_read_cache", lambda p, r, s: None)
+    monkeypatch.setattr(ot, "_pdf_open", lambda p, dpi, max_pages: (_FakeDoc(), 3, 1.0))
+    monkeypatch.setattr(ot, "_pdf_classify", lambda doc, total, order, **kw: ([None] * 3, [0, 1, 2]))
+    monkeypatch.setattr(ot, "_ocr_pdf_page_task", _page)
+    monkeypatch.setattr(ot, "_ocr_pdf_page_isolated", _page)
+    monkeypatch.setattr(ocr_pool, "OCR_POOL_ENABLED", True)
+    _ENGINES.clear()
+    return str(path)
+
+
+def _pages(path, **kw):
+    async def go():
+        out = []
+        async for ev in ot.iter_pages_async(path, **kw):
+            if ev.result is not None:
+                break
+            out.append(ev)
+        return out
+    return asyncio.run(go())
+
+
+def test_page_ocr_goes_through_shared_pool(scanned_pdf, monkeypatch):
+    pool = _FakePool(workers=2)
+    monkeypatch.setattr(ocr_pool, "get_pool", lambda: pool)
+    events = _pages(scanned_pdf, engine="easyocr", priority=ocr_pool.PRIORITY_BACKGROUND)
+
+    assert sorted(ev.page for ev in events) == [1, 2, 3]
+    assert [args[1] for _, args, _, _ in pool.jobs] == [0, 1, 2]
+    assert all(args[-1] == "easyocr" for _, args, _, _ in pool.jobs)
+    assert {prio for _, _, prio, _ in pool.jobs} == {ocr_pool.PRIORITY_BACKGROUND}
+    assert pool.jobs[0][3] == "scan.pdf#p1"
+
+
+def test_broken_pool_falls_back_to_threads_with_same_engine(scanned_pdf, monkeypatch):
+    pool = _FakePool(broken=True)
+    monkeypatch.setattr(ocr_pool, "get_pool", lambda: pool)
+    before = ot.OCR_ENGINE
+    events = _pages(scanned_pdf, engine="tesseract")
+
+    assert sorted(ev.page for ev in events) == [1, 2, 3]
+    assert {ev.source for ev in events} == {"ocr"}
+    assert _ENGINES == ["tesseract"] * 3           # nhánh thread nhận engine= của lượt
+    assert ot.OCR_ENGINE == before
+
+
+def test_engine_override_is_per_thread():
+    before = ot.OCR_ENGINE
+    seen = {}
+
+    def other():
+        seen["other"] = ot._engine()
+
+    with ot.engine_override("easyocr"):
+        assert ot._engine() == "easyocr"
+        t = threading.Thread(target=other)
+        t.start()
+        t.join()
+    assert seen["other"] == before and ot._engine() == before
@@ -0,0 +1,69 @@
+# file: src/tests/test_prompt_compose.py
+# pack_context: lấp ngân sách token theo ưu tiên tài liệu → RAG → transcript → memory.
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from shared import tokenizer as tk  # noqa: E402
+from modules.chat.service import prompt_compose as pc  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def approx_tokenizer(monkeypatch):
+    # đếm xác định (byte / 3) — không phụ thuộc tiktoken có sẵn hay không
+    monkeypatch.setattr(tk, "for_model", lambda pid: tk._APPROX)
+    monkeypatch.setattr(pc, "PROMPT_PACK_MIN_BLOCK", 64)
+
+
+def _words(prefix, n):
+    return " ".join(f"{prefix}{i:04d}" for i in range(n))
+
+
+def test_everything_fits():
+    out = pc.pack_context(provider_model_id="m", budget=10_000, fixed_prompt="Q: hi", question="hi",
+                          doc="doc", rag="rag", recent="recent", glb="glb")
+    assert (out.doc, out.rag, out.recent, out.glb) == ("doc", "rag", "recent", "glb")
+    assert out.truncated == [] and out.dropped == []
+    assert out.total <= out.budget
+    assert out.used["question"] == 1 and out.used["instructions"] == 1
+
+
+def test_priority_truncation_and_drop():
+    doc = _words("d", 200)        # 1199 byte → 400 token
+    recent = _words("r", 200)
+    out = pc.pack_context(provider_model_id="m", budget=700, fixed_prompt="x" * 300, question="",
+                          doc=doc, rag="", recent=recent, glb=_words("g", 50))
+    assert out.doc == doc                          # khối ưu tiên cao giữ nguyên
+    assert out.truncated == ["recent"]
+    assert out.recent.startswith("…\n") and out.recent.endswith("r0199")  # transcript giữ lượt mới nhất
+    assert out.dropped == ["glb"]                  # phần còn lại < PROMPT_PACK_MIN_BLOCK → bỏ
+    assert out.total <= 700
+
+
+def test_budget_smaller_than_fixed_prompt_drops_all_blocks():
+    out = pc.pack_context(provider_model_id="m", budget=10, fixed_prompt="x" * 300, question="",
+                          doc="d" * 500, rag="r" * 500)
+    assert out.doc == "" and out.rag == ""
+    assert out.dropped == ["doc", "rag"]
+
+
+def test_prompt_token_budget(monkeypatch):
+    monkeypatch.setattr(tk, "context_window", lambda pid: 8192)
+    monkeypatch.setattr(pc, "PROMPT_TOKEN_RESERVE", 512)
+    monkeypatch.setattr(pc, "PROMPT_TOKEN_BUDGET", 0)
+    assert pc.prompt_token_budget("m", 1024) == 8192 - 1024 - 512
+    monkeypatch.setattr(pc, "PROMPT_TOKEN_BUDGET", 2000)
+    assert pc.prompt_token_budget("m", 1024) == 2000
+
+
+def test_relevant_doc_text_flags_excerpt_vs_full_fallback(monkeypatch):
+    idx = type("Idx", (), {"DOC_RETRIEVAL_ENABLED": True})()
+    monkeypatch.setattr(pc, "_doc_index", idx)
+    monkeypatch.setattr(pc, "latest_doc_text", lambda session, chat_id, include_header=True: "[a.pdf]\nfull text")
+
+    idx.relevant_text = lambda session, chat_id, q, top_k=None: "[a.pdf]\n(đoạn 2) excerpt"
+    assert pc.relevant_doc_text(None, "c1", "câu hỏi") == ("[a.pdf]\n(đoạn 2) excerpt", True)
+
+    idx.relevant_text = lambda session, chat_id, q, top_k=None: ""
+    assert pc.relevant_doc_text(None, "c1", "câu hỏi") == ("[a.pdf]\nfull text", False)
@@ -0,0 +1,61 @@
+# file: src/tests/test_tokenizer.py
+# shared/tokenizer: backend ước lượng byte, cắt giữ đầu / cuối, chọn spec theo model, fallback khi thiếu thư viện.
+
+import pytest
+
+from shared import tokenizer as tk
+
+
+def test_tokenizer_base_is_abstract():
+    with pytest.raises(TypeError):
+        tk.Tokenizer()  # type: ignore[abstract]
+    assert not hasattr(tk._APPROX, "encode")
+
+
+def test_approx_counts_utf8_bytes():
+    t = tk._ApproxTokenizer()
+    assert t.count("") == 0
+    assert t.count("abc") == 1
+    assert t.count("tiếng Việt") == 5  # 14 byte UTF-8 → ceil(14 / 3)
+
+
+def test_truncate_keeps_head_or_tail_within_budget():
+    t = tk._ApproxTokenizer()
+    text = " ".join(f"w{i:03d}" for i in range(400))
+    head = t.truncate(text, 50)
+    assert head.startswith("w000") and head.endswith(" …")
+    assert t.count(head) <= 50
+    tail = t.truncate(text, 50, keep="tail")
+    assert tail.startswith("…\n") and tail.endswith("w399")
+    assert t.count(tail) <= 50
+    assert t.truncate(text, 10**6) == text
+    assert t.truncate(text, 0) == ""
+
+
+def test_spec_for_defaults_and_map(monkeypatch):
+    assert tk.spec_for("openai/gpt-oss-20b") == "tiktoken:o200k_base"
+    assert tk.spec_for("meta/llama-3") == "tiktoken:cl100k_base"
+    monkeypatch.setitem(tk.TOKENIZER_MAP, "Qwen/Qwen2.5-7B-Instruct", "hf:/models/qwen")
+    assert tk.spec_for("Qwen/Qwen2.5-7B-Instruct") == "hf:/models/qwen"
+    assert "hf:/models/qwen" in tk._warm_specs()
+
+
+def test_missing_backend_falls_back_to_approx(monkeypatch):
+    monkeypatch.setattr(tk, "tiktoken", None)
+    tk._load.cache_clear()
+    try:
+        assert tk._load("tiktoken:o200k_base") is tk._APPROX
+        assert tk._load("approx") is tk._APPROX
+    finally:
+        tk._load.cache_clear()
+
+
+def test_tiktoken_backend_counts_real_tokens():
+    pytest.importorskip("tiktoken")
+    tk._load.cache_clear()
+    t = tk.for_model("openai/gpt-oss-20b")
+    if t is tk._APPROX:
+        pytest.skip("o200k_base encoding not available offline")
+    assert t.name == "tiktoken:o200k_base"
+    assert t.count("hello world") == len(t.encode("hello world"))
+    assert t.decode(t.encode("xin chào")) == "xin chào"
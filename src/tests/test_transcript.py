@@ -0,0 +1,141 @@
+# file: src/tests/test_transcript.py
+# Transcript theo cửa sổ: đọc lùi theo trang (keyset), dừng sớm khi đủ cặp / đủ ký tự, cache theo stamp của chat.
+# Câu truy vấn SQLAlchemy được thay bằng builder giả chạy trên list trong RAM → kiểm tra logic phân trang.
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from modules.chat.service import transcript as tr  # noqa: E402
+
+
+class _Col:
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, other):
+        return ("eq", self.name, other)
+
+    def desc(self):
+        return self
+
+    __hash__ = object.__hash__
+
+
+class _Tuple:
+    def __lt__(self, cursor):
+        return ("before", cursor)
+
+
+class _Model:
+    def __init__(self, *names):
+        for n in names:
+            setattr(self, n, _Col(n))
+
+
+class _Query:
+    def __init__(self, cols):
+        self.cols, self.conds, self.n = [c.name for c in cols], [], None
+
+    def where(self, cond):
+        self.conds.append(cond)
+        return self
+
+    def order_by(self, *cols):
+        return self
+
+    def limit(self, n):
+        self.n = n
+        return self
+
+
+class _Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+    def first(self):
+        return self.rows[0] if self.rows else None
+
+
+class _Session:
+    def __init__(self, messages, stamp=1):
+        self.messages = messages          # (message_id, created, question, answer), cũ → mới
+        self.stamp = stamp
+        self.pages = []                   # (limit, cursor) mỗi lượt đọc message
+
+    def execute(self, q):
+        if q.cols == ["chat_updated_at"]:
+            return _Result([(self.stamp,)])
+        cursor = next((c[1] for c in q.conds if c[0] == "before"), None)
+        self.pages.append((q.n, cursor))
+        rows = sorted(self.messages, key=lambda m: (m[1], m[0]), reverse=True)
+        if cursor is not None:
+            rows = [m for m in rows if (m[1], m[0]) < cursor]
+        return _Result(rows[: q.n])
+
+
+@pytest.fixture(autouse=True)
+def fake_sql(monkeypatch):
+    monkeypatch.setattr(tr, "select", lambda *cols: _Query(cols))
+    monkeypatch.setattr(tr, "tuple_", lambda *cols: _Tuple())
+    monkeypatch.setattr(tr, "ChatMessage", _Model(
+        "message_id", "message_created_at", "message_question", "message_ai_response", "message_chat_id"))
+    monkeypatch.setattr(tr, "ChatHistory", _Model("chat_updated_at", "chat_id"))
+    monkeypatch.setattr(tr, "TRANSCRIPT_PAGE_SLACK", 2)
+    tr._CACHE.clear()
+    yield
+    tr._CACHE.clear()
+
+
+def _chat(n, pending_every=0):
+    out = []
+    for i in range(n):
+        answer = "(queued)" if pending_every and i % pending_every == 0 else f"đáp {i}"
+        out.append((f"m{i:04d}", i, f"hỏi {i}", answer))
+    return out
+
+
+def test_reads_only_the_last_window():
+    s = _Session(_chat(1000))
+    text = tr.recent_transcript(s, "c1", limit_chars=0, max_msgs=3)
+    assert text == "User: hỏi 997\nAssistant: đáp 997\n\nUser: hỏi 998\nAssistant: đáp 998\n\nUser: hỏi 999\nAssistant: đáp 999"
+    assert s.pages == [(5, None)]
+
+
+def test_pages_backwards_past_pending_answers():
+    s = _Session(_chat(100, pending_every=2))          # nửa số message là "(queued)" → phải đọc thêm trang
+    text = tr.recent_transcript(s, "c1", limit_chars=0, max_msgs=6)
+    assert text.count("User:") == 6 and text.startswith("User: hỏi 89\n")
+    assert len(s.pages) == 2 and s.pages[1][1] == (92, "m0092")   # keyset: (created_at, message_id) của dòng cuối trang 1
+
+
+def test_stops_early_on_char_limit_and_trims_head():
+    s = _Session(_chat(1000))
+    text = tr.recent_transcript(s, "c1", limit_chars=60, max_msgs=50)
+    assert len(text) <= 60 and text.endswith("Assistant: đáp 999")
+    assert len(s.pages) == 1
+
+
+def test_short_chat_and_appendix_stripped():
+    msgs = [("m1", 1, "tóm tắt\n\n---\n(Trích nội dung từ tệp đính kèm; …)\nPDF…", "ok")]
+    s = _Session(msgs)
+    assert tr.recent_transcript(s, "c1", limit_chars=0, max_msgs=10) == "User: tóm tắt\nAssistant: ok"
+
+
+def test_cache_hit_until_stamp_changes_or_invalidated():
+    s = _Session(_chat(20))
+    first = tr.recent_transcript(s, "c1", limit_chars=0, max_msgs=4)
+    assert tr.recent_transcript(s, "c1", limit_chars=0, max_msgs=4) == first
+    assert len(s.pages) == 1
+
+    s.messages.append(("m9999", 9999, "mới", "trả lời mới"))
+    s.stamp = 2                                            # trigger bump chat_updated_at
+    assert tr.recent_transcript(s, "c1", limit_chars=0, max_msgs=4).endswith("trả lời mới")
+    assert len(s.pages) == 2
+
+    tr.invalidate("c1")
+    tr.recent_transcript(s, "c1", limit_chars=0, max_msgs=4)
+    assert len(s.pages) == 3
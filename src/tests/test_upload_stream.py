@@ -0,0 +1,114 @@
+# file: src/tests/test_upload_stream.py
+# Parser multipart dạng stream: mọi cách cắt chunk cho cùng kết quả; giới hạn áp ngay khi byte tới; lỗi → dọn blob.
+
+import asyncio
+import os
+
+import pytest
+
+from modules.chat.service import upload_stream as us
+from modules.chat.service.save_documents import (
+    DisallowedType,
+    FileTooLarge,
+    TooManyFiles,
+    TotalTooLarge,
+    UploadError,
+    UploadLimits,
+)
+from shared import file_storage as fs
+
+BOUNDARY = "----docaixBoundary7MA4YWxk"
+CT = f"multipart/form-data; boundary={BOUNDARY}"
+PDF = b"%PDF-1.7\r\n--" + b"\r\n" * 3 + b"noi dung \xe1\xba\xa1" * 50   # có CRLF / "--" giả boundary
+
+
+def _body(parts):
+    out = b""
+    for headers, data in parts:
+        out += f"--{BOUNDARY}\r\n".encode() + headers.encode("utf-8") + b"\r\n\r\n" + data + b"\r\n"
+    return out + f"--{BOUNDARY}--\r\n".encode()
+
+
+def _field(name, value):
+    return (f'Content-Disposition: form-data; name="{name}"', value.encode("utf-8"))
+
+
+def _file(name, filename, data, ctype="application/pdf"):
+    return (f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\nContent-Type: {ctype}', data)
+
+
+BODY = _body([
+    _field("text", "Tóm tắt giúp tôi"),
+    _file("files", "báo cáo.pdf", PDF),
+    _field("chat_id", "c1"),
+    _file("files", "", b""),                   # input file để trống
+])
+
+
+@pytest.fixture(autouse=True)
+def blob_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(fs, "UPLOAD_BLOB_DIR", str(tmp_path / "blobs"))
+    return tmp_path / "blobs"
+
+
+def _read(body, chunk, limits=None, allowed_exts=us.UPLOAD_ALLOWED_EXTS):
+    async def chunks():
+        for i in range(0, len(body), chunk):
+            yield body[i:i + chunk]
+    return asyncio.run(us.read_form(chunks(), CT, limits or UploadLimits(), allowed_exts=allowed_exts))
+
+
+def _blobs(blob_dir):
+    return [f for d in blob_dir.iterdir() if d.name not in ("tmp", ".lock") for f in d.iterdir()] if blob_dir.exists() else []
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 7, 41, 64, len(BOUNDARY) + 5, 1 << 16])
+def test_chunk_splits_give_same_form(chunk):
+    form = _read(BODY, chunk)
+    assert form.get("text") == "Tóm tắt giúp tôi" and form.get("chat_id") == "c1"
+    assert len(form.files) == 1
+    f = form.files[0]
+    assert (f.field_name, f.filename, f.content_type, f.size) == ("files", "báo cáo.pdf", "application/pdf", len(PDF))
+    with open(f.blob.path, "rb") as fh:
+        assert fh.read() == PDF
+    assert form.getlist("files") == [f]
+
+
+def test_boundary_of():
+    assert us.boundary_of(CT) == BOUNDARY.encode()
+    assert us.boundary_of('multipart/form-data; boundary="a b"') == b"a b"
+    assert us.boundary_of("application/json") is None
+
+
+@pytest.mark.parametrize("limits, allowed, exc", [
+    (UploadLimits(per_file_bytes=100), None, FileTooLarge),
+    (UploadLimits(effective_request_cap_bytes=200), None, TotalTooLarge),
+    (UploadLimits(max_files=1), None, TooManyFiles),
+    (UploadLimits(), {"docx"}, DisallowedType),
+])
+def test_limits_abort_and_discard_blobs(limits, allowed, exc, blob_dir):
+    body = _body([_file("files", "a.pdf", PDF), _file("files", "b.pdf", PDF + b"x")])
+    with pytest.raises(exc):
+        _read(body, 16, limits, allowed)
+    assert _blobs(blob_dir) == []
+    assert not (blob_dir / "tmp").exists() or os.listdir(blob_dir / "tmp") == []
+
+
+def test_limit_stops_reading_early():
+    consumed = []
+
+    async def chunks():
+        for i in range(0, 10_000_000, 4096):
+            consumed.append(i)
+            yield (f"--{BOUNDARY}\r\n" + 'Content-Disposition: form-data; name="f"; filename="x.pdf"\r\n\r\n').encode() \
+                if i == 0 else b"\0" * 4096
+
+    with pytest.raises(FileTooLarge):
+        asyncio.run(us.read_form(chunks(), CT, UploadLimits(per_file_bytes=64 * 1024), allowed_exts=None))
+    assert len(consumed) < 30
+
+
+def test_truncated_body_is_rejected(blob_dir):
+    with pytest.raises(UploadError):
+        _read(BODY[:-20], 32)
+    assert _blobs(blob_dir) == []